@@ -30,16 +30,24 @@ import scipy.sparse as sparse
 import time
 import argparse
 import os
+import multiprocessing
 #import sys
 #import itertools
 from io import StringIO
 import networkx as nx
+from scipy.sparse.csgraph import connected_components
 
 from dpCubeIter import dpCubeIter
 from utils.typesh5 import emLabels
 from dpWriteh5 import dpWriteh5
 from dpLoadh5 import dpLoadh5
-from utils import csr_csc_argmax
+from pyCext import label_overlap
+
+# mapping from first pass labels to stitched labels for the parallel second pass workers, set by pool initializer
+_stitch_mapping = None
+def _init_remap_worker(mapping):
+    global _stitch_mapping
+    _stitch_mapping = mapping
 
 class dpCubeStitcher(emLabels):
 
@@ -68,7 +76,15 @@ class dpCubeStitcher(emLabels):
                     left_remainder_size=self.left_remainder_size, right_remainder_size=self.right_remainder_size,
                     chunksize=self.chunksize, leave_edge=self.leave_edge)
 
-        if self.two_pass:
+        # the output is rewritten, remove any mapping stored with the output by a previous two pass stitch
+        if not (self.two_pass_compact and not self.two_pass) and not self.two_pass_load and \
+                os.path.isfile(self.outfile):
+            emLabels.writeLabelsMapping(self.outfile, None, subgroups=self.subgroups_write())
+
+        if self.two_pass and self.two_pass_parallel:
+            assert( not self.concatenate_only ) # silly
+            self.stitch_parallel()
+        elif self.two_pass:
             assert( not self.concatenate_only ) # silly
             # implement a hacky save/load mostly for debugging purposes for two-pass
             if self.two_pass_load:
@@ -79,10 +95,20 @@ class dpCubeStitcher(emLabels):
             if self.two_pass_save:
                 connections.tofile(self.two_pass_save)
 
-            self.stitch_second_pass(connections[:-1,:], total_ncomps)
+            # the mapping is stored with the first pass labels and applied on read (emLabels.readLabels).
+            # rewriting the labels with the mapping applied is an optional compaction step.
+            self.stitch_mapping(connections[:-1,:], total_ncomps)
+            if self.two_pass_compact: self.stitch_second_pass()
+        elif self.two_pass_compact:
+            # compact a two pass output that was written previously without compaction
+            self.stitch_second_pass()
         else:
             self.stitch_first_pass(do_stitching=not self.concatenate_only)
 
+    # subgroups that are written to, same as in dpWriteh5.writeCube
+    def subgroups_write(self):
+        return self.subgroups_out if len(self.subgroups_out)==0 or self.subgroups_out[0] is not None else self.subgroups
+
     def __iter__(self):
         for self.volume_info,n in zip(self.cubeIter, range(self.cubeIter.volume_size)):
             _, self.size, self.chunk, self.offset, suffixes, _, _, _, _ = self.volume_info
@@ -95,7 +121,8 @@ class dpCubeStitcher(emLabels):
             srcfile = os.path.join(self.filepaths[0], self.fileprefixes[0] + suffixes[0] + '.h5') if self.first_pass \
                 else self.srcfile
             loadh5 = emLabels.readLabels(srcfile=srcfile, chunk=self.chunk.tolist(), subgroups=self.subgroups,
-                offset=self.offset.tolist(), size=self.size.tolist(), verbose=self.dpLoadh5_verbose)
+                offset=self.offset.tolist(), size=self.size.tolist(), verbose=self.dpLoadh5_verbose,
+                mapping=self.first_pass)
             assert( (self.chunksize == loadh5.chunksize).all() )
 
             cur_data = loadh5.data_cube.astype(self.data_type_out)
@@ -135,42 +162,33 @@ class dpCubeStitcher(emLabels):
                 if self.dpCubeStitcher_verbose:
                     print('\tstitching first pass'); t = time.time()
 
-                # read the same volume out of the stitched output to get overlapping areas
-                self.readCubeToBuffers()
-                prev_data = self.data_cube.astype(self.data_type_out)
-
-                # create the overlap select
-                asel_ovlp = np.zeros(self.size, dtype=np.int8);
-                if not is_left_border[2]: asel_ovlp[:,:,:self.overlap[2]] = 3
-                if not is_left_border[1]: asel_ovlp[:,:self.overlap[1],:] = 2
-                if not is_left_border[0]: asel_ovlp[:self.overlap[0],:,:] = 1
-                if not is_right_border[0]: asel_ovlp[-self.overlap[0]:,:,:] = 0
-                if not is_right_border[1]: asel_ovlp[:,-self.overlap[1]:,:] = 0
-                if not is_right_border[2]: asel_ovlp[:,:,-self.overlap[2]:] = 0
+                # read only the face slabs of the same volume out of the stitched output to get overlapping areas
+                prev_lbls = [None]*dpLoadh5.ND; cur_lbls = [None]*dpLoadh5.ND
+                for face, lo, hi in dpCubeStitcher.face_boxes(self.size, self.overlap, is_left_border,
+                        is_right_border):
+                    prev_lbls[face] = dpLoadh5.readData(srcfile=self.srcfile, dataset=self.dataset,
+                        chunk=self.chunk.tolist(), offset=(self.offset + lo).tolist(), size=(hi - lo).tolist(),
+                        subgroups=self.subgroups).data_cube.astype(self.data_type_out).reshape(-1)
+                    cur_lbls[face] = cur_data[tuple(slice(i,j) for i,j in zip(lo, hi))].reshape(-1)
 
                 # for the one-pass approach, each supervoxel can only be merged with a single other supervoxel.
                 # for the two-pass approach, any other scheme can be used, currently do it as "face-wise".
+                if nfaces == 1:
+                    sel = [x for x in range(dpLoadh5.ND) if cur_lbls[x] is not None]
+                    prev_lbls = [np.concatenate([prev_lbls[x] for x in sel]) if sel else None]
+                    cur_lbls = [np.concatenate([cur_lbls[x] for x in sel]) if sel else None]
                 no_overlap = [False]*nfaces
                 for face in range(nfaces):
                     nm = n*nfaces + face    # just hand unroll connections, just stacked at end so does not matter
-                    sel_ovlp = (asel_ovlp > 0) if nfaces == 1 else (asel_ovlp == face+1)
-
-                    # get the voxel-wise overlap between the new cube and previous cubes in the overlapping area
-                    prev_lbls = prev_data[sel_ovlp]; cur_lbls = cur_data[sel_ovlp]
 
-                    # do not count any background overlaps
-                    sel_nz = np.logical_and(prev_lbls != 0, cur_lbls != 0)
-                    prev_lbls = prev_lbls[sel_nz]; cur_lbls = cur_lbls[sel_nz]
-
-                    # skip if there is no overlap
-                    if prev_lbls.size == 0:
+                    # get the voxel-wise overlap between the new cube and previous cubes in the overlapping area.
+                    # background overlaps are not counted, skip if there is no overlap.
+                    max_ovlp = None if cur_lbls[face] is None else \
+                        dpCubeStitcher.max_overlap(cur_lbls[face], prev_lbls[face], cur_ncomps)
+                    if max_ovlp is None:
                         no_overlap[face] = True; continue
 
                     no_overlap[face] = False
-                    cx = sparse.csr_matrix((np.ones(prev_lbls.size, dtype=np.int64),
-                                            (cur_lbls.flatten(), prev_lbls.flatten())),
-                                           shape=(cur_ncomps+1, ncomps+1))
-                    max_ovlp = csr_csc_argmax(cx)
                     # background overlaps should have been removed
                     assert( not (max_ovlp==0).any() and max_ovlp[0]==-1)
 
@@ -195,14 +213,8 @@ class dpCubeStitcher(emLabels):
             ncomps += cur_ncomps
 
             # remove the left offset for the write, saves time since offsets cross chunking boundaries
-            sel_novlp = np.ones(self.size, dtype=np.bool)
-            if not is_left_border[0]:
-                sel_novlp[:self.overlap[0],:,:] = 0; self.offset[0] += self.overlap[0]; self.size[0] -= self.overlap[0]
-            if not is_left_border[1]:
-                sel_novlp[:,:self.overlap[1],:] = 0; self.offset[1] += self.overlap[1]; self.size[1] -= self.overlap[1]
-            if not is_left_border[2]:
-                sel_novlp[:,:,:self.overlap[2]] = 0; self.offset[2] += self.overlap[2]; self.size[2] -= self.overlap[2]
-            self.inith5(); self.data_cube = cur_data[sel_novlp].reshape(self.size)
+            left = self.overlap*np.logical_not(is_left_border); self.offset += left; self.size -= left
+            self.inith5(); self.data_cube = cur_data[left[0]:,left[1]:,left[2]:]
 
             self.data_attrs = use_data_attrs
             self.data_attrs['types_nlabels'] = [ncomps]
@@ -218,7 +230,7 @@ class dpCubeStitcher(emLabels):
         connections[-1] = np.array([ncomps, total_ncomps],dtype=np.int64).reshape(1,2)
         return np.vstack(connections)
 
-    def stitch_second_pass(self, connections, total_ncomps):
+    def stitch_mapping(self, connections, total_ncomps):
         # run graph connected components and create mapping from old supervoxels to stitched supervoxels
         G = nx.Graph(); G.add_edges_from(connections)
         compsG = nx.connected_components(G); ncomps = 0; mapping = np.zeros((total_ncomps+1,), dtype=np.int64)
@@ -234,6 +246,17 @@ class dpCubeStitcher(emLabels):
         if self.dpCubeStitcher_verbose:
             print('Second pass, stitching results in %d comps down from %d total' % (ncomps, total_ncomps))
 
+        # store the mapping next to the first pass labels, number of labels is for the labels with mapping applied
+        emLabels.writeLabelsMapping(self.outfile, mapping.astype(self.data_type_out),
+            attrs={'types_nlabels':[ncomps], 'no_overlap_nlabels':[total_ncomps]}, subgroups=self.subgroups_write(),
+            verbose=self.dpCubeStitcher_verbose)
+
+    def stitch_second_pass(self):
+        # xxx - compacting is in place, an interrupted compaction leaves some cubes mapped with mapping still stored
+        mapping = emLabels.readLabelsMapping(self.srcfile, self.subgroups)
+        assert( mapping is not None ) # no two pass mapping stored with labels
+        ncomps = mapping.max(); total_ncomps = mapping.size-1
+
         # turn the overlap off for faster iteration over the volumes
         # xxx - need to fix this if we're trying to keep the right border overlaps (for another round of stitching)
         self.overlap = np.zeros((3,),dtype=np.int32)
@@ -245,7 +268,7 @@ class dpCubeStitcher(emLabels):
         self.first_pass = False
         for cur_cube_info in self:
             cur_data, cur_attrs, cur_ncomps, n = cur_cube_info
-            _, _, _, _, _, _, is_left_border, is_right_border = self.volume_info
+            _, _, _, _, _, _, is_left_border, is_right_border, _ = self.volume_info
 
             if self.dpCubeStitcher_verbose:
                 print('\tremapping supervoxels, second pass'); t = time.time()
@@ -259,9 +282,187 @@ class dpCubeStitcher(emLabels):
                 #print('\tdone in %.4f s, ncomps = %d, total = %d' % (time.time() - t, ncomps, total_ncomps))
                 print('\tdone in %.4f s' % (time.time() - t, ))
 
+        # labels now have the mapping applied
+        emLabels.writeLabelsMapping(self.outfile, None, subgroups=self.subgroups_write())
+
         if self.dpCubeStitcher_verbose:
             print('Second pass, stitching results in %d comps down from %d total' % (ncomps, total_ncomps))
 
+    # the two-pass first pass above is serial because each cube reads back the stitched output for the overlaps.
+    # the parallel two-pass instead reads the overlap slabs for each face of a cube from the source cubes that the
+    #   first pass would have written them from (the cores of the left neighbors), offset by the labels in all previous
+    #   cubes, so the face connections for all cubes are independent and computed in parallel. connected components
+    #   is run once over all the face connections and then the cubes are remapped in parallel.
+    # hdf5 output is only written from this process.
+    def stitch_parallel(self):
+        cubes = self.get_cubes(); ncubes = len(cubes)
+        label_offsets = np.cumsum([0] + [x['ncomps'] for x in cubes], dtype=np.int64)
+        total_ncomps = label_offsets[-1]
+
+        if self.two_pass_load:
+            connections = np.fromfile(self.two_pass_load,dtype=np.int64).reshape((-1,2))
+            assert( connections[-1,1] == total_ncomps ) # saved connections for different source cubes
+        else:
+            if self.dpCubeStitcher_verbose:
+                print('Face connections for %d cubes with %d workers' % (ncubes, self.nworkers)); t = time.time()
+
+            # write start of the cubes along each dimension, cubes are in a regular grid
+            write_begs = [np.zeros((x,), dtype=np.int64) for x in self.cubeIter.volume_step]
+            for x in cubes:
+                for d in range(dpLoadh5.ND): write_begs[d][x['index'][d]] = x['write_beg'][d]
+            tasks = [self.face_connections_task(cubes, label_offsets, write_begs, n) for n in range(ncubes)]
+            with multiprocessing.Pool(self.nworkers) as pool:
+                connections = pool.map(dpCubeStitcher.face_connections, tasks)
+            # same serialization as the serial first pass, ncomps and total ncomps are the same without stitching
+            connections.append(np.array([total_ncomps, total_ncomps],dtype=np.int64).reshape(1,2))
+            connections = np.vstack(connections)
+
+            if self.dpCubeStitcher_verbose:
+                print('\tdone in %.4f s, nconnections = %d' % (time.time() - t, connections.shape[0]-1))
+        if self.two_pass_save:
+            connections.tofile(self.two_pass_save)
+        connections = connections[:-1,:]
+
+        # connected components over the face connections of all the cubes, stitched labels are sequential in order of
+        #   the first label in each component. background is never connected so it stays as the first component.
+        G = sparse.coo_matrix((np.ones((connections.shape[0],), dtype=bool), (connections[:,0], connections[:,1])),
+            shape=(total_ncomps+1,total_ncomps+1))
+        _, comps = connected_components(G, directed=False)
+        _, first, comps = np.unique(comps, return_index=True, return_inverse=True)
+        rank = np.zeros((first.size,), dtype=np.int64); rank[np.argsort(first)] = np.arange(first.size)
+        mapping = rank[comps]; ncomps = first.size - 1; assert( mapping[0] == 0 ); del G, comps, rank
+
+        if self.dpCubeStitcher_verbose:
+            print('Second pass, stitching results in %d comps down from %d total' % (ncomps, total_ncomps))
+            print('Remapping %d cubes with %d workers' % (ncubes, self.nworkers)); t = time.time()
+
+        # read only the part of each cube that the first pass writes (without left overlaps), written in cube order
+        tasks = [(x['srcfile'], x['chunk'], x['write_offset'], x['write_size'], self.subgroups, y) \
+            for x,y in zip(cubes, label_offsets[:-1])]
+        with multiprocessing.Pool(self.nworkers, initializer=_init_remap_worker, initargs=(mapping,)) as pool:
+            for n, (data, attrs, datasize) in enumerate(pool.imap(dpCubeStitcher.remap_cube, tasks)):
+                if n == 0:
+                    # "left-most" volume attributes are used for the output, same as the serial stitch
+                    use_data_attrs = attrs; self.datasize = datasize
+                self.chunk = np.array(cubes[n]['chunk']); self.offset = np.array(cubes[n]['write_offset'])
+                self.size = np.array(cubes[n]['write_size']); self.inith5(); self.data_cube = data
+                self.data_attrs = use_data_attrs
+                self.data_attrs['types_nlabels'] = [ncomps]
+                self.data_attrs['no_overlap_nlabels'] = [total_ncomps]
+                self.writeCube()
+
+        if self.dpCubeStitcher_verbose:
+            print('\tdone in %.4f s' % (time.time() - t, ))
+
+    # locations and source files for all cubes along with number of labels in each source cube (from attributes only)
+    def get_cubes(self):
+        assert( not self.cubeIter.filemodulators_overlap_on ) # not supported
+        cubes = []
+        for volume_info, n in zip(self.cubeIter, range(self.cubeIter.volume_size)):
+            _, size, chunk, offset, suffixes, _, is_left_border, is_right_border, _ = volume_info
+            srcfile = os.path.join(self.filepaths[0], self.fileprefixes[0] + suffixes[0] + '.h5')
+            loadh5 = dpLoadh5.readInith5(srcfile, emLabels.LBLS_DATASET, chunk.tolist(), offset.tolist(),
+                size.tolist(), '', subgroups=self.subgroups, verbose=self.dpLoadh5_verbose)
+            assert( (self.chunksize == loadh5.chunksize).all() )
+
+            # same as the serial first pass, the left overlaps are not written
+            left = self.overlap*np.logical_not(is_left_border)
+            cubes.append({'srcfile':srcfile, 'index':np.unravel_index(n, self.cubeIter.volume_step),
+                'chunk':chunk.tolist(), 'offset':offset.tolist(), 'size':size.tolist(),
+                'write_offset':(offset + left).tolist(), 'write_size':(size - left).tolist(),
+                'beg':chunk*self.chunksize + offset, 'write_beg':chunk*self.chunksize + offset + left,
+                'is_left_border':is_left_border, 'is_right_border':is_right_border,
+                'ncomps':loadh5.data_attrs['types_nlabels'].sum()})
+        return cubes
+
+    # the overlap slab for each face of cube n is read in pieces from the cubes whose cores (first pass writes) cover
+    #   it. cubes are written in order and later cubes overwrite right overlaps, so the last write at any location is
+    #   from the cube with the largest write start before it along each dimension, always a previous cube on a face.
+    # write_begs are the write starts of the cubes along each dimension (indexed by the cube grid index).
+    def face_connections_task(self, cubes, label_offsets, write_begs, n):
+        cube = cubes[n]
+        is_left_border = cube['is_left_border']; is_right_border = cube['is_right_border']
+
+        faces = []
+        for face, lo, hi in dpCubeStitcher.face_boxes(cube['size'], self.overlap, is_left_border, is_right_border):
+            # split the face box along each dimension by the cube that wrote it
+            segments = [None]*dpLoadh5.ND
+            for d in range(dpLoadh5.ND):
+                g0 = cube['beg'][d] + lo[d]; g1 = cube['beg'][d] + hi[d]; segments[d] = []
+                for a in range(np.searchsorted(write_begs[d], g0, side='right')-1,
+                        np.searchsorted(write_begs[d], g1-1, side='right')):
+                    s = max(g0, write_begs[d][a]); e = min(g1, write_begs[d][a+1]) if a+1 < write_begs[d].size else g1
+                    segments[d].append((a, s, e))
+
+            pieces = []; box_beg = cube['beg'] + lo
+            for x in segments[0]:
+                for y in segments[1]:
+                    for z in segments[2]:
+                        beg = np.array([x[1], y[1], z[1]]); end = np.array([x[2], y[2], z[2]])
+                        m = np.ravel_multi_index((x[0], y[0], z[0]), self.cubeIter.volume_step); assert( m < n )
+                        chunk = np.array(cubes[m]['chunk']); slc = zip(beg - box_beg, end - box_beg)
+                        pieces.append((cubes[m]['srcfile'], chunk.tolist(), (beg - chunk*self.chunksize).tolist(),
+                            (end - beg).tolist(), tuple(slice(i,j) for i,j in slc), label_offsets[m]))
+            faces.append(((np.array(cube['offset']) + lo).tolist(), (hi - lo).tolist(), pieces))
+
+        return (cube['srcfile'], cube['chunk'], self.subgroups, label_offsets[n], cube['ncomps'], faces)
+
+    # worker: face connections for a single cube, same as the two-pass serial first pass.
+    # only the face slabs are read, from the cube itself and from the cubes that wrote the overlap.
+    @staticmethod
+    def face_connections(task):
+        srcfile, chunk, subgroups, ncomps, cur_ncomps, faces = task
+        connections = [np.zeros((0,2),dtype=np.int64)]
+        for offset, size, pieces in faces:
+            cur_lbls = emLabels.readLabels(srcfile=srcfile, chunk=chunk, offset=offset, size=size,
+                subgroups=subgroups).data_cube.astype(np.int64)
+            prev_lbls = np.zeros(cur_lbls.shape, dtype=np.int64)
+            for psrcfile, pchunk, poffset, psize, slc, plabel_offset in pieces:
+                data = emLabels.readLabels(srcfile=psrcfile, chunk=pchunk, offset=poffset, size=psize,
+                    subgroups=subgroups).data_cube.astype(np.int64)
+                data[data > 0] += plabel_offset; prev_lbls[slc] = data
+
+            max_ovlp = dpCubeStitcher.max_overlap(cur_lbls, prev_lbls, cur_ncomps)
+            if max_ovlp is None: continue
+            assert( not (max_ovlp==0).any() and max_ovlp[0]==-1)
+            sel = (max_ovlp > 0)
+            connections.append(np.column_stack((np.arange(ncomps, ncomps+cur_ncomps+1)[sel], max_ovlp[sel])))
+        return np.vstack(connections)
+
+    # worker: read the part of a cube that is written (without left overlaps) and map to the stitched labels.
+    @staticmethod
+    def remap_cube(task):
+        srcfile, chunk, offset, size, subgroups, label_offset = task
+        loadh5 = emLabels.readLabels(srcfile=srcfile, chunk=chunk, offset=offset, size=size, subgroups=subgroups)
+        data = loadh5.data_cube.astype(np.int64); sel = (data > 0); data[sel] += label_offset
+        return _stitch_mapping[data], loadh5.data_attrs, loadh5.datasize
+
+    # the overlap with the previous cubes is the left overlap slab on each face (x, y, z faces) without the right
+    #   overlaps, where the slabs intersect the x face takes precedence over y over z. returns face, begin and end
+    #   of each face slab within the cube for faces that are not on the left border.
+    @staticmethod
+    def face_boxes(size, overlap, is_left_border, is_right_border):
+        boxes = []
+        for face in range(dpLoadh5.ND):
+            if is_left_border[face]: continue
+            lo = np.zeros((dpLoadh5.ND,), dtype=np.int64); hi = np.array(size, dtype=np.int64)
+            sel = np.logical_not(is_right_border); hi[sel] -= overlap[sel]
+            sel = np.logical_not(is_left_border); sel[face:] = False; lo[sel] = overlap[sel]
+            hi[face] = min(hi[face], overlap[face])
+            if (hi > lo).all(): boxes.append((face, lo, hi))
+        return boxes
+
+    # for each label in cur the label in prev with the max voxel overlap (-1 for none), ties go to the smaller prev
+    #   label (same as argmax over the rows of the overlap matrix). None if there is no non-background overlap.
+    @staticmethod
+    def max_overlap(cur_lbls, prev_lbls, cur_ncomps):
+        pairs, counts = label_overlap(cur_lbls, prev_lbls, nonzero=True)
+        if counts.size == 0: return None
+        order = np.lexsort((pairs[:,1], -counts, pairs[:,0])); pairs = pairs[order,:].astype(np.int64)
+        first = np.ones((pairs.shape[0],), dtype=bool); first[1:] = (pairs[1:,0] != pairs[:-1,0])
+        max_ovlp = -np.ones((cur_ncomps+1,), dtype=np.int64); max_ovlp[pairs[first,0]] = pairs[first,1]
+        return max_ovlp
+
     @staticmethod
     def addArgs(p):
         dpWriteh5.addArgs(p)
@@ -270,6 +471,12 @@ class dpCubeStitcher(emLabels):
         p.add_argument('--two_pass', action='store_true', help='Use two pass method')
         p.add_argument('--two_pass_load', nargs=1, type=str, default='', help='Raw file to load first pass')
         p.add_argument('--two_pass_save', nargs=1, type=str, default='', help='Raw file to export first pass')
+        p.add_argument('--two_pass_compact', action='store_true',
+            help='Rewrite two pass labels with the stored mapping applied (otherwise mapping is applied on read)')
+        p.add_argument('--two_pass_parallel', action='store_true',
+            help='Two pass method with face connections and remapping of cubes in parallel')
+        p.add_argument('--nworkers', nargs=1, type=int, default=[multiprocessing.cpu_count()],
+            help='Number of worker processes for two_pass_parallel')
 
         p.add_argument('--dpCubeStitcher-verbose', action='store_true',
             help='Debugging output for dpCubeStitcher')
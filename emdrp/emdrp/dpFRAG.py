@@ -35,19 +35,22 @@
 
 
 #import os, sys
+import os
 import argparse
 import time
 import numpy as np
 from numpy import linalg as nla
 from scipy import ndimage as nd
 from scipy import linalg as sla
-import networkx as nx
 from io import StringIO
 from collections import OrderedDict
+import dill
 
 from dpLoadh5 import dpLoadh5
 from dpWriteh5 import dpWriteh5
 from utils.typesh5 import emLabels, emProbabilities
+from utils.ArrayRAG import ArrayRAG
+from utils.AugmentCache import AugmentCache
 from Kuwahara import Kuwahara
 
 try:
@@ -59,6 +62,8 @@ except:
 class dpFRAG(emLabels):
 
     TARGETS = {'no_merge':0, 'yes_merge':1}     # hard coded as false/true throughout code
+    # volumes that are not saved when spilling the FRAG, reloaded on restore
+    SPILL_VOLUMES = ['probs', 'probs_aug', 'probs_static_aug', 'raw', 'raw_aug', 'raw_static_aug', 'gt']
 
     ############ parameters that were found to not be useful so made static
 
@@ -223,6 +228,12 @@ class dpFRAG(emLabels):
 
         d = locals(); return { k:d[k] for k in features_vars }
 
+    # filters that modify the data in place in filter_data
+    inplace_filters = ['kuwahara']
+
+    # version of filter_data for the augment cache, increment this if the filters are changed
+    filter_version = 1
+
     @staticmethod
     def filter_data(data, ftype, sampling_ratio):
         ftype = ftype.lower()
@@ -283,6 +294,10 @@ class dpFRAG(emLabels):
 
         # other inits asserts that we don't need to see printed
         self.bwconn = nd.morphology.generate_binary_structure(dpLoadh5.ND, self.connectivity)
+
+        # optional on-disk cache for raw augments that are calculated on-the-fly
+        self.raw_aug_cache = AugmentCache(self.augment_cache, self.augment_cache_size,
+            verbose=self.dpFRAG_verbose) if self.augment_cache else None
         self.outRAG = None
 
         assert( not self.trainout or self.gtfile )  # need ground truth to generate training data
@@ -362,6 +377,16 @@ class dpFRAG(emLabels):
                 self.nsupervox_nomerge += csel; self.nsupervox_merge -= csel
                 assert(self.nsupervox_merge + self.nsupervox_nomerge == self.nsupervox)
 
+        self.loadVolumes()
+
+        if self.dpFRAG_verbose:
+            print('\tdone in %.4f s, %d supervoxels, %d merge-able supervoxels, %d gt labels' % (time.time() - t, 
+                self.nsupervox, self.nsupervox_merge, self.ngtlbl))
+
+    # load the probability, raw and ground truth volumes, also used to reload the volumes of a spilled FRAG
+    def loadVolumes(self):
+        spad = self.spad
+
         # load the probability data
         if self.probfile:
             if self.pad_prob_perim: offset = self.offset; size = self.size
@@ -435,18 +460,13 @@ class dpFRAG(emLabels):
             if not self.rawaugfile and (self.naugments > 0 or (self.nstatic_augments > 0 and (self.nstatic_augments \
                 > sum([self.static_augments[x][0] != '_' for x in range(self.nstatic_augments)])))):
 
-                fpad=16; offset = offset - fpad; size = size + 2*fpad
-                loadh5 = dpLoadh5.readData(srcfile=self.rawfile, dataset=self.raw_dataset, chunk=self.chunk.tolist(),
-                    offset=offset.tolist(), size=size.tolist(), verbose=self.dpLoadh5_verbose); rdata = loadh5.data_cube
+                # raw data with filter padding is only loaded if any augment is not in the augment cache
+                fpad=16; fstate = {'offset':offset - fpad, 'size':size + 2*fpad, 'fpad':fpad, 'rdata':None,
+                    'inplace':[], 'napplied':0}
 
                 self.raw_aug = [None]*self.naugments
                 for j in range(self.naugments):
-                    if self.dpFRAG_verbose:
-                        print('\tFiltering raw data with %s' % (self.augments[j],)); t = time.time()
-                    data = dpFRAG.filter_data(rdata, self.augments[j],
-                                              self.sampling_ratio)[fpad:-fpad,fpad:-fpad,fpad:-fpad]
-                    if self.dpFRAG_verbose:
-                        print('\t\tdone in %.4f s' % (time.time() - t,))
+                    data = self.filter_raw_augment(self.augments[j][1:], fstate)
 
                     if self.pad_raw_perim:
                         # pad data, xxx - what to pad with, zeros just easy, not clear any other method is better
@@ -459,12 +479,7 @@ class dpFRAG(emLabels):
                 self.raw_static_aug = [None]*self.nstatic_augments
                 for j in range(self.nstatic_augments):
                     if self.static_augments[j][0] == '_':
-                        if self.dpFRAG_verbose:
-                            print('\tFiltering raw data with %s' % (self.static_augments[j],)); t = time.time()
-                        data = dpFRAG.filter_data(rdata, self.static_augments[j][1:],
-                                                  self.sampling_ratio)[fpad:-fpad,fpad:-fpad,fpad:-fpad]
-                        if self.dpFRAG_verbose:
-                            print('\t\tdone in %.4f s' % (time.time() - t,))
+                        data = self.filter_raw_augment(self.static_augments[j][1:], fstate)
 
                         if self.pad_raw_perim:
                             # pad data, xxx - what to pad with, zeros just easy, not clear any other method is better
@@ -519,9 +534,76 @@ class dpFRAG(emLabels):
         else:
             self.gt = None; self.ngtlbl = -1
 
+    # save the FRAG state (RAG, supervoxel attributes and current supervoxels) to a scratch file and free the memory.
+    # only scalar attributes (file names, options, etc) stay resident until the FRAG is restored.
+    # the volumes are not saved, they are reloaded on restore (raw augments from the augment cache if enabled).
+    def spill(self, filename):
         if self.dpFRAG_verbose:
-            print('\tdone in %.4f s, %d supervoxels, %d merge-able supervoxels, %d gt labels' % (time.time() - t, 
-                self.nsupervox, self.nsupervox_merge, self.ngtlbl))
+            print('Spilling FRAG for chunk %d,%d,%d' % tuple(self.chunk.tolist())); t = time.time()
+        # supervoxel views are recreated on restore and the hdf5 dataset objects are reopened on the next read
+        state = {k:v for k,v in vars(self).items() if k not in self.SPILL_VOLUMES + ['supervoxels_noperim',
+            'supervoxels_zeroperim', 'dset', 'group']}
+        with open(filename, 'wb') as f: dill.dump(state, f)
+        self.__dict__ = {k:v for k,v in state.items() if v is None or np.isscalar(v)}; self.spillfile = filename
+        if self.dpFRAG_verbose:
+            print('\tdone in %.4f s' % (time.time() - t, ))
+
+    def restore(self):
+        assert( self.spilled() )
+        if self.dpFRAG_verbose:
+            print('Restoring FRAG from %s' % (self.spillfile,)); t = time.time()
+        with open(self.spillfile, 'rb') as f: state = dill.load(f)
+        os.remove(self.spillfile); del self.spillfile; self.__dict__.update(state)
+        p = self.eperim; self.supervoxels_noperim = self.supervoxels[p[0]:-p[0],p[1]:-p[1],p[2]:-p[2]]
+        if self.pad_svox_perim:
+            self.supervoxels_zeroperim = self.supervoxels
+        else:
+            self.supervoxels_zeroperim = self.supervoxels.copy(); self.supervoxels_zeroperim[self.perim_sel] = 0
+        self.loadVolumes()
+        if self.dpFRAG_verbose:
+            print('\tdone in %.4f s' % (time.time() - t, ))
+
+    def spilled(self):
+        return hasattr(self, 'spillfile')
+
+    # approximate memory used by the FRAG, the arrays for the volumes, supervoxels and the RAGs (views not counted)
+    def nbytes(self):
+        def size(x):
+            if isinstance(x, np.ndarray): return x.nbytes if x.base is None else 0
+            if isinstance(x, (list, tuple)): return sum([size(y) for y in x])
+            if isinstance(x, ArrayRAG): return size(list(vars(x).values()))
+            return 0
+        return size(list(vars(self).values()))
+
+    # filter the raw data for an on-the-fly raw augment, using the on-disk augment cache if enabled.
+    # the kuwahara filter modifies the raw data in place, so it also applies to the input of all following augments.
+    #   in place filters that were loaded from the cache are only applied to the raw data if it is needed.
+    def filter_raw_augment(self, ftype, state):
+        ftype = ftype.lower(); fpad = state['fpad']; data = None
+        if self.raw_aug_cache is not None:
+            key = AugmentCache.key(rawfile=AugmentCache.file_key(self.rawfile), dataset=self.raw_dataset,
+                chunk=self.chunk.tolist(), offset=state['offset'].tolist(), size=state['size'].tolist(), fpad=fpad,
+                ftype=ftype, prior=state['inplace'], sampling_ratio=np.asarray(self.sampling_ratio).tolist(),
+                version=self.filter_version)
+            data = self.raw_aug_cache.get(key)
+
+        if data is None:
+            if self.dpFRAG_verbose:
+                print('\tFiltering raw data with %s' % (ftype,)); t = time.time()
+            if state['rdata'] is None:
+                loadh5 = dpLoadh5.readData(srcfile=self.rawfile, dataset=self.raw_dataset, chunk=self.chunk.tolist(),
+                    offset=state['offset'].tolist(), size=state['size'].tolist(), verbose=self.dpLoadh5_verbose)
+                state['rdata'] = loadh5.data_cube
+            for x in state['inplace'][state['napplied']:]:
+                state['rdata'] = dpFRAG.filter_data(state['rdata'], x, self.sampling_ratio)
+            state['napplied'] = len(state['inplace']) + (ftype in self.inplace_filters)
+            data = dpFRAG.filter_data(state['rdata'], ftype, self.sampling_ratio)[fpad:-fpad,fpad:-fpad,fpad:-fpad]
+            if self.raw_aug_cache is not None: self.raw_aug_cache.put(key, data)
+            if self.dpFRAG_verbose:
+                print('\t\tdone in %.4f s' % (time.time() - t,))
+
+        if ftype in self.inplace_filters: state['inplace'].append(ftype)
+        return data
 
     def createFRAG(self, features=True, update=False):
         # get bounding boxes for each supervoxel
@@ -533,15 +615,18 @@ class dpFRAG(emLabels):
         if update and hasattr(self,'FRAG') and self.FRAG is not None:
             assert( self.nsupervox_merge == self.FRAG.number_of_nodes() )
         else:
-            # create emtpy FRAG, using networkx for now for graph
+            # create emtpy FRAG, array-backed graph with edge features stored in matrix
             # do not even include "do not merge" supervoxels as nodes in the FRAG at all
-            self.FRAG = nx.Graph(); self.FRAG.add_nodes_from(range(1,self.nsupervox_merge+1))
+            self.FRAG = ArrayRAG(self.nsupervox_merge, self.features_names, node_attrs=['svox_attrs'],
+                edge_attrs=['ovlp_attrs','sovlp_attrs'])
 
             if update:
                 # keep another graph that contains the outlbls neighbors
                 # do not even include "do not merge" supervoxels as nodes in the outRAG at all
-                self.outRAG = nx.Graph(); self.outRAG.add_nodes_from(range(1,self.nsupervox_merge+1))
+                self.outRAG = ArrayRAG(self.nsupervox_merge)
                 make_outRAG = True; update = False  # this is first pass, so acting like not update mode
+        FRAG_svox_attrs = self.FRAG.node_attrs['svox_attrs']
+        FRAG_ovlp_attrs = self.FRAG.edge_attrs['ovlp_attrs']; FRAG_sovlp_attrs = self.FRAG.edge_attrs['sovlp_attrs']
 
         # other inits for the supervoxel iteration loop
         mean_probs = [None]*self.nprob_types
@@ -592,12 +677,13 @@ class dpFRAG(emLabels):
             # NOTE: if there are no neighbors left for this supervoxel, no need to compute supervoxel attributes.
             #   In this special case the supervoxel is skipped because all([]) evaluates to True.
             if update:
-                if all([('features' in x and not x['first_pass']) for x in self.FRAG[i].values()]): continue
-                previ = self.prev_max_node + i
+                eids = self.FRAG.incident_edges(i)
+                if np.logical_and(self.FRAG.has_features[eids], np.logical_not(self.FRAG.first_pass[eids])).all():
+                    continue
 
             # if the supervoxel itself has not changed but some neighbors have, load from node attributes.
-            if update and 'svox_attrs' in self.FRAG.node[i]:
-                n = self.FRAG.node[i]['svox_attrs']
+            if update and i in FRAG_svox_attrs:
+                n = FRAG_svox_attrs[i]
 
                 # this has to be redone because some of the neighbors inside of pbnd may have changed
                 svox_cur = self.supervoxels_zeroperim[n['pbnd']]
@@ -634,7 +720,7 @@ class dpFRAG(emLabels):
                         svox_sel_out_perim = nd.morphology.binary_dilation(svox_cur_perim == i, 
                             structure=self.bwconn, iterations=self.neighbor_perim)
                 # save the variables in svox_attrs to node attributes
-                d = locals(); n = { k:d[k] for k in dpFRAG.svox_attrs }; self.FRAG.node[i]['svox_attrs'] = n
+                d = locals(); n = { k:d[k] for k in dpFRAG.svox_attrs }; FRAG_svox_attrs[i] = n
 
             # get the neighbors for this supervoxel
             nbrlbls = np.unique(svox_cur[n['svox_sel_out']])
@@ -656,27 +742,24 @@ class dpFRAG(emLabels):
 
             # add each corresponding neighbor label to the FRAG
             for j in nbrlbls:
-                if update: prevj = self.prev_max_node + j
-
                 if not features:
                     # only make RAG without features (like for agglomeration without fit)
-                    if not self.FRAG.has_edge(i,j):
-                        self.FRAG.add_edge(i,j); self.FRAG[i][j]['features'] = None
+                    self.FRAG.add_edge(i,j)
                     continue
 
                 # add the edge if it does not exist, otherwise update any features for the current supervoxel
-                has_edge = self.FRAG.has_edge(i,j); has_features = has_edge and 'features' in self.FRAG[i][j]
+                e = self.FRAG.edge_id(i,j); has_edge = (e >= 0); has_features = has_edge and self.FRAG.has_features[e]
                 if not has_edge or not has_features:
                     # if the edge is already there and the features are missing, this should only be in the mode
                     #   of updating features in the current FRAG.
-                    if has_features: assert(update)
-                    else: self.FRAG.add_edge(i,j)
+                    if has_edge: assert(update)
+                    else: e = self.FRAG.add_edge(i,j)
 
                     # if this edge contains overlap info that means the FRAG was updated to preserve this overlap.
                     # this is the case if the overlap itself didn't change, but the neighboring supervoxels did not.
-                    loadovlp = update and 'ovlp_attrs' in self.FRAG[i][j]
+                    loadovlp = update and e in FRAG_ovlp_attrs
                     if loadovlp:
-                        m = self.FRAG[i][j]['ovlp_attrs']; mo = m
+                        m = FRAG_ovlp_attrs[e]; mo = m
 
                         # this has to be redone because some of the neighbors
                         #   inside of the bounding box may have changed.
@@ -709,7 +792,7 @@ class dpFRAG(emLabels):
                         ovlp_svox_cur = self.supervoxels[aobnd]
 
                         # convert the overlap to within the same bounding box.
-                        ovlp_cur = np.zeros(ovlp_svox_cur.shape,dtype=np.bool); ovlp_cur[pobnd] = svox_ovlp[obnd]
+                        ovlp_cur = np.zeros(ovlp_svox_cur.shape,dtype=bool); ovlp_cur[pobnd] = svox_ovlp[obnd]
 
                         # Optionally only count the area that is also contained within the supervoxels as overlap.
                         # If neighbor_perim==1, this should be equivalent to the "neighest neighbor only" method.
@@ -773,30 +856,27 @@ class dpFRAG(emLabels):
                         for k in self.ovlp_attrs:
                             if k in d: m[k] = d[k]
                         # concatenate sovlp_attrs and ovlp_attrs for the overlap
-                        self.FRAG[i][j]['ovlp_attrs'] = {**m, **mo}
+                        FRAG_ovlp_attrs[e] = {**m, **mo}
 
                     # more complicated optimization. if the overlap is preserved then calculations on one of the
                     #   supervoxels might also be preserved if it was not agglomerated in the previous iteration.
+                    # sovlp_attrs are only kept by agglomerate for supervoxels that did not change (current labels).
                     loadi = False; loadj = False
-                    if update and 'sovlp_attrs' in self.FRAG[i][j]:
-                        # avoid second pass to renumber nodes in agglomerate because of relabel
-                        loadi = previ in self.FRAG[i][j]['sovlp_attrs']; loadj = prevj in self.FRAG[i][j]['sovlp_attrs']
+                    if update and e in FRAG_sovlp_attrs:
+                        loadi = i in FRAG_sovlp_attrs[e]; loadj = j in FRAG_sovlp_attrs[e]
                         assert( not loadi or not loadj )     # both sovlp_attrs should not happen
                         assert( (not loadi and not loadj) or loadovlp )     # sovlp_attrs without ovlp_attrs
                     else:
-                        self.FRAG[i][j]['sovlp_attrs'] = {}
+                        FRAG_sovlp_attrs[e] = {}
                     if loadi:
-                        mi = self.FRAG[i][j]['sovlp_attrs'][previ]
-                        self.FRAG[i][j]['sovlp_attrs'] = {i:mi}     # move to current supervoxel value
+                        mi = FRAG_sovlp_attrs[e][i]
                     else:
                         mi = self.getOvlpAttrs(ovlp_svox_cur == i, self.sampling, Vother=mo['V'])
-                        self.FRAG[i][j]['sovlp_attrs'][i] = mi
                     if loadj:
-                        mj = self.FRAG[i][j]['sovlp_attrs'][prevj]
-                        self.FRAG[i][j]['sovlp_attrs'] = {j:mj}     # move to current supervoxel value
+                        mj = FRAG_sovlp_attrs[e][j]
                     else:
                         mj = self.getOvlpAttrs(ovlp_svox_cur == j, self.sampling, Vother=mo['V'])
-                        self.FRAG[i][j]['sovlp_attrs'][j] = mj
+                    FRAG_sovlp_attrs[e] = {i:mi, j:mj}
 
                     # calculate angles between corresponding supervoxel eigenvectors within overlap box
                     angles_ij = np.zeros((self.npcaang,),np.double)
@@ -819,12 +899,10 @@ class dpFRAG(emLabels):
                     ##otherlbls = otherlbls[np.logical_and(np.logical_and(otherlbls != i, otherlbls != j),otherlbls != 0)]
 
                     # set all the features except the size of the neighbor label for current object
-                    F = self.features
-                    f = {
-                        F['size_overlap']:mo['lsel_size'],
-                        # these features might need to be swapped depending on which object is larger
-                        F['size_small']:n['lsvox_size'],
-                        }
+                    F = self.features; f = self.FRAG.features[e]; f[:] = 0
+                    f[F['size_overlap']] = mo['lsel_size']
+                    # these features might need to be swapped depending on which object is larger
+                    f[F['size_small']] = n['lsvox_size']
                     # make size_ovlp small and large tied together in feature sets (all or none)
                     if 'size_ovlp_small' in self.features_names:
                         f[F['size_ovlp_small']] = mi['lsel_size']
@@ -848,17 +926,17 @@ class dpFRAG(emLabels):
                         else:
                             f[F['mean_prob_' + self.static_augments[k]]] = m['mean_probs_static_aug'][k]
 
-                    self.FRAG[i][j]['features'] = f; self.FRAG[i][j]['first_pass'] = True
+                    self.FRAG.has_features[e] = True; self.FRAG.first_pass[e] = True
                 else: # if edge already in graph
                     # if this is update mode and the edge is there and not marked as first pass,
                     #   then this is an edge that does not need feature udpates at all (copied from previous FRAG).
                     if update:
-                        if not self.FRAG[i][j]['first_pass']: continue
+                        if not self.FRAG.first_pass[e]: continue
                     else:
-                        assert( self.FRAG[i][j]['first_pass'] )     # meh, sth really wrong
+                        assert( self.FRAG.first_pass[e] )     # meh, sth really wrong
 
                     # update this edge for second pass (the other neighbor is now the current neighbor)
-                    f = self.FRAG[i][j]['features']; F = self.features; self.FRAG[i][j]['first_pass'] = False
+                    f = self.FRAG.features[e]; F = self.features; self.FRAG.first_pass[e] = False
 
                     # features are stored with size sorted by large / small object, so set features accordingly.
                     if f[F['size_small']] <= n['lsvox_size']:
@@ -884,8 +962,8 @@ class dpFRAG(emLabels):
                     # xxx - this sanity check was used during development of this function.
                     #   would need some major updates to verify overlap is the same in both directions...
                     # overlap features here should be the same as done before, can verify with asserts for debug
-                    #if self.FRAG[i][j]['features']['overlap'] != size_ovlp:
-                    #    print(i,j,size_ovlp,self.FRAG[i][j]['features']['overlap']); assert(False)
+                    #if f[F['size_overlap']] != size_ovlp:
+                    #    print(i,j,size_ovlp,f[F['size_overlap']]); assert(False)
 
                 # update progress bar based on size of all neighbors added so far
                 #if self.dpFRAG_verbose and useProgressBar:
@@ -924,6 +1002,10 @@ class dpFRAG(emLabels):
             if self.dpFRAG_verbose and useProgressBar:
                 running_size += 1; pbar.update(running_size)
 
+        # edges (and the feature matrix rows) in sorted order, this is the order of the datasets / targets
+        self.FRAG.sort()
+        if make_outRAG: self.outRAG.sort()
+
         if self.dpFRAG_verbose:
             if useProgressBar: pbar.finish()
             print('\n\tdone in %.4f s' % (time.time() - t))
@@ -969,16 +1051,11 @@ class dpFRAG(emLabels):
         if self.dpFRAG_verbose:
             print('Creating training set from %d edges' % ntargets); t = time.time()
 
-        # iterate the network edges and create a scikit-learn style training set
-        for e,i in zip(self.FRAG.edges_iter(data=True),range(ntargets)):
-            if train:
-                #if supervox_to_gt[e[0]-1] == supervox_to_gt[e[1]-1]:
-                #    target[i] = self.TARGETS['yes_merge']
-                #else:
-                #    target[i] = self.TARGETS['no_merge']
-                target[i] = (supervox_to_gt[e[0]-1] == supervox_to_gt[e[1]-1])
-            if e[2]['features'] is not None:
-                fdata[i,:] = np.array([e[2]['features'][x] for x in range(self.nfeatures)], dtype=np.double)
+        # create a scikit-learn style training set from the FRAG edges (in sorted order) and the feature matrix
+        edges = self.FRAG.edges
+        if train:
+            target[:] = (supervox_to_gt[edges[:,0]-1] == supervox_to_gt[edges[:,1]-1])
+        sel = self.FRAG.has_features; fdata[sel,:] = self.FRAG.features[sel,:]
 
         #dict_keys(['feature_names', 'DESCR', 'target_names', 'target', 'data'])
         descr = 'Training data from dpFRAG.py with command line:\n' + self.arg_str
@@ -1001,93 +1078,17 @@ class dpFRAG(emLabels):
         if self.dpFRAG_verbose:
             print('Doing single agglomeration from supplied targets'); t = time.time()
 
-        # single agglomerate with binary targets
-        #self._incremental_agglomerate(target)
-
-        # create agglomerated graph that only contains yes merge edges
-        aggloG = nx.Graph(); aggloG.add_nodes_from(range(1,self.nsupervox_merge+1))
-        for e,i in zip(self.FRAG.edges_iter(),range(ntargets)):
-            if target[i] and not aggloG.has_edge(e[0],e[1]): aggloG.add_edge(e[0],e[1])
-
-        # get connected component nodes, create supervoxel mapping and update FRAG based on agglomerated components
+        # get connected components of yes merge edges, create supervoxel mapping and update FRAG based on components
         supervox_map = np.zeros((self.nsupervox+1,),dtype=self.data_type_out)
-        compsG = nx.connected_components(aggloG); ncomps = 0
+        ncomps, comps = self.FRAG.components(target.astype(bool))
+        supervox_map[:self.nsupervox_merge+1] = comps
         svox_sizes = np.zeros((self.nsupervox,),dtype=np.int64)
-        
-        # this is used for re-creating the graph after agglo without creating a new graph.
-        # appends nodes that are beyond current last node. typcially this was nsupervox, but added the "do not merge"
-        #   mode for which these supervoxels are not added to the graph at all.
-        # this property indicates the last max node of the graph (also used in optimization).
-        self.prev_max_node = self.nsupervox_merge
-        
-        for nodes in compsG:
-            # SINGLETON NODE: single supervoxel that is not undergoing any merging (agglomeration)
-
-            # supervoxel mapping from previous to new agglomerated supervoxels, update supervoxel sizes
-            npnodes = np.array(tuple(nodes),dtype=np.int64); svox_sizes[ncomps] = self.svox_sizes[npnodes-1].sum()
-            ncomps += 1; supervox_map[npnodes] = ncomps
-
-            # update the FRAG by creating a new agglomerated node and moving neighboring edges to this node.
-            # make a new singleton node for if this node is not containing any agglomerations.
-            newnode = ncomps+self.prev_max_node; self.FRAG.add_node(newnode)
-            if self.outRAG is not None: self.outRAG.add_node(newnode)
-
-            if len(nodes) == 1:
-                # SINGLETON COMPONENT NODE: single supervoxel that is not being merged with anything.
-                # this is the only time that features may be copied over from old FRAG.
-                # i.e., this supervoxel did not change.
-                node = next(iter(nodes))    # the singleton node in old FRAG
-
-                # if this is a singleton node (not agglomerated) then re-add the node attributes.
-                # this saves time in recalculating them in createFRAG as this supervoxel itself has not changed.
-                # NOTE: if there are no neighbors left for this supervoxel, no need to compute supervoxel attributes.
-                #   In this special case the supervoxel is skipped in the createFRAG loop.
-                #   So no need to save the supervoxel attributes in the node.
-                if len(self.FRAG[node]) > 0: self.FRAG.node[newnode]['svox_attrs'] = self.FRAG.node[node]['svox_attrs']
-
-                self._noagglo_iterate_neighbors(self.FRAG, node, newnode, copy_attrs=True)
-                if self.outRAG is not None:
-                    self._noagglo_iterate_neighbors(self.outRAG, node, newnode)
+        svox_sizes[:ncomps] = np.bincount(comps[1:], weights=self.svox_sizes[:self.nsupervox_merge],
+            minlength=ncomps+1)[1:]
 
-            else:
-                # MUTIPLE COMPONENT NODE: group of supervoxels being merged (agglomerated)
-
-                # copy over overlap attributes for neighbors that border on only one of the nodes in the agglomerate.
-                # in this case the overlap area has not changed. need two passes to check for this.
-                neighbors = {}
-
-                # each node in connected component (that compose the agglomerated newnode)
-                for node in nodes:
-                    self._agglo_iterate_neighbors(self.FRAG, node, nodes, neighbors, newnode)
-                    if self.outRAG is not None:
-                        self._agglo_iterate_neighbors(self.outRAG, node, nodes, neighbors, newnode, remove=True)
-
-                for node in nodes:
-                    # for each neighbor of this node (edge in FRAG)
-                    for neighbor,f in self.FRAG[node].items():
-                        # copy over overlap attributes for neighbors that border on only one of agglomerated nodes.
-                        if neighbor not in nodes and neighbors[neighbor] == 1:
-                            if 'ovlp_attrs' in f:
-                                self.FRAG[neighbor][newnode]['ovlp_attrs'] = f['ovlp_attrs']
-                            # copy the neighbor supervoxel overlap attributes over.
-                            # they might be preservable in this case if the neighbor is a singleton node.
-                            if 'sovlp_attrs' in f and neighbor in f['sovlp_attrs']:
-                                self.FRAG[neighbor][newnode]['sovlp_attrs'] = {neighbor: f['sovlp_attrs'][neighbor]}
-                                #assert( 'ovlp_attrs' in f ) # should not have sovlp_attrs without ovlp_attrs, HIASSERT
-                    # after visiting, remove this old node that makes up part of the agglomerated node.
-                    self.FRAG.remove_node(node)
-
-        # sanity checks
-        assert( ncomps == self.FRAG.number_of_nodes() )
-        #assert( self.prev_max_node+ncomps == max(self.FRAG.nodes()) )  # commented for speed, HIASSERT
-        # relabel the FRAG starting at supervoxel 1
-        self.FRAG = nx.relabel_nodes(self.FRAG, {x+self.prev_max_node:x for x in range(1,ncomps+1)}, copy=False)
-
-        # same steps for outRAG as for FRAG
-        if self.outRAG is not None:
-            assert( ncomps == self.outRAG.number_of_nodes() )
-            #assert( self.prev_max_node+ncomps == max(self.outRAG.nodes()) )  # commented for speed, HIASSERT
-            self.outRAG = nx.relabel_nodes(self.outRAG, {x+self.prev_max_node:x for x in range(1,ncomps+1)}, copy=False)
+        # update the FRAG (and outRAG) by contracting the agglomerated supervoxels, keep features and attributes
+        #   for anything that did not change with the agglomeration.
+        self._contract_FRAG(comps, ncomps)
 
         # xxx - this block is identical in threshold_agglomerate()
         if self.nsupervox_nomerge > 0:
@@ -1127,57 +1128,44 @@ class dpFRAG(emLabels):
             print('\tnsupervox',self.data_attrs['types_nlabels'][0])
             print('\tdone in %.4f s' % (time.time() - t, ))
 
-    # "macro" for iterating neighbors for singleton nodes (not being agglomerated) in FRAG and outRAG
-    def _noagglo_iterate_neighbors(self, cRAG, node, newnode, copy_attrs=False):
-        # for each neighbor of this node (edge in FRAG)
-        for neighbor,f in cRAG[node].items():
-            #assert( not cRAG.has_edge(neighbor, newnode) )     # sanity check for singleton node, HIASSERT
-            cRAG.add_edge(neighbor, newnode)   # move this edge to newnode
-
-            # copying features and attributes only happens for FRAG
-            if copy_attrs:
-                # both new nodes must be singleton components to not require any feature updates.
-                # edges not requiring feature updates are marked by having features copied over from previous FRAG.
-                # only copy the features if the other node was already visited and was also singleton (has features)
-                #   or if the other node was not visited yet (neighbor node <= previous max node (nsupervox_merge)).
-                if neighbor <= self.prev_max_node or 'features' in f:
-                    features_copied = True
-                    cRAG[neighbor][newnode]['features'] = f['features']
-                    cRAG[neighbor][newnode]['first_pass'] = False
-                else:
-                    features_copied = False
-
-                # copy over overlap attributes but only if features are not copied over to final new edge.
-                if neighbor <= self.prev_max_node or not features_copied:
-                    # if the overlap attributes are present, then copy them over to the new edge.
-                    if 'ovlp_attrs' in f:
-                        cRAG[neighbor][newnode]['ovlp_attrs'] = f['ovlp_attrs']
-                    # copy the supervoxel overlap attributes over for this singleton node
-                    if 'sovlp_attrs' in f and node in f['sovlp_attrs']:
-                        cRAG[neighbor][newnode]['sovlp_attrs'] = {newnode: f['sovlp_attrs'][node]}
-                        #assert( 'ovlp_attrs' in f )     # should not have sovlp_attrs without ovlp_attrs, HIASSERT
-
-        # remove the old singleton node
-        cRAG.remove_node(node)
-
-    # "macro" for iterating neighbors for compound nodes (those being agglomerated) in FRAG and outRAG
-    def _agglo_iterate_neighbors(self, cRAG, node, nodes, neighbors, newnode, remove=False):
-        # for each neighbor of this node (edge in cRAG)
-        for neighbor in cRAG[node].keys():
-            # skip neighbors that are other nodes of this component.
-            if neighbor not in nodes:
-                # move this edge to newnode
-                if not cRAG.has_edge(neighbor, newnode): cRAG.add_edge(neighbor, newnode)
-                # add or increment neighbor count
-                if neighbor not in neighbors:
-                    neighbors[neighbor] = 1
-                else:
-                    neighbors[neighbor] += 1
-        if remove: cRAG.remove_node(node)
+    # contract the FRAG (and outRAG) with nodes mapped to agglomerated components.
+    # features and supervoxel attributes are kept for supervoxels that are not being agglomerated (singletons),
+    #   so that createFRAG in update mode only calculates features for edges that changed.
+    # overlap attributes are kept for other edges where the overlap area has not changed, which is if there was only
+    #   a single edge (in FRAG or outRAG) between the supervoxels making up the agglomerated nodes.
+    # supervoxel overlap attributes are kept along with the overlap attributes only for singleton supervoxels.
+    def _contract_FRAG(self, comps, ncomps):
+        FRAG, inverse = self.FRAG.contract(comps, ncomps)
+        counts = np.bincount(inverse[inverse >= 0], minlength=FRAG.number_of_edges())
+        if self.outRAG is not None:
+            outRAG, oinverse = self.outRAG.contract(comps, ncomps)
+            oeids = FRAG.edge_ids(comps[self.outRAG.edges[oinverse >= 0,:]])
+            counts += np.bincount(oeids[oeids >= 0], minlength=FRAG.number_of_edges())
+            self.outRAG = outRAG
+        singleton = (np.bincount(comps, minlength=ncomps+1) == 1)
+
+        ovlp_attrs = self.FRAG.edge_attrs['ovlp_attrs']; sovlp_attrs = self.FRAG.edge_attrs['sovlp_attrs']
+        for e in set(ovlp_attrs.keys()) | set(sovlp_attrs.keys()):
+            ne = inverse[e]
+            if ne < 0: continue
+            i,j = comps[self.FRAG.edges[e,:]]
+            # features are copied for edges between singletons, so overlap attributes are not needed.
+            if (singleton[i] and singleton[j]) or counts[ne] != 1: continue
+            if e in ovlp_attrs: FRAG.edge_attrs['ovlp_attrs'][ne] = ovlp_attrs[e]
+            if e in sovlp_attrs:
+                m = { int(comps[x]):y for x,y in sovlp_attrs[e].items() if singleton[comps[x]] }
+                if len(m) > 0: FRAG.edge_attrs['sovlp_attrs'][ne] = m
+
+        # no need to keep supervoxel attributes for singletons with no neighbors, see createFRAG.
+        svox_attrs = FRAG.node_attrs['svox_attrs']
+        for i in [x for x in svox_attrs.keys() if FRAG.degree(x) == 0]: del svox_attrs[i]
+        self.FRAG = FRAG
 
     # multiple probability thresholded agglomerate.
     # this method does NOT update the FRAG based on the target agglomeration.
-    def threshold_agglomerate(self, probs, thresholds, threshold_subgroups=None):
+    # in table mode the supervoxels are written once and each threshold is only written as an "agglomeration table",
+    #   the lookup table from the supervoxels to the agglomerated labels (as labels delta, see emLabels.readLabels).
+    def threshold_agglomerate(self, probs, thresholds, threshold_subgroups=None, table=False):
         ntargets = probs.shape[0]; nthresholds = len(thresholds)
         assert( ntargets == self.FRAG.number_of_edges() ); # agglomerate input data must match FRAG edges
         if threshold_subgroups is None:
@@ -1195,27 +1183,26 @@ class dpFRAG(emLabels):
                 widgets = [RotatingMarker(), ' ', Percentage(), ' ', Bar(marker='='), ' ', ETA()]
                 pbar = ProgressBar(widgets=widgets, maxval=nthresholds).start()
 
-        # create empty agglomerated graph
-        aggloG = nx.Graph(); aggloG.add_nodes_from(range(1,self.nsupervox_merge+1))
-
         # do incremental agglomerate with decreasing thresholds, store each one into output hdf5
         thresholds = np.sort(thresholds)[::-1]; threshold_subgroups = np.sort(threshold_subgroups)[::-1]
-        for i in range(nthresholds):
-            self.subgroups_out[-1] = '%.8f' % threshold_subgroups[i]
 
-            #self._incremental_agglomerate(probs[:,1] > thresholds[i], aggloG)
+        if table:
+            # write the supervoxels that the agglomeration tables are applied to
+            self.subgroups_out[-1] = 'supervoxels'
+            self.data_cube = self.supervoxels_noperim; self.data_attrs['types_nlabels'] = [self.nsupervox]
+            self.writeCube(); base = list(self.subgroups_out)
+            outfile = self.outfile if self.outfile else self.srcfile
 
-            target = probs[:,1] > thresholds[i]
-            # add edges in target if not already present in aggloG
-            for e,j in zip(self.FRAG.edges_iter(),range(ntargets)):
-                if target[j] and not aggloG.has_edge(e[0],e[1]): aggloG.add_edge(e[0],e[1])
+        # thresholds are decreasing so components of edges over current threshold include all previous merges.
+        # edges are sorted by merge probability once and merged incrementally into union-find for each threshold.
+        components = self.FRAG.threshold_components(probs[:,1], thresholds)
+        for i in range(nthresholds):
+            self.subgroups_out[-1] = '%.8f' % threshold_subgroups[i]
 
             # get connected component nodes and create supervoxel mapping based on agglomerated components
             supervox_map = np.zeros((self.nsupervox+1,),dtype=self.data_type_out)
-            compsG = nx.connected_components(aggloG); ncomps = 0
-            for nodes in compsG:
-                # supervoxel mapping from previous to new agglomerated supervoxels
-                ncomps += 1; supervox_map[np.array(tuple(nodes),dtype=np.int64)] = ncomps
+            ncomps, comps = components[i]
+            supervox_map[:self.nsupervox_merge+1] = comps
             # xxx - this block is identical in agglomerate()
             if self.nsupervox_nomerge > 0:
                 assert( ncomps < self.nsupervox_merge ) # sanity check
@@ -1223,15 +1210,20 @@ class dpFRAG(emLabels):
                 supervox_map[self.nsupervox_merge+1:] = \
                     np.arange(ncomps+1,ncomps+self.nsupervox_nomerge+1,dtype=self.data_type_out)
                 ncomps += self.nsupervox_nomerge
-            # create the new supervoxels from the supervoxel_map containing mapping from agglo nodes to new nodes
-            self.data_cube = supervox_map[self.supervoxels_noperim]
 
             if self.dpFRAG_verbose:
                 print('\tnsupervox',ncomps)
                 if useProgressBar: pbar.update(i)
             #print(self.offset, self.size, self.chunk, self.data_type, self.data_type_out)
             self.data_attrs['types_nlabels'] = [ncomps]
-            self.writeCube()
+            if table:
+                emLabels.writeLabelsDelta(outfile, self.chunk.tolist(), self.offset.tolist(), self.size.tolist(),
+                    supervox_map, np.zeros((0,),dtype=np.uint32), np.zeros((0,),dtype=supervox_map.dtype), base,
+                    attrs=self.data_attrs, subgroups=list(self.subgroups_out))
+            else:
+                # create the new supervoxels from the supervoxel_map containing mapping from agglo nodes to new nodes
+                self.data_cube = supervox_map[self.supervoxels_noperim]
+                self.writeCube()
 
         if self.dpFRAG_verbose:
             if useProgressBar: pbar.finish()
@@ -1340,7 +1332,8 @@ class dpFRAG(emLabels):
     @classmethod
     def makeTrainingFRAG(cls, labelfile, chunk, size, offset, probfiles, rawfiles, raw_dataset, gtfile,
             subgroups=[], G=None, progressBar=False, feature_set=None, has_ECS=True, chunk_subgroups=False, 
-            neighbor_only=False, pad_prob_svox_perim=False, no_agglo_ECS=False, verbose=False):
+            neighbor_only=False, pad_prob_svox_perim=False, no_agglo_ECS=False,
+            moment_update=False, nworkers=1, augment_cache='', augment_cache_size=32., verbose=False):
         parser = argparse.ArgumentParser(description='class:dpFRAG',
             formatter_class=argparse.ArgumentDefaultsHelpFormatter)
         dpFRAG.addArgs(parser); arg_str = ''
@@ -1364,6 +1357,10 @@ class dpFRAG(emLabels):
         if pad_prob_svox_perim: arg_str += ' --pad-prob-perim --pad-svox-perim '
         else: arg_str += ' --pad-svox-perim '
         if no_agglo_ECS: arg_str += ' --no-agglo-ECS '
+        if augment_cache:
+            arg_str += ' --augment-cache %s --augment-cache-size %g ' % (augment_cache, augment_cache_size)
+        assert( not moment_update )  # moment update mode is only implemented in dpFRAGc
+        assert( nworkers == 1 )  # parallel edge features are only implemented in dpFRAGc
 
         if verbose: arg_str += ' --dpFRAG-verbose '
         if progressBar: arg_str += ' --progress-bar '
@@ -1377,7 +1374,8 @@ class dpFRAG(emLabels):
     @classmethod
     def makeTestingFRAG(cls, labelfile, chunk, size, offset, probfiles, rawfiles, raw_dataset, outfile=None, 
             subgroups=[], subgroups_out=[], G=None, progressBar=False, feature_set=None, has_ECS=True, 
-            chunk_subgroups=False, neighbor_only=False, pad_prob_svox_perim=False, no_agglo_ECS=False, verbose=False):
+            chunk_subgroups=False, neighbor_only=False, pad_prob_svox_perim=False, no_agglo_ECS=False,
+            moment_update=False, nworkers=1, augment_cache='', augment_cache_size=32., verbose=False):
         parser = argparse.ArgumentParser(description='class:dpFRAG',
             formatter_class=argparse.ArgumentDefaultsHelpFormatter)
         dpFRAG.addArgs(parser); arg_str = ''
@@ -1402,6 +1400,10 @@ class dpFRAG(emLabels):
         if pad_prob_svox_perim: arg_str += ' --pad-prob-perim --pad-svox-perim '
         else: arg_str += ' --pad-svox-perim '
         if no_agglo_ECS: arg_str += ' --no-agglo-ECS '
+        if augment_cache:
+            arg_str += ' --augment-cache %s --augment-cache-size %g ' % (augment_cache, augment_cache_size)
+        assert( not moment_update )  # moment update mode is only implemented in dpFRAGc
+        assert( nworkers == 1 )  # parallel edge features are only implemented in dpFRAGc
 
         if verbose: arg_str += ' --dpFRAG-verbose '
         if progressBar: arg_str += ' --progress-bar '
@@ -1415,7 +1417,8 @@ class dpFRAG(emLabels):
     @classmethod
     def makeBothFRAG(cls, labelfile, chunk, size, offset, probfiles, rawfiles, raw_dataset, gtfile, outfile=None,
             subgroups=[], subgroups_out=None, G=None, progressBar=False, feature_set=None, has_ECS=True, 
-            neighbor_only=False, chunk_subgroups=False, pad_prob_svox_perim=False, no_agglo_ECS=False, verbose=False):
+            neighbor_only=False, chunk_subgroups=False, pad_prob_svox_perim=False, no_agglo_ECS=False,
+            moment_update=False, nworkers=1, augment_cache='', augment_cache_size=32., verbose=False):
         parser = argparse.ArgumentParser(description='class:dpFRAG',
             formatter_class=argparse.ArgumentDefaultsHelpFormatter)
         dpFRAG.addArgs(parser); arg_str = ''
@@ -1441,6 +1444,10 @@ class dpFRAG(emLabels):
         if pad_prob_svox_perim: arg_str += ' --pad-prob-perim --pad-svox-perim '
         else: arg_str += ' --pad-svox-perim '
         if no_agglo_ECS: arg_str += ' --no-agglo-ECS '
+        if augment_cache:
+            arg_str += ' --augment-cache %s --augment-cache-size %g ' % (augment_cache, augment_cache_size)
+        assert( not moment_update )  # moment update mode is only implemented in dpFRAGc
+        assert( nworkers == 1 )  # parallel edge features are only implemented in dpFRAGc
 
         if verbose: arg_str += ' --dpFRAG-verbose '
         if progressBar: arg_str += ' --progress-bar '
@@ -1498,6 +1505,10 @@ class dpFRAG(emLabels):
         p.add_argument('--pad-prob-perim', action='store_true', help='Pad perimeter of probs instead of loading')
         p.add_argument('--pad-svox-perim', action='store_true', help='Pad perimeter of supervoxels instead of loading')
         p.add_argument('--no-agglo-ECS', action='store_true', help='Do not agglomerate ECS supervoxels')
+        p.add_argument('--augment-cache', nargs=1, type=str, default='',
+            help='Directory for caching raw augments that are calculated on-the-fly (no rawaugfile)')
+        p.add_argument('--augment-cache-size', nargs=1, type=float, default=[32.],
+            help='Maximum size of the raw augment cache in GB')
         p.add_argument('--dpFRAG-verbose', action='store_true', help='Debugging output for dpFRAG')
 
 if __name__ == '__main__':
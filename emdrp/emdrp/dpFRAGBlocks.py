@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 Paul Watkins, National Institutes of Health / NINDS
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Blockwise region adjacency graph (RAG) with border statistics for supervoxel volumes too large for a single cube.
+# frag_with_borders (used by dpFRAG) needs the whole label volume in memory along with per supervoxel allocations,
+#   instead for labels with global supervoxel ids (for example the output of dpWatershedBlocks):
+#     (1) workers in a local process pool run frag_with_borders on blocks (cubes from dpCubeIter) with a halo of the
+#         neighborhood size. outside of the dataset is background. each block is relabeled to block local ids so the
+#         memory used scales with the block size and not with the number of supervoxels in the dataset.
+#     (2) border voxels are only kept by the block that contains them in its core. border voxels on block faces are
+#         found by the blocks on both sides (the halo), so this way each border voxel of each edge is counted once.
+#         each block returns an edge table with global supervoxel ids, border voxel counts and moments (sum, sum of
+#         squares, min, max) of the probability channels over the border voxels of each edge.
+#     (3) a single reduction merges the block edge tables into the global edge table keyed by supervoxel id pairs.
+# Optionally the border voxels of each edge are also written as global linear indices (compressed rows).
+
+import argparse
+import time
+import multiprocessing
+from collections import OrderedDict
+import numpy as np
+import h5py
+
+from emdrp.dpCubeIter import dpCubeIter
+from emdrp.dpLoadh5 import dpLoadh5
+from emdrp.utils.typesh5 import emLabels
+
+from pyCext import frag_with_borders
+
+class dpFRAGBlocks(object):
+
+    # moments of the channels over the border voxels that are merged, mean and var are recomputed after merging
+    BORDER_MOMENTS = ['sum', 'sumsq', 'min', 'max']
+
+    def __init__(self, args):
+        self.args = args
+        self.nworkers = args.nworkers[0] if type(args.nworkers) is list else args.nworkers
+        self.labelfile = args.labelfile[0] if type(args.labelfile) is list else args.labelfile
+        self.probfile = args.probfile[0] if type(args.probfile) is list else args.probfile
+        self.outfile = args.outfile[0] if type(args.outfile) is list else args.outfile
+        self.nbhd = args.nbhd[0] if type(args.nbhd) is list else args.nbhd
+        self.connectivity = args.connectivity[0] if type(args.connectivity) is list else args.connectivity
+        self.label_subgroups = args.label_subgroups; self.prob_types = args.prob_types
+        self.prob_subgroups = args.prob_subgroups; self.borders = args.borders
+        self.dpFRAGBlocks_verbose = args.dpFRAGBlocks_verbose
+        assert( self.nbhd > 0 )
+        assert( not self.prob_types or self.probfile )   # probability channels are read from probfile
+
+        # the blocks are the cubes iterated by dpCubeIter, the halo is the neighborhood size and not the overlap
+        p = argparse.ArgumentParser(); dpCubeIter.addArgs(p); cube_args = p.parse_args([])
+        for k in vars(cube_args).keys(): setattr(cube_args, k, getattr(args, k))
+        self.cubeIter = dpCubeIter(cube_args)
+        assert( not self.cubeIter.left_remainder.any() and not self.cubeIter.right_remainder.any() ) # not supported
+        assert( not self.cubeIter.leave_edge and not self.cubeIter.filemodulators_overlap_on )      # not supported
+        assert( (np.array(self.cubeIter.overlap) == 0).all() )   # halo is the neighborhood, no overlap
+        self.core_size = np.array(self.cubeIter.cube_size_voxels, dtype=np.int64)
+        self.chunksize = np.array(self.cubeIter.chunksize, dtype=np.int64)
+        assert( (self.core_size > self.nbhd).all() )
+
+        self.blocks = []
+        for volume_info in self.cubeIter:
+            _, _, chunk, _, _, _, _, _, _ = volume_info
+            self.blocks.append(np.array(chunk, dtype=np.int64))
+        self.nblocks = len(self.blocks)
+
+        # size of the labels dataset, needed for the halo at the dataset edges and for global border voxel indices
+        loadh5 = dpLoadh5.readInith5(self.labelfile, emLabels.LBLS_DATASET, self.blocks[0].tolist(), [0,0,0],
+            [1,1,1], '', self.label_subgroups)
+        self.datasize = np.array(loadh5.datasize, dtype=np.int64); del loadh5
+
+        if self.dpFRAGBlocks_verbose:
+            print('dpFRAGBlocks, verbose mode:\n'); print(vars(self))
+
+    def make_rag(self):
+        if self.dpFRAGBlocks_verbose:
+            print('Calculating RAG for %d blocks with %d workers' % (self.nblocks, self.nworkers)); t = time.time()
+
+        # (1) and (2) block edge tables in parallel
+        with multiprocessing.Pool(self.nworkers) as pool:
+            results = pool.map(self.rag_block, range(self.nblocks))
+
+        if self.dpFRAGBlocks_verbose:
+            print('\tdone in %.4f s' % (time.time() - t, ))
+            print('Merging %d block edge tables' % (self.nblocks, )); t = time.time()
+
+        # (3) merge into the global edge table
+        self.edges, self.counts, self.stats, self.border_voxels, self.border_offsets = self.merge_blocks(results)
+        del results
+
+        if self.dpFRAGBlocks_verbose:
+            print('\tdone in %.4f s, %d edges' % (time.time() - t, self.edges.shape[0]))
+
+    # worker: edge table for the border voxels in the core of a single block.
+    # returns edges (global ids), border voxel counts, border moments of each channel and the border voxels of each
+    #   edge as global linear indices (concatenated in edge order) if border voxels are being saved.
+    def rag_block(self, n):
+        beg = self.blocks[n]*self.chunksize - self.nbhd; size = self.core_size + 2*self.nbhd
+        labels = self.read_padded(self.labelfile, emLabels.LBLS_DATASET, self.label_subgroups, beg, size)
+
+        # block local ids, background must stay zero for frag_with_borders
+        ids, local = np.unique(labels, return_inverse=True); del labels
+        local = local.reshape(size).astype(np.uint32)
+        if ids[0] != 0:
+            ids = np.concatenate((np.zeros((1,), dtype=ids.dtype), ids)); local += 1
+        ids = ids.astype(np.int64)
+
+        # pad with another nbhd of zeros so that the flattened neighborhood steps never wrap around the block
+        list_of_edges, inds, edge_offsets, _, _, _ = frag_with_borders(local, ids.size-1, pad=True, nbhd=self.nbhd,
+            conn=self.connectivity, csr=True)
+        del local
+        nedges = list_of_edges.shape[0]
+        eids = np.repeat(np.arange(nedges, dtype=np.int64), np.diff(edge_offsets))
+
+        # subscripts into the block (with halo), keep only border voxels in the block core
+        subs = np.array(np.unravel_index(inds, tuple((size + 2*self.nbhd).tolist())), dtype=np.int64) - self.nbhd
+        sel = np.logical_and(subs >= self.nbhd, subs < self.nbhd + self.core_size[:,None]).all(0)
+        subs = subs[:,sel]; eids = eids[sel]; inds = np.ravel_multi_index(tuple(subs), tuple(size.tolist()))
+        counts = np.bincount(eids, minlength=nedges)
+
+        # only edges with border voxels in the core, voxels stay sorted by edge from frag_with_borders
+        keep = (counts > 0); edge_map = np.cumsum(keep) - 1
+        edges = ids[np.array(list_of_edges, dtype=np.int64).reshape((-1,2))[keep,:]]
+        counts = counts[keep]; eids = edge_map[eids]; nedges = edges.shape[0]
+        starts = np.zeros((nedges,), dtype=np.int64); starts[1:] = np.cumsum(counts)[:-1]
+
+        stats = OrderedDict()
+        for prob_type in self.prob_types:
+            data = self.read_padded(self.probfile, prob_type, self.prob_subgroups, beg, size)
+            values = np.take(data, inds).astype(np.double); del data
+            if nedges > 0:
+                stats[prob_type] = np.stack((np.bincount(eids, weights=values, minlength=nedges),
+                    np.bincount(eids, weights=values*values, minlength=nedges),
+                    np.minimum.reduceat(values, starts), np.maximum.reduceat(values, starts)), axis=1)
+            else:
+                stats[prob_type] = np.zeros((0,len(self.BORDER_MOMENTS)), dtype=np.double)
+
+        if self.borders:
+            voxels = np.ravel_multi_index(tuple(subs + beg[:,None]), tuple(self.datasize.tolist()))
+        else:
+            voxels = None
+        return edges, counts, stats, voxels
+
+    # reduction: combine the edge tables from all the blocks by supervoxel id pairs.
+    def merge_blocks(self, results):
+        edges = np.concatenate([x[0] for x in results], axis=0)
+        counts = np.concatenate([x[1] for x in results])
+        order = np.lexsort((edges[:,1], edges[:,0])); edges = edges[order,:]
+        first = np.ones((edges.shape[0],), dtype=bool)
+        first[1:] = (edges[1:,:] != edges[:-1,:]).any(1)
+        starts = np.nonzero(first)[0]; nedges = starts.size
+        gcounts = np.add.reduceat(counts[order], starts) if nedges > 0 else np.zeros((0,), dtype=np.int64)
+        dcounts = gcounts.astype(np.double)
+
+        stats = OrderedDict()
+        for prob_type in self.prob_types:
+            moments = np.concatenate([x[2][prob_type] for x in results], axis=0)[order,:]
+            stats[prob_type] = OrderedDict()
+            for moment, ufunc, col in zip(self.BORDER_MOMENTS, [np.add, np.add, np.minimum, np.maximum],
+                    range(len(self.BORDER_MOMENTS))):
+                stats[prob_type][moment] = ufunc.reduceat(moments[:,col], starts) if nedges > 0 else \
+                    np.zeros((0,), dtype=np.double)
+            mean = stats[prob_type]['sum']/dcounts; var = stats[prob_type]['sumsq']/dcounts - mean*mean
+            var[var < 0] = 0    # roundoff
+            stats[prob_type]['mean'] = mean; stats[prob_type]['var'] = var
+
+        if self.borders:
+            # global edge index for each border voxel, then sort by edge and voxel index
+            gids = np.cumsum(first) - 1; rank = np.empty_like(gids); rank[order] = gids
+            veids = np.repeat(rank, counts); voxels = np.concatenate([x[3] for x in results])
+            vorder = np.lexsort((voxels, veids)); voxels = voxels[vorder]
+            offsets = np.zeros((nedges+1,), dtype=np.int64); offsets[1:] = np.cumsum(gcounts)
+        else:
+            voxels = None; offsets = None
+
+        return edges[first,:], gcounts, stats, voxels, offsets
+
+    # read a cube in global voxel coordinates, anything outside of the dataset is zero.
+    def read_padded(self, srcfile, dataset, subgroups, beg, size):
+        end = beg + size; cbeg = np.maximum(beg, 0); cend = np.minimum(end, self.datasize)
+        chunk = cbeg // self.chunksize; offset = cbeg - chunk*self.chunksize
+        loadh5 = dpLoadh5.readData(srcfile=srcfile, dataset=dataset, chunk=chunk.tolist(), offset=offset.tolist(),
+            size=(cend - cbeg).tolist(), subgroups=subgroups)
+        if (cbeg == beg).all() and (cend == end).all(): return loadh5.data_cube
+        data = np.zeros(size, dtype=loadh5.data_cube.dtype)
+        data[tuple(slice(x, y) for x, y in zip(cbeg - beg, cend - beg))] = loadh5.data_cube
+        return data
+
+    def writeRAG(self):
+        h5file = h5py.File(self.outfile, 'w')
+        h5file.create_dataset('edges', data=self.edges); h5file.create_dataset('counts', data=self.counts)
+        for prob_type, stats in self.stats.items():
+            for name, value in stats.items(): h5file.create_dataset(prob_type + '/' + name, data=value)
+        if self.borders:
+            h5file.create_dataset('border_voxels', data=self.border_voxels)
+            h5file.create_dataset('border_offsets', data=self.border_offsets)
+        h5file.attrs['datasize'] = self.datasize; h5file.attrs['nbhd'] = self.nbhd
+        h5file.attrs['connectivity'] = self.connectivity
+        h5file.close()
+
+    @staticmethod
+    def addArgs(p):
+        dpCubeIter.addArgs(p)
+        p.add_argument('--labelfile', nargs=1, type=str, default='', help='Path/name of hdf5 supervoxels (input)')
+        p.add_argument('--label-subgroups', nargs='*', type=str, default=[],
+            help='List of groups to identify subgroup for the supervoxels')
+        p.add_argument('--probfile', nargs=1, type=str, default='',
+            help='Path/name of hdf5 probabilities for border statistics (input)')
+        p.add_argument('--prob-types', nargs='*', type=str, default=[],
+            help='Datasets in probfile to calculate border statistics for')
+        p.add_argument('--prob-subgroups', nargs='*', type=str, default=[],
+            help='List of groups to identify subgroup for the probabilities')
+        p.add_argument('--outfile', nargs=1, type=str, default='', help='Output hdf5 with the global edge table')
+        p.add_argument('--nbhd', nargs=1, type=int, default=[1], help='Neighborhood size for the RAG')
+        p.add_argument('--connectivity', nargs=1, type=int, default=[3], help='Connectivity for the RAG')
+        p.add_argument('--borders', action='store_true',
+            help='Also save the border voxels of each edge as global linear indices')
+        p.add_argument('--nworkers', nargs=1, type=int, default=[multiprocessing.cpu_count()],
+            help='Number of worker processes for the blocks')
+        p.add_argument('--dpFRAGBlocks-verbose', action='store_true', help='Debugging output for dpFRAGBlocks')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Blockwise region adjacency graph and border statistics ' + \
+        'for supervoxels with global ids', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    dpFRAGBlocks.addArgs(parser)
+    args = parser.parse_args()
+
+    rag = dpFRAGBlocks(args)
+    rag.make_rag()
+    rag.writeRAG()
@@ -35,27 +35,45 @@
 
 
 #import os, sys
+import os
 import argparse
 import time
+import multiprocessing
 import numpy as np
 from numpy import linalg as nla
 from scipy import ndimage as nd
 from scipy import linalg as sla
-import networkx as nx
 from io import StringIO
 from collections import OrderedDict
+import dill
 
 from dpLoadh5 import dpLoadh5
 from dpWriteh5 import dpWriteh5
 from utils.typesh5 import emLabels, emProbabilities
+from utils.ArrayRAG import ArrayRAG
+from utils.AugmentCache import AugmentCache
+from utils.HierarchicalAgglo import HierarchicalAgglo
 from Kuwahara import Kuwahara
 
 from pyCext import frag_with_borders
 
 
+# the frag used by the parallel edge feature workers, set by the pool initializer
+_edge_worker_frag = None
+
+def _init_edge_worker(frag, supervoxels, shape, dtype):
+    global _edge_worker_frag
+    frag.supervoxels = np.frombuffer(supervoxels, dtype=dtype).reshape(shape)
+    _edge_worker_frag = frag
+
+def _edge_worker(tasks):
+    return _edge_worker_frag.edgeFeaturesBlock(tasks)
+
 class dpFRAG(emLabels):
 
     TARGETS = {'no_merge':0, 'yes_merge':1}     # hard coded as false/true throughout code
+    # volumes that are not saved when spilling the FRAG, reloaded on restore
+    SPILL_VOLUMES = ['probs', 'probs_aug', 'probs_static_aug', 'raw', 'raw_aug', 'raw_static_aug', 'gt']
 
     ############ parameters that were found to not be useful so made static
 
@@ -84,9 +102,17 @@ class dpFRAG(emLabels):
     #   preserved, but some of the overlap calculations can still be preserved.
     #svox_attrs = ['pbnd','svox_size','lsvox_size','svox_sel_out','ppbnd','perim_ovlp','svox_sel_out_perim']
     sovlp_attrs = ['sel_size','lsel_size','C','V','angles','Cpts']
-    ovlp_attrs = ['mean_probs','mean_probs_aug','mean_probs_static_aug',
-                  'mean_grayscale','mean_grayscale_aug','mean_grayscale_static_aug',
-                  'aobnd','rad_std_ovlp','ang_std_ovlp','conv_overlap','labeled_ovlp']
+    ovlp_attrs = ['aobnd','rad_std_ovlp','ang_std_ovlp','conv_overlap','labeled_ovlp']
+
+    # features (along with all the mean_ features) that only depend on the border voxels and supervoxel sizes.
+    # these are calculated for all the edges at once without iterating the edges.
+    border_features = ['size_small', 'size_large', 'size_overlap']
+
+    # attributes needed by edgeFeatures, only these are copied to the parallel workers
+    edge_worker_attrs = ['features_names', 'npcaang', 'log_size', 'perim', 'sampling', 'svox_sizes']
+
+    # statistics calculated over the border voxels for each data channel
+    border_stats_names = ['sum', 'sumsq', 'mean', 'min', 'max', 'var']
 
     @staticmethod
     def make_features(feature_set, has_ECS):
@@ -223,6 +249,12 @@ class dpFRAG(emLabels):
 
         d = locals(); return { k:d[k] for k in features_vars }
 
+    # filters that modify the data in place in filter_data
+    inplace_filters = ['kuwahara']
+
+    # version of filter_data for the augment cache, increment this if the filters are changed
+    filter_version = 1
+
     @staticmethod
     def filter_data(data, ftype, sampling_ratio):
         ftype = ftype.lower()
@@ -286,6 +318,28 @@ class dpFRAG(emLabels):
         # other inits asserts that we don't need to see printed
         self.bwconn = nd.morphology.generate_binary_structure(dpLoadh5.ND, self.connectivity)
 
+        # optional on-disk cache for raw augments that are calculated on-the-fly
+        self.raw_aug_cache = AugmentCache(self.augment_cache, self.augment_cache_size,
+            verbose=self.dpFRAG_verbose) if self.augment_cache else None
+
+        # moments stored with the FRAG for updating features without the voxels after agglomeration
+        self.border_channel_names = [x[len('mean_'):] for x in self.features_names if x.startswith('mean_')]
+        if self.moment_update:
+            # moment update only supports the features that are calculated from the supervoxel sizes and the border
+            #   statistics (the minimal feature set). the overlap geometry (centroids, pca, bounding boxes) is not
+            #   stored as moments and would have to be recomputed from the voxels.
+            unsupported = [x for x in self.features_names if not (x in self.border_features or x.startswith('mean_'))]
+            if len(unsupported) > 0:
+                raise Exception('In dpFRAG, moment update only supports size and mean border features, not ' + \
+                    ','.join(unsupported))
+            self.node_moments = [('size','sum')]
+            self.edge_moments = [('count','sum')]
+            for name in self.border_channel_names:
+                self.edge_moments += [('sum_' + name,'sum'), ('sumsq_' + name,'sum'), ('min_' + name,'min'),
+                    ('max_' + name,'max')]
+        else:
+            self.node_moments = []; self.edge_moments = []
+
         assert( not self.trainout or self.gtfile )  # need ground truth to generate training data
 
     def loadData(self):
@@ -319,9 +373,21 @@ class dpFRAG(emLabels):
             self.nsupervox_nomerge = self.nsupervox - self.nsupervox_merge
         
         self.supervoxels_noperim = relabel.astype(self.lbl_dtype, copy=False)
-        self.supervoxels = np.lib.pad(self.supervoxels_noperim, self.spad, 'constant', constant_values=0)
+        # pad keeps the F-order of the loaded cube with newer numpy, the C extensions need C-order
+        self.supervoxels = np.ascontiguousarray(np.lib.pad(self.supervoxels_noperim, self.spad, 'constant',
+            constant_values=0))
         self.supervoxels_zeroperim = self.supervoxels
 
+        self.loadVolumes()
+
+        if self.dpFRAG_verbose:
+            print('\tdone in %.4f s, %d supervoxels, %d merge-able supervoxels, %d gt labels' % (time.time() - t, 
+                self.nsupervox, self.nsupervox_merge, self.ngtlbl))
+
+    # load the probability, raw and ground truth volumes, also used to reload the volumes of a spilled FRAG
+    def loadVolumes(self):
+        spad = self.spad
+
         # load the probability data
         if self.probfile:
             if self.pad_prob_perim: offset = self.offset; size = self.size
@@ -395,18 +461,13 @@ class dpFRAG(emLabels):
             if not self.rawaugfile and (self.naugments > 0 or (self.nstatic_augments > 0 and (self.nstatic_augments \
                 > sum([self.static_augments[x][0] != '_' for x in range(self.nstatic_augments)])))):
 
-                fpad=16; offset = offset - fpad; size = size + 2*fpad
-                loadh5 = dpLoadh5.readData(srcfile=self.rawfile, dataset=self.raw_dataset, chunk=self.chunk.tolist(),
-                    offset=offset.tolist(), size=size.tolist(), verbose=self.dpLoadh5_verbose); rdata = loadh5.data_cube
+                # raw data with filter padding is only loaded if any augment is not in the augment cache
+                fpad=16; fstate = {'offset':offset - fpad, 'size':size + 2*fpad, 'fpad':fpad, 'rdata':None,
+                    'inplace':[], 'napplied':0}
 
                 self.raw_aug = [None]*self.naugments
                 for j in range(self.naugments):
-                    if self.dpFRAG_verbose:
-                        print('\tFiltering raw data with %s' % (self.augments[j],)); t = time.time()
-                    data = dpFRAG.filter_data(rdata, self.augments[j],
-                                              self.sampling_ratio)[fpad:-fpad,fpad:-fpad,fpad:-fpad]
-                    if self.dpFRAG_verbose:
-                        print('\t\tdone in %.4f s' % (time.time() - t,))
+                    data = self.filter_raw_augment(self.augments[j][1:], fstate)
 
                     if self.pad_raw_perim:
                         # pad data, xxx - what to pad with, zeros just easy, not clear any other method is better
@@ -419,12 +480,7 @@ class dpFRAG(emLabels):
                 self.raw_static_aug = [None]*self.nstatic_augments
                 for j in range(self.nstatic_augments):
                     if self.static_augments[j][0] == '_':
-                        if self.dpFRAG_verbose:
-                            print('\tFiltering raw data with %s' % (self.static_augments[j],)); t = time.time()
-                        data = dpFRAG.filter_data(rdata, self.static_augments[j][1:],
-                                                  self.sampling_ratio)[fpad:-fpad,fpad:-fpad,fpad:-fpad]
-                        if self.dpFRAG_verbose:
-                            print('\t\tdone in %.4f s' % (time.time() - t,))
+                        data = self.filter_raw_augment(self.static_augments[j][1:], fstate)
 
                         if self.pad_raw_perim:
                             # pad data, xxx - what to pad with, zeros just easy, not clear any other method is better
@@ -479,14 +535,87 @@ class dpFRAG(emLabels):
         else:
             self.gt = None; self.ngtlbl = -1
 
+    # save the FRAG state (RAG, supervoxel attributes and current supervoxels) to a scratch file and free the memory.
+    # only scalar attributes (file names, options, etc) stay resident until the FRAG is restored.
+    # the volumes are not saved, they are reloaded on restore (raw augments from the augment cache if enabled).
+    def spill(self, filename):
         if self.dpFRAG_verbose:
-            print('\tdone in %.4f s, %d supervoxels, %d merge-able supervoxels, %d gt labels' % (time.time() - t, 
-                self.nsupervox, self.nsupervox_merge, self.ngtlbl))
+            print('Spilling FRAG for chunk %d,%d,%d' % tuple(self.chunk.tolist())); t = time.time()
+        # supervoxel views are recreated on restore and the hdf5 dataset objects are reopened on the next read
+        state = {k:v for k,v in vars(self).items() if k not in self.SPILL_VOLUMES + ['supervoxels_noperim',
+            'supervoxels_zeroperim', 'dset', 'group']}
+        with open(filename, 'wb') as f: dill.dump(state, f)
+        self.__dict__ = {k:v for k,v in state.items() if v is None or np.isscalar(v)}; self.spillfile = filename
+        if self.dpFRAG_verbose:
+            print('\tdone in %.4f s' % (time.time() - t, ))
+
+    def restore(self):
+        assert( self.spilled() )
+        if self.dpFRAG_verbose:
+            print('Restoring FRAG from %s' % (self.spillfile,)); t = time.time()
+        with open(self.spillfile, 'rb') as f: state = dill.load(f)
+        os.remove(self.spillfile); del self.spillfile; self.__dict__.update(state)
+        p = self.eperim; self.supervoxels_noperim = self.supervoxels[p[0]:-p[0],p[1]:-p[1],p[2]:-p[2]]
+        self.supervoxels_zeroperim = self.supervoxels
+        self.loadVolumes()
+        if self.dpFRAG_verbose:
+            print('\tdone in %.4f s' % (time.time() - t, ))
+
+    def spilled(self):
+        return hasattr(self, 'spillfile')
+
+    # approximate memory used by the FRAG, the arrays for the volumes, supervoxels and the RAGs (views not counted).
+    # arrays restored from a spilled FRAG own their memory through the unpickled buffer (base is not an array).
+    def nbytes(self):
+        def size(x):
+            if isinstance(x, np.ndarray): return 0 if isinstance(x.base, np.ndarray) else x.nbytes
+            if isinstance(x, (list, tuple)): return sum([size(y) for y in x])
+            if isinstance(x, ArrayRAG): return size(list(vars(x).values()))
+            return 0
+        return size(list(vars(self).values()))
+
+    # filter the raw data for an on-the-fly raw augment, using the on-disk augment cache if enabled.
+    # the kuwahara filter modifies the raw data in place, so it also applies to the input of all following augments.
+    #   in place filters that were loaded from the cache are only applied to the raw data if it is needed.
+    def filter_raw_augment(self, ftype, state):
+        ftype = ftype.lower(); fpad = state['fpad']; data = None
+        if self.raw_aug_cache is not None:
+            key = AugmentCache.key(rawfile=AugmentCache.file_key(self.rawfile), dataset=self.raw_dataset,
+                chunk=self.chunk.tolist(), offset=state['offset'].tolist(), size=state['size'].tolist(), fpad=fpad,
+                ftype=ftype, prior=state['inplace'], sampling_ratio=np.asarray(self.sampling_ratio).tolist(),
+                version=self.filter_version)
+            data = self.raw_aug_cache.get(key)
+
+        if data is None:
+            if self.dpFRAG_verbose:
+                print('\tFiltering raw data with %s' % (ftype,)); t = time.time()
+            if state['rdata'] is None:
+                loadh5 = dpLoadh5.readData(srcfile=self.rawfile, dataset=self.raw_dataset, chunk=self.chunk.tolist(),
+                    offset=state['offset'].tolist(), size=state['size'].tolist(), verbose=self.dpLoadh5_verbose)
+                state['rdata'] = loadh5.data_cube
+            for x in state['inplace'][state['napplied']:]:
+                state['rdata'] = dpFRAG.filter_data(state['rdata'], x, self.sampling_ratio)
+            state['napplied'] = len(state['inplace']) + (ftype in self.inplace_filters)
+            data = dpFRAG.filter_data(state['rdata'], ftype, self.sampling_ratio)[fpad:-fpad,fpad:-fpad,fpad:-fpad]
+            if self.raw_aug_cache is not None: self.raw_aug_cache.put(key, data)
+            if self.dpFRAG_verbose:
+                print('\t\tdone in %.4f s' % (time.time() - t,))
+
+        if ftype in self.inplace_filters: state['inplace'].append(ftype)
+        return data
 
     def createFRAG(self, features=True, update=False):
         if self.dpFRAG_verbose:
             print('Creating FRAG'); ttime = time.time()
-            
+
+        # in moment update mode the features are only updated from the moments stored with the FRAG
+        if update and self.moment_update and hasattr(self,'FRAG') and self.FRAG is not None:
+            assert( self.nsupervox_merge == self.FRAG.number_of_nodes() )
+            if features: self.momentFeatures()
+            if self.dpFRAG_verbose:
+                print('\tdone in %.4f s' % (time.time() - ttime))
+            return
+
         #if self.dpFRAG_verbose:
         #    print('\tFind objects'); t = time.time()
         ## get bounding boxes for each supervoxel
@@ -498,11 +627,13 @@ class dpFRAG(emLabels):
         if self.dpFRAG_verbose:
             print('\tCalculating RAG and border voxels'); t = time.time()
         if hasattr(self, 'steps'):
-            list_of_edges, list_of_borders = frag_with_borders(self.supervoxels, self.nsupervox_merge, pad=False, 
-                steps=self.steps, min_step=self.min_step, max_step=self.max_step)
+            list_of_edges, border_voxel_index, edge_offsets = frag_with_borders(self.supervoxels,
+                self.nsupervox_merge, pad=False, steps=self.steps, min_step=self.min_step, max_step=self.max_step,
+                csr=True)
         else:            
-            list_of_edges, list_of_borders, self.steps, self.min_step, self.max_step = frag_with_borders(\
-                self.supervoxels, self.nsupervox_merge, pad=False, nbhd=self.neighbor_perim, conn=self.connectivity)
+            list_of_edges, border_voxel_index, edge_offsets, self.steps, self.min_step, self.max_step = \
+                frag_with_borders(self.supervoxels, self.nsupervox_merge, pad=False, nbhd=self.neighbor_perim,
+                    conn=self.connectivity, csr=True)
         if self.dpFRAG_verbose:
             print('\t\tdone in %.4f s' % (time.time() - t))
         nedges = list_of_edges.shape[0]; 
@@ -511,211 +642,259 @@ class dpFRAG(emLabels):
             assert( self.nsupervox_merge == self.FRAG.number_of_nodes() )
             
             ## HIASSERT, compare graphs
-            #G = nx.Graph(); G.add_nodes_from(range(1,self.nsupervox_merge+1)); G.add_edges_from(list_of_edges)
-            #assert( nx.difference(self.FRAG, G).number_of_edges() == 0 )
+            #assert( self.FRAG.number_of_edges() == nedges and (self.FRAG.edge_ids(list_of_edges) >= 0).all() )
         else:
             # initialize FRAG based on RAG computed in C-code
             # do not even include "do not merge" supervoxels as nodes in the FRAG at all
-            self.FRAG = nx.Graph(); self.FRAG.add_nodes_from(range(1,self.nsupervox_merge+1)); 
-            
-            # this is the first iteration, add the edges calculated from the C-code
-            self.FRAG.add_edges_from(list_of_edges)
+            self.FRAG = ArrayRAG(self.nsupervox_merge, self.features_names, edge_attrs=['ovlp_attrs','sovlp_attrs'],
+                nalloc=max([nedges,1]), node_moments=self.node_moments, edge_moments=self.edge_moments)
 
-            # do this init the first time incase features is turned off
-            for e in self.FRAG.edges_iter(data=True): e[2]['features'] = None
+            # this is the first iteration, add the edges calculated from the C-code.
+            # edges are stored in sorted order, which is the order of the datasets / targets.
+            self.FRAG.add_edges(list_of_edges); self.FRAG.sort()
 
             update = False  # this is first iteration, so acting like not update mode
 
+        # FRAG edge ids for the edges (and corresponding borders) from the C-code
+        list_of_eids = self.FRAG.edge_ids(list_of_edges)
+        FRAG_ovlp_attrs = self.FRAG.edge_attrs['ovlp_attrs']; FRAG_sovlp_attrs = self.FRAG.edge_attrs['sovlp_attrs']
+
         # only make RAG without features (like for agglomeration without fit)
         if not features: return
 
-        # other inits for the supervoxel iteration loop
-        mean_probs = [None]*self.nprob_types
-        mean_probs_aug = [[None]*self.nprob_types for x in range(self.naugments)]
-        mean_probs_static_aug = [None]*self.nstatic_augments
-        mean_grayscale_aug = [None]*self.naugments
-        mean_grayscale_static_aug = [None]*self.nstatic_augments
+        # decide which edges need features computed.
+        # if this is a FRAG update, then skip if all the edges coming out of either node have features.
+        # NOTE: if there are no neighbors left for this supervoxel, no need to compute supervoxel attributes.
+        # edges are visited in list_of_edges order and has_features is set as they are computed, so an edge with
+        #   features is only recomputed if both nodes have an edge without features that is visited after it.
+        eorder = np.arange(nedges)
+        if update:
+            has_features = self.FRAG.has_features; FRAG_edges = self.FRAG.edges
+            epos = np.empty((self.FRAG.number_of_edges(),), dtype=np.int64); epos.fill(nedges)
+            epos[list_of_eids] = eorder
+            last_missing = -np.ones((self.nsupervox_merge+1,), dtype=np.int64)
+            sel = np.logical_not(has_features)
+            np.maximum.at(last_missing, FRAG_edges[sel,0], epos[sel])
+            np.maximum.at(last_missing, FRAG_edges[sel,1], epos[sel])
+            compute_edges = np.logical_or(np.logical_not(has_features[list_of_eids]),
+                np.logical_and(last_missing[list_of_edges[:,0]] > eorder, last_missing[list_of_edges[:,1]] > eorder))
+        else:
+            compute_edges = np.ones((nedges,), dtype=bool)
+        compute_eids = list_of_eids[compute_edges]
 
+        # SIMPLEST FEATURES: sizes and mean features in the overlapping area between the neighbors.
+        # these are computed for all edges at once using segmented reductions over the border voxels.
         if self.dpFRAG_verbose:
-            print('\tCalculating features for each RAG edge'); t = time.time()
+            print('\tCalculating border voxel statistics'); t = time.time()
+        self.border_counts, self.border_stats = self.getBorderStats(border_voxel_index, edge_offsets,
+            self.border_channels())
+        if self.dpFRAG_verbose:
+            print('\t\tdone in %.4f s' % (time.time() - t))
 
-        # iterate over all the edges in the RAG and compute features
-        for e in range(nedges):
-            # the labels involved in this edge
-            i,j = list_of_edges[e,:]
-
-            # if this is a FRAG update, then skip if all the edges coming out of this node have features.
-            # NOTE: if there are no neighbors left for this supervoxel, no need to compute supervoxel attributes.
-            #   In this special case the supervoxel is skipped because all([]) evaluates to True.
-            if update:
-                if all([('features' in x) for x in self.FRAG[i].values()]) or \
-                        all([('features' in x) for x in self.FRAG[j].values()]): 
-                    continue
-                previ = self.prev_max_node + i; prevj = self.prev_max_node + j
-                loadovlp = 'ovlp_attrs' in self.FRAG[i][j]
-
-            # not recalculating sizes every time is big optimization, keep updated during agglo
-            svox_size = self.svox_sizes[i-1]
-            lsvox_size = self.voxel_size_xform(svox_size)
-            ljsvox_size = self.voxel_size_xform(self.svox_sizes[j-1])
-            
-            # get bounding box of the border voxels for this edge and add overlap perimeter
-            border_voxels = np.transpose(np.unravel_index(list_of_borders[e], self.supervoxels.shape))
-            bmin = border_voxels.min(axis=0); bmax = border_voxels.max(axis=0)+1
-            aobnd = tuple([slice(x-z, y+z) for x,y,z in zip(bmin,bmax,self.perim)])
+        # store the border statistics and supervoxel sizes as moments that are combined by agglomerate
+        if self.moment_update:
+            M = self.FRAG.edge_moments_index; moments = self.FRAG.edge_moments
+            moments[list_of_eids,M['count']] = self.border_counts
+            for name in self.border_stats.keys():
+                for x in ['sum','sumsq','min','max']:
+                    moments[list_of_eids,M[x + '_' + name]] = self.border_stats[name][x]
+            self.FRAG.node_moments[1:,self.FRAG.node_moments_index['size']] = self.svox_sizes[:self.nsupervox_merge]
+
+        F = self.features; features = self.FRAG.features
+        features[compute_eids,:] = 0
+        lsvox_sizes = self.voxel_size_xform(self.svox_sizes[list_of_edges[compute_edges,:].astype(np.int64)-1])
+        features[compute_eids,F['size_small']] = lsvox_sizes.min(axis=1)
+        features[compute_eids,F['size_large']] = lsvox_sizes.max(axis=1)
+        features[compute_eids,F['size_overlap']] = self.voxel_size_xform(self.border_counts[compute_edges])
+        for name in self.border_stats.keys():
+            features[compute_eids,F['mean_' + name]] = self.border_stats[name]['mean'][compute_edges]
+        self.FRAG.has_features[compute_eids] = True
+
+        # the remaining features all require the geometry of the overlap, skip the edge loop if there are none.
+        if all([x in self.border_features or x.startswith('mean_') for x in self.features_names]):
+            if self.dpFRAG_verbose:
+                print('\tdone in %.4f s' % (time.time() - ttime))
+            return
 
-            # get the supervoxels within the overlap bounding box.
-            ovlp_svox_cur = self.supervoxels[aobnd]
+        if self.dpFRAG_verbose:
+            print('\tCalculating features for each RAG edge'); t = time.time()
 
-            # create mask for overlap within the overlap bounding box
-            ovlp_cur = np.zeros(ovlp_svox_cur.shape,dtype=np.bool)
-            ovlp_cur.flat[np.ravel_multi_index((border_voxels - bmin + self.perim).T, ovlp_svox_cur.shape)] = 1
+        # iterate over all the edges in the RAG that need features and compute the remaining features.
+        # in parallel mode results come back in the same order as the edges so the FRAG is identical.
+        compute_inds = np.nonzero(compute_edges)[0]
+        tasks = [(list_of_edges[e,0], list_of_edges[e,1], border_voxel_index[edge_offsets[e]:edge_offsets[e+1]],
+            FRAG_sovlp_attrs.get(list_of_eids[e], None) if update else None,
+            update and list_of_eids[e] in FRAG_ovlp_attrs) for e in compute_inds]
+        if self.nworkers > 1 and len(tasks) > 1:
+            results = self.parallelEdgeFeatures(tasks)
+        else:
+            results = self.edgeFeaturesBlock(tasks)
 
-            # SIMPLEST FEATURES: calculate mean features in the overlapping area between the neighbors.
+        for e,(fvals, ovlp_attrs, sovlp_attrs) in zip(compute_inds, results):
+            fe = list_of_eids[e]; f = features[fe]
+            for k,v in fvals.items(): f[F[k]] = v
+            FRAG_ovlp_attrs[fe] = ovlp_attrs; FRAG_sovlp_attrs[fe] = sovlp_attrs
 
-            # optionally further dilate the overlap in order to increase averaging area for boundaries.
-            if self.ovlp_dilate > 0:
-                ovlp_cur_dilate = nd.morphology.binary_dilation(ovlp_cur, structure=self.bwconn,
-                                                                iterations=self.ovlp_dilate)
-            else:
-                ovlp_cur_dilate = ovlp_cur
-
-            for k in range(self.nprob_types):
-                mean_probs[k] = self.probs[k][aobnd][ovlp_cur_dilate].mean(dtype=np.double)
-            mean_grayscale = self.raw[aobnd][ovlp_cur_dilate].mean(dtype=np.double)
-
-            # augmented raw data and probability mean boundary features
-            for k in range(self.naugments):
-                mean_grayscale_aug[k] = self.raw_aug[k][aobnd][ovlp_cur_dilate].mean(dtype=np.double)
-                for x in range(self.nprob_types):
-                    mean_probs_aug[k][x] = \
-                        self.probs_aug[k][x][aobnd][ovlp_cur_dilate].mean(dtype=np.double)
-
-            # static augmented raw data and probability mean boundary features
-            for k in range(self.nstatic_augments):
-                if self.static_augments[k][0] == '_':
-                    mean_grayscale_static_aug[k] = \
-                        self.raw_static_aug[k][aobnd][ovlp_cur_dilate].mean(dtype=np.double)
-                else:
-                    mean_probs_static_aug[k] = \
-                        self.probs_static_aug[k][aobnd][ovlp_cur_dilate].mean(dtype=np.double)
-
-            # MORE COMPLEX FEATURES: object attributes within the overlap bounding box.
-            # xxx - missing some optimization here not doing ovlp pca for reduced set... punting
-            mo = self.getOvlpAttrs(ovlp_cur, self.sampling, return_Cpts=True)
-
-            if 'labeled_ovlp' in self.features_names:
-                # percentage of voxels in the overlap area that are labeled (not background).
-                labeled_ovlp = (ovlp_svox_cur[ovlp_cur] > 0).sum(dtype=np.double)/mo['sel_size']
-
-            if 'rad_std_ovlp' in self.features_names:
-                # radial standard deviation of the overlap from the centroid
-                rad_std_ovlp = np.std(nla.norm(mo['Cpts'], axis=1))
-            if 'ang_std_ovlp' in self.features_names:
-                # angular standard deviation of the overlap from the first principle component
-                ang_std_ovlp = np.std(np.arctan2(nla.norm(np.cross(mo['Cpts'],mo['V'][0,:]),axis=1),
-                    np.dot(mo['Cpts'],mo['V'][0,:])))
-            mo['Cpts'] = None  # no need for this potentially large item to persist
-
-            if 'conv_overlap' in self.features_names:
-                # simple "convexity" measure, compare size of overlap with that of overlap bounding box
-                conv_overlap = mo['sel_size']/(bmin-bmax).prod(dtype=np.double)
-                #assert(conv_overlap <= 1)     # silly sanity check, HIASSERT
-
-            # save the variables in ovlp_attrs to edge attributes
-            d = locals(); m = {}
-            for k in self.ovlp_attrs:
-                if k in d: m[k] = d[k]
-            # concatenate sovlp_attrs and ovlp_attrs for the overlap
-            self.FRAG[i][j]['ovlp_attrs'] = {**m, **mo}
-
-            # more complicated optimization. if the overlap is preserved then calculations on one of the
-            #   supervoxels might also be preserved if it was not agglomerated in the previous iteration.
-            loadi = False; loadj = False
-            if update and 'sovlp_attrs' in self.FRAG[i][j]:
-                # avoid second pass to renumber nodes in agglomerate because of relabel
-                loadi = previ in self.FRAG[i][j]['sovlp_attrs']; loadj = prevj in self.FRAG[i][j]['sovlp_attrs']
-                assert( not loadi or not loadj )     # both sovlp_attrs should not happen
-                assert( (not loadi and not loadj) or loadovlp )     # sovlp_attrs without ovlp_attrs
-            else:
-                self.FRAG[i][j]['sovlp_attrs'] = {}
-            if loadi:
-                mi = self.FRAG[i][j]['sovlp_attrs'][previ]
-                self.FRAG[i][j]['sovlp_attrs'] = {i:mi}     # move to current supervoxel value
-            else:
-                mi = self.getOvlpAttrs(ovlp_svox_cur == i, self.sampling, Vother=mo['V'])
-                self.FRAG[i][j]['sovlp_attrs'][i] = mi
-            if loadj:
-                mj = self.FRAG[i][j]['sovlp_attrs'][prevj]
-                self.FRAG[i][j]['sovlp_attrs'] = {j:mj}     # move to current supervoxel value
-            else:
-                mj = self.getOvlpAttrs(ovlp_svox_cur == j, self.sampling, Vother=mo['V'])
-                self.FRAG[i][j]['sovlp_attrs'][j] = mj
+        if self.dpFRAG_verbose:
+            print('\t\tdone in %.4f s' % (time.time() - t))
+            print('\tdone in %.4f s' % (time.time() - ttime))
 
-            # calculate angles between corresponding supervoxel eigenvectors within overlap box
-            angles_ij = np.zeros((self.npcaang,),np.double)
+    # compute edgeFeatures for a block of edges, the overlap attributes are computed for the whole block at once.
+    def edgeFeaturesBlock(self, tasks):
+        if len(tasks) == 0: return []
+        ovlps = self.getOvlpAttrs(np.array([x[:2] for x in tasks]), [x[2] for x in tasks], [x[3] for x in tasks])
+        return [self.edgeFeatures(*x, ovlp=y) for x,y in zip(tasks, ovlps)]
+
+    # features for a single edge that need the geometry of the overlap, everything except the border features.
+    # sovlp are the supervoxel overlap attributes saved for this edge in update mode (None for no saved attributes).
+    # ovlp are the overlap attributes from getOvlpAttrs for this edge (computed for this edge only if None).
+    # returns the features by name along with the overlap and supervoxel overlap attributes for the edge.
+    def edgeFeatures(self, i, j, border_inds, sovlp=None, loadovlp=False, ovlp=None):
+        # not recalculating sizes every time is big optimization, keep updated during agglo
+        svox_size = self.svox_sizes[i-1]
+        lsvox_size = self.voxel_size_xform(svox_size)
+        ljsvox_size = self.voxel_size_xform(self.svox_sizes[j-1])
+        
+        # get bounding box of the border voxels for this edge and add overlap perimeter
+        border_voxels = np.transpose(np.unravel_index(border_inds, self.supervoxels.shape))
+        bmin = border_voxels.min(axis=0); bmax = border_voxels.max(axis=0)+1
+        aobnd = tuple([slice(x-z, y+z) for x,y,z in zip(bmin,bmax,self.perim)])
+
+        # MORE COMPLEX FEATURES: object attributes within the overlap bounding box.
+        if ovlp is None: ovlp = self.getOvlpAttrs(np.array([[i,j]]), [border_inds], [sovlp])[0]
+        mo, mi, mj = ovlp
+
+        if 'labeled_ovlp' in self.features_names:
+            # percentage of voxels in the overlap area that are labeled (not background).
+            labeled_ovlp = (self.supervoxels.flat[border_inds] > 0).sum(dtype=np.double)/mo['sel_size']
+
+        if 'rad_std_ovlp' in self.features_names or 'ang_std_ovlp' in self.features_names:
+            # overlap points centered around the overlap centroid
+            mo['Cpts'] = (border_voxels - bmin + self.perim)*self.sampling - mo['C']
+        if 'rad_std_ovlp' in self.features_names:
+            # radial standard deviation of the overlap from the centroid
+            rad_std_ovlp = np.std(nla.norm(mo['Cpts'], axis=1))
+        if 'ang_std_ovlp' in self.features_names:
+            # angular standard deviation of the overlap from the first principle component
+            ang_std_ovlp = np.std(np.arctan2(nla.norm(np.cross(mo['Cpts'],mo['V'][0,:]),axis=1),
+                np.dot(mo['Cpts'],mo['V'][0,:])))
+        mo['Cpts'] = None  # no need for this potentially large item to persist
+
+        if 'conv_overlap' in self.features_names:
+            # simple "convexity" measure, compare size of overlap with that of overlap bounding box
+            conv_overlap = mo['sel_size']/(bmin-bmax).prod(dtype=np.double)
+            #assert(conv_overlap <= 1)     # silly sanity check, HIASSERT
+
+        # save the variables in ovlp_attrs to edge attributes
+        d = locals(); m = {}
+        for k in self.ovlp_attrs:
+            if k in d: m[k] = d[k]
+        # concatenate sovlp_attrs and ovlp_attrs for the overlap
+        ovlp_attrs = {**m, **mo}
+
+        # more complicated optimization. if the overlap is preserved then calculations on one of the
+        #   supervoxels might also be preserved if it was not agglomerated in the previous iteration.
+        # sovlp_attrs are only kept by agglomerate for supervoxels that did not change (current labels).
+        loadi = False; loadj = False
+        if sovlp is not None:
+            loadi = i in sovlp; loadj = j in sovlp
+            assert( not loadi or not loadj )     # both sovlp_attrs should not happen
+            assert( (not loadi and not loadj) or loadovlp )     # sovlp_attrs without ovlp_attrs
+        if loadi: mi = sovlp[i]
+        if loadj: mj = sovlp[j]
+        sovlp_attrs = {i:mi, j:mj}
+
+        # calculate angles between corresponding supervoxel eigenvectors within overlap box
+        angles_ij = np.zeros((self.npcaang,),np.double)
+        for k in range(self.npcaang):
+            angles_ij[k] = np.arctan2(nla.norm(np.cross(mi['V'][k,:],mj['V'][k,:])),
+                np.dot(mi['V'][k,:],mj['V'][k,:]))
+
+        # make ang_cntr and dist_cntr_* tied together in feature sets (all or none)
+        if 'ang_cntr' in self.features_names:
+            # angle / distance of vectors from overlap centroid to object centroids
+            Vi = mi['C'] - mo['C']; Vj = mj['C'] - mo['C']
+            # https://newtonexcelbach.wordpress.com/2014/03/01/the-angle-between-two-vectors-python-version/
+            m['ang_cntr'] = np.arctan2(nla.norm(np.cross(Vi,Vj)), np.dot(Vi,Vj))
+            m['dist_cntr_i'] = nla.norm(Vi); m['dist_cntr_j'] = nla.norm(Vj)
+
+        # xxx - this feature is expensive and seemed marginally useful at best.
+        ### total number of other labels in the overlap area
+        ##otherlbls = np.unique(ovlp_svox_cur[m['ovlp_cur']])
+        ### do not count background or the labels currently involved in this edge
+        ##otherlbls = otherlbls[np.logical_and(np.logical_and(otherlbls != i, otherlbls != j),otherlbls != 0)]
+
+        # the remaining features for this edge
+        f = OrderedDict()
+        for k in self.features_names:
+            if k in m: f[k] = m[k]
+
+        if lsvox_size < ljsvox_size:
+            if 'size_ovlp_small' in self.features_names:
+                f['size_ovlp_small'], f['size_ovlp_large'] = mi['lsel_size'], mj['lsel_size']
+            if 'ang_cntr' in self.features_names:
+                f['dist_cntr_small'], f['dist_cntr_large'] = m['dist_cntr_i'], m['dist_cntr_j']
             for k in range(self.npcaang):
-                angles_ij[k] = np.arctan2(nla.norm(np.cross(mi['V'][k,:],mj['V'][k,:])),
-                    np.dot(mi['V'][k,:],mj['V'][k,:]))
-
-            # make ang_cntr and dist_cntr_* tied together in feature sets (all or none)
+                f['pca_angle_small' + str(k)] = mi['angles'][k]
+                f['pca_angle_large' + str(k)] = mj['angles'][k]
+        else:
+            if 'size_ovlp_small' in self.features_names:
+                f['size_ovlp_small'], f['size_ovlp_large'] = mj['lsel_size'], mi['lsel_size']
             if 'ang_cntr' in self.features_names:
-                # angle / distance of vectors from overlap centroid to object centroids
-                Vi = mi['C'] - mo['C']; Vj = mj['C'] - mo['C']
-                # https://newtonexcelbach.wordpress.com/2014/03/01/the-angle-between-two-vectors-python-version/
-                m['ang_cntr'] = np.arctan2(nla.norm(np.cross(Vi,Vj)), np.dot(Vi,Vj))
-                m['dist_cntr_i'] = nla.norm(Vi); m['dist_cntr_j'] = nla.norm(Vj)
-
-            # xxx - this feature is expensive and seemed marginally useful at best.
-            ### total number of other labels in the overlap area
-            ##otherlbls = np.unique(ovlp_svox_cur[m['ovlp_cur']])
-            ### do not count background or the labels currently involved in this edge
-            ##otherlbls = otherlbls[np.logical_and(np.logical_and(otherlbls != i, otherlbls != j),otherlbls != 0)]
-
-            # set all the features for this edge
-            F = self.features
-            f = { F['size_overlap']:mo['lsel_size'] }
-            for k in self.features_names:
-                if k in m: f[F[k]] = m[k]
-
-            if lsvox_size < ljsvox_size:
-                f[F['size_small']], f[F['size_large']] = lsvox_size, ljsvox_size
-                if 'size_ovlp_small' in self.features_names:
-                    f[F['size_ovlp_small']], f[F['size_ovlp_large']] = mi['lsel_size'], mj['lsel_size']
-                if 'ang_cntr' in self.features_names:
-                    f[F['dist_cntr_small']], f[F['dist_cntr_large']] = m['dist_cntr_i'], m['dist_cntr_j']
-                for k in range(self.npcaang):
-                    f[F['pca_angle_small' + str(k)]] = mi['angles'][k]
-                    f[F['pca_angle_large' + str(k)]] = mj['angles'][k]
-            else:
-                f[F['size_small']], f[F['size_large']] = ljsvox_size, lsvox_size
-                if 'size_ovlp_small' in self.features_names:
-                    f[F['size_ovlp_small']], f[F['size_ovlp_large']] = mj['lsel_size'], mi['lsel_size']
-                if 'ang_cntr' in self.features_names:
-                    f[F['dist_cntr_small']], f[F['dist_cntr_large']] = m['dist_cntr_j'], m['dist_cntr_i']
-                for k in range(self.npcaang):
-                    f[F['pca_angle_small' + str(k)]] = mj['angles'][k]
-                    f[F['pca_angle_large' + str(k)]] = mi['angles'][k]
-                
+                f['dist_cntr_small'], f['dist_cntr_large'] = m['dist_cntr_j'], m['dist_cntr_i']
             for k in range(self.npcaang):
-                f[F['pca_angle' + str(k)]] = angles_ij[k]
-            for k in range(self.nprob_types):
-                f[F['mean_prob_' + self.prob_types[k]]] = m['mean_probs'][k]
-            for k in range(self.naugments):
-                f[F['mean_grayscale' + self.augments[k]]] = m['mean_grayscale_aug'][k]
-                for x in range(self.nprob_types):
-                    f[F['mean_prob_' + self.prob_types[x] + self.augments[k]]] = m['mean_probs_aug'][k][x]
-            for k in range(self.nstatic_augments):
-                if self.static_augments[k][0] == '_':
-                    f[F['mean_grayscale' + self.static_augments[k]]] = m['mean_grayscale_static_aug'][k]
-                else:
-                    f[F['mean_prob_' + self.static_augments[k]]] = m['mean_probs_static_aug'][k]
-
-            self.FRAG[i][j]['features'] = f
+                f['pca_angle_small' + str(k)] = mj['angles'][k]
+                f['pca_angle_large' + str(k)] = mi['angles'][k]
+            
+        for k in range(self.npcaang):
+            f['pca_angle' + str(k)] = angles_ij[k]
+
+        return f, ovlp_attrs, sovlp_attrs
+
+    # compute edgeFeatures for a list of argument tuples using a process pool.
+    # the supervoxels are put into shared memory and the workers get a copy of the frag without any of the volumes.
+    def parallelEdgeFeatures(self, tasks):
+        shape = self.supervoxels.shape; dtype = self.supervoxels.dtype
+        supervoxels = multiprocessing.RawArray(np.ctypeslib.as_ctypes_type(dtype), self.supervoxels.size)
+        np.frombuffer(supervoxels, dtype=dtype).reshape(shape)[:] = self.supervoxels
+
+        frag = object.__new__(type(self))
+        for k in self.edge_worker_attrs: setattr(frag, k, getattr(self, k))
+
+        # contiguous blocks of edges, several per worker for load balancing
+        bounds = np.linspace(0, len(tasks), min([len(tasks), 4*self.nworkers])+1).astype(np.int64)
+        blocks = [tasks[x:y] for x,y in zip(bounds[:-1], bounds[1:])]
+        with multiprocessing.Pool(self.nworkers, initializer=_init_edge_worker,
+                initargs=(frag, supervoxels, shape, dtype)) as pool:
+            results = pool.map(_edge_worker, blocks, chunksize=1)
+        return [x for y in results for x in y]
+
+    # update the border features for the edges without features from the moments stored in the FRAG.
+    # after agglomeration the moments for the border of each agglomerated edge are the sums of the moments of the
+    #   contracted edges. this is approximate because voxels that border more than one of the contracted supervoxels
+    #   are counted for each of them.
+    def momentFeatures(self):
+        if self.dpFRAG_verbose:
+            print('\tCalculating features from moments'); t = time.time()
+        sel = np.logical_not(self.FRAG.has_features)
+        self.FRAG.features[sel,:] = self.momentFeatureMatrix(self.FRAG.edge_moments[sel,:],
+            self.FRAG.node_moments[self.FRAG.edges[sel,:], self.FRAG.node_moments_index['size']])
+        self.FRAG.has_features[sel] = True
 
         if self.dpFRAG_verbose:
             print('\t\tdone in %.4f s' % (time.time() - t))
-            print('\tdone in %.4f s' % (time.time() - ttime))
+
+    # the border features from edge moments and the sizes of the two supervoxels for each edge (nedges x 2).
+    def momentFeatureMatrix(self, moments, sizes):
+        F = self.features; M = self.FRAG.edge_moments_index; counts = moments[:,M['count']]
+        features = np.zeros((moments.shape[0], len(self.features_names)), dtype=np.double)
+        lsvox_sizes = self.voxel_size_xform(sizes)
+        features[:,F['size_small']] = lsvox_sizes.min(axis=1)
+        features[:,F['size_large']] = lsvox_sizes.max(axis=1)
+        features[:,F['size_overlap']] = self.voxel_size_xform(counts)
+        for name in self.border_channel_names:
+            features[:,F['mean_' + name]] = moments[:,M['sum_' + name]]/counts
+        return features
 
     def createDataset(self, train=True):
         if train:
@@ -758,16 +937,11 @@ class dpFRAG(emLabels):
         if self.dpFRAG_verbose:
             print('Creating training set from %d edges' % ntargets); t = time.time()
 
-        # iterate the network edges and create a scikit-learn style training set
-        for e,i in zip(self.FRAG.edges_iter(data=True),range(ntargets)):
-            if train:
-                #if supervox_to_gt[e[0]-1] == supervox_to_gt[e[1]-1]:
-                #    target[i] = self.TARGETS['yes_merge']
-                #else:
-                #    target[i] = self.TARGETS['no_merge']
-                target[i] = (supervox_to_gt[e[0]-1] == supervox_to_gt[e[1]-1])
-            if e[2]['features'] is not None:
-                fdata[i,:] = np.array([e[2]['features'][x] for x in range(self.nfeatures)], dtype=np.double)
+        # create a scikit-learn style training set from the FRAG edges (in sorted order) and the feature matrix
+        edges = self.FRAG.edges
+        if train:
+            target[:] = (supervox_to_gt[edges[:,0]-1] == supervox_to_gt[edges[:,1]-1])
+        sel = self.FRAG.has_features; fdata[sel,:] = self.FRAG.features[sel,:]
 
         #dict_keys(['feature_names', 'DESCR', 'target_names', 'target', 'data'])
         descr = 'Training data from dpFRAG.py with command line:\n' + self.arg_str
@@ -790,82 +964,17 @@ class dpFRAG(emLabels):
         if self.dpFRAG_verbose:
             print('Doing single agglomeration from supplied targets'); t = time.time()
 
-        # single agglomerate with binary targets
-        #self._incremental_agglomerate(target)
-
-        # create agglomerated graph that only contains yes merge edges
-        aggloG = nx.Graph(); aggloG.add_nodes_from(range(1,self.nsupervox_merge+1))
-        for e,i in zip(self.FRAG.edges_iter(),range(ntargets)):
-            if target[i] and not aggloG.has_edge(e[0],e[1]): aggloG.add_edge(e[0],e[1])
-
-        # get connected component nodes, create supervoxel mapping and update FRAG based on agglomerated components
+        # get connected components of yes merge edges, create supervoxel mapping and update FRAG based on components
         supervox_map = np.zeros((self.nsupervox+1,),dtype=self.lbl_dtype)
-        compsG = nx.connected_components(aggloG); ncomps = 0
+        ncomps, comps = self.FRAG.components(target.astype(bool))
+        supervox_map[:self.nsupervox_merge+1] = comps
         svox_sizes = np.zeros((self.nsupervox,),dtype=np.int64)
-        
-        # this is used for re-creating the graph after agglo without creating a new graph.
-        # appends nodes that are beyond current last node. typcially this was nsupervox, but added the "do not merge"
-        #   mode for which these supervoxels are not added to the graph at all.
-        # this property indicates the last max node of the graph (also used in optimization).
-        self.prev_max_node = self.nsupervox_merge
-        
-        for nodes in compsG:
-            # SINGLETON NODE: single supervoxel that is not undergoing any merging (agglomeration)
-
-            # supervoxel mapping from previous to new agglomerated supervoxels, update supervoxel sizes
-            npnodes = np.array(tuple(nodes),dtype=np.int64); svox_sizes[ncomps] = self.svox_sizes[npnodes-1].sum()
-            ncomps += 1; supervox_map[npnodes] = ncomps
-
-            # update the FRAG by creating a new agglomerated node and moving neighboring edges to this node.
-            # make a new singleton node for if this node is not containing any agglomerations.
-            newnode = ncomps+self.prev_max_node; self.FRAG.add_node(newnode)
-
-            if len(nodes) == 1:
-                # SINGLETON COMPONENT NODE: single supervoxel that is not being merged with anything.
-                # this is the only time that features may be copied over from old FRAG.
-                # i.e., this supervoxel did not change.
-                node = next(iter(nodes))    # the singleton node in old FRAG
+        svox_sizes[:ncomps] = np.bincount(comps[1:], weights=self.svox_sizes[:self.nsupervox_merge],
+            minlength=ncomps+1)[1:]
 
-                # if this is a singleton node (not agglomerated) then re-add the node attributes.
-                # this saves time in recalculating them in createFRAG as this supervoxel itself has not changed.
-                # NOTE: if there are no neighbors left for this supervoxel, no need to compute supervoxel attributes.
-                #   In this special case the supervoxel is skipped in the createFRAG loop.
-                #   So no need to save the supervoxel attributes in the node.
-                #if len(self.FRAG[node]) > 0: self.FRAG.node[newnode]['svox_attrs'] = self.FRAG.node[node]['svox_attrs']
-
-                self._noagglo_iterate_neighbors(self.FRAG, node, newnode, copy_attrs=True)
-
-            else:
-                # MUTIPLE COMPONENT NODE: group of supervoxels being merged (agglomerated)
-
-                # copy over overlap attributes for neighbors that border on only one of the nodes in the agglomerate.
-                # in this case the overlap area has not changed. need two passes to check for this.
-                neighbors = {}
-
-                # each node in connected component (that compose the agglomerated newnode)
-                for node in nodes:
-                    self._agglo_iterate_neighbors(self.FRAG, node, nodes, neighbors, newnode)
-
-                for node in nodes:
-                    # for each neighbor of this node (edge in FRAG)
-                    for neighbor,f in self.FRAG[node].items():
-                        # copy over overlap attributes for neighbors that border on only one of agglomerated nodes.
-                        if neighbor not in nodes and neighbors[neighbor] == 1:
-                            if 'ovlp_attrs' in f:
-                                self.FRAG[neighbor][newnode]['ovlp_attrs'] = f['ovlp_attrs']
-                            # copy the neighbor supervoxel overlap attributes over.
-                            # they might be preservable in this case if the neighbor is a singleton node.
-                            if 'sovlp_attrs' in f and neighbor in f['sovlp_attrs']:
-                                self.FRAG[neighbor][newnode]['sovlp_attrs'] = {neighbor: f['sovlp_attrs'][neighbor]}
-                                #assert( 'ovlp_attrs' in f ) # should not have sovlp_attrs without ovlp_attrs, HIASSERT
-                    # after visiting, remove this old node that makes up part of the agglomerated node.
-                    self.FRAG.remove_node(node)
-
-        # sanity checks
-        assert( ncomps == self.FRAG.number_of_nodes() )
-        #assert( self.prev_max_node+ncomps == max(self.FRAG.nodes()) )  # commented for speed, HIASSERT
-        # relabel the FRAG starting at supervoxel 1
-        self.FRAG = nx.relabel_nodes(self.FRAG, {x+self.prev_max_node:x for x in range(1,ncomps+1)}, copy=False)
+        # update the FRAG by contracting the agglomerated supervoxels, keep features and attributes
+        #   for anything that did not change with the agglomeration.
+        self._contract_FRAG(comps, ncomps)
 
         # xxx - this block is identical in threshold_agglomerate()
         if self.nsupervox_nomerge > 0:
@@ -896,56 +1005,35 @@ class dpFRAG(emLabels):
             print('\tnsupervox',self.data_attrs['types_nlabels'][0])
             print('\tdone in %.4f s' % (time.time() - t, ))
 
-    # "macro" for iterating neighbors for singleton nodes (not being agglomerated) in FRAG
-    def _noagglo_iterate_neighbors(self, cRAG, node, newnode, copy_attrs=False):
-        # for each neighbor of this node (edge in FRAG)
-        for neighbor,f in cRAG[node].items():
-            #assert( not cRAG.has_edge(neighbor, newnode) )     # sanity check for singleton node, HIASSERT
-            cRAG.add_edge(neighbor, newnode)   # move this edge to newnode
-
-            # copying features and attributes only happens for FRAG
-            if copy_attrs:
-                # both new nodes must be singleton components to not require any feature updates.
-                # edges not requiring feature updates are marked by having features copied over from previous FRAG.
-                # only copy the features if the other node was already visited and was also singleton (has features)
-                #   or if the other node was not visited yet (neighbor node <= previous max node (nsupervox_merge)).
-                if neighbor <= self.prev_max_node or 'features' in f:
-                    features_copied = True
-                    cRAG[neighbor][newnode]['features'] = f['features']
-                else:
-                    features_copied = False
-
-                # copy over overlap attributes but only if features are not copied over to final new edge.
-                if neighbor <= self.prev_max_node or not features_copied:
-                    # if the overlap attributes are present, then copy them over to the new edge.
-                    if 'ovlp_attrs' in f:
-                        cRAG[neighbor][newnode]['ovlp_attrs'] = f['ovlp_attrs']
-                    # copy the supervoxel overlap attributes over for this singleton node
-                    if 'sovlp_attrs' in f and node in f['sovlp_attrs']:
-                        cRAG[neighbor][newnode]['sovlp_attrs'] = {newnode: f['sovlp_attrs'][node]}
-                        #assert( 'ovlp_attrs' in f )     # should not have sovlp_attrs without ovlp_attrs, HIASSERT
-
-        # remove the old singleton node
-        cRAG.remove_node(node)
-
-    # "macro" for iterating neighbors for compound nodes (those being agglomerated) in FRAG
-    def _agglo_iterate_neighbors(self, cRAG, node, nodes, neighbors, newnode, remove=False):
-        # for each neighbor of this node (edge in cRAG)
-        for neighbor in cRAG[node].keys():
-            # skip neighbors that are other nodes of this component.
-            if neighbor not in nodes:
-                # move this edge to newnode
-                if not cRAG.has_edge(neighbor, newnode): cRAG.add_edge(neighbor, newnode)
-                # add or increment neighbor count
-                if neighbor not in neighbors:
-                    neighbors[neighbor] = 1
-                else:
-                    neighbors[neighbor] += 1
-        if remove: cRAG.remove_node(node)
+    # contract the FRAG with nodes mapped to agglomerated components.
+    # features are kept for edges between supervoxels that are not being agglomerated (singletons),
+    #   so that createFRAG in update mode only calculates features for edges that changed.
+    # overlap attributes are kept for other edges where the overlap area has not changed, which is if there was only
+    #   a single edge between the supervoxels making up the agglomerated nodes.
+    # supervoxel overlap attributes are kept along with the overlap attributes only for singleton supervoxels.
+    def _contract_FRAG(self, comps, ncomps):
+        FRAG, inverse = self.FRAG.contract(comps, ncomps)
+        counts = np.bincount(inverse[inverse >= 0], minlength=FRAG.number_of_edges())
+        singleton = (np.bincount(comps, minlength=ncomps+1) == 1)
+
+        ovlp_attrs = self.FRAG.edge_attrs['ovlp_attrs']; sovlp_attrs = self.FRAG.edge_attrs['sovlp_attrs']
+        for e in set(ovlp_attrs.keys()) | set(sovlp_attrs.keys()):
+            ne = inverse[e]
+            if ne < 0: continue
+            i,j = comps[self.FRAG.edges[e,:]]
+            # features are copied for edges between singletons, so overlap attributes are not needed.
+            if (singleton[i] and singleton[j]) or counts[ne] != 1: continue
+            if e in ovlp_attrs: FRAG.edge_attrs['ovlp_attrs'][ne] = ovlp_attrs[e]
+            if e in sovlp_attrs:
+                m = { int(comps[x]):y for x,y in sovlp_attrs[e].items() if singleton[comps[x]] }
+                if len(m) > 0: FRAG.edge_attrs['sovlp_attrs'][ne] = m
+        self.FRAG = FRAG
 
     # multiple probability thresholded agglomerate.
     # this method does NOT update the FRAG based on the target agglomeration.
-    def threshold_agglomerate(self, probs, thresholds, threshold_subgroups=None):
+    # in table mode the supervoxels are written once and each threshold is only written as an "agglomeration table",
+    #   the lookup table from the supervoxels to the agglomerated labels (as labels delta, see emLabels.readLabels).
+    def threshold_agglomerate(self, probs, thresholds, threshold_subgroups=None, table=False):
         ntargets = probs.shape[0]; nthresholds = len(thresholds)
         assert( ntargets == self.FRAG.number_of_edges() ); # agglomerate input data must match FRAG edges
         if threshold_subgroups is None:
@@ -959,27 +1047,84 @@ class dpFRAG(emLabels):
             print('Threshold agglomeration for thresholds %s' % (' '.join([str(x) for x in thresholds]),))
             t = time.time()
 
-        # create empty agglomerated graph
-        aggloG = nx.Graph(); aggloG.add_nodes_from(range(1,self.nsupervox_merge+1))
-
         # do incremental agglomerate with decreasing thresholds, store each one into output hdf5
         thresholds = np.sort(thresholds)[::-1]; threshold_subgroups = np.sort(threshold_subgroups)[::-1]
-        for i in range(nthresholds):
-            self.subgroups_out[-1] = '%.8f' % threshold_subgroups[i]
 
-            #self._incremental_agglomerate(probs[:,1] > thresholds[i], aggloG)
+        # thresholds are decreasing so components of edges over current threshold include all previous merges.
+        # edges are sorted by merge probability once and merged incrementally into union-find for each threshold.
+        self._write_components(self.FRAG.threshold_components(probs[:,1], thresholds), threshold_subgroups, table)
+
+        if self.dpFRAG_verbose:
+            print('\n\tdone in %.4f s' % (time.time() - t))
+
+        self.dpWriteh5_verbose = verbose
+
+    # hierarchical agglomeration of the FRAG with a priority queue (see HierarchicalAgglo), requires moment_update.
+    # the edge with the highest score is merged next and only the edges of the merged supervoxels are rescored from
+    #   their moments, which are updated incrementally. the supervoxels for each threshold are written the same as
+    #   threshold_agglomerate, the merge tree is kept in self.hagglo for extracting other thresholds.
+    # without clf the score is one minus the mean membrane probability over the border (mean_boundary).
+    # with clf the score is the classifier merge probability of the border features calculated from the moments.
+    #   the features are normalized with the mean / std of the features of the initial edges, or with the scaler
+    #   (mean, std) that the classifier was trained with.
+    # this method does NOT update the FRAG based on the agglomeration.
+    def hierarchical_agglomerate(self, thresholds, threshold_subgroups=None, clf=None, table=False, scaler=None):
+        assert( self.moment_update )    # merged edge statistics are updated from the moments
+        nthresholds = len(thresholds)
+        if threshold_subgroups is None:
+            threshold_subgroups = thresholds
+        else:
+            assert( nthresholds == len(threshold_subgroups) )   # output subgroups must match length of actual thrs
 
-            target = probs[:,1] > thresholds[i]
-            # add edges in target if not already present in aggloG
-            for e,j in zip(self.FRAG.edges_iter(),range(ntargets)):
-                if target[j] and not aggloG.has_edge(e[0],e[1]): aggloG.add_edge(e[0],e[1])
+        verbose = self.dpWriteh5_verbose; self.dpWriteh5_verbose = False;
+
+        if self.dpFRAG_verbose:
+            print('Hierarchical agglomeration (%s) for thresholds %s' % ('mean_boundary' if clf is None else
+                'classifier', ' '.join([str(x) for x in thresholds]))); t = time.time()
+
+        S = self.FRAG.node_moments_index['size']
+        if clf is None:
+            assert( 'prob_MEM' in self.border_channel_names )   # need membrane probabilities on the borders
+            M = self.FRAG.edge_moments_index
+            score = lambda edges, moments, node_moments: 1 - moments[:,M['sum_prob_MEM']]/moments[:,M['count']]
+        else:
+            if scaler is None:
+                # same normalization as sklearn scale() but fixed to the initial edges
+                data = self.momentFeatureMatrix(self.FRAG.edge_moments, self.FRAG.node_moments[self.FRAG.edges,S])
+                mu = data.mean(axis=0); sd = data.std(axis=0); sd[sd == 0] = 1
+            else:
+                mu, sd = scaler
+            score = lambda edges, moments, node_moments: clf.predict_proba((self.momentFeatureMatrix(moments,
+                node_moments[edges,S]) - mu)/sd)[:,1]
+
+        self.hagglo = HierarchicalAgglo(self.FRAG, score, verbose=self.dpFRAG_verbose)
+        self.hagglo.agglomerate(min_score=min(thresholds))
+
+        thresholds = np.sort(thresholds)[::-1]; threshold_subgroups = np.sort(threshold_subgroups)[::-1]
+        self._write_components([self.hagglo.components(x) for x in thresholds], threshold_subgroups, table)
+
+        if self.dpFRAG_verbose:
+            print('\n\tdone in %.4f s' % (time.time() - t))
+
+        self.dpWriteh5_verbose = verbose
+
+    # write the supervoxels agglomerated into the components for each threshold subgroup.
+    # components is a list of the number of components and the component for each FRAG node (ArrayRAG.components).
+    def _write_components(self, components, threshold_subgroups, table=False):
+        if table:
+            # write the supervoxels that the agglomeration tables are applied to
+            self.subgroups_out[-1] = 'supervoxels'
+            self.data_cube = self.supervoxels_noperim; self.data_attrs['types_nlabels'] = [self.nsupervox]
+            self.writeCube(); base = list(self.subgroups_out)
+            outfile = self.outfile if self.outfile else self.srcfile
+
+        for i in range(len(components)):
+            self.subgroups_out[-1] = '%.8f' % threshold_subgroups[i]
 
             # get connected component nodes and create supervoxel mapping based on agglomerated components
             supervox_map = np.zeros((self.nsupervox+1,),dtype=self.lbl_dtype)
-            compsG = nx.connected_components(aggloG); ncomps = 0
-            for nodes in compsG:
-                # supervoxel mapping from previous to new agglomerated supervoxels
-                ncomps += 1; supervox_map[np.array(tuple(nodes),dtype=np.int64)] = ncomps
+            ncomps, comps = components[i]
+            supervox_map[:self.nsupervox_merge+1] = comps
             # xxx - this block is identical in agglomerate()
             if self.nsupervox_nomerge > 0:
                 assert( ncomps < self.nsupervox_merge ) # sanity check
@@ -987,86 +1132,181 @@ class dpFRAG(emLabels):
                 supervox_map[self.nsupervox_merge+1:] = \
                     np.arange(ncomps+1,ncomps+self.nsupervox_nomerge+1,dtype=self.lbl_dtype)
                 ncomps += self.nsupervox_nomerge
-            # create the new supervoxels from the supervoxel_map containing mapping from agglo nodes to new nodes
-            self.data_cube = supervox_map[self.supervoxels_noperim]
 
             if self.dpFRAG_verbose:
                 print('\tnsupervox',ncomps)
             self.data_attrs['types_nlabels'] = [ncomps]
-            self.writeCube()
-
-        if self.dpFRAG_verbose:
-            print('\n\tdone in %.4f s' % (time.time() - t))
-
-        self.dpWriteh5_verbose = verbose
+            if table:
+                emLabels.writeLabelsDelta(outfile, self.chunk.tolist(), self.offset.tolist(), self.size.tolist(),
+                    supervox_map, np.zeros((0,),dtype=np.uint32), np.zeros((0,),dtype=supervox_map.dtype), base,
+                    attrs=self.data_attrs, subgroups=list(self.subgroups_out))
+            else:
+                # create the new supervoxels from the supervoxel_map containing mapping from agglo nodes to new nodes
+                self.data_cube = supervox_map[self.supervoxels_noperim]
+                self.writeCube()
 
     def voxel_size_xform(self, size):
         return np.log10(size.astype(np.double)) if self.log_size else size.astype(np.double)
 
-    # macro for computing attributes of supervoxels and overlap that are within the overlap bounding box.
-    # these are used for the more complex features in createFRAG.
-    # called for the two neighboring supervoxels and the overlap area.
-    def getOvlpAttrs(self, sel, sampling, Vother=None, return_Cpts=False):
-        # size of supervoxel or overlap selection
-        sel_size = sel.sum(dtype=np.int64)
-        lsel_size = self.voxel_size_xform(sel_size)
-
-        # get the point coordinates within the overlap bounding box.
-        # use the sampling resolution for the points if available.
-        pts = np.transpose(np.nonzero(sel)).astype(np.double)*sampling
-        C = np.mean(pts, axis=0) # centroid
-
-        # xxx - this is hacky, but prevent pca from being called on svox areas in bounding box when
-        #   the pca angles are not being calculated at all for the feature set.
-        # xxx - maybe clean this up by just a single input bool that is "for overlap" or "for svox"
-        if Vother is None or self.npcaang > 0:
-            Cpts = pts-C # center points around centroid
-            V = dpFRAG.getOrthoAxes(Cpts, sampling) # get the principal axes.
-        else:
-            V = None; Cpts = None
-
-        # only return points if needed
-        if not return_Cpts: Cpts = None
-
-        # calculate angles between corresponding eigenvectors
-        #if Vother is None:
-        if Vother is None or self.npcaang == 0:
-            angles = None
-        else:
-            angles = np.zeros((self.npcaang,),np.double)
-            for k in range(self.npcaang):
-                angles[k] = np.arctan2(nla.norm(np.cross(V[k,:],Vother[k,:])), np.dot(V[k,:],Vother[k,:]))
+    # data channels that mean features are calculated for over the border voxels, keyed by feature name without mean_
+    def border_channels(self):
+        channels = OrderedDict()
+        for k in range(self.nprob_types):
+            channels['prob_' + self.prob_types[k]] = self.probs[k]
+        channels['grayscale'] = self.raw
+        for k in range(self.naugments):
+            channels['grayscale' + self.augments[k]] = self.raw_aug[k]
+            for x in range(self.nprob_types):
+                channels['prob_' + self.prob_types[x] + self.augments[k]] = self.probs_aug[k][x]
+        for k in range(self.nstatic_augments):
+            if self.static_augments[k][0] == '_':
+                channels['grayscale' + self.static_augments[k]] = self.raw_static_aug[k]
+            else:
+                channels['prob_' + self.static_augments[k]] = self.probs_static_aug[k]
+        return channels
+
+    # segmented reductions over the border voxels of all edges for each data channel.
+    # borders are the border voxels of all edges in a single index array (border_voxel_index) along with the offsets
+    #   into it for each edge (edge_offsets), as returned by frag_with_borders in csr mode.
+    # returns the number of border voxels for each edge and for each channel the border_stats_names statistics.
+    # NOTE: the border voxels are not dilated, ovlp_dilate is not supported here.
+    @staticmethod
+    def getBorderStats(border_voxel_index, edge_offsets, channels):
+        nedges = edge_offsets.size - 1; counts = np.diff(edge_offsets).astype(np.int64)
+        inds = border_voxel_index.astype(np.int64, copy=False)
+        eids = np.repeat(np.arange(nedges, dtype=np.int64), counts)
+        starts = edge_offsets[:-1].astype(np.int64)
+        dcounts = counts.astype(np.double)
+
+        stats = OrderedDict()
+        for name,data in channels.items():
+            # data might not be C-order, but border indices are into the C-order flattened array
+            values = np.take(data, inds).astype(np.double)
+            vsum = np.bincount(eids, weights=values, minlength=nedges)
+            vsumsq = np.bincount(eids, weights=values*values, minlength=nedges)
+            mean = vsum/dcounts; var = vsumsq/dcounts - mean*mean
+            var[var < 0] = 0    # roundoff
+            if nedges > 0:
+                vmin = np.minimum.reduceat(values, starts); vmax = np.maximum.reduceat(values, starts)
+            else:
+                vmin = np.zeros((0,), dtype=np.double); vmax = np.zeros((0,), dtype=np.double)
+            stats[name] = OrderedDict(zip(dpFRAG.border_stats_names, [vsum, vsumsq, mean, vmin, vmax, var]))
+
+        return counts, stats
+
+    # compute attributes of the overlap and of the two neighboring supervoxels within the overlap bounding box
+    #   for a list of edges. these are used for the more complex features in createFRAG.
+    # the coordinate moments of all the selections are accumulated first and then the principal axes are computed
+    #   for all of them at once from the moments and the first points of each selection (no svd for each selection).
+    # supervoxel attributes that are saved in sovlps (update mode) are not recomputed.
+    # returns a list of (mo, mi, mj) attribute dicts for each edge, mi / mj are None for saved supervoxel attributes.
+    def getOvlpAttrs(self, edges, list_of_borders, sovlps):
+        nedges = edges.shape[0]; sampling = np.asarray(self.sampling, dtype=np.double)
+
+        # the overlap selection is the border voxels, use segmented sums over the border voxels of all the edges.
+        # the point coordinates are relative to the overlap bounding box (border voxels bounding box plus perim).
+        # the border voxels of each edge are sorted so that the points are in the same order as for the overlap box,
+        #   the first 4 points of each selection are needed for the principal axes (see getOrthoAxes).
+        nborders = np.array([x.size for x in list_of_borders], dtype=np.int64)
+        segs = np.repeat(np.arange(nedges), nborders); border_inds = np.concatenate(list_of_borders)
+        border_inds = border_inds[np.lexsort((border_inds, segs))]
+        border_voxels = np.transpose(np.unravel_index(border_inds, self.supervoxels.shape))
+        starts = np.concatenate(([0], np.cumsum(nborders)[:-1]))
+        bmin = np.minimum.reduceat(border_voxels, starts, axis=0)
+        bmax = np.maximum.reduceat(border_voxels, starts, axis=0)+1
+        pts = (border_voxels - bmin[segs] + self.perim)*sampling
+        counts, S1, S2 = dpFRAG.getCoordMoments(pts, segs, nedges)
+        first = pts[np.minimum(starts[:,None] + np.arange(4), (starts + nborders - 1)[:,None])]
+        counts = [counts]; S1 = [S1]; S2 = [S2]; first = [first]
+
+        # supervoxel selections within the overlap bounding box, the overlaps are the first nedges selections.
+        svox_sel = -np.ones((nedges,2), dtype=np.int64); nsel = nedges
+        for e in range(nedges):
+            aobnd = tuple([slice(x-z, y+z) for x,y,z in zip(bmin[e],bmax[e],self.perim)])
+            ovlp_svox_cur = self.supervoxels[aobnd]
+            for k in range(2):
+                if sovlps[e] is not None and edges[e,k] in sovlps[e]: continue
+                pts = np.transpose(np.nonzero(ovlp_svox_cur == edges[e,k])).astype(np.double)*sampling
+                counts.append([pts.shape[0]]); S1.append(pts.sum(axis=0)[None,:]); S2.append(np.dot(pts.T,pts)[None,:])
+                first.append(pts[np.minimum(np.arange(4), pts.shape[0]-1)][None,:,:])
+                svox_sel[e,k] = nsel; nsel += 1
+        counts = np.concatenate(counts); S1 = np.concatenate(S1); S2 = np.concatenate(S2)
+        first = np.concatenate(first)
+
+        # centroids and principal axes of all the overlap and supervoxel selections
+        C, V = dpFRAG.getOrthoAxes(counts, S1, S2, first, sampling)
+        sel_size = counts; lsel_size = self.voxel_size_xform(sel_size)
+
+        # calculate angles between corresponding eigenvectors of the supervoxels and the overlap
+        if self.npcaang > 0:
+            Vsvox = V[nedges:,:self.npcaang,:]; Vother = V[np.nonzero(svox_sel >= 0)[0],:self.npcaang,:]
+            angles = np.arctan2(nla.norm(np.cross(Vsvox,Vother),axis=2), (Vsvox*Vother).sum(axis=2))
+            angles = np.concatenate((np.zeros((nedges,self.npcaang),np.double), angles))
 
             # rigid transform rotation decomposed to Euler angles.
             # xxx - this method did not work as well for classification. look at this again in the future?
             #   later found a bug in the rigid body function, maybe try this again?
             #R, t = dpFRAG.rigid_transform_3D(V, Vother); angles = dpFRAG.decompose_rotation(R)
 
-        # save the variables in dict to return
-        d = locals(); return { k:d[k] for k in dpFRAG.sovlp_attrs }
-
-    # this is just svd to get eigenvectors of points, but handling degenerate cases by forcing each voxel into 3d by
-    #   expanding each point to 6 points at the center of each voxel face (based on voxel size, sampling).
-    # NOTE IMPORTANT: from scipy, svd different from matlab:
-    #   "The SVD is commonly written as a = U S V.H. The v returned by this function is V.H and u = U."
-    # pts is Nx3
-    # returns Vt, the eigenvectors along the rows (along axis 0, i.e., Nx3 where N=3 with full rank)
+        # save the variables in dicts to return
+        ovlps = [None]*nedges
+        for e in range(nedges):
+            m = [None]*3
+            for k,x in enumerate([e, svox_sel[e,0], svox_sel[e,1]]):
+                if x < 0: continue
+                m[k] = {'sel_size':sel_size[x], 'lsel_size':lsel_size[x], 'C':C[x], 'V':V[x],
+                    'angles':angles[x] if self.npcaang > 0 and k > 0 else None, 'Cpts':None}
+            ovlps[e] = tuple(m)
+        return ovlps
+
+    # coordinate moments (counts, sums and sums of outer products) of points grouped by segment ids.
     @staticmethod
-    def getOrthoAxes(pts, sampling):
-        assert(pts.shape[1] == 3)     # coordinates along axis 1
-        if pts.shape[0] > 3:
-            U, S, Vt = sla.svd(pts,overwrite_a=False,full_matrices=False)
-            convertPts = (Vt.shape[0] < 3)
-        else:
-            convertPts = True
-        if convertPts:
-            newpts = np.vstack((pts,pts,pts,pts,pts,pts)); npts = pts.shape[0]; cnt = 0
-            for d in range(pts.shape[1]):
-                for sign in [-1,1]:
-                    newpts[cnt:cnt+npts,d] += sign*sampling[d]/2; cnt = cnt + npts
-            U, S, Vt = sla.svd(newpts,overwrite_a=True,full_matrices=False)
-            assert(Vt.shape[0] == 3)
-        return Vt
+    def getCoordMoments(pts, segs, nsegs):
+        counts = np.bincount(segs, minlength=nsegs)
+        S1 = np.zeros((nsegs,3), dtype=np.double); S2 = np.zeros((nsegs,3,3), dtype=np.double)
+        for a in range(3):
+            S1[:,a] = np.bincount(segs, weights=pts[:,a], minlength=nsegs)
+            for b in range(a,3):
+                S2[:,a,b] = S2[:,b,a] = np.bincount(segs, weights=pts[:,a]*pts[:,b], minlength=nsegs)
+        return counts, S1, S2
+
+    # principal axes of point sets from their coordinate moments, the same as the svd of the centered points in the
+    #   per selection getOrthoAxes, including the signs of the eigenvectors (the svd sign convention).
+    # degenerate cases are handled by forcing each voxel into 3d by expanding each point to 6 points at the center of
+    #   each voxel face (based on voxel size, sampling), this is only done for 3 or less points.
+    # first are the first 4 points of each selection (in the order of np.nonzero), repeated for selections with less
+    #   points. selections with at most 4 points are computed from the points directly.
+    # for larger selections, the lapack svd is the svd of R from a QR decomposition of the points. R only depends on
+    #   the first 3 points (householder signs) and the scatter matrix of the remaining points, so R is computed from
+    #   the first 3 points stacked on a factor of the remaining scatter matrix. the signs can still be different from
+    #   the svd of the points if an element of R is zero up to rounding (also the case between lapack versions).
+    # returns the centroids (N x 3) and Vt, the eigenvectors along the rows by decreasing eigenvalue (N x 3 x 3).
+    @staticmethod
+    def getOrthoAxes(counts, S1, S2, first, sampling):
+        assert( (counts > 0).all() and first.shape[1:] == (4,3) )
+        n = counts.astype(np.double); C = S1 / n[:,None]; Cpts = first - C[:,None,:]
+        Vt = np.zeros((counts.size,3,3), dtype=np.double)
+
+        # svd of the points for small selections, batched over selections with the same number of points
+        for npts in np.unique(counts[counts <= 4]):
+            sel = (counts == npts); pts = Cpts[sel,:npts,:]
+            if npts <= 3:
+                pts = np.tile(pts, (1,6,1)); cnt = 0
+                for d in range(3):
+                    for sign in [-1,1]:
+                        pts[:,cnt:cnt+npts,d] += sign*sampling[d]/2; cnt = cnt + npts
+            Vt[sel] = nla.svd(pts, full_matrices=False)[2]
+
+        # first 3 points and a factor of the scatter matrix of the remaining points have the same R as the points
+        sel = (counts > 4)
+        if sel.any():
+            F = Cpts[sel,:3,:]
+            scatter = S2[sel] - n[sel,None,None]*C[sel,:,None]*C[sel,None,:] - np.matmul(F.transpose((0,2,1)), F)
+            w, Q = nla.eigh(scatter)
+            Z = np.sqrt(np.maximum(w, 0))[:,:,None]*Q.transpose((0,2,1))
+            Vt[sel] = nla.svd(nla.qr(np.concatenate((F, Z), axis=1), mode='r'))[2]
+
+        return C, Vt
 
     # modified from http://nghiaho.com/uploads/code/rigid_transform_3D.py_
     #       https://en.wikipedia.org/wiki/Kabsch_algorithm
@@ -1101,7 +1341,8 @@ class dpFRAG(emLabels):
     @classmethod
     def makeTrainingFRAG(cls, labelfile, chunk, size, offset, probfiles, rawfiles, raw_dataset, gtfile,
             subgroups=[], G=None, progressBar=False, feature_set=None, has_ECS=True, chunk_subgroups=False, 
-            neighbor_only=False, pad_prob_svox_perim=False, no_agglo_ECS=False, verbose=False):
+            neighbor_only=False, pad_prob_svox_perim=False, no_agglo_ECS=False,
+            moment_update=False, nworkers=1, augment_cache='', augment_cache_size=32., verbose=False):
         parser = argparse.ArgumentParser(description='class:dpFRAG',
             formatter_class=argparse.ArgumentDefaultsHelpFormatter)
         dpFRAG.addArgs(parser); arg_str = ''
@@ -1123,6 +1364,10 @@ class dpFRAG(emLabels):
         if neighbor_only: arg_str += ' --neighbor-only '
         if pad_prob_svox_perim: arg_str += ' --pad-prob-perim '
         if no_agglo_ECS: arg_str += ' --no-agglo-ECS '
+        if augment_cache:
+            arg_str += ' --augment-cache %s --augment-cache-size %g ' % (augment_cache, augment_cache_size)
+        if moment_update: arg_str += ' --moment-update '
+        arg_str += ' --nworkers %d ' % nworkers
 
         if verbose: arg_str += ' --dpFRAG-verbose '
         if verbose: print(arg_str)
@@ -1135,7 +1380,8 @@ class dpFRAG(emLabels):
     @classmethod
     def makeTestingFRAG(cls, labelfile, chunk, size, offset, probfiles, rawfiles, raw_dataset, outfile=None, 
             subgroups=[], subgroups_out=[], G=None, progressBar=False, feature_set=None, has_ECS=True, 
-            chunk_subgroups=False, neighbor_only=False, pad_prob_svox_perim=False, no_agglo_ECS=False, verbose=False):
+            chunk_subgroups=False, neighbor_only=False, pad_prob_svox_perim=False, no_agglo_ECS=False,
+            moment_update=False, nworkers=1, augment_cache='', augment_cache_size=32., verbose=False):
         parser = argparse.ArgumentParser(description='class:dpFRAG',
             formatter_class=argparse.ArgumentDefaultsHelpFormatter)
         dpFRAG.addArgs(parser); arg_str = ''
@@ -1158,6 +1404,10 @@ class dpFRAG(emLabels):
         if neighbor_only: arg_str += ' --neighbor-only '
         if pad_prob_svox_perim: arg_str += ' --pad-prob-perim '
         if no_agglo_ECS: arg_str += ' --no-agglo-ECS '
+        if augment_cache:
+            arg_str += ' --augment-cache %s --augment-cache-size %g ' % (augment_cache, augment_cache_size)
+        if moment_update: arg_str += ' --moment-update '
+        arg_str += ' --nworkers %d ' % nworkers
 
         if verbose: arg_str += ' --dpFRAG-verbose '
         if verbose: print(arg_str)
@@ -1170,7 +1420,8 @@ class dpFRAG(emLabels):
     @classmethod
     def makeBothFRAG(cls, labelfile, chunk, size, offset, probfiles, rawfiles, raw_dataset, gtfile, outfile=None,
             subgroups=[], subgroups_out=None, G=None, progressBar=False, feature_set=None, has_ECS=True, 
-            neighbor_only=False, chunk_subgroups=False, pad_prob_svox_perim=False, no_agglo_ECS=False, verbose=False):
+            neighbor_only=False, chunk_subgroups=False, pad_prob_svox_perim=False, no_agglo_ECS=False,
+            moment_update=False, nworkers=1, augment_cache='', augment_cache_size=32., verbose=False):
         parser = argparse.ArgumentParser(description='class:dpFRAG',
             formatter_class=argparse.ArgumentDefaultsHelpFormatter)
         dpFRAG.addArgs(parser); arg_str = ''
@@ -1194,6 +1445,10 @@ class dpFRAG(emLabels):
         if neighbor_only: arg_str += ' --neighbor-only '
         if pad_prob_svox_perim: arg_str += ' --pad-prob-perim '
         if no_agglo_ECS: arg_str += ' --no-agglo-ECS '
+        if augment_cache:
+            arg_str += ' --augment-cache %s --augment-cache-size %g ' % (augment_cache, augment_cache_size)
+        if moment_update: arg_str += ' --moment-update '
+        arg_str += ' --nworkers %d ' % nworkers
 
         if verbose: arg_str += ' --dpFRAG-verbose '
         if verbose: print(arg_str)
@@ -1250,6 +1505,15 @@ class dpFRAG(emLabels):
         p.add_argument('--pad-prob-perim', action='store_true', help='Pad perimeter of probs instead of loading')
         #p.add_argument('--pad-svox-perim', action='store_true', help='Pad perimeter of supervoxels instead of loading')
         p.add_argument('--no-agglo-ECS', action='store_true', help='Do not agglomerate ECS supervoxels')
+        p.add_argument('--augment-cache', nargs=1, type=str, default='',
+            help='Directory for caching raw augments that are calculated on-the-fly (no rawaugfile)')
+        p.add_argument('--augment-cache-size', nargs=1, type=float, default=[32.],
+            help='Maximum size of the raw augment cache in GB')
+        p.add_argument('--nworkers', nargs=1, type=int, default=[1],
+            help='Number of processes for calculating the edge features')
+        p.add_argument('--moment-update', action='store_true',
+            help='Update features after agglomeration from moments stored with the FRAG instead of voxels (approx), '
+                'only for size and mean border features (minimal feature set)')
         p.add_argument('--dpFRAG-verbose', action='store_true', help='Debugging output for dpFRAG')
 
 if __name__ == '__main__':
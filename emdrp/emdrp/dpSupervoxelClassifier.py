@@ -37,11 +37,16 @@ import argparse
 import os
 #import sys
 import importlib
+import resource
+from concurrent.futures import ProcessPoolExecutor
 from io import BytesIO
+from collections import OrderedDict
+import tempfile
 
 from configobj import ConfigObj, flatten_errors
 from validate import Validator, ValidateError
 import dill
+import h5py
 from io import StringIO
 from sklearn.preprocessing import scale
 from sklearn.utils import shuffle
@@ -54,7 +59,7 @@ from sklearn.ensemble import RandomForestClassifier, AdaBoostClassifier
 from sklearn.naive_bayes import GaussianNB
 from sklearn.discriminant_analysis import LinearDiscriminantAnalysis
 from sklearn.discriminant_analysis import QuadraticDiscriminantAnalysis
-from sklearn.linear_model import LogisticRegression
+from sklearn.linear_model import LogisticRegression, SGDClassifier
 
 # xxx - how to make imports as optional? make plotting class?
 from matplotlib import pylab as pl
@@ -69,7 +74,24 @@ from dpLoadh5 import dpLoadh5
 #from dpFRAGc import dpFRAG
 dpFRAG = []
 from metrics import pixel_error_fscore
-from utils import print_cpu_info_linux
+from utils.utils import print_cpu_info_linux
+from utils.ArrayRAG import ArrayRAG
+from utils.FeatureStore import FeatureStore
+
+# set in the training data process pool workers, edge features are calculated with a single process in the workers
+_in_train_worker = False
+
+def _init_train_worker(mem, useFRAGc):
+    global _in_train_worker
+    _in_train_worker = True
+    # the dynamic dpFRAG import from init is not inherited by spawn or forkserver workers
+    dpFRAGl = importlib.import_module('dpFRAGc') if useFRAGc else importlib.import_module('dpFRAG')
+    globals().update({'dpFRAG':dpFRAGl.dpFRAG})
+    if mem > 0:
+        # limit the address space so that a worker over the memory budget fails instead of exhausting the node
+        soft, hard = resource.getrlimit(resource.RLIMIT_AS); nbytes = int(mem*1024**3)
+        if hard != resource.RLIM_INFINITY: nbytes = min(nbytes, hard)
+        resource.setrlimit(resource.RLIMIT_AS, (nbytes, hard))
 
 class dpSupervoxelClassifier():
 
@@ -124,6 +146,10 @@ class dpSupervoxelClassifier():
         dpFRAGl = importlib.import_module('dpFRAGc') if self.useFRAGc else importlib.import_module('dpFRAG')
         globals().update({'dpFRAG':dpFRAGl.dpFRAG})
 
+        # hierarchical agglomeration updates the merged edges from the moments stored with the FRAG
+        assert( self.hierarchical_agglo in ['', 'mean_boundary', 'classifier'] )
+        assert( not self.hierarchical_agglo or (self.useFRAGc and self.moment_update and self.iterate_count == 0) )
+
         # these are so standard cubeIter inputs can be used from command line to override from .ini
         if (self.chunk >= 0).all():
             self.chunk_range_beg = self.chunk
@@ -133,6 +159,10 @@ class dpSupervoxelClassifier():
 
         self.doplots = (self.show_plots or self.export_plots)
 
+        # streaming training normalizes with the training mean / std, which is saved with the classifier.
+        #   otherwise each test chunk is normalized with its own mean / std (scale).
+        self.train_mean = None; self.train_std = None
+
         # default is to have sklearn calculate the priors
         self.priors = None
         if self.merge_prior > 0: self.priors = np.array([1-self.merge_prior, self.merge_prior],dtype=np.double)
@@ -212,6 +242,8 @@ class dpSupervoxelClassifier():
         # inits for iterative prior mode
         self.iterative_mode = (self.iterate_count > 0)
         self.iterative_frag = [None] * self.nchunks
+        self.iterative_lru = OrderedDict()  # resident FRAGs in least recently used order, for the memory budget
+        if not self.iterative_scratch: self.iterative_scratch = tempfile.gettempdir()
         self.iterative_mode_count = 0
         if self.outfile:
             if len(self.iterate_save_ranges) > 0:
@@ -278,66 +310,72 @@ class dpSupervoxelClassifier():
 
         if self.dpSupervoxelClassifier_verbose: print('\nTRAIN')
 
-        if self.trainin and (not self.classifierin or self.doplots):
+        # out-of-core training reads the training data in batches from the feature store (input or created here)
+        stream = self.train_streaming and not self.classifierin
+        if stream:
+            streamfile = self.trainin if self.trainin else self.trainout
+            assert( FeatureStore.isFeatureStore(streamfile) )    # streaming training needs a feature store
+            assert( not self.iterative_mode and not self.doplots )   # needs all the training data in memory
+
+        if self.trainin and (not self.classifierin or self.doplots) and not stream:
             if self.dpSupervoxelClassifier_verbose:
                 print('Loading training data')
-            with open(self.trainin, 'rb') as f: data = dill.load(f)
-            target = data['target']; fdata = data['data']
-            ntargets = target.size; nfeatures = fdata.shape[1]
+            if FeatureStore.isFeatureStore(self.trainin):
+                target, fdata = self.readTrainingStore()
+            else:
+                with open(self.trainin, 'rb') as f: data = dill.load(f)
+                target = data['target']; fdata = data['data']
+            ntargets = target.size; nfeatures = fdata.shape[1]; cnt_targets = ntargets
             assert( nfeatures == self.nfeatures )
 
-        elif not self.classifierin:
+        elif not self.classifierin and not self.trainin:
             #dict_keys(['feature_names', 'DESCR', 'target_names', 'target', 'data'])
             nalloc = self.nchunks*self.nalloc_per_chunk
             nfeatures = self.nfeatures
-            target = np.zeros((nalloc,), dtype=np.int64)
-            fdata = np.zeros((nalloc,nfeatures), dtype=np.double)
+            if not stream:
+                target = np.zeros((nalloc,), dtype=np.int64)
+                fdata = np.zeros((nalloc,nfeatures), dtype=np.double)
 
             # accumulate training data from all training chunks
-            cnt_targets = 0; ntargets = np.zeros((self.nchunks,),dtype=np.int64)
-            for chunk in range(self.nchunks):
-                cchunk, chunk_list_index, chunk_range_index = self.get_chunk_inds(chunk)
-                offset = self.offset_list[chunk_list_index,:]; size = self.size_list[chunk_list_index,:]
-
-                if chunk_list_index in self.test_chunks: continue
-                print('Appending training data for chunk %d,%d,%d' % tuple(cchunk.tolist()))
-
-                if self.iterative_mode:
-                    if self.iterative_frag[chunk] is None:
-                        frag = dpFRAG.makeBothFRAG(self.labelfile, cchunk, size, offset,
-                            [self.probfile, self.probaugfile], [self.rawfile, self.rawaugfile],
-                            self.raw_dataset, self.gtfile, self.outfile, self.label_subgroups, 
-                            ['agglomeration_training'], progressBar=self.progress_bar, feature_set=self.feature_set, 
-                            has_ECS=self.has_ECS, chunk_subgroups=self.chunk_subgroups, no_agglo_ECS=self.no_agglo_ECS,
-                            pad_prob_svox_perim = not self.prob_svox_context, neighbor_only=self.neighbor_only, 
-                            verbose=self.dpSupervoxelClassifier_verbose)
-                        frag.isTraining = True; self.iterative_frag[chunk] = frag
-                    else:
-                        frag = self.iterative_frag[chunk]
-                else:
-                    frag = dpFRAG.makeTrainingFRAG(self.labelfile, cchunk, size, offset,
-                        [self.probfile, self.probaugfile], [self.rawfile, self.rawaugfile],
-                        self.raw_dataset, self.gtfile, self.label_subgroups, feature_set=self.feature_set,
-                        has_ECS=self.has_ECS, chunk_subgroups=self.chunk_subgroups, neighbor_only=self.neighbor_only,
-                        pad_prob_svox_perim = not self.prob_svox_context, progressBar=self.progress_bar, 
-                        no_agglo_ECS=self.no_agglo_ECS, verbose=self.dpSupervoxelClassifier_verbose)
-                frag.createFRAG(update = self.iterative_mode)
-                #frag.createFRAG(update = False)
-                data = frag.createDataset()
-                ntargets[chunk] = data['target'].shape[0]
-                target[cnt_targets:cnt_targets+ntargets[chunk]] = data['target']
-                fdata[cnt_targets:cnt_targets+ntargets[chunk],:] = data['data']
-                cnt_targets += ntargets[chunk]
-            target = target[:cnt_targets]; fdata = fdata[:cnt_targets,:]
+            chunks = [x for x in range(self.nchunks) if self.get_chunk_inds(x)[1] not in self.test_chunks]
+            pool = None; futures = []
+            if self.train_nworkers > 1 and not self.iterative_mode and len(chunks) > 1:
+                # chunks are independent, create the FRAGs in a process pool and only return the datasets.
+                # results are taken in chunk order, so the training data is the same as for a single process.
+                # a worker that dies (for example over the memory budget) raises BrokenProcessPool instead of hanging.
+                pool = ProcessPoolExecutor(self.train_nworkers, initializer=_init_train_worker,
+                    initargs=(self.train_worker_mem, self.useFRAGc))
+                futures = [pool.submit(self.trainDataset, x) for x in chunks]
+                datasets = (x.result() for x in futures)
+            else:
+                datasets = map(self.trainDataset, chunks)
 
-            if self.trainout:
+            store = FeatureStore(self.trainout) if self.trainout and FeatureStore.isFeatureStore(self.trainout) \
+                else None
+            cnt_targets = 0; ntargets = np.zeros((self.nchunks,),dtype=np.int64)
+            try:
+                for chunk, data in zip(chunks, datasets):
+                    edges = data.pop('edges'); nnodes = data.pop('nnodes')
+                    if store is not None: self.writeStore(store, chunk, data, edges, nnodes)
+                    ntargets[chunk] = data['target'].shape[0]
+                    if not stream:
+                        target[cnt_targets:cnt_targets+ntargets[chunk]] = data['target']
+                        fdata[cnt_targets:cnt_targets+ntargets[chunk],:] = data['data']
+                    cnt_targets += ntargets[chunk]
+            finally:
+                # also shutdown the workers if a chunk fails, cancel so that pending chunks are not started
+                for x in futures: x.cancel()
+                if pool is not None: pool.shutdown(wait=True)
+            if not stream: target = target[:cnt_targets]; fdata = fdata[:cnt_targets,:]
+
+            if self.trainout and store is None:
                 #dict_keys(['feature_names', 'DESCR', 'target_names', 'target', 'data'])
                 descr = 'Training data from dpFRAG.py with command line:\n' + self.arg_str
                 descr = ('With ini file "%s":\n' % (self.cfgfile,)) + self.ini_str
                 data['data'] = fdata; data['target'] = target; data['DESCR'] = descr
                 with open(self.trainout, 'wb') as f: dill.dump(data, f)
 
-        if not self.classifierin or self.doplots:
+        if (not self.classifierin or self.doplots) and not stream:
             # everyone wants to be norml
             sdata = scale(fdata)   # normalize for the classifiers
             # shuffle data for training as well
@@ -349,6 +387,16 @@ class dpSupervoxelClassifier():
 
             with open(self.classifierin, 'rb') as f: d = dill.load(f)
             self.clf = d['classifier'];
+            if 'scaler' in d: self.train_mean, self.train_std = d['scaler']
+        elif stream:
+            # trainStreaming prints the number of examples after the first pass, elapsed time is printed below
+            if self.dpSupervoxelClassifier_verbose:
+                print('\nStreaming training classifier %s from %s:' % (self.classifier, streamfile)); t = time.time()
+            self.trainStreaming(streamfile)
+
+            if self.classifierout:
+                with open(self.classifierout, 'wb') as f:
+                    dill.dump({'classifier':self.clf, 'scaler':(self.train_mean, self.train_std)}, f)
         else:
             if self.dpSupervoxelClassifier_verbose:
                 print('\nTraining classifier %s with %d examples and %d features:' % (self.classifier,
@@ -378,6 +426,8 @@ class dpSupervoxelClassifier():
                 self.clf = AdaBoostClassifier()
             elif self.classifier == 'lr':
                 self.clf = LogisticRegression(penalty='l2',dual=False,solver='sag',n_jobs=self.nthreads)
+            elif self.classifier == 'sgd':
+                self.clf = SGDClassifier(loss='log_loss',penalty='l2')
             else:
                 assert(False)   # i never try anything, i just do it
 
@@ -396,27 +446,139 @@ class dpSupervoxelClassifier():
             cnt_targets = 0
             for chunk in range(self.nchunks):
                 if self.iterative_frag[chunk] is None or not self.iterative_frag[chunk].isTraining: continue
+                frag = self.getIterativeFRAG(chunk)
 
                 # get the feature data for current training chunk only
                 cdata = sdata[cnt_targets:cnt_targets+ntargets[chunk],:]
                 cnt_targets += ntargets[chunk]
 
                 # merge based on current classifier
-                self.iterative_frag[chunk].subgroups_out[-1] = '%.8f' \
-                    % self.threshold_subgroups[self.iterative_mode_count]
+                frag.subgroups_out[-1] = '%.8f' % self.threshold_subgroups[self.iterative_mode_count]
                 clf_predict, thr = self.get_merge_predict_thr(cdata)
-                self.iterative_frag[chunk].agglomerate(clf_predict,
-                    doWrite=self.iterate_save_mask[self.iterative_mode_count])
+                frag.agglomerate(clf_predict, doWrite=self.iterate_save_mask[self.iterative_mode_count])
 
                 # make the next training iteration load from the current agglomerated supervoxels
-                self.iterative_frag[chunk].srcfile = self.iterative_frag[chunk].outfile
-                self.iterative_frag[chunk].subgroups = self.iterative_frag[chunk].subgroups_out
+                frag.srcfile = frag.outfile
+                frag.subgroups = frag.subgroups_out
 
         if self.doplots:
             return self.createPlots(target,sdata,self.clf,self.export_plots,
                 name=self.classifier + '_train_' + '_'.join([str(x) for x in self.test_chunks]) + \
                 '_iter_' + str(self.iterative_mode_count), thr=thr, plot_features=self.plot_features)
 
+    # create the FRAG for a training chunk and return the training dataset
+    def trainDataset(self, chunk):
+        frag_nworkers = 1 if _in_train_worker else self.frag_nworkers
+        cchunk, chunk_list_index, chunk_range_index = self.get_chunk_inds(chunk)
+        offset = self.offset_list[chunk_list_index,:]; size = self.size_list[chunk_list_index,:]
+
+        print('Appending training data for chunk %d,%d,%d' % tuple(cchunk.tolist()))
+
+        if self.iterative_mode:
+            if self.iterative_frag[chunk] is None:
+                frag = dpFRAG.makeBothFRAG(self.labelfile, cchunk, size, offset,
+                    [self.probfile, self.probaugfile], [self.rawfile, self.rawaugfile],
+                    self.raw_dataset, self.gtfile, self.outfile, self.label_subgroups, 
+                    ['agglomeration_training'], progressBar=self.progress_bar, feature_set=self.feature_set, 
+                    has_ECS=self.has_ECS, chunk_subgroups=self.chunk_subgroups, no_agglo_ECS=self.no_agglo_ECS,
+                    pad_prob_svox_perim = not self.prob_svox_context, neighbor_only=self.neighbor_only, 
+                    moment_update=self.moment_update, nworkers=frag_nworkers,
+                    augment_cache=self.augment_cache, augment_cache_size=self.augment_cache_size,
+                    verbose=self.dpSupervoxelClassifier_verbose)
+                frag.isTraining = True; self.iterative_frag[chunk] = frag
+            frag = self.getIterativeFRAG(chunk)
+        else:
+            frag = dpFRAG.makeTrainingFRAG(self.labelfile, cchunk, size, offset,
+                [self.probfile, self.probaugfile], [self.rawfile, self.rawaugfile],
+                self.raw_dataset, self.gtfile, self.label_subgroups, feature_set=self.feature_set,
+                has_ECS=self.has_ECS, chunk_subgroups=self.chunk_subgroups, neighbor_only=self.neighbor_only,
+                pad_prob_svox_perim = not self.prob_svox_context, progressBar=self.progress_bar, 
+                no_agglo_ECS=self.no_agglo_ECS, moment_update=self.moment_update, nworkers=frag_nworkers,
+                augment_cache=self.augment_cache, augment_cache_size=self.augment_cache_size,
+                verbose=self.dpSupervoxelClassifier_verbose)
+        frag.createFRAG(update = self.iterative_mode)
+        #frag.createFRAG(update = False)
+        data = frag.createDataset()
+        # the FRAG edges in the order of the dataset, for the feature store
+        data['edges'] = frag.FRAG.edges.copy(); data['nnodes'] = frag.FRAG.number_of_nodes()
+        return data
+
+    # store the dataset for a chunk along with the FRAG edges and location in a feature store
+    # the feature names and extraction options are stored with each chunk so that cached features can be validated.
+    def writeStore(self, store, chunk, data, edges, nnodes):
+        cchunk, chunk_list_index, chunk_range_index = self.get_chunk_inds(chunk)
+        names = sorted(data['feature_names'].keys(), key=lambda x: data['feature_names'][x])
+        attrs = {'index':chunk, 'chunk':cchunk, 'offset':self.offset_list[chunk_list_index,:],
+            'size':self.size_list[chunk_list_index,:], 'chunk_list_index':chunk_list_index, 'nnodes':nnodes,
+            'feature_names':np.array(names, dtype=h5py.string_dtype()), 'feature_options':self.featureOptions()}
+        store.write('chunk%d' % (chunk,), data, edges, attrs)
+
+    # string of the options that the FRAG features for a chunk depend on (other than the chunk location)
+    def featureOptions(self):
+        opts = ['useFRAGc', 'feature_set', 'has_ECS', 'neighbor_only', 'prob_svox_context', 'no_agglo_ECS',
+            'label_subgroups', 'chunk_subgroups', 'labelfile', 'probfile', 'probaugfile', 'rawfile', 'rawaugfile',
+            'raw_dataset', 'gtfile']
+        return ', '.join(['%s=%r' % (x, getattr(self, x)) for x in opts])
+
+    # training data from the feature store, only the training chunks are read (test chunks are skipped)
+    def readTrainingStore(self):
+        store = FeatureStore(self.trainin)
+        datasets = [store.read(name) for name, attrs in store.cubes() if attrs['chunk_list_index'] not in \
+            self.test_chunks]
+        assert( len(datasets) > 0 )     # no training chunks in the feature store
+        return np.concatenate([x['target'] for x in datasets]), np.concatenate([x['data'] for x in datasets], axis=0)
+
+    # out-of-core training from the training chunks in the feature store, only one batch is in memory at a time.
+    # features are normalized with a two-pass running mean and variance over all the training chunks (same as scale),
+    #   then the classifier is trained with partial_fit over shuffled mini-batches.
+    def trainStreaming(self, filename):
+        # only classifiers that support partial_fit, logistic regression is trained with stochastic gradient descent
+        if self.classifier == 'nb':
+            self.clf = GaussianNB()
+        elif self.classifier in ['lr', 'sgd']:
+            self.clf = SGDClassifier(loss='log_loss',penalty='l2')
+        else:
+            assert(False)   # classifier does not support streaming training
+        classes = np.array(sorted(dpFRAG.TARGETS.values()), dtype=np.int64)
+
+        store = FeatureStore(filename)
+        names = [name for name, attrs in store.cubes() if attrs['chunk_list_index'] not in self.test_chunks]
+        assert( len(names) > 0 )     # no training chunks in the feature store
+        bs = self.train_batch_size
+
+        # first pass for the mean, second pass for the variance about the mean
+        cnt_targets = 0; nbatches = 0; fsum = np.zeros((self.nfeatures,), dtype=np.double)
+        for name in names:
+            fdata = store.read(name)['data']; assert( fdata.shape[1] == self.nfeatures )
+            for beg in range(0, fdata.shape[0], bs): fsum += fdata[beg:beg+bs,:].sum(0)
+            cnt_targets += fdata.shape[0]; nbatches += -(-fdata.shape[0] // bs)
+        assert( cnt_targets > 0 )
+        self.train_mean = fsum / cnt_targets; fsum[:] = 0
+        for name in names:
+            fdata = store.read(name)['data']
+            for beg in range(0, fdata.shape[0], bs): fsum += ((fdata[beg:beg+bs,:] - self.train_mean)**2).sum(0)
+        self.train_std = np.sqrt(fsum / cnt_targets); self.train_std[self.train_std == 0] = 1
+
+        if self.dpSupervoxelClassifier_verbose:
+            print('\t%d examples and %d features, %d epochs of %d batches' % \
+                (cnt_targets, self.nfeatures, self.train_epochs, nbatches))
+
+        # shuffle the chunks and batches for each epoch, and the examples within each batch
+        for epoch in range(self.train_epochs):
+            for name in np.random.permutation(names):
+                data = store.read(name); n = data['target'].shape[0]
+                for beg in np.random.permutation(np.arange(0, n, bs)):
+                    target, sdata = shuffle(data['target'][beg:beg+bs],
+                        (data['data'][beg:beg+bs,:] - self.train_mean) / self.train_std)
+                    self.clf.partial_fit(sdata, target, classes=classes)
+
+    # testing data for a chunk from the feature store, along with a RAG from the stored edges for the agglomeration
+    def readTestingStore(self, chunk):
+        data = FeatureStore(self.testin).read('chunk%d' % (chunk,))
+        FRAG = ArrayRAG(data['attrs']['nnodes'], nalloc=max([data['edges'].shape[0],1]))
+        FRAG.add_edges(data['edges']); FRAG.sort()
+        return data, FRAG
+
     def test(self):
         if self.dpSupervoxelClassifier_verbose: print('\nTEST')
 
@@ -437,14 +599,20 @@ class dpSupervoxelClassifier():
         print('Exporting testing data for chunk %d,%d,%d' % tuple(cchunk.tolist()))
         offset = self.offset_list[chunk_list_index,:]; size = self.size_list[chunk_list_index,:]
 
-        FRAG = None
-        if len(self.test_chunks) == 1 and self.testin:
+        FRAG = None; data = None
+        if self.testin and FeatureStore.isFeatureStore(self.testin):
+            if self.dpSupervoxelClassifier_verbose:
+                print('Loading testing data from feature store')
+            # the moments for hierarchical agglomeration are not in the feature store
+            assert( not self.hierarchical_agglo )
+            data, FRAG = self.readTestingStore(ichunk)
+        elif len(self.test_chunks) == 1 and self.testin:
             if self.dpSupervoxelClassifier_verbose:
                 print('Loading testing data')
             with open(self.testin, 'rb') as f: data = dill.load(f)
             FRAG = data['FRAG']; data = data['data']
 
-        frag = self.iterative_frag[ichunk] if self.iterative_mode else None
+        frag = self.getIterativeFRAG(ichunk) if self.iterative_mode else None
         subgroups_out = list(self.label_subgroups_out)
 
         if frag is None:
@@ -455,6 +623,8 @@ class dpSupervoxelClassifier():
                     G=FRAG, progressBar=self.progress_bar, feature_set=self.feature_set, has_ECS=self.has_ECS,
                     chunk_subgroups=self.chunk_subgroups, neighbor_only=self.neighbor_only, 
                     pad_prob_svox_perim = not self.prob_svox_context, no_agglo_ECS=self.no_agglo_ECS, 
+                    moment_update=self.moment_update, nworkers=self.frag_nworkers,
+                    augment_cache=self.augment_cache, augment_cache_size=self.augment_cache_size,
                     verbose=self.dpSupervoxelClassifier_verbose)
             else:
                 frag = dpFRAG.makeTestingFRAG(self.labelfile, cchunk, size, offset,
@@ -463,10 +633,12 @@ class dpSupervoxelClassifier():
                     progressBar=self.progress_bar, feature_set=self.feature_set, has_ECS=self.has_ECS,
                     chunk_subgroups=self.chunk_subgroups, neighbor_only=self.neighbor_only,
                     pad_prob_svox_perim = not self.prob_svox_context, no_agglo_ECS=self.no_agglo_ECS,
+                    moment_update=self.moment_update, nworkers=self.frag_nworkers,
+                    augment_cache=self.augment_cache, augment_cache_size=self.augment_cache_size,
                     verbose=self.dpSupervoxelClassifier_verbose)
 
         if self.iterative_mode and self.iterative_frag[ichunk] is None:
-            frag.isTraining = False; self.iterative_frag[ichunk] = frag
+            frag.isTraining = False; self.iterative_frag[ichunk] = frag; self.getIterativeFRAG(ichunk)
 
             # write out the starting labels as as subgroup 0
             frag.subgroups_out[-1] = '%.8f' % 0.0
@@ -475,7 +647,7 @@ class dpSupervoxelClassifier():
             #self.data_attrs['types_nlabels'] = [ncomps]
             frag.writeCube(); frag.dpWriteh5_verbose = verbose
 
-        if not (len(self.test_chunks) == 1 and self.testin):
+        if data is None:
             frag.createFRAG(update = self.iterative_mode)
             #frag.createFRAG(update = False)
             data = frag.createDataset(train=self.doplots)
@@ -486,9 +658,17 @@ class dpSupervoxelClassifier():
                 descr = 'Testing data from dpFRAG.py with command line:\n' + self.arg_str
                 descr = ('With ini file "%s":\n' % (self.cfgfile,)) + self.ini_str
                 data['DESCR'] = descr
-                with open(self.testout, 'wb') as f: dill.dump({'data':data,'FRAG':frag.FRAG}, f)
+                if FeatureStore.isFeatureStore(self.testout):
+                    self.writeStore(FeatureStore(self.testout), ichunk, data, frag.FRAG.edges,
+                        frag.FRAG.number_of_nodes())
+                else:
+                    with open(self.testout, 'wb') as f: dill.dump({'data':data,'FRAG':frag.FRAG}, f)
 
-        sdata = scale(data['data'])     # normalize for the classifiers
+        # normalize for the classifiers, same as the training data for streaming training
+        if self.train_mean is None:
+            sdata = scale(data['data'])
+        else:
+            sdata = (data['data'] - self.train_mean) / self.train_std
 
         thr = -1
         if self.iterative_mode:
@@ -498,12 +678,18 @@ class dpSupervoxelClassifier():
             frag.agglomerate(clf_predict, doWrite=self.iterate_save_mask[self.iterative_mode_count])
 
             # make the next training iteration load from the current agglomerated supervoxels
-            self.iterative_frag[ichunk].srcfile = self.iterative_frag[ichunk].outfile
-            self.iterative_frag[ichunk].subgroups = self.iterative_frag[ichunk].subgroups_out
+            frag.srcfile = frag.outfile
+            frag.subgroups = frag.subgroups_out
+        elif self.hierarchical_agglo:
+            # merge from a priority queue rescoring only merged edges and write outputs at the thresholds
+            frag.hierarchical_agglomerate(self.thresholds, self.threshold_subgroups,
+                clf=self.clf if self.hierarchical_agglo == 'classifier' else None, table=self.threshold_table,
+                scaler=None if self.train_mean is None else (self.train_mean, self.train_std))
         else:
             try:
                 # predict merge or not on testing cube and write outputs at specified probability thresholds
-                frag.threshold_agglomerate(self.clf.predict_proba(sdata), self.thresholds, self.threshold_subgroups)
+                frag.threshold_agglomerate(self.clf.predict_proba(sdata), self.thresholds, self.threshold_subgroups,
+                    table=self.threshold_table)
                 # there's an issue here if there are no mergers left, would be better to just copy the current
                 #   agglomeration, xxx - deal with this later. handled this explicitly in other locations.
                 #except AttributeError:
@@ -514,6 +700,28 @@ class dpSupervoxelClassifier():
 
         return data,sdata,thr
 
+    # get the FRAG for a chunk in iterative mode, restoring it if it was spilled to the scratch directory.
+    # the least recently used FRAGs are then spilled until the resident FRAGs fit in the memory budget.
+    def getIterativeFRAG(self, chunk):
+        frag = self.iterative_frag[chunk]
+        if frag is None: return None
+        if frag.spilled(): frag.restore()
+        self.iterative_lru.pop(chunk, None); self.iterative_lru[chunk] = frag
+
+        # the FRAG being used is never spilled, sizes are updated as the FRAGs grow with the features
+        if self.iterative_mem > 0:
+            budget = self.iterative_mem*2**30; nbytes = [x.nbytes() for x in self.iterative_lru.values()]
+            while sum(nbytes) > budget and len(self.iterative_lru) > 1:
+                spill, sfrag = self.iterative_lru.popitem(last=False); nbytes.pop(0)
+                sfrag.spill(os.path.join(self.iterative_scratch, 'frag_%d_chunk%d.dill' % (os.getpid(), spill)))
+        return frag
+
+    # remove the FRAG for a chunk in iterative mode, including the scratch file if it was spilled.
+    def freeIterativeFRAG(self, chunk):
+        frag = self.iterative_frag[chunk]
+        if frag is not None and frag.spilled(): os.remove(frag.spillfile)
+        self.iterative_lru.pop(chunk, None); self.iterative_frag[chunk] = None
+
     def iterative_classify(self):
         assert(self.iterative_mode)
 
@@ -556,7 +764,7 @@ class dpSupervoxelClassifier():
 
                 # let the previous chunk get garbage collected to save memory.
                 # that is essentially the purpose of this special mode (iteration loop as inner loop).
-                self.iterative_frag[chunk] = None
+                self.freeIterativeFRAG(chunk)
         else:
             print('Normal iterative mode with merge prior %.4f' % (self.merge_prior,))
             for i in range(self.iterate_count):
@@ -581,6 +789,11 @@ class dpSupervoxelClassifier():
                     with open(fn, 'wb') as f:
                         dill.dump({'classifier':self.clf,'train_metrics':train_metrics,'test_metrics':test_metrics},f)
 
+            # remove the FRAGs that are still spilled from the scratch directory
+            for chunk in range(self.nchunks):
+                if self.iterative_frag[chunk] is not None and self.iterative_frag[chunk].spilled():
+                    self.freeIterativeFRAG(chunk)
+
     def get_merge_predict_thr(self,data):
         thr = -1; #ntargets = data.shape[0]
         # without merge percentage specified just use the classifier predict().
@@ -800,13 +1013,15 @@ class dpSupervoxelClassifier():
     @staticmethod
     def addArgs(p):
         p.add_argument('--cfgfile', nargs=1, type=str, default='', help='Path/name of ini config file')
-        p.add_argument('--trainin', nargs=1, type=str, default='', help='Input file for loading training data (dill)')
+        p.add_argument('--trainin', nargs=1, type=str, default='',
+            help='Input file for loading training data (dill or hdf5 feature store)')
         p.add_argument('--classifier', nargs=1, type=str, default='lda', help='Which sklearn classifier to use')
         p.add_argument('--classifierin', nargs=1, type=str, default='',
             help='Input file for loading trained classifier(s) (dill)')
         p.add_argument('--classifierout', nargs=1, type=str, default='',
             help='Output file for saving trained classifier(s) (dill)')
-        p.add_argument('--testin', nargs=1, type=str, default='', help='Input file for loading testing data (dill)')
+        p.add_argument('--testin', nargs=1, type=str, default='',
+            help='Input file for loading testing data (dill or hdf5 feature store)')
         p.add_argument('--test-chunks', nargs='*', type=int, default=[],
             metavar='CHUNKS', help='Chunks to use for test (override from .ini)')
         p.add_argument('--show-plots', action='store_true', help='Show various plots')
@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 Paul Watkins, National Institutes of Health / NINDS
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Leave-one-out cross-fold driver for the supervoxel classifier (dpSupervoxelClassifier.py).
+# The features for each chunk are extracted once into a feature store (see utils/FeatureStore.py), instead of
+#   re-extracting the training chunks for each fold as a separate dpSupervoxelClassifier run.
+# All folds (each chunk list index left out for testing) and all classifier types are then trained and tested from the
+#   cached features in a process pool. The edge merge / no merge metrics for every fold and classifier type are saved
+#   to a single results file (dill).
+
+import os
+import numpy as np
+import time
+import argparse
+import copy
+import dill
+from concurrent.futures import ProcessPoolExecutor
+from sklearn.preprocessing import scale
+
+from dpSupervoxelClassifier import dpSupervoxelClassifier, _init_train_worker
+from metrics import pixel_error_fscore
+from utils.FeatureStore import FeatureStore
+
+class dpSupervoxelXfold(dpSupervoxelClassifier):
+
+    # Constants
+    LIST_ARGS = dpSupervoxelClassifier.LIST_ARGS + ['classifiers', 'folds']
+
+    def __init__(self, args):
+        dpSupervoxelClassifier.__init__(self, args)
+
+        # cross-fold only for flat learning from cached features
+        assert( not self.iterative_mode and not self.doplots )
+        assert( FeatureStore.isFeatureStore(self.featurestore) )   # need hdf5 file name for the feature store
+
+        # default is leave-one-out over all the chunk list indices (test_chunks from ini is ignored)
+        if len(self.folds) == 0: self.folds = list(range(self.nchunk_list))
+        assert( all([x >= 0 and x < self.nchunk_list for x in self.folds]) )
+
+    def run(self):
+        self.extract()
+        self.crossfold()
+
+    # extract the features for any chunks that are not already in the feature store, or if the chunk location,
+    #   the feature extraction options or the feature names changed.
+    def extract(self):
+        store = FeatureStore(self.featurestore); cached = []; names = None
+        if os.path.isfile(self.featurestore):
+            options = self.featureOptions()
+            for name, attrs in store.cubes():
+                chunk = attrs['index']
+                if chunk >= self.nchunks or 'feature_names' not in attrs or attrs['feature_options'] != options:
+                    continue
+                cchunk, chunk_list_index, chunk_range_index = self.get_chunk_inds(chunk)
+                offset = self.offset_list[chunk_list_index,:]; size = self.size_list[chunk_list_index,:]
+                # cached chunks must all have the same features, the first matching chunk sets the feature names
+                if names is None: names = list(attrs['feature_names'])
+                if (attrs['chunk'] == cchunk).all() and (attrs['offset'] == offset).all() and \
+                        (attrs['size'] == size).all() and list(attrs['feature_names']) == names:
+                    cached.append(chunk)
+        chunks = [x for x in range(self.nchunks) if x not in cached]
+
+        if self.dpSupervoxelClassifier_verbose:
+            print('\nExtracting features for %d of %d chunks' % (len(chunks), self.nchunks)); t = time.time()
+        extracted = self.extractChunks(store, chunks)
+        # features that changed without the options changing (different code version), also extract cached chunks
+        if names is not None and extracted is not None and extracted != names:
+            if self.dpSupervoxelClassifier_verbose:
+                print('\tfeature names changed, extracting %d cached chunks' % (len(cached),))
+            self.extractChunks(store, cached)
+
+        if self.dpSupervoxelClassifier_verbose:
+            print('\tdone in %.4f s' % (time.time() - t))
+
+    # extract and write the features for the chunks, returns the feature names (None if no chunks)
+    def extractChunks(self, store, chunks):
+        pool = None; futures = []; names = None
+        if self.xfold_nworkers > 1 and len(chunks) > 1:
+            # same as parallel training in dpSupervoxelClassifier, only the datasets are returned from the workers
+            pool = ProcessPoolExecutor(self.xfold_nworkers, initializer=_init_train_worker,
+                initargs=(self.train_worker_mem, self.useFRAGc))
+            futures = [pool.submit(self.trainDataset, x) for x in chunks]
+            datasets = (x.result() for x in futures)
+        else:
+            datasets = map(self.trainDataset, chunks)
+        try:
+            for chunk, data in zip(chunks, datasets):
+                edges = data.pop('edges'); nnodes = data.pop('nnodes')
+                self.writeStore(store, chunk, data, edges, nnodes)
+                names = sorted(data['feature_names'].keys(), key=lambda x: data['feature_names'][x])
+        finally:
+            for x in futures: x.cancel()
+            if pool is not None: pool.shutdown(wait=True)
+        return names
+
+    # train and test all the folds and classifier types and save the consolidated results
+    def crossfold(self):
+        jobs = [(fold, classifier) for classifier in self.classifiers for fold in self.folds]
+        if self.dpSupervoxelClassifier_verbose:
+            print('\nCross-fold with %d folds and %d classifiers' % (len(self.folds), len(self.classifiers)))
+            t = time.time()
+
+        if self.xfold_nworkers > 1 and len(jobs) > 1:
+            with ProcessPoolExecutor(self.xfold_nworkers) as pool:
+                results = list(pool.map(self.runFold, jobs))
+        else:
+            results = list(map(self.runFold, jobs))
+
+        if self.dpSupervoxelClassifier_verbose:
+            print('\tdone in %.4f s' % (time.time() - t))
+
+        # summary over the folds for each classifier type using the classifier predict
+        for classifier in self.classifiers:
+            fscores = np.array([x['predict']['fscore'] for x in results if x['classifier'] == classifier])
+            print('%s: fscore %.4f +- %.4f over %d folds' % (classifier, fscores.mean(), fscores.std(), fscores.size))
+
+        if self.resultsfile:
+            with open(self.resultsfile, 'wb') as f:
+                dill.dump({'results':results, 'folds':self.folds, 'classifiers':self.classifiers,
+                    'thresholds':self.thresholds, 'arg_str':self.arg_str, 'ini_str':self.ini_str}, f)
+        return results
+
+    # train on all chunks not in the fold and test on the chunks in the fold, from the feature store only
+    def runFold(self, job):
+        fold, classifier = job
+        svc = copy.copy(self); svc.test_chunks = [fold]; svc.classifier = classifier
+        svc.trainin = self.featurestore; svc.trainout = ''; svc.classifierin = ''; svc.classifierout = ''
+        svc.train()
+
+        store = FeatureStore(self.featurestore)
+        datasets = [store.read(name) for name, attrs in store.cubes() if attrs['chunk_list_index'] == fold]
+        assert( len(datasets) > 0 )     # no chunks for this fold in the feature store
+        target = np.concatenate([x['target'] for x in datasets])
+        # test data is normalized per chunk, same as in dpSupervoxelClassifier test
+        sdata = [scale(x['data']) for x in datasets]
+        preds = np.concatenate([svc.clf.predict(x) for x in sdata])
+
+        result = {'fold':fold, 'classifier':classifier, 'ntest':target.size,
+            'predict':self.edge_metrics(target, preds), 'thresholds':self.thresholds, 'threshold_metrics':[]}
+        if hasattr(svc.clf, 'predict_proba'):
+            probs = np.concatenate([svc.clf.predict_proba(x)[:,1] for x in sdata])
+            result['threshold_metrics'] = [self.edge_metrics(target, probs > x) for x in self.thresholds]
+
+        print('fold %d, %s: p=%d, n=%d, rec=%.4f, prec=%.4f, fscore=%.4f' % (fold, classifier, (target==1).sum(),
+            (target==0).sum(), result['predict']['recall'], result['predict']['precision'],
+            result['predict']['fscore']))
+        return result
+
+    @staticmethod
+    def edge_metrics(target, preds):
+        fScore, tpr_recall, precision, pixel_error, fpr, tp, tn, fp, fn = pixel_error_fscore(target.astype(bool),
+            preds.astype(bool))
+        return {'fscore':fScore, 'recall':tpr_recall, 'precision':precision, 'fpr':fpr, 'tp':tp, 'tn':tn, 'fp':fp,
+            'fn':fn}
+
+    @staticmethod
+    def addArgs(p):
+        dpSupervoxelClassifier.addArgs(p)
+        p.add_argument('--featurestore', nargs=1, type=str, default='',
+            help='Feature store (hdf5) for the cached chunk features, missing chunks are extracted')
+        p.add_argument('--classifiers', nargs='+', type=str, default=['lda', 'qda', 'rf', 'lr'],
+            help='Which sklearn classifiers to cross-fold')
+        p.add_argument('--folds', nargs='*', type=int, default=[],
+            metavar='FOLDS', help='Chunk list indices to leave out (default all)')
+        p.add_argument('--xfold-nworkers', nargs=1, type=int, default=[1],
+            help='Number of processes for feature extraction and the folds')
+        p.add_argument('--resultsfile', nargs=1, type=str, default='', help='Output file for the results (dill)')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Cross-fold Supervoxel Classifier from cached features',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    dpSupervoxelXfold.addArgs(parser)
+    args = parser.parse_args()
+
+    xfold = dpSupervoxelXfold(args)
+    xfold.run()
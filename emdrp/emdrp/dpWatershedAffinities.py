@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 Paul Watkins, National Institutes of Health / NINDS
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Python object for reading EM affinities and watershedding them to create supervoxels in a single pass.
+#     This is the affinity counterpart to dpWatershedTypes, which iterates over thresholds of voxel type probabilities.
+#     Affinities are expected in the format written by dpMergeProbs (one dataset per dimension, <type>_DIM0..2),
+#     where the affinity at a voxel in a dimension is the affinity to the next voxel in that dimension.
+# Supervoxels are created by:
+#     (1) seeds are affinity connected components at a high threshold, removing seeds smaller than Tmin.
+#     (2) seeded watershed on a voxel "boundary map" made from the mean of the affinities to each neighboring voxel,
+#         only flooding voxels with at least one affinity above a low threshold.
+#     (3) size-based agglomeration, supervoxels smaller than Tsize are merged along edges with maximum affinity.
+# Supervoxels are written to the same subgroups as dpWatershedTypes (with_background, zero_background, no_adjacencies).
+
+import argparse
+import time
+import numpy as np
+from scipy import ndimage as nd
+
+from emdrp.dpLoadh5 import dpLoadh5
+from emdrp.utils.typesh5 import emLabels, emProbabilities
+from emdrp.utils.pyCext.pyCext import label_affinities, seeded_watershed
+from emdrp.utils.utils import print_cpu_info_linux
+
+class dpWatershedAffinities(object):
+
+    def __init__(self, args):
+        # save command line arguments from argparse, see definitions in main or run with --help
+        for k, v in vars(args).items():
+            if type(v) is list and k not in ['subgroups', 'subgroups_out']:
+                # do not save items that are known to be lists (even if one element) as single elements
+                if len(v)==1:
+                    setattr(self,k,v[0])  # save single element lists as first element
+                elif type(v[0]) is int:   # convert the sizes and offsets to numpy arrays
+                    setattr(self,k,np.array(v,dtype=np.int32))
+                else:
+                    setattr(self,k,v)   # store other list types as usual (floats)
+            else:
+                setattr(self,k,v)
+
+        # initialize class properties
+        self.ndims = dpLoadh5.ND
+        self.datasets = [self.affin_type + '_DIM' + str(i) for i in range(self.ndims)]
+
+        # input validations
+        assert( self.ThrLo > 0 and self.ThrLo <= self.ThrHi and self.ThrHi < 1 )
+        assert( self.Tmin > 1 )     # single voxel seeds are not labeled by label_affinities anyways
+
+        # print out all initialized variables in verbose mode
+        if self.dpWatershedAffinities_verbose:
+            print('dpWatershedAffinities, verbose mode:\n'); print(vars(self))
+            print_cpu_info_linux()
+
+    def watershed_cube(self):
+        writeVerbose = False;
+        #writeVerbose = self.dpWatershedAffinities_verbose
+        readVerbose = False;
+        #readVerbose = self.dpWatershedAffinities_verbose
+
+        # load the affinities into a single C-order 4d volume as required by label_affinities
+        affins = np.zeros(np.append(self.size, self.ndims), dtype=emProbabilities.PROBS_DTYPE, order='C')
+        for i in range(self.ndims):
+            loadh5 = dpLoadh5.readData(srcfile=self.probfile, dataset=self.datasets[i], chunk=self.chunk.tolist(),
+                offset=self.offset.tolist(), size=self.size.tolist(), data_type=emProbabilities.PROBS_STR_DTYPE,
+                subgroups=self.subgroups, verbose=readVerbose)
+            self.datasize = loadh5.datasize; self.chunksize = loadh5.chunksize; self.attrs = loadh5.data_attrs
+            affins[:,:,:,i] = loadh5.data_cube; del loadh5
+
+        # save some of the parameters as attributes
+        self.attrs['affin_type'] = self.affin_type; self.attrs['ThrLo'] = self.ThrLo
+        self.attrs['Tsize'] = self.Tsize; self.attrs['ThrMerge'] = self.ThrMerge
+        self.bwconn = nd.morphology.generate_binary_structure(self.ndims, self.connectivity)
+
+        if self.dpWatershedAffinities_verbose:
+            print('creating seeds at affinity threshold = %.8f with Tmin = %d' % (self.ThrHi, self.Tmin))
+            t = time.time()
+
+        # (1) seeds are the affinity graph connected components at high threshold
+        seeds = np.zeros(self.size, dtype=emLabels.LBLS_DTYPE)
+        label_affinities(affins, seeds, 1, float(self.ThrHi))
+        seeds, sizes = emLabels.thresholdSizes(seeds, minSize=self.Tmin)
+
+        if self.dpWatershedAffinities_verbose:
+            print('\tnseeds = %d' % (sizes.size,))
+            print('\tdone in %.4f s' % (time.time() - t,))
+            print('watershedding with affinity threshold = %.8f' % (self.ThrLo,)); t = time.time()
+
+        # (2) seeded watershed on the mean affinity to neighboring voxels, within voxels with any affinity above ThrLo.
+        sumaffins = np.zeros(self.size, dtype=np.float32); maxaffins = np.zeros(self.size, dtype=np.float32)
+        nneighbors = np.zeros(self.size, dtype=np.float32)
+        for i in range(self.ndims):
+            slc = [slice(None)]*self.ndims; slc[i] = slice(0,-1); slc = tuple(slc)
+            nslc = [slice(None)]*self.ndims; nslc[i] = slice(1,None); nslc = tuple(nslc)
+            a = affins[:,:,:,i][slc]
+            for s in [slc, nslc]:
+                sumaffins[s] += a; nneighbors[s] += 1; maxaffins[s] = np.maximum(maxaffins[s], a)
+        nneighbors[nneighbors == 0] = 1
+        mask = np.logical_or(maxaffins > self.ThrLo, seeds > 0); del maxaffins
+        labels = seeded_watershed(1 - sumaffins/nneighbors, seeds, self.bwconn, mask=mask, nblocks=self.ws_nblocks)
+        del sumaffins, nneighbors, mask
+
+        if self.dpWatershedAffinities_verbose:
+            print('\tdone in %.4f s' % (time.time() - t,))
+            print('agglomerating supervoxels smaller than %d with affinity threshold = %.8f' % (self.Tsize,
+                self.ThrMerge)); t = time.time()
+
+        # (3) size-based agglomeration along supervoxel edges with maximum affinity
+        labels, nlabels = self.agglomerate_sizes(labels, affins)
+        del affins
+
+        # make the same label versions as dpWatershedTypes
+        uclabels = emLabels.remove_adjacencies_nconn(labels, bwconn=self.bwconn.copy())
+        wlabels = emLabels.nearest_neighbor_fill(labels, mask=None,
+            sampling=self.attrs['scale'] if 'scale' in self.attrs else None)
+
+        if self.dpWatershedAffinities_verbose:
+            print('\tnlabels = %d' % (nlabels,))
+            print('\tdone in %.4f s' % (time.time() - t,))
+
+        # write out the results
+        subgroups = ['%.8f' % (self.ThrHi,)]
+        d = self.attrs.copy(); d['threshold'] = self.ThrHi
+        d['types_nlabels'] = np.array([nlabels], dtype=np.int64); d['Tmin'] = self.Tmin
+        for data, kind in zip([labels, wlabels, uclabels], ['with_background', 'zero_background', 'no_adjacencies']):
+            emLabels.writeLabels(outfile=self.outlabels, chunk=self.chunk.tolist(), offset=self.offset.tolist(),
+                size=self.size.tolist(), datasize=self.datasize.tolist(), chunksize=self.chunksize.tolist(),
+                data=data, verbose=writeVerbose, attrs=d, strbits=self.outlabelsbits,
+                subgroups=self.subgroups_out + [kind] + subgroups)
+
+    # merge supervoxels smaller than Tsize with the neighbor sharing the maximum affinity, in order of decreasing
+    #   affinity (union-find). edges with affinity below ThrMerge are never merged.
+    def agglomerate_sizes(self, labels, affins):
+        nlabels = int(labels.max()); n = nlabels + 1
+
+        # get the maximum affinity for each pair of neighboring supervoxels
+        edges = []; weights = []
+        for i in range(self.ndims):
+            slc = [slice(None)]*self.ndims; slc[i] = slice(0,-1); slc = tuple(slc)
+            nslc = [slice(None)]*self.ndims; nslc[i] = slice(1,None); nslc = tuple(nslc)
+            a = labels[slc].astype(np.int64); b = labels[nslc].astype(np.int64)
+            sel = np.logical_and(np.logical_and(a > 0, b > 0), a != b)
+            edges.append(np.minimum(a[sel], b[sel])*n + np.maximum(a[sel], b[sel]))
+            weights.append(affins[:,:,:,i][slc][sel])
+        edges = np.concatenate(edges); weights = np.concatenate(weights)
+        if edges.size > 0:
+            order = np.argsort(edges, kind='stable'); edges = edges[order]; weights = weights[order]
+            beg = np.concatenate(([0], np.flatnonzero(np.diff(edges)) + 1))
+            edges = edges[beg]; weights = np.maximum.reduceat(weights, beg)
+        sel = (weights > self.ThrMerge); edges = edges[sel]; weights = weights[sel]
+        order = np.argsort(-weights, kind='stable'); edges = edges[order]
+
+        # union-find over edges in order of decreasing affinity
+        sizes = emLabels.getSizes(labels, nlabels).astype(np.int64)
+        sizes = np.concatenate((sizes, np.zeros((n - sizes.size,), dtype=np.int64)))
+        parent = np.arange(n, dtype=np.int64)
+        def find(x):
+            while parent[x] != x:
+                parent[x] = parent[parent[x]]; x = parent[x]
+            return x
+        for e in edges.tolist():
+            i = find(e // n); j = find(e % n)
+            if i == j or (sizes[i] >= self.Tsize and sizes[j] >= self.Tsize): continue
+            if sizes[i] < sizes[j]: i, j = j, i
+            parent[j] = i; sizes[i] += sizes[j]
+
+        # relabel sequentially using the merged components
+        mapping = np.array([find(x) for x in range(n)], dtype=np.int64)
+        mapping, sizes = emLabels.relabel_sequential(mapping)
+        return mapping[labels], sizes.size
+
+    @staticmethod
+    def addArgs(p):
+        # adds arguments required for this object to specified ArgumentParser object
+        p.add_argument('--probfile', nargs=1, type=str, default='.',
+            help='Path/name of hdf5 affinity probability (input) file')
+        p.add_argument('--affin-type', nargs=1, type=str, default=['ICS'],
+            help='Voxel type (dataset prefix) of the affinities in the hdf5 (datasets <type>_DIM0..2)')
+        p.add_argument('--chunk', nargs=3, type=int, default=[0,0,0], metavar=('X', 'Y', 'Z'),
+            help='Corner chunk to parse out of hdf5')
+        p.add_argument('--offset', nargs=3, type=int, default=[0,0,0], metavar=('X', 'Y', 'Z'),
+            help='Offset in chunk to read')
+        p.add_argument('--size', nargs=3, type=int, default=[256,256,128], metavar=('X', 'Y', 'Z'),
+            help='Size in voxels to read')
+        p.add_argument('--ThrHi', nargs=1, type=float, default=[0.99],
+            help='Affinity threshold for connected components that are used as watershed seeds')
+        p.add_argument('--ThrLo', nargs=1, type=float, default=[0.3],
+            help='Voxels need at least one affinity above this threshold to be flooded by watershed')
+        p.add_argument('--Tmin', nargs=1, type=int, default=[64],
+            help='Minimum component size for seeds')
+        p.add_argument('--Tsize', nargs=1, type=int, default=[256],
+            help='Supervoxels smaller than this are merged to neighbor with max affinity')
+        p.add_argument('--ThrMerge', nargs=1, type=float, default=[0.2],
+            help='Minimum affinity between supervoxels for size-based merging')
+        p.add_argument('--outlabels', nargs=1, type=str, default='', metavar='FILE', help='Supervoxels h5 output file')
+        p.add_argument('--outlabelsbits', nargs=1, type=str, default=['32'], metavar=('BITS'),
+            help='Number of bits for labels (always uint type)')
+        p.add_argument('--connectivity', nargs=1, type=int, default=[1], choices=[1,2,3],
+            help='Connectivity for watershed and for removing adjacencies')
+        p.add_argument('--ws-nblocks', nargs=1, type=int, default=[1],
+            help='Number of blocks to run watershed in parallel (watershed near block edges may differ)')
+        p.add_argument('--subgroups', nargs='*', type=str, default=[], metavar=('GRPS'),
+            help='List of groups to identify subgroup for the input datasets (empty for top level)')
+        p.add_argument('--subgroups-out', nargs='*', type=str, default=[], metavar=('GRPS'),
+            help='List of groups to identify subgroup for the output datasets (empty for top level)')
+        p.add_argument('--dpWatershedAffinities-verbose', action='store_true',
+            help='Debugging output for dpWatershedAffinities')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Read EM affinity data from h5 and create supervoxels',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    dpWatershedAffinities.addArgs(parser)
+    args = parser.parse_args()
+
+    ws = dpWatershedAffinities(args)
+    ws.watershed_cube()
@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 Paul Watkins, National Institutes of Health / NINDS
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Block-parallel whole dataset watershed with globally consistent supervoxel ids.
+# Instead of running dpWatershedTypes per cube (from dpCubeIter command lines) and then stitching with dpCubeStitcher:
+#     (1) workers in a local process pool run dpWatershedTypes on blocks (cubes from dpCubeIter) with an overlap halo.
+#         each worker returns the labels in slabs around each face of its block core (face label tables).
+#     (2) a single reduction links labels across faces (same method as dpCubeStitcher two pass, each label is linked
+#         to the label in the neighboring block with max overlap) and runs connected components (union-find) on
+#         the links of all the faces to get the global supervoxel ids.
+#     (3) the block cores are remapped to the global ids and written to the output.
+# All the label datasets written by the watershed (each threshold and label type) are stitched separately.
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+import multiprocessing
+import numpy as np
+import h5py
+import scipy.sparse as sparse
+from scipy.sparse.csgraph import connected_components
+
+from emdrp.dpCubeIter import dpCubeIter
+from emdrp.dpLoadh5 import dpLoadh5
+from emdrp.dpWatershedTypes import dpWatershedTypes
+from emdrp.utils.typesh5 import emLabels, emVoxelType
+
+class dpWatershedBlocks(object):
+
+    def __init__(self, args):
+        self.args = args
+        self.nworkers = args.nworkers[0] if type(args.nworkers) is list else args.nworkers
+        self.tmpdir = args.tmpdir[0] if type(args.tmpdir) is list else args.tmpdir
+        self.outlabels = args.outlabels[0] if type(args.outlabels) is list else args.outlabels
+        self.keep_blocks = args.keep_blocks; self.dpWatershedBlocks_verbose = args.dpWatershedBlocks_verbose
+
+        # the blocks are the cubes iterated by dpCubeIter, the overlap is the halo around each block core
+        p = argparse.ArgumentParser(); dpCubeIter.addArgs(p); cube_args = p.parse_args([])
+        for k in vars(cube_args).keys(): setattr(cube_args, k, getattr(args, k))
+        self.cubeIter = dpCubeIter(cube_args)
+        assert( not self.cubeIter.left_remainder.any() and not self.cubeIter.right_remainder.any() ) # not supported
+        assert( not self.cubeIter.leave_edge and not self.cubeIter.filemodulators_overlap_on )      # not supported
+        self.overlap = np.array(self.cubeIter.overlap, dtype=np.int64)
+        self.core_size = np.array(self.cubeIter.cube_size_voxels, dtype=np.int64)
+        assert( (self.overlap > 0).all() and (2*self.overlap <= self.core_size).all() )
+
+        self.blocks = []; self.block_index = {}
+        for volume_info in self.cubeIter:
+            cur_volume, size, chunk, left_offset, _, _, is_left_border, is_right_border, _ = volume_info
+            self.block_index[tuple(cur_volume.tolist())] = len(self.blocks)
+            self.blocks.append((cur_volume, size, chunk, left_offset, is_left_border, is_right_border))
+        self.nblocks = len(self.blocks)
+
+        # arguments for the watershed on each block, only those for dpWatershedTypes
+        p = argparse.ArgumentParser(); dpWatershedTypes.addArgs(p); self.ws_args = p.parse_args([])
+        for k in vars(self.ws_args).keys(): setattr(self.ws_args, k, getattr(args, k))
+
+        if self.dpWatershedBlocks_verbose:
+            print('dpWatershedBlocks, verbose mode:\n'); print(vars(self))
+
+    def watershed(self):
+        tmpdir = tempfile.mkdtemp(dir=self.tmpdir if self.tmpdir else None)
+        self.blockfiles = [os.path.join(tmpdir, 'block%06d.h5' % (n,)) for n in range(self.nblocks)]
+
+        if self.dpWatershedBlocks_verbose:
+            print('Watershedding %d blocks with %d workers' % (self.nblocks, self.nworkers)); t = time.time()
+
+        # (1) watershed all the blocks in parallel, collect the face label tables
+        with multiprocessing.Pool(self.nworkers) as pool:
+            results = pool.map(self.watershed_block, range(self.nblocks))
+        nlabels = [x[0] for x in results]; faces = [x[1] for x in results]; del results
+        self.subgroups = self.get_label_subgroups(self.blockfiles[0])
+
+        if self.dpWatershedBlocks_verbose:
+            print('\tdone in %.4f s' % (time.time() - t, ))
+            print('Resolving faces for %d label datasets' % (len(self.subgroups), )); t = time.time()
+
+        # (2) resolve the faces to get the mapping from per block ids to global ids for each label dataset
+        mappings = {}; offsets = {}
+        for subgroups in self.subgroups:
+            key = tuple(subgroups)
+            offsets[key] = np.cumsum([0] + [x[key] for x in nlabels], dtype=np.int64)
+            mappings[key] = self.resolve_faces(key, [x[key] for x in faces], offsets[key])
+        del faces
+
+        if self.dpWatershedBlocks_verbose:
+            print('\tdone in %.4f s' % (time.time() - t, ))
+            print('Remapping and writing %d blocks' % (self.nblocks, )); t = time.time()
+
+        # (3) remap the block cores and write to output, hdf5 output is only written from this process
+        with multiprocessing.Pool(self.nworkers) as pool:
+            for n, cores in enumerate(pool.imap(self.read_block_cores, range(self.nblocks))):
+                _, _, chunk, _, _, _ = self.blocks[n]
+                for key, data in cores.items():
+                    if key is None: continue
+                    data = data.astype(np.int64); sel = (data > 0); data[sel] += offsets[key][n]
+                    data = mappings[key][0][data]
+                    attrs = cores[None][key]; attrs['types_nlabels'] = [mappings[key][1]]
+                    emLabels.writeLabels(outfile=self.outlabels, chunk=chunk.tolist(), offset=[0,0,0],
+                        size=self.core_size.tolist(), datasize=cores[None]['datasize'].tolist(),
+                        chunksize=self.cubeIter.chunksize.tolist(), data=data, attrs=attrs,
+                        strbits=self.ws_args.outlabelsbits[0], subgroups=list(key))
+                if self.voxel_type is not None:
+                    emVoxelType.writeVoxType(outfile=self.outlabels, chunk=chunk.tolist(), offset=[0,0,0],
+                        size=self.core_size.tolist(), datasize=cores[None]['datasize'].tolist(),
+                        chunksize=self.cubeIter.chunksize.tolist(), data=cores[None]['voxel_type'],
+                        subgroups_out=self.ws_args.subgroups_out)
+
+        if self.dpWatershedBlocks_verbose:
+            print('\tdone in %.4f s' % (time.time() - t, ))
+
+        if not self.keep_blocks: shutil.rmtree(tmpdir)
+
+    # worker: run watershed on a single block with halo, return label counts and face label tables.
+    def watershed_block(self, n):
+        cur_volume, size, chunk, left_offset, is_left_border, is_right_border = self.blocks[n]
+        args = argparse.Namespace(**vars(self.ws_args))
+        args.chunk = chunk.tolist(); args.offset = left_offset.tolist(); args.size = size.tolist()
+        args.outlabels = [self.blockfiles[n]]
+        ws = dpWatershedTypes(args); ws.watershed_cube(); del ws
+
+        nlabels = {}; faces = {}
+        for subgroups in self.get_label_subgroups(self.blockfiles[n]):
+            key = tuple(subgroups)
+            data = emLabels.readLabels(srcfile=self.blockfiles[n], chunk=chunk.tolist(), offset=left_offset.tolist(),
+                size=size.tolist(), subgroups=subgroups).data_cube
+            nlabels[key] = int(data.max())
+            faces[key] = [[data[self.get_face_slices(n, d, side)] for side in range(2)] for d in range(dpLoadh5.ND)]
+            # labels present in the core, labels only in the halo do not get global ids
+            faces[key].append(np.unique(data[tuple(slice(x, x + y) for x, y in zip(-left_offset, self.core_size))]))
+        return nlabels, faces
+
+    # worker: read the cores of all label datasets (and voxel type) for a single block.
+    # the None key contains the attributes for each label dataset and the voxel type.
+    def read_block_cores(self, n):
+        _, _, chunk, _, _, _ = self.blocks[n]
+        cores = {None:{}}
+        for subgroups in self.subgroups:
+            loadh5 = emLabels.readLabels(srcfile=self.blockfiles[n], chunk=chunk.tolist(), offset=[0,0,0],
+                size=self.core_size.tolist(), subgroups=subgroups)
+            cores[tuple(subgroups)] = loadh5.data_cube; cores[None][tuple(subgroups)] = loadh5.data_attrs
+            cores[None]['datasize'] = loadh5.datasize
+        if self.voxel_type is not None:
+            cores[None]['voxel_type'] = dpLoadh5.readData(srcfile=self.blockfiles[n],
+                dataset=emVoxelType.VOXTYPE_DATASET, chunk=chunk.tolist(), offset=[0,0,0],
+                size=self.core_size.tolist(), subgroups=self.ws_args.subgroups_out).data_cube
+        return cores
+
+    # the face label tables are slabs around the face of the block core, halo on one side and core on the other.
+    # the right face slab of a block covers the same voxels as the left face slab of the next block in that dimension.
+    def get_face_slices(self, n, d, side):
+        _, size, _, left_offset, is_left_border, is_right_border = self.blocks[n]
+        if (is_left_border if side == 0 else is_right_border)[d]: return tuple([slice(0,0)]*dpLoadh5.ND)
+        core_beg = -left_offset; core_end = core_beg + self.core_size
+        slc = [slice(core_beg[i], core_end[i]) for i in range(dpLoadh5.ND)]
+        face = core_beg[d] if side == 0 else core_end[d]
+        slc[d] = slice(face - self.overlap[d], face + self.overlap[d])
+        return tuple(slc)
+
+    # link labels across all block faces and run connected components to get the global ids.
+    # each label is linked to the label with the max overlap in the previous block (as in dpCubeStitcher two pass).
+    def resolve_faces(self, key, faces, offsets):
+        ntotal = int(offsets[-1]) + 1; links = [np.zeros((0,), dtype=np.int64)]*2
+        for n in range(self.nblocks):
+            cur_volume = self.blocks[n][0]
+            for d in range(dpLoadh5.ND):
+                nxt = cur_volume.copy(); nxt[d] += 1; m = self.block_index.get(tuple(nxt.tolist()))
+                if m is None: continue
+                prv = faces[n][d][1].astype(np.int64); cur = faces[m][d][0].astype(np.int64)
+                assert( prv.shape == cur.shape )
+                sel = np.logical_and(prv > 0, cur > 0)
+                prv = prv[sel] + offsets[n]; cur = cur[sel] + offsets[m]
+                if prv.size == 0: continue
+
+                # for each label in the current block get the label in the previous block with max overlap
+                pairs, counts = np.unique(cur*ntotal + prv, return_counts=True)
+                pc = pairs // ntotal; pp = pairs % ntotal
+                order = np.lexsort((counts, pc)); pc = pc[order]; pp = pp[order]
+                last = np.ones(pc.shape, dtype=bool); last[:-1] = (pc[1:] != pc[:-1])
+                links = [np.concatenate((links[0], pc[last])), np.concatenate((links[1], pp[last]))]
+
+        G = sparse.coo_matrix((np.ones(links[0].shape, dtype=bool), (links[0], links[1])), shape=(ntotal,ntotal))
+        ncomps, comps = connected_components(G, directed=False)
+
+        # sequential global ids in order of first label in each component for components present in any core
+        present = np.zeros((ntotal,), dtype=bool)
+        for n in range(self.nblocks):
+            cur = faces[n][dpLoadh5.ND]; present[cur[cur > 0] + offsets[n]] = 1
+        present[0] = 1; present = np.unique(comps[present])
+        _, first = np.unique(comps, return_index=True); first = first[present]
+        rank = np.zeros((ncomps,), dtype=np.int64); rank[present[np.argsort(first)]] = np.arange(present.size)
+        mapping = rank[comps]; assert( mapping[0] == 0 )
+        return mapping, present.size - 1
+
+    # all the label datasets written by dpWatershedTypes, along with whether voxel type was written
+    def get_label_subgroups(self, fn):
+        subgroups = []
+        def visit(name, obj):
+            path = name.split('/')
+            if path[-1] in [emLabels.LBLS_DATASET, emLabels.LBLS_DELTA_DATASET]: subgroups.append(path[:-1])
+        h5file = h5py.File(fn, 'r'); h5file.visititems(visit)
+        self.voxel_type = emVoxelType.VOXTYPE_DATASET if \
+            '/'.join(self.ws_args.subgroups_out + [emVoxelType.VOXTYPE_DATASET]) in h5file else None
+        h5file.close()
+        return sorted(subgroups)
+
+    @staticmethod
+    def addArgs(p):
+        dpWatershedTypes.addArgs(p)
+        dpCubeIter.addArgs(p)
+        p.add_argument('--nworkers', nargs=1, type=int, default=[multiprocessing.cpu_count()],
+            help='Number of worker processes for watershedding blocks')
+        p.add_argument('--tmpdir', nargs=1, type=str, default='',
+            help='Directory for temporary block outputs (default system temp)')
+        p.add_argument('--keep-blocks', action='store_true', help='Do not delete the temporary block outputs')
+        p.add_argument('--dpWatershedBlocks-verbose', action='store_true',
+            help='Debugging output for dpWatershedBlocks')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Block parallel watershed of EM voxel type probabilities ' + \
+        'with global supervoxel ids', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    dpWatershedBlocks.addArgs(parser)
+    args = parser.parse_args()
+
+    ws = dpWatershedBlocks(args)
+    ws.watershed()
@@ -38,13 +38,12 @@ import time
 import numpy as np
 import h5py
 from scipy import ndimage as nd
-from scipy import interpolate
-from skimage import morphology as morph
-import networkx as nx
+import scipy.sparse as sparse
+from scipy.sparse.csgraph import connected_components
 
 from emdrp.dpLoadh5 import dpLoadh5
 from emdrp.utils.typesh5 import emLabels, emProbabilities, emVoxelType
-from emdrp.utils.pyCext.pyCext import binary_warping
+from emdrp.utils.pyCext.pyCext import binary_warping, seeded_watershed, label_overlap
 from emdrp.utils.utils import print_cpu_info_linux
 
 class dpWatershedTypes(object):
@@ -143,7 +142,7 @@ class dpWatershedTypes(object):
                 for i in range(self.ntypes): probs[i][loadh5.data_cube==i] = 1
             else:
                 # optionally "clean" labels by removing small bg and fg components for each foreground type
-                fgbwlabels = np.zeros(self.size, dtype=np.bool)
+                fgbwlabels = np.zeros(self.size, dtype=bool)
                 for i in range(self.nfg_types):
                     # background connected components and threshold
                     comps, nlbls = nd.measurements.label(loadh5.data_cube!=i+1)
@@ -196,7 +195,7 @@ class dpWatershedTypes(object):
         # optionally apply filters in attempt to fill small background (membrane) probability gaps.
         if self.close_bg > 0:
             # create structuring element
-            n = 2*self.close_bg + 1; h = self.close_bg; strel = np.zeros((n,n,n),dtype=np.bool); strel[h,h,h]=1;
+            n = 2*self.close_bg + 1; h = self.close_bg; strel = np.zeros((n,n,n),dtype=bool); strel[h,h,h]=1;
             strel = nd.binary_dilation(strel,iterations=self.close_bg)
 
             # xxx - this was the only thing tried here that helped some but didn't work well against the skeletons
@@ -242,7 +241,8 @@ class dpWatershedTypes(object):
         # at last iteration keep all remaining components.
         # do this separately for foreground types.
         for k in range(self.nTmin):
-            for i in range(self.nfg_types): bwseeds[i] = np.zeros(self.size, dtype=np.bool, order='C')
+            for i in range(self.nfg_types): bwseeds[i] = np.zeros(self.size, dtype=bool, order='C')
+            self.delta_pending = {}
             for i in range(self.nthresh):
                 if self.dpWatershedTypes_verbose:
                     print('creating supervoxels at threshold = %.8f with Tmin = %d' % (self.Ts[i], self.Tmins[k]))
@@ -284,18 +284,16 @@ class dpWatershedTypes(object):
                         uclabels, ucnlabels = emLabels.remove_adjacencies(labels)
                     elif self.method == 'skim-ws':
                         # xxx - still trying to evaluate if there is any advantage to this more traditional watershed.
-                        #   it does not leave a non-adjacency boundary and is about 1.5 times slower than bwmorph
 
                         # run connected components on the thresholded labels merged with previous seeds
                         labels, nlabels = nd.measurements.label(bwlabels, self.bwconn)
 
-                        # run a true watershed based the current foreground probs using current components as markers
-                        labels = morph.watershed(probs[j+1], labels, connectivity=self.bwconn, mask=voxTypeSel[j])
-
-                        # remove any adjacencies created during the watershed
-                        # NOTE: currently this only removes 6-connectivity, no matter what specified connecitity is
-                        # xxx - some method of removing adjacencies with arbitrary connectivity?
-                        uclabels, ucnlabels = emLabels.remove_adjacencies(labels)
+                        # run a true watershed based the current foreground probs using current components as markers.
+                        # the native watershed also leaves a non-adjacency boundary (with specified connectivity)
+                        #   for the unconnected labels, so no separate pass to remove adjacencies is needed.
+                        labels, uclabels = seeded_watershed(probs[j+1], labels, self.bwconn, mask=voxTypeSel[j],
+                            no_adjacencies=True, nblocks=self.ws_nblocks)
+                        ucnlabels = nlabels     # markers are never removed by the non-adjacency boundary
                     else:
                         if self.method == 'comps-ws' and i>1:
                             # this is an alternative to the traditional watershed that warps out only based on stepping
@@ -307,14 +305,14 @@ class dpWatershedTypes(object):
                             # make an unconnected version of bwlabels by warping out but with mask only for this type
                             # everything above current threshold is already labeled, so only need to use gray thresholds
                             #    starting below the current threshold level.
-                            bwlabels, diff, self.simpleLUT = binary_warping(bwlabels, np.ones(self.size,dtype=np.bool),
+                            bwlabels, diff, self.simpleLUT = binary_warping(bwlabels, np.ones(self.size,dtype=bool),
                                 mask=voxTypeSel[j], borderval=False, slow=True, simpleLUT=self.simpleLUT,
                                 connectivity=self.connectivity, gray=probs[j+1],
                                 grayThresholds=self.Ts[i-1::-1].astype(np.float32, order='C'))
                         else:
                             assert( self.method == 'comps' )     # bad method option
                             # make an unconnected version of bwlabels by warping out but with mask only for this type
-                            bwlabels, diff, self.simpleLUT = binary_warping(bwlabels, np.ones(self.size,dtype=np.bool),
+                            bwlabels, diff, self.simpleLUT = binary_warping(bwlabels, np.ones(self.size,dtype=bool),
                                 mask=voxTypeSel[j], borderval=False, slow=True, simpleLUT=self.simpleLUT,
                                 connectivity=self.connectivity)
 
@@ -382,88 +380,106 @@ class dpWatershedTypes(object):
                     else: subgroups = ['%d' % (self.Tmins[k],), '%.8f' % (self.Ts[i],)]
                     d = self.attrs.copy(); d['threshold'] = self.Ts[i];
                     d['types_nlabels'] = types_nlabels; d['Tmin'] = self.Tmins[k]
-                    emLabels.writeLabels(outfile=self.outlabels, chunk=self.chunk.tolist(),
-                        offset=self.offset_crop.tolist(), size=self.size_crop.tolist(), datasize=self.datasize.tolist(),
-                        chunksize=self.chunksize.tolist(), data=labels, verbose=writeVerbose,
-                        attrs=d, strbits=self.outlabelsbits, subgroups=self.subgroups_out+['with_background']+subgroups )
-                    emLabels.writeLabels(outfile=self.outlabels, chunk=self.chunk.tolist(),
-                        offset=self.offset_crop.tolist(), size=self.size_crop.tolist(), datasize=self.datasize.tolist(),
-                        chunksize=self.chunksize.tolist(), data=wlabels, verbose=writeVerbose,
-                        attrs=d, strbits=self.outlabelsbits, subgroups=self.subgroups_out+['zero_background']+subgroups )
-                    d['type_nlabels'] = types_ucnlabels;
-                    emLabels.writeLabels(outfile=self.outlabels, chunk=self.chunk.tolist(),
-                        offset=self.offset_crop.tolist(), size=self.size_crop.tolist(), datasize=self.datasize.tolist(),
-                        chunksize=self.chunksize.tolist(), data=uclabels, verbose=writeVerbose,
-                        attrs=d, strbits=self.outlabelsbits, subgroups=self.subgroups_out+['no_adjacencies']+subgroups )
+                    self.write_labels(labels, 'with_background', subgroups, d)
+                    self.write_labels(wlabels, 'zero_background', subgroups, d)
+                    d = d.copy(); d['type_nlabels'] = types_ucnlabels;
+                    self.write_labels(uclabels, 'no_adjacencies', subgroups, d)
                     if self.skeletonize:
-                        emLabels.writeLabels(outfile=self.outlabels, chunk=self.chunk.tolist(),
-                            offset=self.offset_crop.tolist(), size=self.size_crop.tolist(),
-                            datasize=self.datasize.tolist(), chunksize=self.chunksize.tolist(), data=sklabels,
-                            verbose=writeVerbose, attrs=d, strbits=self.outlabelsbits,
-                            subgroups=self.subgroups_out+['skeletonized']+subgroups )
+                        self.write_labels(sklabels, 'skeletonized', subgroups, d)
+
+            # in delta mode the labels at the last (finest) saved threshold are written in full
+            self.write_labels_flush()
+
+    # write labels for a saved threshold. in delta mode labels are held until labels at the next (finer) saved
+    #   threshold are available, then only written as a lookup table (plus residual voxels) into the finer labels.
+    #   supervoxels at increasing thresholds are (mostly) nested refinements, so this is much smaller than full labels.
+    # emLabels.readLabels reconstructs the labels at any saved threshold from the deltas.
+    def write_labels(self, data, kind, subgroups, attrs):
+        writeVerbose = False;
+        #writeVerbose = self.dpWatershedTypes_verbose
+        subgroups = self.subgroups_out + [kind] + subgroups
+        if self.delta_out:
+            if kind in self.delta_pending:
+                pdata, psubgroups, pattrs = self.delta_pending[kind]
+                lut, inds, vals = emLabels.delta_encode(data, pdata)
+                emLabels.writeLabelsDelta(outfile=self.outlabels, chunk=self.chunk.tolist(),
+                    offset=self.offset_crop.tolist(), size=self.size_crop.tolist(), lut=lut, inds=inds, vals=vals,
+                    base=subgroups, attrs=pattrs, subgroups=psubgroups, verbose=writeVerbose)
+            self.delta_pending[kind] = (data, subgroups, attrs.copy())
+        else:
+            emLabels.writeLabels(outfile=self.outlabels, chunk=self.chunk.tolist(),
+                offset=self.offset_crop.tolist(), size=self.size_crop.tolist(), datasize=self.datasize.tolist(),
+                chunksize=self.chunksize.tolist(), data=data, verbose=writeVerbose,
+                attrs=attrs, strbits=self.outlabelsbits, subgroups=subgroups )
+
+    def write_labels_flush(self):
+        if not self.delta_out: return
+        for kind,(data, subgroups, attrs) in self.delta_pending.items():
+            emLabels.writeLabels(outfile=self.outlabels, chunk=self.chunk.tolist(),
+                offset=self.offset_crop.tolist(), size=self.size_crop.tolist(), datasize=self.datasize.tolist(),
+                chunksize=self.chunksize.tolist(), data=data, attrs=attrs, strbits=self.outlabelsbits,
+                subgroups=subgroups )
+        self.delta_pending = {}
 
     # This labeling method connects zslices layer-by-layer. This can be done by simply overlapping the eroded labeled
     #   regoins or by overlapping by using warped labels (with warps generated externally by some optic flow method).
+    # Only the binary warping is done per zslice, the labeling, warping and overlap linking of all zslices is vectorized,
+    #   followed by a single connected components (union-find) over the linked labels of all the zslices.
     def label_overlap(self, bwlabels, mask, warps=None):
-        # this method operates slice by slice
-        zlabels = np.zeros(self.size, dtype=np.int64)
-        nzlabels = 0; prv_labels = None; connections = [None]*(self.size[2]-1)
         s = self.size; s2 = [s[0], s[1], 1]; c = self.cropborder
+
+        # make an unconnected version of bwlabels by warping out but with mask only for this type, per zslice
+        fill_bwlabels = np.zeros(self.size, dtype=bool)
+        for z in range(self.size[2]):
+            bw = bwlabels[:,:,z][:,:,None].copy(order='C'); msk = mask[:,:,z][:,:,None].copy(order='C')
+            bw, diff, self.simpleLUT = binary_warping(bw, np.ones(s2,dtype=bool),
+                mask=msk, borderval=False, slow=True, simpleLUT=self.simpleLUT, connectivity=self.connectivity)
+            fill_bwlabels[:,:,z] = bw[:,:,0]
+
+        # run connected components on the thresholded labels merged with previous seeds (warped out).
+        # no connectivity in z, so this labels all zslices at once with labels unique across zslices.
+        bwconn = np.zeros((3,3,3), dtype=bool); bwconn[:,:,1] = self.bwconn2d
+        zlabels = np.zeros(self.size, dtype=np.int64)
+        nzlabels = nd.measurements.label(fill_bwlabels, bwconn, output=zlabels)
+
+        # get eroded labels by applying mask for original bwlabels
+        cur_labels = zlabels.copy(); cur_labels[np.logical_not(bwlabels)] = 0
+        prv_labels = cur_labels[:,:,:-1]; cur_labels = cur_labels[:,:,1:]
+
         if warps:
+            # apply warping from previous label slices to current slices using nearest neighbor interpolation.
+            # nearest rounds ties down and points outside of the slice are background, same as RegularGridInterpolator.
             x = np.arange(s[0], dtype=warps[0].dtype); y = np.arange(s[1], dtype=warps[0].dtype)
             X = np.meshgrid(x,y, indexing='ij')
-        for z in range(self.size[2]):
-            # get bwlabels and mask for the current zslice
-            cur_bwlabels = bwlabels[:,:,z]; cur_mask = mask[:,:,z]
-
-            # make an unconnected version of bwlabels by warping out but with mask only for this type
-            bw = cur_bwlabels[:,:,None].copy(order='C'); msk = cur_mask[:,:,None].copy(order='C')
-            bw, diff, self.simpleLUT = binary_warping(bw, np.ones(s2,dtype=np.bool),
-                mask=msk, borderval=False, slow=True, simpleLUT=self.simpleLUT, connectivity=self.connectivity)
-            cur_fill_bwlabels = bw[:,:,0]
-
-            # run connected components on the thresholded labels merged with previous seeds (warped out)
-            cur_fill_labels, cur_nlabels = nd.measurements.label(cur_fill_bwlabels, self.bwconn2d, output=np.int64)
-
-            # make labels for this zslice unique and add to whole label cube
-            sel = (cur_fill_labels > 0); cur_fill_labels[sel] += nzlabels; zlabels[:,:,z] = cur_fill_labels
-
-            # get eroded labels by applying mask for original bwlabels
-            cur_labels = cur_fill_labels.copy(); cur_labels[np.logical_not(cur_bwlabels)] = 0
-
-            # warp the previous slice to this slice and connect them
-            if z > 0:
-                if warps:
-                    # apply warping from previous label slice to current slice using nearest neighbor interpolation.
-                    cur_warpsx = warps[0][:,:,z-1]; cur_warpsy = warps[1][:,:,z-1]
-                    xi = X[0] + cur_warpsx; yi = X[1] + cur_warpsy
-                    # remove warps that are out of the size bounds
-                    #xi[xi < 0] = 0; xi[xi > s[0]-1] = s[0]-1; yi[yi < 0] = 0; yi[yi > s[1]-1] = s[1]-1
-                    f = interpolate.RegularGridInterpolator((x,y), prv_labels, method='nearest',
-                        bounds_error=False, fill_value=0)
-                    prv_labels = f( np.vstack((xi.ravel(),yi.ravel())).T ).reshape(prv_labels.shape)
-
-                # map the previous warped labels to the current labels based on pixel-by-pixel overlap of eroded labels.
-                # only used the xy cropped area to do the linkage.
-                prv_labels_crop = prv_labels; cur_labels_crop = cur_labels
-                if self.docrop:
-                    prv_labels_crop = prv_labels_crop[c[0]:s[0]-c[0],c[1]:s[1]-c[1]]
-                    cur_labels_crop = cur_labels_crop[c[0]:s[0]-c[0],c[1]:s[1]-c[1]]
-                tmp = dpWatershedTypes.unique_rows(\
-                    np.ascontiguousarray( np.vstack((prv_labels_crop.ravel(),cur_labels_crop.ravel())).T ))
-                # remove background connections (any rows with zeros)
-                connections[z-1] = tmp[(tmp>0).all(axis=1),:]
-
-            # loop updates for linking current slice to next
-            prv_labels = cur_labels; nzlabels += cur_nlabels
-
-        # run graph connected components on graph created from pairwise connections.
+            xi = X[0][:,:,None] + warps[0][:,:,:-1]; yi = X[1][:,:,None] + warps[1][:,:,:-1]
+            sel = np.logical_and(np.logical_and(xi >= 0, xi <= s[0]-1), np.logical_and(yi >= 0, yi <= s[1]-1))
+            xi = np.ceil(xi - 0.5).astype(np.int64); yi = np.ceil(yi - 0.5).astype(np.int64)
+            xi[np.logical_not(sel)] = 0; yi[np.logical_not(sel)] = 0
+            zi = np.broadcast_to(np.arange(s[2]-1, dtype=np.int64), xi.shape)
+            prv_labels = prv_labels[xi, yi, zi]; prv_labels[np.logical_not(sel)] = 0
+
+        # map the previous warped labels to the current labels based on pixel-by-pixel overlap of eroded labels.
+        # only used the xy cropped area to do the linkage.
+        if self.docrop:
+            prv_labels = prv_labels[c[0]:s[0]-c[0],c[1]:s[1]-c[1],:]
+            cur_labels = cur_labels[c[0]:s[0]-c[0],c[1]:s[1]-c[1],:]
+        # remove background connections (any pairs with zeros)
+        connections, _ = label_overlap(prv_labels, cur_labels, nonzero=True)
+        connections = connections.astype(np.int64)
+
+        # run connected components on graph created from pairwise connections.
         # this graph represents labels that have been linked by the warping between zslices.
-        G = nx.Graph(); G.add_edges_from(np.vstack(connections))
-        compsG = nx.connected_components(G); nlabels = 0; mapping = np.zeros((nzlabels+1,), dtype=np.int64)
-        for nodes in compsG:
-            # create mapping from current per-zslice labels to linked labels across zslices
-            nlabels += 1; mapping[np.array(tuple(nodes),dtype=np.int64)] = nlabels
+        G = sparse.coo_matrix((np.ones((connections.shape[0],), dtype=bool),
+            (connections[:,0], connections[:,1])), shape=(nzlabels+1,nzlabels+1))
+        ncomps, comps = connected_components(G, directed=False)
+
+        # create mapping from current per-zslice labels to linked labels across zslices.
+        # only labels that are linked to another zslice are kept (labels with no connections are set to background).
+        linked = np.zeros((nzlabels+1,), dtype=bool); linked[connections[:,0]] = 1
+        linked[connections[:,1]] = 1
+        mapping = np.zeros((nzlabels+1,), dtype=np.int64)
+        ucomps, mapping[linked] = np.unique(comps[linked], return_inverse=True); nlabels = ucomps.size
+        mapping[linked] += 1
 
         # create the final labels using the mapping built from the graph connected components
         return mapping[zlabels], nlabels
@@ -531,12 +547,16 @@ class dpWatershedTypes(object):
             help='Datasets for x/y warpings')
         p.add_argument('--cropborder', nargs=3, type=int, default=[0,0,0], metavar=('X', 'Y', 'Z'),
            help='Optionally crop down outputs before writing')
+        p.add_argument('--ws-nblocks', nargs=1, type=int, default=[1],
+            help='Number of blocks to run in parallel for skim-ws method (watershed near block edges may differ)')
         p.add_argument('--close-bg', nargs=1, type=int, default=[0], choices=range(5),
             help='Diamond radius of structuring element to try to fill in background (membrane) gaps')
         p.add_argument('--subgroups', nargs='*', type=str, default=[], metavar=('GRPS'),
             help='List of groups to identify subgroup for the input datasets (empty for top level)')            
         p.add_argument('--subgroups-out', nargs='*', type=str, default=[], metavar=('GRPS'),
             help='List of groups to identify subgroup for the output datasets (empty for top level)')            
+        p.add_argument('--delta-out', action='store_true',
+            help='Write labels only at finest saved threshold, other thresholds as lookup tables into finer labels')
         p.add_argument('--dpWatershedTypes-verbose', action='store_true',
             help='Debugging output for dpWatershedTypes')
 
@@ -165,10 +165,11 @@ if not plot_only:
             fps = os.path.join(segp, seg)
             print('calculating metrics for ' + seg + (' chunk %d %d %d' % tuple(chunk))); t = time.time()
 
+            # thresholds written as agglomeration tables only read the base supervoxels once
+            base_cache = {}
             for k,prm in zip(range(nparams[i]),segparams[i]):
-                loadh5 = emLabels.readLabels(srcfile=fps, chunk=chunk, offset=offset, size=size,
+                segComps = emLabels.readLabelsCached(fps, chunk, offset, size, base_cache,
                     subgroups=subgroups[i] + ['%.8f' % (prm,)])
-                segComps = loadh5.data_cube
 
                 # calculate the ISBI2013 rand error (gala, excludes gt background) using the full out components
                 are, prec, rec = ev.adapted_rand_error(segComps, gtComps, all_stats=True)
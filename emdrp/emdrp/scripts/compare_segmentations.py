@@ -179,10 +179,11 @@ if not plot_only:
             # calculate the categorization error
             cat_error[i,j] = (gtLbls != outLbls).sum(dtype=np.int64) / float(outLbls.size)
 
+            # thresholds written as agglomeration tables only read the base supervoxels once
+            base_cache = {}
             for k,prm in zip(range(nparams[i]),segparams[i]):
-                loadh5 = emLabels.readLabels(srcfile=fps, chunk=chunk, offset=offset, size=size,
+                segComps = emLabels.readLabelsCached(fps, chunk, offset, size, base_cache,
                     subgroups=subgroups[i] + ['%.8f' % (prm,)], verbose=False)
-                segComps = loadh5.data_cube
 
                 # calculate the ISBI2013 rand error (gala, excludes gt background) using the full out components
                 are, prec, rec = ev.adapted_rand_error(segComps, gtComps, all_stats=True)
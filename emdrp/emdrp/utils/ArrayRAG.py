@@ -0,0 +1,312 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 Paul Watkins, National Institutes of Health / NINDS
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Array-backed region adjacency graph (RAG) for supervoxels, replaces the networkx graph in dpFRAG.
+# With hundreds of thousands of supervoxels the per-node and per-edge python dicts in networkx use gigabytes.
+#   (1) nodes are the supervoxels 1..nnodes (0 is background and is never a node).
+#   (2) edges are stored as int32 node pairs (i < j), edge ids are the rows of the edge array.
+#       sort() puts the edges in lexicographic order, which is the order used for the feature matrix / datasets.
+#   (3) edge features are stored in a contiguous float matrix with named columns (parallel to the edge array).
+#   (4) neighbors are looked up from a CSR adjacency that is built on demand.
+#   (5) optional node and edge attributes (optimizations in dpFRAG update mode) are sparse dicts keyed by
+#       node or edge id and are only populated for the nodes / edges that have them.
+#   (6) optional node and edge moments are named columns of statistics (counts, sums, min / max) that are combined
+#       with their reduction when nodes are contracted, so they can be updated without going back to the voxels.
+
+import numpy as np
+import scipy.sparse as sparse
+from scipy.sparse.csgraph import connected_components
+from collections import OrderedDict
+
+class ArrayRAG(object):
+
+    # number of edges added one at a time before the edge lookup keys are merged into the sorted keys
+    NPENDING_MERGE = 65536
+
+    # how moments are combined on contraction and the value they are initialized to
+    MOMENT_REDUCTIONS = {'sum':(np.add, 0.), 'min':(np.minimum, np.inf), 'max':(np.maximum, -np.inf)}
+
+    # node_moments and edge_moments are lists of (name, reduction) with reduction in MOMENT_REDUCTIONS
+    def __init__(self, nnodes, features_names=[], node_attrs=[], edge_attrs=[], nalloc=1024, node_moments=[],
+            edge_moments=[]):
+        self.nnodes = int(nnodes); self.nedges = 0
+        # edges are looked up by key i*key_mult + j with i < j
+        self.key_mult = np.int64(self.nnodes + 1)
+
+        self.features_names = list(features_names); self.nfeatures = len(self.features_names)
+        self.features_index = OrderedDict([(x,y) for x,y in zip(self.features_names,range(self.nfeatures))])
+
+        self._edges = np.zeros((nalloc,2), dtype=np.int32)
+        self._features = np.zeros((nalloc,self.nfeatures), dtype=np.double)
+        self._has_features = np.zeros((nalloc,), dtype=bool)
+        self._first_pass = np.zeros((nalloc,), dtype=bool)
+
+        self.node_moments_reduce = OrderedDict(node_moments); self.edge_moments_reduce = OrderedDict(edge_moments)
+        self.node_moments_index = OrderedDict([(x,y) for x,y in zip(self.node_moments_reduce.keys(),
+            range(len(self.node_moments_reduce)))])
+        self.edge_moments_index = OrderedDict([(x,y) for x,y in zip(self.edge_moments_reduce.keys(),
+            range(len(self.edge_moments_reduce)))])
+        self.node_moments = np.zeros((self.nnodes+1,len(self.node_moments_reduce)), dtype=np.double)
+        self._edge_moments = np.zeros((nalloc,len(self.edge_moments_reduce)), dtype=np.double)
+
+        # sorted keys with corresponding edge ids, keys for recently added edges are in a dict
+        self._keys = np.zeros((0,), dtype=np.int64); self._key_ids = np.zeros((0,), dtype=np.int64)
+        self._pending = {}
+        self._csr = None
+
+        self.node_attrs = { k:{} for k in node_attrs }
+        self.edge_attrs = { k:{} for k in edge_attrs }
+
+    # views of the edges and the per edge arrays
+    @property
+    def edges(self):
+        return self._edges[:self.nedges,:]
+
+    @property
+    def features(self):
+        return self._features[:self.nedges,:]
+
+    @property
+    def has_features(self):
+        return self._has_features[:self.nedges]
+
+    @property
+    def first_pass(self):
+        return self._first_pass[:self.nedges]
+
+    @property
+    def edge_moments(self):
+        return self._edge_moments[:self.nedges,:]
+
+    def number_of_nodes(self):
+        return self.nnodes
+
+    def number_of_edges(self):
+        return self.nedges
+
+    def edge_id(self, i, j):
+        if i > j: i,j = j,i
+        key = i*self.key_mult + j
+        eid = self._pending.get(key, -1)
+        if eid < 0 and self._keys.size > 0:
+            k = np.searchsorted(self._keys, key)
+            if k < self._keys.size and self._keys[k] == key: eid = self._key_ids[k]
+        return int(eid)
+
+    def has_edge(self, i, j):
+        return self.edge_id(i,j) >= 0
+
+    # vectorized edge lookup, returns -1 for edges that are not in the RAG
+    def edge_ids(self, edges):
+        self._merge_pending()
+        keys = self._get_keys(edges)
+        k = np.searchsorted(self._keys, keys); k[k >= self._keys.size] = 0
+        eids = -np.ones(keys.shape, dtype=np.int64)
+        if self._keys.size > 0:
+            sel = (self._keys[k] == keys); eids[sel] = self._key_ids[k[sel]]
+        return eids
+
+    # add single edge, returns the edge id (existing id if edge is already in the RAG)
+    def add_edge(self, i, j):
+        eid = self.edge_id(i,j)
+        if eid >= 0: return eid
+        if i > j: i,j = j,i
+        assert( i > 0 and j <= self.nnodes )
+        self._grow(self.nedges + 1); eid = self.nedges; self.nedges += 1
+        self._edges[eid,:] = (i,j); self._pending[i*self.key_mult + j] = eid; self._csr = None
+        if len(self._pending) >= self.NPENDING_MERGE: self._merge_pending()
+        return eid
+
+    # vectorized add edges, returns the edge ids for all the specified edges
+    def add_edges(self, edges):
+        edges = np.sort(np.asarray(edges).reshape((-1,2)), axis=1)
+        assert( edges.size == 0 or (edges[:,0] > 0).all() and (edges[:,1] <= self.nnodes).all() )
+        eids = self.edge_ids(edges); sel = (eids < 0)
+        if sel.any():
+            keys, inds, inverse = np.unique(self._get_keys(edges[sel,:]), return_index=True, return_inverse=True)
+            nnew = keys.size; self._grow(self.nedges + nnew)
+            self._edges[self.nedges:self.nedges+nnew,:] = edges[sel,:][inds,:]
+            eids[sel] = self.nedges + inverse.reshape(-1)
+            self._merge_keys(keys, np.arange(self.nedges, self.nedges+nnew, dtype=np.int64))
+            self.nedges += nnew; self._csr = None
+        return eids
+
+    # symmetric CSR adjacency, returns indptr, neighbor nodes and corresponding edge ids.
+    def csr(self):
+        if self._csr is None:
+            nodes = np.concatenate((self.edges[:,0], self.edges[:,1]))
+            nbrs = np.concatenate((self.edges[:,1], self.edges[:,0]))
+            eids = np.concatenate((np.arange(self.nedges), np.arange(self.nedges)))
+            order = np.lexsort((nbrs, nodes))
+            indptr = np.zeros((self.nnodes+2,), dtype=np.int64)
+            indptr[1:] = np.cumsum(np.bincount(nodes, minlength=self.nnodes+1))
+            self._csr = (indptr, nbrs[order].astype(np.int32), eids[order])
+        return self._csr
+
+    def neighbors(self, i):
+        indptr, nbrs, _ = self.csr()
+        return nbrs[indptr[i]:indptr[i+1]]
+
+    def incident_edges(self, i):
+        indptr, _, eids = self.csr()
+        return eids[indptr[i]:indptr[i+1]]
+
+    def degree(self, i):
+        indptr, _, _ = self.csr()
+        return indptr[i+1] - indptr[i]
+
+    # put edges in lexicographic order, returns the previous edge ids in the new order
+    def sort(self):
+        self._merge_pending()
+        order = np.argsort(self._get_keys(self.edges), kind='stable')
+        if (order != np.arange(self.nedges)).any():
+            n = self.nedges
+            self._edges[:n,:] = self._edges[:n,:][order,:]; self._features[:n,:] = self._features[:n,:][order,:]
+            self._has_features[:n] = self._has_features[:n][order]; self._first_pass[:n] = self._first_pass[:n][order]
+            self._edge_moments[:n,:] = self._edge_moments[:n,:][order,:]
+            new_ids = np.empty_like(order); new_ids[order] = np.arange(n)
+            for k,v in self.edge_attrs.items():
+                self.edge_attrs[k] = { int(new_ids[x]):y for x,y in v.items() }
+            self._csr = None
+        self._keys = self._get_keys(self.edges); self._key_ids = np.arange(self.nedges, dtype=np.int64)
+        return order
+
+    # one-to-one relabeling of the nodes, mapping is from current nodes (index) to new nodes.
+    # edge attributes are kept, node attributes and moments are moved to the new nodes.
+    def relabel(self, mapping, nnodes=None):
+        mapping = np.asarray(mapping); assert( mapping[0] == 0 )
+        if nnodes is None: nnodes = int(mapping.max())
+        self.nnodes = int(nnodes); self.key_mult = np.int64(self.nnodes + 1)
+        self._edges[:self.nedges,:] = np.sort(mapping[self.edges], axis=1)
+        for k,v in self.node_attrs.items():
+            self.node_attrs[k] = { int(mapping[x]):y for x,y in v.items() }
+        node_moments = np.zeros((self.nnodes+1,self.node_moments.shape[1]), dtype=np.double)
+        node_moments[mapping,:] = self.node_moments; self.node_moments = node_moments
+        self._pending = {}; self._csr = None
+        return self.sort()
+
+    # contract nodes into new nodes, mapping is from current nodes (index) to new nodes 1..nnodes.
+    # edges between nodes that are mapped together are removed, parallel edges are combined.
+    # features are only kept for edges between nodes that are not merged with any other nodes (unchanged), as are
+    #   the node attributes. returns the new RAG and the new edge id for each current edge (-1 for removed edges).
+    # edge attributes are not copied because it depends on the attribute whether they are valid after contraction.
+    # moments are combined over all the nodes / edges that are contracted together.
+    def contract(self, mapping, nnodes):
+        mapping = np.asarray(mapping); assert( mapping[0] == 0 )
+        rag = ArrayRAG(nnodes, self.features_names, self.node_attrs.keys(), self.edge_attrs.keys(),
+            nalloc=max([self.nedges,1]), node_moments=self.node_moments_reduce.items(),
+            edge_moments=self.edge_moments_reduce.items())
+
+        medges = np.sort(mapping[self.edges], axis=1); sel = (medges[:,0] != medges[:,1])
+        inverse = -np.ones((self.nedges,), dtype=np.int64)
+        inverse[sel] = rag.add_edges(medges[sel,:]); rag.sort()
+        inverse[sel] = rag.edge_ids(medges[sel,:])
+
+        unchanged = (np.bincount(mapping, minlength=nnodes+1) == 1); unchanged[0] = 0
+        keep = np.logical_and(sel, unchanged[medges].all(axis=1))
+        rag._features[inverse[keep],:] = self.features[keep,:]
+        rag._has_features[inverse[keep]] = self.has_features[keep]
+        rag._first_pass[inverse[keep]] = self.first_pass[keep]
+        for k,v in self.node_attrs.items():
+            rag.node_attrs[k] = { int(mapping[x]):y for x,y in v.items() if unchanged[mapping[x]] }
+
+        ArrayRAG._reduce_moments(rag.node_moments, self.node_moments, mapping, self.node_moments_reduce)
+        ArrayRAG._reduce_moments(rag.edge_moments, self.edge_moments[sel,:], inverse[sel],
+            self.edge_moments_reduce)
+        return rag, inverse
+
+    # connected components over all the edges or over the selected edges.
+    # returns the number of components and the component (1..ncomps) for each node, in order of the lowest node.
+    def components(self, sel=None):
+        edges = self.edges if sel is None else self.edges[sel,:]
+        G = sparse.coo_matrix((np.ones((edges.shape[0],), dtype=bool), (edges[:,0], edges[:,1])),
+            shape=(self.nnodes+1,self.nnodes+1))
+        ncomps, labels = connected_components(G, directed=False)
+        assert( labels[0] == 0 )    # background is the first node so it is always the first component
+        return ncomps-1, labels
+
+    # connected components for decreasing thresholds on edge weights, merging the edges with weights over threshold.
+    # edges are sorted by weight once and each threshold only adds the edges above it to an array union-find.
+    # returns list of the number of components and the component for each node (same as components()) per threshold.
+    def threshold_components(self, weights, thresholds):
+        assert( (np.diff(thresholds) <= 0).all() )  # thresholds must be decreasing
+        order = np.argsort(-weights, kind='stable'); nweights = -weights[order]
+        edges = self.edges[order,:].astype(np.int64)
+
+        # union-find forest where the root is always the smallest node in the component
+        parent = np.arange(self.nnodes+1, dtype=np.int64); nmerged = 0; comps = []
+        for thr in thresholds:
+            n = np.searchsorted(nweights, -thr, side='left')   # number of weights over threshold
+            ArrayRAG._union(parent, edges[nmerged:n,:]); nmerged = n
+            # components are ordered by their root which is their lowest node, background is always component 0.
+            roots = (parent == np.arange(self.nnodes+1)); labels = np.cumsum(roots) - 1
+            comps.append((int(roots.sum())-1, labels[parent]))
+        return comps
+
+    # vectorized union of edges into a fully compressed union-find forest (parent of each node is its root).
+    # each pass hooks the larger root of every edge to the smallest root it is connected to and then compresses.
+    @staticmethod
+    def _union(parent, edges):
+        while edges.shape[0] > 0:
+            a = parent[edges[:,0]]; b = parent[edges[:,1]]; sel = (a != b)
+            if not sel.any(): break
+            a = a[sel]; b = b[sel]; edges = edges[sel,:]
+            np.minimum.at(parent, np.maximum(a,b), np.minimum(a,b))
+            # pointer jumping until every node points to its root
+            while True:
+                pparent = parent[parent]
+                if (pparent == parent).all(): break
+                parent[:] = pparent
+
+    @staticmethod
+    def _reduce_moments(out, moments, inds, reduce):
+        for k,r in zip(range(len(reduce)), reduce.values()):
+            ufunc, init = ArrayRAG.MOMENT_REDUCTIONS[r]
+            out[:,k] = init; ufunc.at(out[:,k], inds, moments[:,k])
+
+    def _get_keys(self, edges):
+        edges = np.asarray(edges).reshape((-1,2)).astype(np.int64)
+        return np.minimum(edges[:,0], edges[:,1])*self.key_mult + np.maximum(edges[:,0], edges[:,1])
+
+    def _merge_pending(self):
+        if len(self._pending) == 0: return
+        keys = np.fromiter(self._pending.keys(), dtype=np.int64, count=len(self._pending))
+        ids = np.fromiter(self._pending.values(), dtype=np.int64, count=len(self._pending))
+        self._pending = {}; self._merge_keys(keys, ids)
+
+    def _merge_keys(self, keys, ids):
+        keys = np.concatenate((self._keys, keys)); ids = np.concatenate((self._key_ids, ids))
+        order = np.argsort(keys, kind='stable'); self._keys = keys[order]; self._key_ids = ids[order]
+
+    def _grow(self, n):
+        nalloc = self._edges.shape[0]
+        if n <= nalloc: return
+        nalloc = max([n, 2*nalloc])
+        self._edges = np.resize(self._edges, (nalloc,2))
+        features = np.zeros((nalloc,self.nfeatures), dtype=np.double)
+        features[:self.nedges,:] = self._features[:self.nedges,:]; self._features = features
+        self._has_features = np.concatenate((self._has_features[:self.nedges],
+            np.zeros((nalloc-self.nedges,), dtype=bool)))
+        self._first_pass = np.concatenate((self._first_pass[:self.nedges],
+            np.zeros((nalloc-self.nedges,), dtype=bool)))
+        edge_moments = np.zeros((nalloc,self._edge_moments.shape[1]), dtype=np.double)
+        edge_moments[:self.nedges,:] = self._edge_moments[:self.nedges,:]; self._edge_moments = edge_moments
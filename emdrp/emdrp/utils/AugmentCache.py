@@ -0,0 +1,104 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 Paul Watkins, National Institutes of Health / NINDS
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# On-disk cache for raw EM augments that are filtered on-the-fly by dpFRAG (no rawaugfile).
+# The filters (kuwahara, gaussian blurs, max filters) are recomputed for every cube in every run otherwise.
+#   (1) entries are keyed by a hash of everything the filtered data depends on (raw file and its modification time,
+#       dataset, cube window, filter, sampling and filter code version), so any change gives a new entry.
+#   (2) each entry is a separate hdf5 file in the cache directory, written to a temporary file and renamed so that
+#       multiple processes can share the cache without locking.
+#   (3) the cache is bounded in size, least recently used entries are removed when the size is exceeded.
+
+import os
+import hashlib
+import tempfile
+import h5py
+
+class AugmentCache(object):
+
+    HDF5_CLVL = 5
+    EXT = '.h5'
+
+    def __init__(self, cachedir, max_size_gb=32., verbose=False):
+        self.cachedir = cachedir; self.max_bytes = int(max_size_gb*2**30); self.verbose = verbose
+        os.makedirs(self.cachedir, exist_ok=True)
+
+    # key for the cached data, the description is also stored with the entry for debugging
+    @staticmethod
+    def key(**kwargs):
+        desc = ', '.join(['%s=%s' % (k, kwargs[k]) for k in sorted(kwargs.keys())])
+        return hashlib.sha1(desc.encode('utf-8')).hexdigest(), desc
+
+    # identifies the contents of a file without reading it
+    @staticmethod
+    def file_key(fn):
+        st = os.stat(fn)
+        return '%s:%d:%d' % (os.path.realpath(fn), st.st_size, st.st_mtime_ns)
+
+    def get(self, key):
+        fn = self._get_fn(key)
+        try:
+            with h5py.File(fn, 'r') as h5file:
+                data = h5file['data'][:]
+        except (OSError, KeyError):
+            return None
+        # update the access time used for eviction
+        try: os.utime(fn)
+        except OSError: pass
+        if self.verbose: print('\tloaded cached %s' % (key[1],))
+        return data
+
+    def put(self, key, data):
+        fh, tmpfn = tempfile.mkstemp(suffix='.tmp', dir=self.cachedir); os.close(fh)
+        try:
+            with h5py.File(tmpfn, 'w') as h5file:
+                h5file.create_dataset('data', data=data, compression='gzip', compression_opts=self.HDF5_CLVL,
+                    shuffle=True, fletcher32=True)
+                h5file.attrs['key'] = key[1].encode('ascii', 'ignore')
+            os.replace(tmpfn, self._get_fn(key))
+        finally:
+            # do not leave partially written temporary files in the cache (already renamed if written)
+            if os.path.isfile(tmpfn): os.remove(tmpfn)
+        self.evict()
+
+    # remove least recently used entries until the cache is within the maximum size
+    def evict(self):
+        entries = []
+        for fn in os.listdir(self.cachedir):
+            if not fn.endswith(self.EXT): continue
+            try:
+                st = os.stat(os.path.join(self.cachedir, fn))
+            except OSError:
+                continue    # removed by another process
+            entries.append((st.st_mtime, st.st_size, fn))
+        total = sum([x[1] for x in entries])
+        for mtime, size, fn in sorted(entries):
+            if total <= self.max_bytes: break
+            try:
+                os.remove(os.path.join(self.cachedir, fn))
+            except OSError:
+                pass
+            total -= size
+            if self.verbose: print('\tevicted cached augment %s' % (fn,))
+
+    def _get_fn(self, key):
+        return os.path.join(self.cachedir, key[0] + self.EXT)
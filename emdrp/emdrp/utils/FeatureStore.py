@@ -0,0 +1,92 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 Paul Watkins, National Institutes of Health / NINDS
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Columnar hdf5 store for the supervoxel classifier training and testing datasets (instead of dill dumps).
+# Each cube (chunk) is a group with the feature matrix (data), the targets, the FRAG edges in the same order as the
+#   features and the cube location and number of FRAG nodes as attributes. feature names and target names are
+#   stored as attributes of the file.
+# The datasets are written contiguous (not chunked or compressed) so they are memory mapped on load, meaning that
+#   only the parts that are accessed are read from disk and a cube can be loaded without loading the others.
+
+import os
+import numpy as np
+import h5py
+from collections import OrderedDict
+
+class FeatureStore(object):
+
+    EXTENSIONS = ['.h5', '.hdf5']
+    DATASETS = ['data', 'target', 'edges']
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    # whether the file name is for a feature store (otherwise a dill file)
+    @classmethod
+    def isFeatureStore(cls, filename):
+        return os.path.splitext(filename)[1].lower() in cls.EXTENSIONS
+
+    # write dataset dict (from dpFRAG createDataset) for a cube, replaces the cube if it is already in the store.
+    # edges are the FRAG edges in the order of the dataset, attrs are stored with the cube (location, etc).
+    def write(self, name, data, edges=None, attrs={}):
+        h5file = h5py.File(self.filename, 'a')
+        names = sorted(data['feature_names'].keys(), key=lambda x: data['feature_names'][x])
+        h5file.attrs['feature_names'] = np.array(names, dtype=h5py.string_dtype())
+        h5file.attrs['target_names'] = np.array(list(data['target_names'].keys()), dtype=h5py.string_dtype())
+        h5file.attrs['target_values'] = np.array(list(data['target_names'].values()), dtype=np.int64)
+        if 'DESCR' in data: h5file.attrs['DESCR'] = data['DESCR']
+
+        if name in h5file: del h5file[name]
+        grp = h5file.create_group(name)
+        grp.create_dataset('data', data=np.asarray(data['data'], dtype=np.double))
+        grp.create_dataset('target', data=np.asarray(data['target'], dtype=np.int64))
+        if edges is not None: grp.create_dataset('edges', data=np.asarray(edges, dtype=np.int64))
+        for k,v in attrs.items(): grp.attrs[k] = v
+        h5file.close()
+
+    # names of the cubes in the store with their attributes, in order of the index attribute (if written)
+    def cubes(self):
+        h5file = h5py.File(self.filename, 'r')
+        cubes = [(name, dict(h5file[name].attrs)) for name in h5file.keys()]
+        h5file.close()
+        return sorted(cubes, key=lambda x: x[1].get('index', 0))
+
+    # read a cube as a dataset dict (same as dpFRAG createDataset) with memory mapped data, target and edges.
+    # the attributes of the cube are also returned in the dict.
+    def read(self, name):
+        h5file = h5py.File(self.filename, 'r')
+        names = [x for x in h5file.attrs['feature_names']]
+        data = {'feature_names':OrderedDict([(x,y) for x,y in zip(names,range(len(names)))]),
+            'target_names':dict(zip(h5file.attrs['target_names'], h5file.attrs['target_values'].tolist())),
+            'DESCR':h5file.attrs.get('DESCR', '')}
+        grp = h5file[name]
+        for k in self.DATASETS:
+            if k in grp: data[k] = self.memmap(grp[k])
+        data['attrs'] = dict(grp.attrs)
+        h5file.close()
+        return data
+
+    # memory map a contiguous dataset, datasets that can not be mapped (empty, chunked) are read into memory
+    def memmap(self, dset):
+        offset = dset.id.get_offset()
+        if offset is None or dset.chunks is not None or dset.size == 0: return dset[()]
+        return np.memmap(self.filename, mode='r', dtype=dset.dtype, shape=dset.shape, offset=offset)
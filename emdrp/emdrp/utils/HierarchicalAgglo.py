@@ -0,0 +1,144 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 Paul Watkins, National Institutes of Health / NINDS
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Priority queue hierarchical agglomeration on a region adjacency graph with moments (see ArrayRAG).
+# Alternative to threshold cuts or iterative re-featurizing of the FRAG, the whole hierarchy is built in one pass.
+#   (1) the edge with the highest merge score is repeatedly merged, edges are kept in a heap with lazy deletion
+#       (heap entries are skipped if the edge was rescored or removed after they were pushed).
+#   (2) merged nodes get new ids nnodes+1, nnodes+2, ... (dendrogram style). the node moments and the moments of
+#       parallel edges to common neighbors are combined with their reductions, so the statistics are updated
+#       incrementally without going back to the voxels.
+#   (3) only the edges of the merged node are rescored after each merge, using the score function on their moments.
+#   (4) the merges are recorded as a merge tree. the score of later merges can be higher than earlier ones, so the
+#       height of each merge is the running minimum of the merge scores. the segmentation for a threshold is all the
+#       merges with heights over the threshold, i.e. the greedy agglomeration stopped at the first score below it.
+
+import heapq
+import numpy as np
+
+class HierarchicalAgglo(object):
+
+    # how moments are combined on merges, same as ArrayRAG.MOMENT_REDUCTIONS
+    MOMENT_UFUNCS = {'sum':np.add, 'min':np.minimum, 'max':np.maximum}
+
+    # rag is an ArrayRAG with node and edge moments.
+    # score is a function score(edges, edge_moments, node_moments) returning the merge score of the edges,
+    #   where edges are (n x 2) node ids indexing node_moments. higher scores are merged first.
+    def __init__(self, rag, score, verbose=False):
+        self.nnodes = rag.number_of_nodes(); self.score = score; self.verbose = verbose
+        nedges = rag.number_of_edges()
+
+        # node ids for merged nodes continue after the rag nodes, there are at most nnodes-1 merges
+        self.node_moments = np.zeros((2*self.nnodes+1, rag.node_moments.shape[1]), dtype=np.double)
+        self.node_moments[:self.nnodes+1,:] = rag.node_moments
+        self.edges = rag.edges.astype(np.int64); self.edge_moments = rag.edge_moments.copy()
+        self.node_reduce = self._get_reduce(rag.node_moments_reduce); self.edge_reduce = self._get_reduce(
+            rag.edge_moments_reduce)
+
+        # adjacency as neighbor to edge id dicts, edges are reused for merged nodes so they never increase
+        self.adj = [{} for x in range(2*self.nnodes+1)]
+        for e,(i,j) in enumerate(self.edges.tolist()):
+            self.adj[i][j] = e; self.adj[j][i] = e
+
+        # version of each edge, heap entries with other versions are stale
+        self.version = np.zeros((nedges,), dtype=np.int64)
+        self.scores = np.zeros((nedges,), dtype=np.double)
+
+        # merge tree, children and merge score for each merge, merge k creates node nnodes+k+1
+        self.nmerges = 0
+        self.children = np.zeros((max([self.nnodes-1,0]),2), dtype=np.int64)
+        self.merge_scores = np.zeros((max([self.nnodes-1,0]),), dtype=np.double)
+
+    # merge edges until there are no edges left or until the best score is below min_score.
+    def agglomerate(self, min_score=-np.inf):
+        heap = self._rescore(np.arange(self.edges.shape[0])); heapq.heapify(heap)
+        while len(heap) > 0:
+            nscore, e, version = heapq.heappop(heap)
+            if version != self.version[e]: continue
+            if -nscore < min_score: break
+            self._merge(e, -nscore, heap)
+        if self.verbose:
+            print('\t%d merges, %d nodes remaining' % (self.nmerges, self.nnodes - self.nmerges))
+
+    # running minimum of the merge scores, heights are non-increasing
+    @property
+    def heights(self):
+        return np.minimum.accumulate(self.merge_scores[:self.nmerges])
+
+    # segmentation of the rag nodes for merges with heights over threshold.
+    # returns the number of components and the component (1..ncomps) for each node in order of the lowest node,
+    #   node 0 (background) is component 0, same as ArrayRAG.components().
+    def components(self, threshold):
+        n = np.searchsorted(-self.heights, -threshold, side='left')  # number of merges with heights over threshold
+
+        # the parent of each node is the node created by the merge it was a child of, root nodes are their own parent.
+        # pointer jumping until every node points to its root.
+        parent = np.arange(2*self.nnodes+1, dtype=np.int64)
+        parent[self.children[:n,:]] = (self.nnodes + 1 + np.arange(n, dtype=np.int64))[:,None]
+        while True:
+            pparent = parent[parent]
+            if (pparent == parent).all(): break
+            parent = pparent
+
+        # number the components in order of their lowest node, which is the first node in each component
+        roots, first, inverse = np.unique(parent[1:self.nnodes+1], return_index=True, return_inverse=True)
+        rank = np.empty((roots.size,), dtype=np.int64); rank[np.argsort(first)] = np.arange(roots.size)
+        labels = np.zeros((self.nnodes+1,), dtype=np.int64); labels[1:] = rank[inverse.reshape(-1)] + 1
+        return int(roots.size), labels
+
+    def _merge(self, e, score, heap):
+        i, j = self.edges[e,:]; w = self.nnodes + self.nmerges + 1
+        self.children[self.nmerges,:] = (i,j); self.merge_scores[self.nmerges] = score; self.nmerges += 1
+        for ufunc, cols in self.node_reduce:
+            self.node_moments[w,cols] = ufunc(self.node_moments[i,cols], self.node_moments[j,cols])
+        self.version[e] += 1
+
+        # edges of both nodes are moved to the new node, edges to common neighbors are combined into one edge.
+        adj = {}
+        for n in (i, j):
+            for x,ex in self.adj[n].items():
+                if x == i or x == j: continue
+                del self.adj[x][n]
+                if x in adj:
+                    ew = adj[x]
+                    for ufunc, cols in self.edge_reduce:
+                        self.edge_moments[ew,cols] = ufunc(self.edge_moments[ew,cols], self.edge_moments[ex,cols])
+                    self.version[ex] += 1
+                else:
+                    adj[x] = ex; self.edges[ex,:] = (x, w)
+        for x,ex in adj.items(): self.adj[x][w] = ex
+        self.adj[w] = adj; self.adj[i] = None; self.adj[j] = None
+
+        for x in self._rescore(np.fromiter(adj.values(), dtype=np.int64, count=len(adj))): heapq.heappush(heap, x)
+
+    # score the edges and invalidate any previous heap entries, returns the new heap entries
+    def _rescore(self, eids):
+        if eids.size == 0: return []
+        self.version[eids] += 1
+        self.scores[eids] = self.score(self.edges[eids,:], self.edge_moments[eids,:], self.node_moments)
+        return list(zip((-self.scores[eids]).tolist(), eids.tolist(), self.version[eids].tolist()))
+
+    # moment columns grouped by their reduction
+    def _get_reduce(self, reduce):
+        reduce = list(reduce.values())
+        return [(self.MOMENT_UFUNCS[r], np.array([k for k,x in enumerate(reduce) if x == r], dtype=np.int64))
+            for r in sorted(set(reduce))]
@@ -29,20 +29,40 @@ def calc_supervoxel_eftpl(nml_filepath, h5_filepath, dset_vals=None, dset_folder
     if size is not None:
         selection = tuple(slice(dset_start[ax],dset_start[ax]+size[ax]) for ax in h5_dim_idcs)
 
+    # labels written as an agglomeration table (labels delta without residual voxels) are looked up from the base
+    #   labels (supervoxels), which are only read once for all the tables.
+    base_path = None
     for i, dset_val in enumerate(dset_vals):
+        lut = None
         with h5py.File(h5_filepath, 'r') as h5file:
-            dset = h5file['/'.join([dset_folder, dset_val, dset_suffix])]
+            dset_path = '/'.join([dset_folder, dset_val, dset_suffix])
+            if dset_path not in h5file and dset_path + '_delta' in h5file:
+                delta = h5file[dset_path + '_delta']
+                # deltas are stored per cube, a single table for the whole volume can be looked up directly
+                if 'lut' not in delta:
+                    assert len(delta.keys()) == 1, 'labels delta written for multiple cubes, use emLabels.readLabels'
+                    delta = delta[list(delta.keys())[0]]
+                assert delta['inds'].shape[0] == 0, 'labels delta with residual voxels, use emLabels.readLabels'
+                lut = delta['lut'][:]
+                base = [x.decode('ascii') if isinstance(x, bytes) else x for x in delta.attrs['base']]
+                dset_path = '/'.join(base + [dset_suffix])
+                if dset_path == base_path:
+                    eftpl[i] = calc_eftpl(nml, Vlbls, dset_start, lut=lut)
+                    continue
+
+            dset = h5file[dset_path]
             if size is None:
                 Vlbls = dset[:]
             else:
                 Vlbls = np.zeros(tuple(size[ax] for ax in h5_dim_idcs), dtype=dset.dtype)
                 dset.read_direct(Vlbls, selection)
-        eftpl[i] = calc_eftpl(nml, Vlbls, dset_start)
+            base_path = dset_path if lut is not None else None
+        eftpl[i] = calc_eftpl(nml, Vlbls, dset_start, lut=lut)
 
     return eftpl, dset_vals
 
 
-def calc_eftpl(nml, Vlbls, dataset_start=np.zeros((1,3), dtype=int), verbose=False):
+def calc_eftpl(nml, Vlbls, dataset_start=np.zeros((1,3), dtype=int), verbose=False, lut=None):
     
     ### Extract, clean, and transform node data from nml file
 
@@ -74,6 +94,11 @@ def calc_eftpl(nml, Vlbls, dataset_start=np.zeros((1,3), dtype=int), verbose=Fal
     nodes = nodes[np.logical_not(node_is_outside_volume)]
 
     nodes['label'] = Vlbls[tuple(nodes[f'idx_{ax}'] for ax in HDF5_DIM_ORDER)]
+    if lut is not None:
+        # apply the lookup table (agglomeration table) only to the labels at the nodes, labels outside of the lookup
+        #   table (not written with the table, empty label) are kept as they are.
+        labels = nodes['label'].values
+        nodes['label'] = np.where(labels < lut.size, lut[np.minimum(labels, lut.size-1)], labels)
 
     position_colums = [f'position_{ax}' for ax in NML_DIM_ORDER]
     nodes[position_colums] = nodes[idx_columns] * np.array(nml.parameters.scale)
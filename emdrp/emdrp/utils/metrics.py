@@ -26,6 +26,8 @@ from scipy import ndimage as nd
 import scipy.sparse as sparse
 from threading import Thread
 
+from pyCext import label_overlap
+
 def pix_fscore_metric( lbl_truth, lbl_proposed, calcAll=False ):
     # calcAll is to return all associated pixel metrics. false only returns those used by labrainth frontend
 
@@ -119,8 +121,9 @@ def adapted_rand_error_getconfusion( lbl_truth, lbl_proposed, nogtbg = False ):
 
     # compute overlap matrix, AKA contingency or confusion matrix
     # xxx - this can probably be fixed to not go dense? is there a point?
-    #m_ij = sparse.csr_matrix((np.ones(n, dtype=np.double), (segT, segP)), shape=(nlabelsT, nlabelsP))
-    m_ij = sparse.csr_matrix((np.ones(n, dtype=np.double), (segT, segP)), shape=(nlabelsT, nlabelsP)).toarray()
+    pairs, counts = label_overlap(segT, segP)
+    m_ij = sparse.csr_matrix((counts.astype(np.double), (pairs[:,0], pairs[:,1])),
+        shape=(nlabelsT, nlabelsP)).toarray()
 
     # optionally remove ground truth background from metric
     if nogtbg: m_ij = m_ij[1:,:]; n = (segT > 0).sum(dtype=np.int64)
@@ -41,7 +41,7 @@ static PyMethodDef _pyCextMethods[] = {
     {"binary_warping", binary_warping, METH_VARARGS},
     {"type_components", type_components, METH_VARARGS},
     {"remove_adjacencies", remove_adjacencies, METH_VARARGS},
-    {"label_overlap", label_overlap, METH_VARARGS},
+    {"seeded_watershed", seeded_watershed, METH_VARARGS},
 
     {NULL, NULL}     /* Sentinel - marks the end of this structure */
 };
@@ -453,89 +453,78 @@ static PyObject *remove_adjacencies(PyObject *self, PyObject *args)
 } // remove_adjacencies
 
 
-// xxx - not validated
-static PyObject *label_overlap(PyObject *self, PyObject *args)
+/* Seeded priority flood watershed (Meyer's flooding). Voxels are flooded in order of increasing image value starting
+ *   from the seeds in labels, only within the mask. Ties are flooded in the order they were queued. Neighborhood is given by steps (linear C-order offsets).
+ *   Caller must pad the volumes so that the mask is zero around the edges (no bounds checking).
+ * Optionally leaves a no-adjacency boundary in labels_uc. In this mode a voxel is only labeled in labels_uc when it is
+ *   popped and only if it is not adjacent to any other label in labels_uc, otherwise it is left as boundary (zero).
+ *   Flooding is not affected by the boundary, so labels are the same as without the no-adjacency boundary.
+ */
+static PyObject *seeded_watershed(PyObject *self, PyObject *args)
 {
-    PyArrayObject *labelsA, *labelsB, *labelsA_ovlp, *labelsB_ovlp;
-    PyArrayObject *labelsA_perc_ovlp, *labelsB_perc_ovlp, *labelsA_bg_perc_ovlp, *labelsB_bg_perc_ovlp;
-    npy_uint32 *lblsA, *lblsB, *lblsA_ovlp, *lblsB_ovlp;
-    npy_float32 *lblsA_perc_ovlp, *lblsB_perc_ovlp, *lblsA_bg_perc_ovlp, *lblsB_bg_perc_ovlp;
-    npy_uint64 *lblsA_cnt, *lblsB_cnt, *ovlp_cnt, *lblsA_bg_cnt, *lblsB_bg_cnt;
-
-    npy_int m,n,nz; //, x,y,z, xp,yp,zp, ip;
-    npy_intp *dims, size, nalloc, cnt=0, nlblsA, nlblsB;
-    npy_intp pt, i;
-    npy_bool error=0;
-
-    // cnt = _pyCext.label_overlap(lblsA, lblsB, lblsA_ovlp, lblsB_ovlp, lblsA_perc_ovlp, lblsB_perc_povlp,
-    //                             lblsA_bg_perc_ovlp, lblsB_bg_perc_ovlp)
-    if (!PyArg_ParseTuple(args, "O!O!O!O!O!O!O!O!", &PyArray_Type, &labelsA, &PyArray_Type, &labelsB,
-            &PyArray_Type, &labelsA_ovlp, &PyArray_Type, &labelsB_ovlp,
-            &PyArray_Type, &labelsA_perc_ovlp, &PyArray_Type, &labelsB_perc_ovlp,
-            &PyArray_Type, &labelsA_bg_perc_ovlp, &PyArray_Type, &labelsB_bg_perc_ovlp))
+    PyArrayObject *image, *labels, *labels_uc, *mask, *steps;
+    npy_float32 *img;
+    npy_uint32 *lbls, *lblsuc;
+    npy_bool *msk;
+    npy_int64 *stps;
+    int no_adjacencies;
+
+    npy_intp *dims, size, nsteps, pt, ind, i;
+    npy_uint64 age = 0;
+    heap_queue heap;
+    heap_elem elem;
+    npy_bool adjacent;
+
+    if (!PyArg_ParseTuple(args, "O!O!O!O!O!i", &PyArray_Type, &image, &PyArray_Type, &labels,
+            &PyArray_Type, &labels_uc, &PyArray_Type, &mask, &PyArray_Type, &steps, &no_adjacencies))
         return NULL;
 
-    /* Get the dimensions of the labels and the c pointer to the labels and allocated overlap arrays */
-    dims = PyArray_DIMS(labelsA); m = dims[0]; n = dims[1]; nz = dims[2]; size = m*n*nz;
-    lblsA = (npy_uint32 *) PyArray_DATA(labelsA); lblsB = (npy_uint32 *) PyArray_DATA(labelsB);
-
-    nalloc = PyArray_SIZE(labelsA_ovlp);
-    lblsA_ovlp = (npy_uint32 *) PyArray_DATA(labelsA_ovlp); lblsB_ovlp = (npy_uint32 *) PyArray_DATA(labelsB_ovlp);
-    lblsA_perc_ovlp = (npy_float32 *) PyArray_DATA(labelsA_perc_ovlp);
-    lblsB_perc_ovlp = (npy_float32 *) PyArray_DATA(labelsB_perc_ovlp);
-
-    nlblsA = PyArray_SIZE(labelsA_bg_perc_ovlp); nlblsB = PyArray_SIZE(labelsB_bg_perc_ovlp);
-    lblsA_bg_perc_ovlp = (npy_float32 *) PyArray_DATA(labelsA_bg_perc_ovlp);
-    lblsB_bg_perc_ovlp = (npy_float32 *) PyArray_DATA(labelsB_bg_perc_ovlp);
-
-    // allocate the counts
-    lblsA_cnt = (npy_uint64 *) calloc((size_t) nlblsA, sizeof(npy_uint64));
-    lblsB_cnt = (npy_uint64 *) calloc((size_t) nlblsB, sizeof(npy_uint64));
-    ovlp_cnt = (npy_uint64 *) calloc((size_t) nalloc, sizeof(npy_uint64));
-    lblsA_bg_cnt = (npy_uint64 *) calloc((size_t) nlblsA, sizeof(npy_uint64));
-    lblsB_bg_cnt = (npy_uint64 *) calloc((size_t) nlblsB, sizeof(npy_uint64));
-    if( lblsA_cnt == NULL || lblsA_cnt == NULL || ovlp_cnt == NULL ||
-            lblsA_bg_cnt == NULL ||  lblsB_bg_cnt == NULL ) {
-        printf("In label_overlap allocation of memory for counts failed."); exit(0);
+    dims = PyArray_DIMS(image); size = dims[0]*dims[1]*dims[2]; nsteps = PyArray_SIZE(steps);
+    img = (npy_float32 *) PyArray_DATA(image);
+    lbls = (npy_uint32 *) PyArray_DATA(labels); lblsuc = (npy_uint32 *) PyArray_DATA(labels_uc);
+    msk = (npy_bool *) PyArray_DATA(mask); stps = (npy_int64 *) PyArray_DATA(steps);
+
+    Py_BEGIN_ALLOW_THREADS
+
+    // labels are assigned when voxels are queued, so each voxel is only queued (and visited) once.
+    heap.nalloc = 1024; heap.size = 0; heap.elems = (heap_elem *) malloc(heap.nalloc*sizeof(heap_elem));
+    if( heap.elems == NULL ) {
+        printf("In seeded_watershed allocation of memory failed."); exit(0);
     }
 
+    // push all the seeds
     for( pt = 0; pt < size; pt++ ) {
-        if( (lblsA[pt] > 0) && (lblsB[pt] > 0) ) {
-            // overlapping foreground objects
-            lblsA_cnt[lblsA[pt]-1]++; lblsB_cnt[lblsB[pt]-1]++;
-
-            // brute force search
-            for( i=0; i < cnt; i++ ) if( (lblsA_ovlp[i] == lblsA[pt]) && (lblsB_ovlp[i] == lblsB[pt]) ) break;
-            if( i == cnt ) {
-                lblsA_ovlp[cnt] = lblsA[pt]; lblsB_ovlp[cnt] = lblsB[pt]; cnt++;
-                if( cnt == nalloc ) { cnt--; error=1; break; }
-            }
-            ovlp_cnt[i]++;
-        } else if( lblsA[pt] > 0 ) {
-            // label in A overlaps with background in B
-            lblsA_cnt[lblsA[pt]-1]++; lblsA_bg_cnt[lblsA[pt]-1]++;
-        } else if( lblsB[pt] > 0 ) {
-            // label in B overlaps with background in A
-            lblsB_cnt[lblsB[pt]-1]++; lblsB_bg_cnt[lblsB[pt]-1]++;
-        } // xxx - don't care about both background, metric is for objects, don't see need to consider BG a true object
+        if( lbls[pt] ) heap_push(&heap, img[pt], age++, pt);
+    }
 
-    } // for each voxel in volume
+    while( heap.size > 0 ) {
+        elem = heap_pop(&heap); pt = elem.ind;
 
-    // iterate over all overlapping labels and calculate overlapping percentages
-    for( i=0; i < cnt; i++ ) {
-        lblsA_perc_ovlp[i] = (npy_float32)ovlp_cnt[i]/lblsA_cnt[lblsA_ovlp[i]-1];
-        lblsB_perc_ovlp[i] = (npy_float32)ovlp_cnt[i]/lblsB_cnt[lblsB_ovlp[i]-1];
-    }
+        if( no_adjacencies && !lblsuc[pt] ) {
+            // label at pop, unless adjacent to another label in which case this voxel is boundary.
+            // boundary voxels still flood out, so the full labels are the same as without no_adjacencies.
+            adjacent = 0;
+            for( i = 0; i < nsteps; i++ ) {
+                ind = pt + stps[i];
+                if( lblsuc[ind] && lblsuc[ind] != lbls[pt] ) { adjacent = 1; break; }
+            }
+            if( !adjacent ) lblsuc[pt] = lbls[pt];
+        }
+
+        // flood out to neighbors
+        for( i = 0; i < nsteps; i++ ) {
+            ind = pt + stps[i];
+            if( !msk[ind] || lbls[ind] ) continue;
+            lbls[ind] = lbls[pt]; heap_push(&heap, img[ind], age++, ind);
+        }
+    } // while heap not empty
 
-    // calculate percentage overlapping with other background
-    for( i=0; i < nlblsA; i++ ) lblsA_bg_perc_ovlp[i] = (double)lblsA_bg_cnt[i]/lblsA_cnt[i];
-    for( i=0; i < nlblsB; i++ ) lblsB_bg_perc_ovlp[i] = (double)lblsB_bg_cnt[i]/lblsB_cnt[i];
+    free(heap.elems);
 
-    // free memory and return the count of overlapping matrix (nonzero elements of sparse overlap matrix)
-    free(lblsA_cnt); free(lblsB_cnt); free(ovlp_cnt); free(lblsA_bg_cnt); free(lblsB_bg_cnt);
-    return Py_BuildValue("L", error ? -1.0:cnt);
-} // label_overlap
+    Py_END_ALLOW_THREADS
 
+    return Py_BuildValue("L", 0);
+} // seeded_watershed
 
 
 
@@ -593,4 +582,40 @@ npy_uint32 get_simpleLUTind_from_patch(npy_bool *patch) {
     return ind;
 }
 
+// min heap ordered by value then age
+#define HEAP_LESS(a,b) ((a).value < (b).value || ((a).value == (b).value && (a).age < (b).age))
+
+void heap_push(heap_queue *heap, npy_float32 value, npy_uint64 age, npy_intp ind) {
+    npy_intp i, p;
+    heap_elem elem;
+
+    if( heap->size == heap->nalloc ) {
+        heap->nalloc *= 2; heap->elems = (heap_elem *) realloc(heap->elems, heap->nalloc*sizeof(heap_elem));
+        if( heap->elems == NULL ) {
+            printf("In heap_push reallocation of memory failed."); exit(0);
+        }
+    }
 
+    elem.value = value; elem.age = age; elem.ind = ind;
+    // sift up
+    for( i = heap->size++; i > 0; i = p ) {
+        p = (i-1)/2;
+        if( !HEAP_LESS(elem, heap->elems[p]) ) break;
+        heap->elems[i] = heap->elems[p];
+    }
+    heap->elems[i] = elem;
+}
+
+heap_elem heap_pop(heap_queue *heap) {
+    npy_intp i, c;
+    heap_elem top = heap->elems[0], last = heap->elems[--heap->size];
+
+    // sift down
+    for( i = 0; (c = 2*i+1) < heap->size; i = c ) {
+        if( c+1 < heap->size && HEAP_LESS(heap->elems[c+1], heap->elems[c]) ) c++;
+        if( !HEAP_LESS(heap->elems[c], last) ) break;
+        heap->elems[i] = heap->elems[c];
+    }
+    heap->elems[i] = last;
+    return top;
+}
@@ -38,7 +38,7 @@ static PyObject *label_affinities(PyObject *self, PyObject *args);
 static PyObject *binary_warping(PyObject *self, PyObject *args);
 static PyObject *type_components(PyObject *self, PyObject *args);
 static PyObject *remove_adjacencies(PyObject *self, PyObject *args);
-static PyObject *label_overlap(PyObject *self, PyObject *args);
+static PyObject *seeded_watershed(PyObject *self, PyObject *args);
 
 // .... Helper functions for EM data extensions ..................
 npy_intp get_misclass_points(const npy_bool *src, const npy_bool *tgt, const npy_bool *msk, npy_intp numel,
@@ -46,3 +46,18 @@ npy_intp get_misclass_points(const npy_bool *src, const npy_bool *tgt, const npy
 int get_nbhd_patch(npy_bool *patch, const npy_bool *src, npy_int x, npy_int y, npy_int z, npy_int m, npy_int n,
         npy_int nz);
 npy_uint32 get_simpleLUTind_from_patch(npy_bool *patch);
+
+// min heap for priority flood watershed, ties are popped in order pushed (by age)
+typedef struct {
+    npy_float32 value;
+    npy_uint64 age;
+    npy_intp ind;
+} heap_elem;
+
+typedef struct {
+    heap_elem *elems;
+    npy_intp size, nalloc;
+} heap_queue;
+
+void heap_push(heap_queue *heap, npy_float32 value, npy_uint64 age, npy_intp ind);
+heap_elem heap_pop(heap_queue *heap);
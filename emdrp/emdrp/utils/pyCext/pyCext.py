@@ -31,6 +31,7 @@ import os
 #import sys
 import snappy
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
 
 from scipy import ndimage as nd
 
@@ -70,7 +71,7 @@ def label_affinities(affinities, labels, nextlabel, threshold):
 def binary_warping(source, target, mask=None, gray=None, grayThresholds=None, borderval=False, numiters=-1, slow=False,
         simpleLUT=None, connectivity=1, return_nonSimple=False):
     sz =  [x+2 for x in source.shape]   # need border for neighborhoods around the edge voxels
-    dtype = np.bool; pdtype = np.float32
+    dtype = bool; pdtype = np.float32
     test=np.zeros((2,2),dtype=dtype)
 
     if type(source) != type(test):
@@ -237,7 +238,7 @@ def remove_adjacencies(labels, bwconn):
     if labels.dtype != test.dtype:
         raise Exception('In remove_adjacencies, labels not uint32')
 
-    testB=np.zeros((2,2),dtype=np.bool)
+    testB=np.zeros((2,2),dtype=bool)
     if type(bwconn) != type(testB):
         raise Exception( 'In remove_adjacencies, bwconn is not *NumPy* array')
     if len(bwconn.shape) != 3:
@@ -258,6 +259,69 @@ def remove_adjacencies(labels, bwconn):
     _pyCext.remove_adjacencies(lbls, lblsout, bwconn)
     return lblsout[slc]
 
+# seeded priority flood watershed of image (flooding from low to high values) starting from non-zero markers.
+# neighborhood is given by 3x3x3 bwconn. optionally also returns labels with a no-adjacency boundary (based on bwconn),
+#   the full flood labels are returned unchanged (same as without the boundary).
+# optionally run in blocks (along first dimension) in parallel threads. blocks are extended by halo voxels on either
+#   side and only the inner block is kept. markers are shared, so labels are consistent across blocks.
+# xxx - voxels that are flooded from markers further than the halo away from a block can differ from whole volume
+def seeded_watershed(image, markers, bwconn, mask=None, no_adjacencies=False, nblocks=1, halo=16):
+    dtype = np.uint32; pdtype = np.float32; test=np.zeros((2,2),dtype=dtype)
+    if type(image) != type(test):
+        raise Exception( 'In seeded_watershed, image is not *NumPy* array')
+    if len(image.shape) != 3:
+        raise Exception( 'In seeded_watershed, image is not 3 dimensional')
+    if type(markers) != type(test):
+        raise Exception( 'In seeded_watershed, markers is not *NumPy* array')
+    if not np.array_equal(markers.shape, image.shape):
+        raise Exception( 'In seeded_watershed, markers not same shape as image')
+    if markers.dtype.kind not in 'iu' or markers.max() > np.iinfo(dtype).max:
+        raise Exception( 'In seeded_watershed, markers not integer type that fits into uint32')
+    if mask is None:
+        mask = np.ones(image.shape, dtype=bool)
+    else:
+        if type(mask) != type(test):
+            raise Exception( 'In seeded_watershed, mask is not *NumPy* array')
+        if mask.dtype != bool:
+            raise Exception( 'In seeded_watershed, mask not correct data type')
+        if not np.array_equal(mask.shape, image.shape):
+            raise Exception( 'In seeded_watershed, mask not same shape as image')
+    if type(bwconn) != type(test) or bwconn.shape != (3,3,3):
+        raise Exception( 'In seeded_watershed, bwconn is not 3x3x3 *NumPy* array')
+    if type(nblocks) != type(1) or nblocks < 1:
+        raise Exception( 'In seeded_watershed, nblocks argument is not a positive integer')
+
+    labels = np.zeros(image.shape, dtype=dtype)
+    uclabels = np.zeros(image.shape, dtype=dtype) if no_adjacencies else None
+
+    def watershed_block(beg, end):
+        # extend the block by the halo and add border for neighborhoods around the edge voxels (mask is zero there)
+        hbeg = max(beg - halo, 0); hend = min(end + halo, image.shape[0])
+        sz = [hend - hbeg + 2, image.shape[1] + 2, image.shape[2] + 2]
+        img = np.zeros(sz, dtype=pdtype); img[1:-1,1:-1,1:-1] = image[hbeg:hend,:,:]
+        lbls = np.zeros(sz, dtype=dtype); lbls[1:-1,1:-1,1:-1] = markers[hbeg:hend,:,:]
+        msk = np.zeros(sz, dtype=bool); msk[1:-1,1:-1,1:-1] = mask[hbeg:hend,:,:]
+        lblsuc = lbls.copy() if no_adjacencies else np.zeros((0,), dtype=dtype)
+
+        # linear C-order offsets in the padded volume for each neighbor in bwconn (excluding center)
+        pts = np.transpose(np.nonzero(bwconn)) - 1; pts = pts[np.abs(pts).sum(axis=1) > 0,:]
+        steps = (pts[:,0]*sz[1]*sz[2] + pts[:,1]*sz[2] + pts[:,2]).astype(np.int64)
+
+        _pyCext.seeded_watershed(img, lbls, lblsuc, msk, steps, int(no_adjacencies))
+        slc = np.s_[1+beg-hbeg:1+end-hbeg,1:-1,1:-1]
+        labels[beg:end,:,:] = lbls[slc]
+        if no_adjacencies: uclabels[beg:end,:,:] = lblsuc[slc]
+
+    nblocks = min(nblocks, image.shape[0]); blocks = np.linspace(0, image.shape[0], nblocks+1).astype(np.int64)
+    if nblocks == 1:
+        watershed_block(0, image.shape[0])
+    else:
+        # the C code releases the GIL, so threads are enough to run the blocks in parallel
+        with ThreadPoolExecutor(max_workers=nblocks) as executor:
+            for f in [executor.submit(watershed_block, blocks[i], blocks[i+1]) for i in range(nblocks)]: f.result()
+
+    return (labels, uclabels) if no_adjacencies else labels
+
 # assign type for each supervoxel using majority vote of contained voxels, output to supervoxel_type
 def type_components(labels, voxel_type, supervoxel_type, voxel_out_type, num_types=2):
     test=np.zeros((2,2),dtype=np.uint32)
@@ -305,8 +369,11 @@ def type_components(labels, voxel_type, supervoxel_type, voxel_out_type, num_typ
 
     return _pyCext.type_components(labels, voxel_type, supervoxel_type, voxel_out_type, num_types)
 
+# csr returns the border voxels as a single int64 array of border voxel indices (border_voxel_index) along with the
+#   offsets into it for each edge (edge_offsets, size nedges+1) instead of a list of border voxel arrays.
+#   the borders are counted before they are allocated, so this is more efficient for cubes with many border voxels.
 def frag_with_borders(supervoxels, nsupervoxels, pad=True, nbhd=1, conn=3, steps=None, min_step=None, max_step=None, 
-                      nalloc_rag=50, nalloc_borders=1000):
+                      nalloc_rag=50, nalloc_borders=1000, csr=False):
     dtype=np.uint32; test=np.zeros((2,2),dtype=dtype)
     if type(supervoxels) != type(test):
         raise Exception( 'In frag_with_borders, supervoxels is not *NumPy* array')
@@ -334,7 +401,7 @@ def frag_with_borders(supervoxels, nsupervoxels, pad=True, nbhd=1, conn=3, steps
         bwconn = nd.morphology.generate_binary_structure(supervoxels.ndim, conn)
 
         neigh_sel_size = 2*nbhd + 1
-        dilate_array = np.zeros((neigh_sel_size,neigh_sel_size,neigh_sel_size), dtype=np.bool)
+        dilate_array = np.zeros((neigh_sel_size,neigh_sel_size,neigh_sel_size), dtype=bool)
         dilate_array[neigh_sel_size//2,neigh_sel_size//2,neigh_sel_size//2] = 1;
         neigh_sel = nd.morphology.binary_dilation(dilate_array, bwconn, nbhd)
         neigh_sel_indices = np.transpose(np.nonzero(neigh_sel)) - (neigh_sel_size//2)
@@ -349,6 +416,17 @@ def frag_with_borders(supervoxels, nsupervoxels, pad=True, nbhd=1, conn=3, steps
         # steps range used in Cpp-code so that we don't look out-of-bounds
         min_step = steps.min(); max_step = steps.max()
 
+    if csr:
+        # the csr method visits the steps in both directions
+        if (steps <= 0).any():
+            raise Exception( 'In frag_with_borders, csr requires positive steps')
+        list_of_edges, border_voxel_index, edge_offsets = _pyCppext.frag_with_borders_csr(svox, nsupervoxels,
+                                                                                          steps, max_step)
+        if return_steps:
+            return list_of_edges, border_voxel_index, edge_offsets, steps, min_step, max_step
+        else:
+            return list_of_edges, border_voxel_index, edge_offsets
+
     list_of_edges, list_of_borders = _pyCppext.frag_with_borders(svox, nsupervoxels, steps, min_step, max_step, 
                                                                  nalloc_rag, nalloc_borders)
 
@@ -357,41 +435,50 @@ def frag_with_borders(supervoxels, nsupervoxels, pad=True, nbhd=1, conn=3, steps
     else:
         return list_of_edges, list_of_borders
 
-# xxx - not validated
-# calculate percentage overlap "sparse matrices" as lists for comparing two different labels
-def label_overlap(lblsA, lblsB, nlblsA=None, nlblsB=None, nAlloc=None):
-    dtype = np.uint32; test=np.zeros((2,2),dtype=dtype)
-    if type(lblsA) != type(test):
-        raise Exception( 'In type_components, lblsA is not *NumPy* array')
-    if len(lblsA.shape) != 3:
-        raise Exception( 'In type_components, lblsA is not 3 dimensional')
-    if not lblsA.flags.contiguous or np.isfortran(lblsA):
-        raise Exception( 'In type_components, lblsA not C-order contiguous')
-    if lblsA.dtype != np.uint32:
-        raise Exception( 'In type_components, lblsA not uint32')
-
-    if type(lblsB) != type(test):
-        raise Exception( 'In type_components, lblsB is not *NumPy* array')
-    if len(lblsB.shape) != 3:
-        raise Exception( 'In type_components, lblsB is not 3 dimensional')
-    if not lblsB.flags.contiguous or np.isfortran(lblsB):
-        raise Exception( 'In type_components, lblsB not C-order contiguous')
-    if lblsB.dtype != np.uint32:
-        raise Exception( 'In type_components, lblsB not uint32')
-
-    if not nlblsA: nlblsA = lblsA.max()
-    if not nlblsB: nlblsB = lblsB.max()
-    if not nAlloc: nAlloc = 10*max([nlblsA, nlblsB])
-
-    lblsA_ovlp = np.zeros((nAlloc,), dtype=dtype); lblsB_ovlp = np.zeros((nAlloc,), dtype=dtype)
-
-    dtype_perc = np.float32
-    lblsA_perc_ovlp = np.zeros((nAlloc,), dtype=dtype_perc)
-    lblsB_perc_ovlp = np.zeros((nAlloc,), dtype=dtype_perc)
-    lblsA_bg_perc_ovlp = np.zeros((nlblsA,), dtype=dtype_perc)
-    lblsB_bg_perc_ovlp = np.zeros((nlblsB,), dtype=dtype_perc)
-
-    cnt = _pyCext.label_overlap(lblsA, lblsB, lblsA_ovlp, lblsB_ovlp, lblsA_perc_ovlp, lblsB_perc_ovlp,
-                                lblsA_bg_perc_ovlp, lblsB_bg_perc_ovlp)
-    return cnt, lblsA_ovlp[:cnt], lblsB_ovlp[:cnt], lblsA_perc_ovlp[:cnt], lblsB_perc_ovlp[:cnt],\
-        lblsA_bg_perc_ovlp, lblsB_bg_perc_ovlp
+# sparse contingency (overlap) table of two label arrays of the same shape, the counts of voxels for each pair of
+#   labels (a, b) at the same location. optionally only within mask and only for pairs of non-zero labels (nonzero).
+# pairs are counted in a hash table so the cost scales with the number of voxels and not the label ranges.
+# the C code releases the GIL, so the arrays are split into nblocks that are counted in parallel threads.
+# a table (pairs, counts) returned from a previous call is accumulated into (chunked processing of large volumes).
+# returns the label pairs sorted by label a then label b (npairs x 2 uint32) and the counts (int64).
+def label_overlap(lblsA, lblsB, mask=None, nonzero=False, table=None, nblocks=1):
+    dtype=np.uint32; test=np.zeros((2,2),dtype=dtype)
+    if type(lblsA) != type(test) or type(lblsB) != type(test):
+        raise Exception( 'In label_overlap, labels are not *NumPy* arrays')
+    if lblsA.shape != lblsB.shape:
+        raise Exception( 'In label_overlap, labels are not the same shape')
+    if mask is not None and (type(mask) != type(test) or mask.shape != lblsA.shape):
+        raise Exception( 'In label_overlap, mask is not *NumPy* array the same shape as labels')
+
+    # any integer labels that fit in the label datatype, the C code only takes contiguous uint32
+    lbls = [lblsA, lblsB]
+    for i in range(2):
+        if lbls[i].dtype != dtype:
+            if not np.issubdtype(lbls[i].dtype, np.integer) and lbls[i].dtype != bool:
+                raise Exception( 'In label_overlap, labels not integer datatype')
+            if lbls[i].size > 0 and (lbls[i].min() < 0 or lbls[i].max() > np.iinfo(dtype).max):
+                raise Exception( 'In label_overlap, labels out of range for uint32')
+        lbls[i] = np.ascontiguousarray(lbls[i], dtype=dtype).reshape(-1)
+    if mask is not None: mask = np.ascontiguousarray(mask, dtype=bool).reshape(-1)
+
+    if table is None:
+        pairs = np.zeros((0,2), dtype=dtype); counts = np.zeros((0,), dtype=np.int64)
+    else:
+        pairs = np.ascontiguousarray(table[0], dtype=dtype); counts = np.ascontiguousarray(table[1], dtype=np.int64)
+
+    if nblocks == 1:
+        pairs, counts = _pyCppext.label_overlap(lbls[0], lbls[1], mask, int(nonzero), pairs, counts)
+    else:
+        # count the blocks in parallel, then merge the block tables (and the input table) into a single table
+        blocks = np.linspace(0, lbls[0].size, nblocks+1).astype(np.int64); empty = np.zeros((0,), dtype=dtype)
+        def overlap_block(beg, end):
+            return _pyCppext.label_overlap(lbls[0][beg:end], lbls[1][beg:end], None if mask is None else mask[beg:end],
+                int(nonzero), np.zeros((0,2), dtype=dtype), np.zeros((0,), dtype=np.int64))
+        with ThreadPoolExecutor(max_workers=nblocks) as executor:
+            tables = list(executor.map(overlap_block, blocks[:-1], blocks[1:]))
+        pairs = np.concatenate([pairs] + [x[0] for x in tables])
+        counts = np.concatenate([counts] + [x[1] for x in tables])
+        pairs, counts = _pyCppext.label_overlap(empty, empty, None, 0, pairs, counts)
+
+    order = np.lexsort((pairs[:,1], pairs[:,0]))
+    return pairs[order,:], counts[order]
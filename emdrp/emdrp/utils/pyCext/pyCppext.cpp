@@ -31,6 +31,7 @@
 
 #include <iostream>
 #include <assert.h>
+#include <unordered_map>
 
 /* #### Globals #################################### */
 
@@ -38,6 +39,8 @@
 static PyMethodDef _pyCppextMethods[] = {
     // EM data extensions
     {"frag_with_borders", frag_with_borders, METH_VARARGS},
+    {"frag_with_borders_csr", frag_with_borders_csr, METH_VARARGS},
+    {"label_overlap", label_overlap, METH_VARARGS},
 
     {NULL, NULL}     /* Sentinel - marks the end of this structure */
 };
@@ -231,3 +234,198 @@ static PyObject *frag_with_borders(PyObject *self, PyObject *args) {
     //return (PyObject *) list_of_edges; // to return single object
     return Py_BuildValue("OO", (PyObject *) list_of_edges, border_list);
 }
+
+// Same RAG as frag_with_borders, but the border voxels are returned in compressed sparse row format, as a single
+//   array of border voxel indices and the offsets into it for each edge (parallel to the edge list).
+// Instead of growing a border list for each edge, a first pass counts the border voxels for each edge so that the
+//   border voxels are allocated exactly once, and a second pass fills them in. The border voxels are unique by
+//   visiting the whole (symmetric) neighborhood of each voxel and counting it once for each neighboring label.
+//   Voxels are visited in order, so the border voxels for each edge are sorted without any inserts.
+// Both passes only visit voxels marked as border voxels by a scan with the positive steps (as frag_with_borders).
+static PyObject *frag_with_borders_csr(PyObject *self, PyObject *args) {
+
+    PyArrayObject *input_watershed, *input_steps;
+    npy_uint32 *watershed, label, nlabel, cvalue, *nlabels;
+    npy_intp n_voxels, n_steps, n_nlabels, edge_count=0, border_count=0, j;
+    npy_int32 *steps;
+    npy_uint32 n_supervoxels;
+    int max_step;
+    std::vector<RAG_CSR> *cedges;
+    std::vector<RAG_CSR>::iterator it;
+    RAG_CSR crag;
+    PyArrayObject *list_of_edges = NULL, *edge_offsets = NULL, *border_voxel_index = NULL;
+    npy_uint32 *edges = NULL;
+    npy_int64 *offsets = NULL, *borders = NULL;
+
+    // parse arguments, steps must all be positive (same as passed to frag_with_borders)
+    if (!PyArg_ParseTuple(args, "O!IO!i", &PyArray_Type, &input_watershed, &n_supervoxels,
+                          &PyArray_Type, &input_steps, &max_step))
+       return NULL;
+
+    // supervoxels or "watershed" label input
+    n_voxels = PyArray_SIZE(input_watershed);
+    watershed = (npy_uint32 *) PyArray_DATA(input_watershed);
+
+    // integers specifying where to look relative to current voxel, both directions are visited
+    n_steps = PyArray_SIZE(input_steps);
+    steps = (npy_int32 *) PyArray_DATA(input_steps);
+
+    // allocate data structure for storing edges and the unique neighboring labels of the current voxel
+    std::vector<RAG_CSR> **sparse_edges = new std::vector<RAG_CSR>* [n_supervoxels];
+    for( npy_uint32 i=0; i < n_supervoxels; i++ ) sparse_edges[i] = new std::vector<RAG_CSR>;
+    nlabels = new npy_uint32 [2*n_steps];
+
+    // same as frag_with_borders, only pairs of voxels where the first voxel is at least max_step from the end
+    npy_int64 n_first = n_voxels - max_step;
+
+    // mark the border voxels, any voxel in a pair of voxels with different labels
+    std::vector<npy_uint8> is_border(n_voxels, 0);
+    for( npy_int64 vox = 0, cvox; vox < n_first; vox++ ) {
+        label = watershed[vox];
+        if( label == 0 || label > n_supervoxels ) continue;
+        for( int step = 0; step < n_steps; step++ ) {
+            cvox = vox + steps[step]; nlabel = watershed[cvox];
+            if( nlabel != 0 && nlabel != label && nlabel <= n_supervoxels ) {
+                is_border[vox] = 1; is_border[cvox] = 1;
+            }
+        }
+    }
+
+    for( int pass = 0; pass < 2; pass++ ) {
+        for( npy_int64 vox = 0, cvox; vox < n_voxels; vox++ ) {
+            if( !is_border[vox] ) continue;
+            label = watershed[vox];
+
+            // unique neighboring labels over the whole neighborhood
+            n_nlabels = 0;
+            for( int step = 0; step < n_steps; step++ ) {
+                for( int dir = 0; dir < 2; dir++ ) {
+                    if( dir ) {
+                        cvox = vox - steps[step];
+                        if( cvox < 0 || cvox >= n_first ) continue;
+                    } else {
+                        cvox = vox + steps[step];
+                        if( vox >= n_first ) continue;
+                    }
+                    nlabel = watershed[cvox];
+                    if( nlabel == 0 || nlabel == label || nlabel > n_supervoxels ) continue; // no self-directed edges
+                    for( j = 0; j < n_nlabels; j++ )
+                        if( nlabels[j] == nlabel ) break;
+                    if( j == n_nlabels ) nlabels[n_nlabels++] = nlabel;
+                }
+            }
+
+            for( j = 0; j < n_nlabels; j++ ) {
+                // only store "triangular" matrix so edges are not duplicated (RAG is not directed)
+                nlabel = nlabels[j];
+                if( nlabel < label ) {
+                    cedges = sparse_edges[label-1]; cvalue = nlabel;
+                } else {
+                    cedges = sparse_edges[nlabel-1]; cvalue = label;
+                }
+
+                // search for the edge, kept in descending order same as frag_with_borders
+                for( it = cedges->begin(); it != cedges->end(); it++ )
+                    if( it->value <= cvalue ) break;
+
+                if( pass == 0 ) {
+                    // store the edge if not already there and count the border voxel
+                    if( it == cedges->end() || it->value != cvalue ) {
+                        crag.value = cvalue; crag.count = 0;
+                        it = cedges->insert(it, crag); edge_count++;
+                    }
+                    it->count++; border_count++;
+                } else {
+                    borders[it->count++] = vox;
+                }
+            }
+        }
+
+        if( pass == 0 ) {
+            // allocate the outputs, copy the edges and replace the counts with the offsets for the second pass
+            npy_intp eshp[2]; eshp[0] = edge_count; eshp[1] = 2;
+            list_of_edges = (PyArrayObject *) PyArray_Empty(2, eshp, PyArray_DescrFromType(NPY_UINT32), 0);
+            edges = (npy_uint32 *) PyArray_DATA(list_of_edges);
+            npy_intp oshp[1]; oshp[0] = edge_count + 1;
+            edge_offsets = (PyArrayObject *) PyArray_Empty(1, oshp, PyArray_DescrFromType(NPY_INT64), 0);
+            offsets = (npy_int64 *) PyArray_DATA(edge_offsets);
+            npy_intp bshp[1]; bshp[0] = border_count;
+            border_voxel_index = (PyArrayObject *) PyArray_Empty(1, bshp, PyArray_DescrFromType(NPY_INT64), 0);
+            borders = (npy_int64 *) PyArray_DATA(border_voxel_index);
+
+            npy_intp cnt = 0; offsets[0] = 0;
+            for( npy_uint32 i=0; i < n_supervoxels; i++ ) {
+                for( it = sparse_edges[i]->begin(); it != sparse_edges[i]->end(); it++, cnt++ ) {
+                    edges[2*cnt] = it->value; edges[2*cnt+1] = i+1;
+                    offsets[cnt+1] = offsets[cnt] + it->count; it->count = offsets[cnt];
+                }
+            }
+        }
+    }
+
+    for( npy_uint32 i=0; i < n_supervoxels; i++ ) delete sparse_edges[i];
+    delete[] sparse_edges; delete[] nlabels;
+
+    return Py_BuildValue("NNN", (PyObject *) list_of_edges, (PyObject *) border_voxel_index,
+                         (PyObject *) edge_offsets);
+}
+
+// sparse contingency table of two label arrays, count the voxels for each pair of labels at the same location.
+// optionally only count voxels within a mask and / or only pairs where both labels are non-zero.
+// pairs are kept in a hash table, so the cost scales with the number of voxels and not the label ranges.
+// the table is initialized with the input pairs and counts, so counts can be accumulated over multiple calls.
+// the counting is done with the GIL released. pairs are returned in hash table order.
+static PyObject *label_overlap(PyObject *self, PyObject *args) {
+
+    PyArrayObject *input_labelsA, *input_labelsB, *input_pairs, *input_counts;
+    PyObject *input_mask;
+    npy_uint32 *lblsA, *lblsB, *ipairs;
+    npy_bool *mask = NULL;
+    npy_int64 *icounts;
+    npy_intp n_voxels, n_init, cnt = 0;
+    int nonzero;
+    std::unordered_map<npy_uint64, npy_int64> counts;
+    std::unordered_map<npy_uint64, npy_int64>::iterator it;
+    PyArrayObject *label_pairs = NULL, *pair_counts = NULL;
+    npy_uint32 *pairs = NULL;
+    npy_int64 *pcounts = NULL;
+
+    // pairs, counts = _pyCppext.label_overlap(lblsA, lblsB, mask or None, nonzero, pairs, counts)
+    if (!PyArg_ParseTuple(args, "O!O!OiO!O!", &PyArray_Type, &input_labelsA, &PyArray_Type, &input_labelsB,
+                          &input_mask, &nonzero, &PyArray_Type, &input_pairs, &PyArray_Type, &input_counts))
+       return NULL;
+
+    n_voxels = PyArray_SIZE(input_labelsA);
+    lblsA = (npy_uint32 *) PyArray_DATA(input_labelsA);
+    lblsB = (npy_uint32 *) PyArray_DATA(input_labelsB);
+    if( input_mask != Py_None ) mask = (npy_bool *) PyArray_DATA((PyArrayObject *) input_mask);
+    n_init = PyArray_SIZE(input_counts);
+    ipairs = (npy_uint32 *) PyArray_DATA(input_pairs);
+    icounts = (npy_int64 *) PyArray_DATA(input_counts);
+
+    Py_BEGIN_ALLOW_THREADS
+    for( npy_intp i = 0; i < n_init; i++ )
+        counts[((npy_uint64) ipairs[2*i] << 32) | (npy_uint64) ipairs[2*i+1]] += icounts[i];
+
+    for( npy_intp vox = 0; vox < n_voxels; vox++ ) {
+        if( mask && !mask[vox] ) continue;
+        if( nonzero && (lblsA[vox] == 0 || lblsB[vox] == 0) ) continue;
+        counts[((npy_uint64) lblsA[vox] << 32) | (npy_uint64) lblsB[vox]]++;
+    }
+    Py_END_ALLOW_THREADS
+
+    // allocate the outputs and copy the pairs out of the hash table
+    npy_intp pshp[2]; pshp[0] = counts.size(); pshp[1] = 2;
+    label_pairs = (PyArrayObject *) PyArray_Empty(2, pshp, PyArray_DescrFromType(NPY_UINT32), 0);
+    pairs = (npy_uint32 *) PyArray_DATA(label_pairs);
+    npy_intp cshp[1]; cshp[0] = counts.size();
+    pair_counts = (PyArrayObject *) PyArray_Empty(1, cshp, PyArray_DescrFromType(NPY_INT64), 0);
+    pcounts = (npy_int64 *) PyArray_DATA(pair_counts);
+
+    for( it = counts.begin(); it != counts.end(); it++, cnt++ ) {
+        pairs[2*cnt] = (npy_uint32) (it->first >> 32); pairs[2*cnt+1] = (npy_uint32) (it->first & 0xFFFFFFFF);
+        pcounts[cnt] = it->second;
+    }
+
+    return Py_BuildValue("NN", (PyObject *) label_pairs, (PyObject *) pair_counts);
+}
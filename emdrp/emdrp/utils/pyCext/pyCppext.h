@@ -39,10 +39,19 @@ typedef struct {
         npy_intp last_border;
     } RAG;
 
+// a RAG graph element for the compressed sparse row borders, count is the number of border voxels in the first pass
+//   and the current position in the border voxels for the edge in the second pass.
+typedef struct {
+        npy_uint32 value;
+        npy_intp count;
+    } RAG_CSR;
+
 /* ==== Prototypes =================================== */
 
 // .... Python callable EM data extensions ..................
 
 static PyObject *frag_with_borders(PyObject *self, PyObject *args);
+static PyObject *frag_with_borders_csr(PyObject *self, PyObject *args);
+static PyObject *label_overlap(PyObject *self, PyObject *args);
 
 // .... Helper functions for EM data extensions ..................
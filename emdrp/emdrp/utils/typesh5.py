@@ -27,10 +27,12 @@
 #     (2) label - unsigned integer containing ICS/ECS supervoxel labels
 #     (3) probabilities - single floats containing network output probabilities (voxel type, affinity, etc)
 
+import os
 import numpy as np
+import h5py
 from scipy import ndimage as nd
 import argparse
-#import time
+import time
 import networkx as nx
 from emdrp.utils.utils import optimal_color
 #import sys
@@ -119,8 +121,12 @@ class emLabels(dpWriteh5):
         self.EMPTY_LABEL = np.iinfo(self.data_type).max
         self.fillvalue = self.EMPTY_LABEL
 
+    LBLS_DELTA_DATASET = LBLS_DATASET + '_delta'
+    LBLS_MAPPING_DATASET = LBLS_DATASET + '_mapping'
+
     @classmethod
-    def readLabels(cls, srcfile, chunk, offset, size, data_type=None, subgroups=[], verbose=False):
+    def readLabels(cls, srcfile, chunk, offset, size, data_type=None, subgroups=[], verbose=False, delta=True,
+            mapping=True):
         if not data_type: data_type = cls.LBLS_STR_DTYPE
         parser = argparse.ArgumentParser(description='class:emLabels',
             formatter_class=argparse.ArgumentDefaultsHelpFormatter)
@@ -134,9 +140,149 @@ class emLabels(dpWriteh5):
         if verbose: arg_str += ' --dpLoadh5-verbose '
         if verbose: print(arg_str)
         args = parser.parse_args(arg_str.split())
-        loadh5 = cls(args); loadh5.readCubeToBuffers()
+        loadh5 = cls(args)
+
+        # if there is no labels dataset at this location, optionally reconstruct labels that were written as a delta,
+        #   meaning a lookup table (and residual voxels) applied to the labels at some other (finer) location.
+        if delta and loadh5.isFile and not loadh5.isDataset:
+            deltas = cls.readLabelsDelta(srcfile, subgroups)
+            if deltas is not None:
+                loadh5 = cls.readLabels(srcfile, chunk, offset, size, data_type=data_type, subgroups=deltas[0]['base'],
+                    verbose=verbose, mapping=mapping)
+                loadh5.data_cube = cls.delta_decode_cubes(loadh5.data_cube, chunk, offset, loadh5.chunksize,
+                    deltas).astype(loadh5.data_type, copy=False)
+                for d in deltas: loadh5.data_attrs.update(d['attrs'])
+                loadh5.subgroups = subgroups
+                return loadh5
+
+        loadh5.readCubeToBuffers()
+
+        # labels written with a global mapping (stitched labels, see dpCubeStitcher two pass) optionally have the
+        #   mapping applied on read, values outside the mapping (unwritten fillvalue) are not mapped.
+        # only the mapping entries for the labels in the cube are read, the mapping is for the whole volume.
+        # without applying the mapping, the number of labels before mapping is returned in mapping_nlabels.
+        if loadh5.isDataset:
+            h5file = h5py.File(srcfile,'r'); dsetpath = '/'.join(subgroups + [cls.LBLS_MAPPING_DATASET])
+            if dsetpath in h5file:
+                dset = h5file[dsetpath]
+                if mapping:
+                    lbls, inv = np.unique(loadh5.data_cube, return_inverse=True); sel = (lbls < dset.shape[0])
+                    if sel.any(): lbls[sel] = dset[lbls[sel]]
+                    loadh5.data_cube = lbls[inv].reshape(loadh5.data_cube.shape)
+                else:
+                    loadh5.data_attrs['mapping_nlabels'] = np.array([dset.shape[0]-1])
+            h5file.close()
         return loadh5
 
+    # read labels keeping the base labels of a delta in cache (dict), so that the base labels are only read once for
+    #   all the deltas written against them, for example the agglomeration tables for all the thresholds of a sweep.
+    # only the base labels for the last cube are kept in the cache.
+    @classmethod
+    def readLabelsCached(cls, srcfile, chunk, offset, size, cache, data_type=None, subgroups=[], verbose=False):
+        deltas = cls.readLabelsDelta(srcfile, subgroups) if os.path.isfile(srcfile) else None
+        if deltas is None:
+            return cls.readLabels(srcfile, chunk, offset, size, data_type=data_type, subgroups=subgroups,
+                verbose=verbose).data_cube
+
+        key = (srcfile, tuple(deltas[0]['base']), tuple(chunk), tuple(offset), tuple(size), data_type)
+        if key not in cache:
+            cache.clear(); loadh5 = cls.readLabels(srcfile, chunk, offset, size, data_type=data_type,
+                subgroups=deltas[0]['base'], verbose=verbose)
+            cache[key] = (loadh5.data_cube, loadh5.chunksize)
+        base, chunksize = cache[key]
+        return cls.delta_decode_cubes(base, chunk, offset, chunksize, deltas).astype(base.dtype, copy=False)
+
+    # name of the group for the delta of a single cube. deltas written for different cubes to the same location
+    #   (for example dpWatershedTypes or dpFRAG run per cube) are stored next to each other in the delta group.
+    @staticmethod
+    def delta_cube_name(chunk, offset, size):
+        return 'c%d_%d_%d_o%d_%d_%d_s%d_%d_%d' % tuple(list(chunk) + list(offset) + list(size))
+
+    # read the deltas (lookup table into base labels plus residual voxels) for all the cubes written at specified
+    #   subgroups, in the order they were written, None if not present.
+    @classmethod
+    def readLabelsDelta(cls, srcfile, subgroups=[]):
+        h5file = h5py.File(srcfile,'r'); dsetpath = '/'.join(subgroups + [cls.LBLS_DELTA_DATASET])
+        if dsetpath not in h5file: h5file.close(); return None
+        # single delta written directly into the delta group (previous format) is read as a single cube
+        grp = h5file[dsetpath]; grps = [grp] if 'lut' in grp else [grp[x] for x in grp.keys()]
+        deltas = []
+        for grp in grps:
+            d = {'attrs':{}, 'order':0}
+            for name in ['lut','inds','vals']: d[name] = grp[name][:]
+            for name,value in grp.attrs.items():
+                if name in ['chunk','offset','size']:
+                    d[name] = value.tolist()
+                elif name == 'order':
+                    d[name] = int(value)
+                elif name == 'base':
+                    d[name] = [x.decode('ascii') if isinstance(x, bytes) else x for x in value]
+                else:
+                    d['attrs'][name] = value
+            deltas.append(d)
+        h5file.close()
+        return sorted(deltas, key=lambda d: d['order']) if len(deltas) > 0 else None
+
+    # read the global mapping stored next to the labels at specified subgroups, None if not present.
+    @classmethod
+    def readLabelsMapping(cls, srcfile, subgroups=[]):
+        h5file = h5py.File(srcfile,'r'); dsetpath = '/'.join(subgroups + [cls.LBLS_MAPPING_DATASET])
+        m = h5file[dsetpath][:] if dsetpath in h5file else None
+        h5file.close()
+        return m
+
+    # write a global mapping next to the labels at specified subgroups that is applied when the labels are read.
+    # attrs are written to the labels dataset (for example number of labels after mapping).
+    # mapping of None removes the mapping, for example after the mapping has been applied to the labels.
+    @classmethod
+    def writeLabelsMapping(cls, outfile, mapping, attrs={}, subgroups=[], verbose=False):
+        if verbose:
+            print('emLabels: Writing labels mapping to %s with %d entries' % ('/'.join(subgroups),
+                0 if mapping is None else mapping.size)); t = time.time()
+        h5file = h5py.File(outfile, 'r+' if os.path.isfile(outfile) else 'w')
+        dsetpath = '/'.join(subgroups + [cls.LBLS_MAPPING_DATASET])
+        if dsetpath in h5file: del h5file[dsetpath]
+        if mapping is not None:
+            h5file.create_dataset(dsetpath, data=mapping, compression='gzip', compression_opts=cls.HDF5_CLVL,
+                shuffle=True, fletcher32=True)
+        dsetpath = '/'.join(subgroups + [cls.LBLS_DATASET])
+        if dsetpath in h5file:
+            for name,value in attrs.items(): h5file[dsetpath].attrs[name] = value
+        h5file.close()
+        if verbose: print('\tdone in %.4f s' % (time.time() - t))
+
+    # write labels as a delta against labels at subgroups base (normally the next finer threshold).
+    # only the lookup table from base labels and the residual voxels that are not explained by the lookup are stored.
+    @classmethod
+    def writeLabelsDelta(cls, outfile, chunk, offset, size, lut, inds, vals, base, attrs={}, subgroups=[],
+            verbose=False):
+        if verbose:
+            print('emLabels: Writing labels delta to %s with %d lut entries, %d residual voxels' % \
+                ('/'.join(subgroups), lut.size, inds.size)); t = time.time()
+        h5file = h5py.File(outfile, 'r+' if os.path.isfile(outfile) else 'w')
+        dsetpath = '/'.join(subgroups + [cls.LBLS_DELTA_DATASET])
+        # deltas for other cubes are kept, remove previous format (single delta) or this cube if already written.
+        # order is kept so that overlapping cubes are decoded in the order they were written (last write wins).
+        if dsetpath in h5file and 'lut' in h5file[dsetpath]: del h5file[dsetpath]
+        if dsetpath not in h5file: h5file.create_group(dsetpath)
+        order = max([h5file[dsetpath][x].attrs['order'] for x in h5file[dsetpath].keys()], default=-1) + 1
+        dsetpath = '/'.join([dsetpath, cls.delta_cube_name(chunk, offset, size)])
+        if dsetpath in h5file: del h5file[dsetpath]
+        grp = h5file.create_group(dsetpath)
+        for name,value in zip(['lut','inds','vals'], [lut,inds,vals]):
+            grp.create_dataset(name, data=value, compression='gzip', compression_opts=cls.HDF5_CLVL, shuffle=True,
+                fletcher32=True)
+        grp.attrs['chunk'] = chunk; grp.attrs['offset'] = offset; grp.attrs['size'] = size; grp.attrs['order'] = order
+        grp.attrs['base'] = [x.encode('ascii', 'ignore') for x in base]
+        for name,value in attrs.items():
+            if isinstance(value, str):
+                value = value.encode('ascii', 'ignore')
+            elif type(value) is list and len(value) > 0 and isinstance(value[0], str):
+                value = [n.encode('ascii', 'ignore') for n in value]
+            grp.attrs.create(name,value)
+        h5file.close()
+        if verbose: print('\tdone in %.4f s' % (time.time() - t))
+
     @classmethod
     def writeLabels(cls, outfile, chunk, offset, size, datasize, chunksize, fillvalue=None, data=None, inraw='',
             strbits='32', outraw='', attrs={}, subgroups=[], verbose=False):
@@ -168,6 +314,60 @@ class emLabels(dpWriteh5):
     # xxx - not a great reason that these were written as static methdods, maybe make as normal methods?
     #   would either modify labels in place or return a modified set of labels.
 
+    # encode coarse labels as a lookup table into fine labels plus residual voxels (flat C-order indices) where the
+    #   lookup does not reproduce the coarse labels. each fine label maps to the coarse label it overlaps most.
+    # for nested labelings (like consecutive watershed thresholds) the residual is empty or very small.
+    @staticmethod
+    def delta_encode(fine, coarse):
+        assert( fine.shape == coarse.shape )
+        f = fine.reshape(-1).astype(np.int64); c = coarse.reshape(-1)
+        nfine = int(f.max()) + 1 if f.size > 0 else 1; ncoarse = int(c.max()) + 1 if c.size > 0 else 1
+        assert( nfine * ncoarse < np.iinfo(np.int64).max )   # label pairs must be encodable in int64
+        pairs, counts = np.unique(f*ncoarse + c, return_counts=True)
+        pf = pairs // ncoarse; pc = pairs % ncoarse
+
+        # for each fine label take the coarse label with the maximum overlap
+        order = np.lexsort((counts, pf)); pf = pf[order]; pc = pc[order]
+        sel = np.ones(pf.shape, dtype=bool); sel[:-1] = (pf[1:] != pf[:-1])
+        lut = np.zeros((nfine,), dtype=coarse.dtype); lut[pf[sel]] = pc[sel]
+
+        # residual voxels that are not nested within the fine labels
+        inds = np.flatnonzero(lut[f] != c)
+        inds = inds.astype(np.uint32 if f.size <= np.iinfo(np.uint32).max else np.int64)
+        return lut, inds, c[inds]
+
+    # inverse of delta_encode, reconstruct the coarse labels from fine labels, lookup table and residual voxels.
+    @staticmethod
+    def delta_decode(fine, lut, inds, vals):
+        assert( fine.size == 0 or fine.max() < lut.size )   # lookup table does not match fine labels
+        labels = lut[fine]
+        # labels read from hdf5 are typically F-order views, so do not assume flat indexing is a view
+        if inds.size > 0: labels[np.unravel_index(inds.astype(np.int64), labels.shape)] = vals
+        return labels
+
+    # decode the deltas written for (possibly) multiple cubes in the cube read at chunk / offset with the base labels.
+    # each delta is applied where its cube intersects the cube read, residual voxels are flat indices in the cube the
+    #   delta was written for. the cube read must be completely covered by the cubes the deltas were written for.
+    @staticmethod
+    def delta_decode_cubes(base, chunk, offset, chunksize, deltas):
+        start = np.array(chunk)*chunksize + np.array(offset); stop = start + np.array(base.shape)
+        labels = np.zeros(base.shape, dtype=deltas[0]['lut'].dtype); covered = np.zeros(base.shape, dtype=bool)
+        for d in deltas:
+            dsize = np.array(d['size']); dstart = np.array(d['chunk'])*chunksize + np.array(d['offset'])
+            lo = np.maximum(start, dstart); hi = np.minimum(stop, dstart + dsize)
+            if (hi <= lo).any(): continue
+            sel = tuple(slice(x,y) for x,y in zip(lo - start, hi - start)); fine = base[sel]
+            assert( fine.size == 0 or fine.max() < d['lut'].size )   # lookup table does not match base labels
+            labels[sel] = d['lut'][fine]; covered[sel] = True
+            if d['inds'].size > 0:
+                crds = [x + y for x,y in zip(np.unravel_index(d['inds'].astype(np.int64), tuple(dsize)), dstart)]
+                isel = np.ones(d['inds'].shape, dtype=bool)
+                for x,l,h in zip(crds, lo, hi): isel = np.logical_and(isel, np.logical_and(x >= l, x < h))
+                labels[tuple(x[isel] - y for x,y in zip(crds, start))] = d['vals'][isel]
+        if not covered.all():
+            raise Exception('In delta_decode_cubes, delta labels were not written for the whole cube read')
+        return labels
+
     # relabel sequential using thresholdSizes, just for a more clear name and if mappings are not needed
     @staticmethod
     def relabel_sequential(lbls, return_mapping=False):
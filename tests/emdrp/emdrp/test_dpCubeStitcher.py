@@ -0,0 +1,146 @@
+import os
+import sys
+import argparse
+import numpy as np
+from scipy import ndimage as nd
+import emdrp.dpLoadh5
+
+# dpCubeStitcher uses script style imports, with the package and its utils on the path (see set_environment.sh)
+sys.path.insert(0, os.path.dirname(emdrp.dpLoadh5.__file__)); import utils.typesh5
+sys.path.append(os.path.join(sys.path[0], 'utils'))
+from dpCubeStitcher import dpCubeStitcher
+from dpCubeIter import dpCubeIter
+from utils.typesh5 import emLabels
+
+chunksize = np.array([16,16,16]); volume_range = [3,2,2]; overlap = np.array([4,4,4])
+datasize = chunksize*volume_range
+
+# separately labeled cubes with overlaps, voronoi supervoxels from seeds shared by all cubes plus extra seeds for each
+#   cube so that the cubes do not agree in the overlaps. returns the cube iterator info and labels for each cube.
+def write_cubes(tmp_path):
+    rs = np.random.RandomState(0); shared = [rs.randint(x, size=30) for x in datasize]; cubes = []
+    for volume_info in dpCubeIter.cubeIterGen([0,0,0], volume_range, overlap, [1,1,1], chunksize=chunksize):
+        _, size, chunk, offset, suffixes = volume_info[:5]; beg = chunk*chunksize + offset
+        pts = [np.concatenate((x, rs.randint(b, b+s, size=4))) for x,b,s in zip(shared, beg, size)]
+        seeds = np.zeros(datasize, dtype=np.uint32); seeds[tuple(pts)] = rs.permutation(pts[0].size) + 1
+        lbls = seeds[tuple(nd.distance_transform_edt(seeds == 0, return_distances=False, return_indices=True))]
+        lbls = lbls[tuple(slice(b, b+s) for b,s in zip(beg, size))].copy(); lbls[rs.rand(*size) < 0.02] = 0
+        lbls, sizes = emLabels.relabel_sequential(lbls)
+        emLabels.writeLabels(outfile=str(tmp_path / ('labels%s.h5' % suffixes[0])), chunk=chunk.tolist(),
+            offset=offset.tolist(), size=size.tolist(), datasize=datasize.tolist(), chunksize=chunksize.tolist(),
+            data=lbls.astype(np.uint32), attrs={'types_nlabels':[sizes.size]})
+        cubes.append((volume_info, lbls))
+    return cubes
+
+# stitch the cubes, returns the saved connections (two pass only) and the stitched labels with any mapping applied
+def run_stitch(tmp_path, outfile, extra=''):
+    outfile = str(tmp_path / outfile); savefile = outfile + '.connections'
+    parser = argparse.ArgumentParser(); dpCubeStitcher.addArgs(parser)
+    arg_str = '--srcfile %s --outfile %s --filepaths %s --fileprefixes labels --volume_range_beg 0 0 0 ' \
+        '--volume_range_end %d %d %d --overlap %d %d %d --cube_size 1 1 1 --use-chunksize %d %d %d ' % \
+        tuple([outfile, outfile, str(tmp_path)] + volume_range + overlap.tolist() + chunksize.tolist())
+    if '--two_pass' in extra: arg_str += '--two_pass_save %s ' % (savefile,)
+    dpCubeStitcher(parser.parse_args((arg_str + extra).split())).stitch()
+    connections = np.fromfile(savefile, dtype=np.int64).reshape((-1,2)) if '--two_pass' in extra else None
+    return connections, emLabels.readLabels(outfile, [0,0,0], [0,0,0], datasize.tolist())
+
+# labels are the same up to the label values
+def same_labels(a, b):
+    pairs = np.unique(np.column_stack((a.reshape(-1), b.reshape(-1))), axis=0)
+    return np.unique(pairs[:,0]).size == pairs.shape[0] and np.unique(pairs[:,1]).size == pairs.shape[0]
+
+def test_stitch_parallel(tmp_path):
+    write_cubes(tmp_path)
+    serial, serial_lbls = run_stitch(tmp_path, 'serial.h5', '--two_pass')
+    parallel, parallel_lbls = run_stitch(tmp_path, 'parallel.h5', '--two_pass --two_pass_parallel --nworkers 2')
+
+    # same connection tables (in a different order) and the same number of labels without stitching
+    assert( serial.shape[0] > 1 and (serial[-1,:] == parallel[-1,:]).all() )
+    assert( (np.unique(serial[:-1,:], axis=0) == np.unique(parallel[:-1,:], axis=0)).all() )
+    assert( serial.shape == parallel.shape )
+
+    # same stitched supervoxels, the parallel stitch writes the remapped labels directly
+    assert( serial_lbls.data_attrs['types_nlabels'] == parallel_lbls.data_attrs['types_nlabels'] )
+    assert( serial_lbls.data_attrs['types_nlabels'][0] < serial[-1,1] )
+    assert( same_labels(serial_lbls.data_cube, parallel_lbls.data_cube) )
+    compact, compact_lbls = run_stitch(tmp_path, 'serial.h5', '--two_pass_compact')
+    assert( same_labels(compact_lbls.data_cube, parallel_lbls.data_cube) )
+
+# select for the overlap with the previous cubes on each face (1, 2, 3 for x, y, z faces, 0 for no overlap),
+#   as used by the first pass before it read only the face slabs.
+def overlap_select(size, overlap, is_left_border, is_right_border):
+    asel_ovlp = np.zeros(size, dtype=np.int8);
+    if not is_left_border[2]: asel_ovlp[:,:,:overlap[2]] = 3
+    if not is_left_border[1]: asel_ovlp[:,:overlap[1],:] = 2
+    if not is_left_border[0]: asel_ovlp[:overlap[0],:,:] = 1
+    if not is_right_border[0]: asel_ovlp[-overlap[0]:,:,:] = 0
+    if not is_right_border[1]: asel_ovlp[:,-overlap[1]:,:] = 0
+    if not is_right_border[2]: asel_ovlp[:,:,-overlap[2]:] = 0
+    return asel_ovlp
+
+# first pass comparing the whole cube read back from the stitched output, with the overlap select (in memory)
+def full_cube_first_pass(cubes, do_stitching):
+    nfaces = 1 if do_stitching else 3; ncomps = 0; connections = []; out = np.zeros(datasize, dtype=np.int64)
+    for volume_info, lbls in cubes:
+        _, size, chunk, offset, _, _, is_left_border, is_right_border, _ = volume_info
+        beg = chunk*chunksize + offset; cur_data = lbls.astype(np.int64); cur_ncomps = int(lbls.max())
+        if not is_left_border.all():
+            prev_data = out[tuple(slice(b, b+s) for b,s in zip(beg, size))]
+            asel_ovlp = overlap_select(size, overlap, is_left_border, is_right_border); no_overlap = [False]*nfaces
+            for face in range(nfaces):
+                sel_ovlp = (asel_ovlp > 0) if nfaces == 1 else (asel_ovlp == face+1)
+                prev_lbls = prev_data[sel_ovlp]; cur_lbls = cur_data[sel_ovlp]
+                sel_nz = np.logical_and(prev_lbls != 0, cur_lbls != 0)
+                prev_lbls = prev_lbls[sel_nz]; cur_lbls = cur_lbls[sel_nz]
+                if prev_lbls.size == 0:
+                    no_overlap[face] = True; continue
+                # argmax over the rows of the overlap counts, ties go to the smaller previous label
+                cx = np.zeros((cur_ncomps+1, ncomps+1), dtype=np.int64); np.add.at(cx, (cur_lbls, prev_lbls), 1)
+                max_ovlp = np.argmax(cx, axis=1); max_ovlp[cx.max(axis=1) == 0] = -1
+                sel = (max_ovlp > 0)
+                if do_stitching:
+                    mapping = np.zeros((cur_ncomps+1,), dtype=np.int64)
+                    nsel = (max_ovlp < 0); nsel[0] = False; cur_ncomps = nsel.sum()
+                    mapping[sel] = max_ovlp[sel]; mapping[nsel] = np.arange(1,cur_ncomps+1) + ncomps
+                    cur_data = mapping[cur_data]
+                else:
+                    connections.append(np.column_stack((np.arange(ncomps, ncomps+cur_ncomps+1)[sel], max_ovlp[sel])))
+            if not do_stitching or all(no_overlap): cur_data[cur_data > 0] += ncomps
+        ncomps += cur_ncomps
+        left = overlap*np.logical_not(is_left_border)
+        out[tuple(slice(b+l, b+s) for b,l,s in zip(beg, left, size))] = cur_data[left[0]:,left[1]:,left[2]:]
+    return (np.vstack(connections) if connections else None), out
+
+def test_face_boxes():
+    size = np.array([24, 20, 28]); overlap = np.array([4, 3, 5])
+    for border in range(64):
+        is_left_border = np.array([(border >> x) & 1 for x in range(3)], dtype=bool)
+        is_right_border = np.array([(border >> x) & 1 for x in range(3, 6)], dtype=bool)
+        asel_ovlp = overlap_select(size, overlap, is_left_border, is_right_border)
+
+        # each face box is exactly the overlap select for that face, x takes precedence over y over z
+        boxes = dpCubeStitcher.face_boxes(size, overlap, is_left_border, is_right_border)
+        assert( [x[0] for x in boxes] == [x for x in range(3) if (asel_ovlp == x+1).any()] )
+        for face, lo, hi in boxes:
+            sel = np.zeros(size, dtype=bool); sel[tuple(slice(i,j) for i,j in zip(lo, hi))] = 1
+            assert( (sel == (asel_ovlp == face+1)).all() )
+            assert( hi[face] - lo[face] == overlap[face] and (lo[face+1:] == 0).all() )
+            assert( all([lo[x] == (0 if is_left_border[x] else overlap[x]) for x in range(face)]) )
+
+def test_first_pass(tmp_path):
+    cubes = write_cubes(tmp_path)
+
+    # the one pass stitch with face slabs only is the same as comparing the whole cube
+    _, lbls = run_stitch(tmp_path, 'one_pass.h5')
+    _, out = full_cube_first_pass(cubes, True)
+    assert( (lbls.data_cube == out).all() and lbls.data_attrs['types_nlabels'][0] == out.max() )
+    assert( out.max() < sum([x.max() for _,x in cubes]) )
+
+    # the two pass connections and first pass labels are the same, so the stitched mapping is the same
+    connections, lbls = run_stitch(tmp_path, 'two_pass.h5', '--two_pass')
+    ref_connections, out = full_cube_first_pass(cubes, False)
+    assert( (np.unique(connections[:-1,:], axis=0) == np.unique(ref_connections, axis=0)).all() )
+    assert( connections[-1,0] == sum([x.max() for _,x in cubes]) )
+    first_pass = emLabels.readLabels(str(tmp_path / 'two_pass.h5'), [0,0,0], [0,0,0], datasize.tolist(),
+        mapping=False)
+    assert( (first_pass.data_cube == out).all() )
@@ -0,0 +1,46 @@
+from emdrp.dpFRAGBlocks import *
+from scipy import ndimage as nd
+
+def test_imports():
+    pass
+
+def write_volume(labelfile, probfile):
+    # voronoi supervoxels with some background and smooth probabilities
+    rs = np.random.RandomState(0); size = [32, 32, 16]
+    seeds = np.zeros(size, dtype=np.uint32); pts = [rs.randint(x, size=40) for x in size]
+    seeds[tuple(pts)] = np.arange(1, 41)
+    labels = seeds[tuple(nd.distance_transform_edt(seeds == 0, return_distances=False, return_indices=True))]
+    labels[rs.rand(*size) < 0.05] = 0
+    emLabels.writeLabels(outfile=labelfile, chunk=[0,0,0], offset=[0,0,0], size=size, datasize=size,
+        chunksize=[16,16,16], data=labels)
+    probs = nd.gaussian_filter(rs.rand(*size), 1).astype(np.float32)
+    with h5py.File(probfile, 'w') as h5file:
+        # hdf5 is stored in zyx order
+        h5file.create_dataset('MEM', data=probs.transpose((2,1,0)), chunks=(16,16,16))
+    return labels, probs
+
+def test_make_rag(tmp_path):
+    labelfile = str(tmp_path / 'labels.h5'); probfile = str(tmp_path / 'probs.h5')
+    labels, probs = write_volume(labelfile, probfile); size = np.array(labels.shape)
+
+    for nbhd in [1, 2]:
+        # 2x2x1 blocks of a single chunk each
+        parser = argparse.ArgumentParser(); dpFRAGBlocks.addArgs(parser)
+        arg_str = '--labelfile %s --probfile %s --prob-types MEM --outfile %s --borders --nbhd %d' % \
+            (labelfile, probfile, str(tmp_path / 'rag.h5'), nbhd)
+        arg_str += ' --use-chunksize 16 16 16 --cube_size 1 1 1 --volume_range_beg 0 0 0 --volume_range_end 2 2 1'
+        rag = dpFRAGBlocks(parser.parse_args((arg_str + ' --nworkers 2').split())); rag.make_rag()
+
+        # whole volume rag, border voxels are indices into the padded volume
+        edges, borders, *_ = frag_with_borders(labels, int(labels.max()), pad=True, nbhd=nbhd, conn=3)
+        edges = np.array(edges, dtype=np.int64).reshape((-1,2)); order = np.lexsort((edges[:,1], edges[:,0]))
+        assert( (edges[order,:] == rag.edges).all() )
+        assert( (np.diff(rag.border_offsets) == rag.counts).all() )
+        for k,e in enumerate(order):
+            subs = np.array(np.unravel_index(borders[e].astype(np.int64), tuple(size + 2*nbhd))) - nbhd
+            voxels = np.sort(np.ravel_multi_index(tuple(subs), labels.shape))
+            assert( (voxels == rag.border_voxels[rag.border_offsets[k]:rag.border_offsets[k+1]]).all() )
+            values = probs.flat[voxels].astype(np.double); stats = rag.stats['MEM']
+            assert( rag.counts[k] == voxels.size )
+            assert( np.allclose([values.sum(), values.min(), values.max(), values.mean(), values.var()],
+                [stats[x][k] for x in ['sum', 'min', 'max', 'mean', 'var']]) )
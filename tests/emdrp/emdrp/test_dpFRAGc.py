@@ -0,0 +1,194 @@
+import os
+import sys
+import numpy as np
+import h5py
+from scipy import ndimage as nd
+from scipy import linalg as sla
+from numpy import linalg as nla
+import emdrp.dpLoadh5
+
+# dpFRAGc uses script style imports, with the package and its utils on the path (see set_environment.sh)
+sys.path.insert(0, os.path.dirname(emdrp.dpLoadh5.__file__)); import utils.typesh5
+sys.path.append(os.path.join(sys.path[0], 'utils'))
+from dpFRAGc import dpFRAG
+from utils.typesh5 import emLabels
+
+# principal axes by svd of the points per selection, as computed before the batched moments
+def svd_ortho_axes(pts, sampling):
+    if pts.shape[0] <= 3:
+        newpts = np.vstack([pts]*6); npts = pts.shape[0]; cnt = 0
+        for d in range(3):
+            for sign in [-1,1]:
+                newpts[cnt:cnt+npts,d] += sign*sampling[d]/2; cnt = cnt + npts
+        pts = newpts
+    U, S, Vt = sla.svd(pts, full_matrices=False)
+    # the signs are decided by rounding if an element of R (QR of the points) is zero up to rounding
+    R = np.triu(sla.qr(pts, mode='r')[0][:3]); R[np.tril_indices(3,-1)] = np.nan
+    return Vt, S, (np.abs(R) < 1e-10*np.abs(pts).max()).any()
+
+def svd_attrs(sel, sampling, Vother=None):
+    pts = np.transpose(np.nonzero(sel)).astype(np.double)*sampling; C = np.mean(pts, axis=0)
+    V, S, rounding = svd_ortho_axes(pts - C, sampling); angles = None
+    if Vother is not None:
+        angles = np.array([np.arctan2(nla.norm(np.cross(V[k,:],Vother[k,:])), np.dot(V[k,:],Vother[k,:]))
+            for k in range(3)])
+    return {'sel_size':pts.shape[0], 'C':C, 'V':V, 'S':S, 'angles':angles, 'rounding':rounding}
+
+def test_getOvlpAttrs():
+    # voronoi supervoxels, padded so the overlap bounding boxes with perimeter stay inside
+    rs = np.random.RandomState(0); shape = (20, 20, 10); sampling = np.array([1., 1.3, 2.6])
+    seeds = np.zeros(shape, dtype=np.uint32); pts = [rs.randint(x, size=16) for x in shape]
+    seeds[tuple(pts)] = np.arange(1, 17)
+    svox = seeds[tuple(nd.distance_transform_edt(seeds == 0, sampling=sampling, return_distances=False,
+        return_indices=True))]
+    perim = np.array([2, 2, 1]); svox = np.pad(svox, [(x, x) for x in perim])
+
+    frag = dpFRAG.__new__(dpFRAG); frag.supervoxels = svox; frag.sampling = sampling; frag.perim = perim
+    frag.npcaang = 3; frag.log_size = False
+
+    # border voxels of each edge are the voxels with a neighbor of the other label
+    borders = {}
+    for d in range(3):
+        a = np.take(svox, range(svox.shape[d]-1), axis=d); b = np.take(svox, range(1, svox.shape[d]), axis=d)
+        inds = np.ravel_multi_index(np.nonzero(np.ones(a.shape, dtype=bool)), svox.shape).reshape(a.shape)
+        step = np.ravel_multi_index(tuple(int(x == d) for x in range(3)), svox.shape)
+        sel = np.logical_and(np.logical_and(a > 0, b > 0), a != b)
+        for x, y, i in zip(a[sel], b[sel], inds[sel]):
+            e = (min(x, y), max(x, y)); borders.setdefault(e, set()).update([i, i + step])
+    edges = np.array(sorted(borders.keys()), dtype=np.uint32)
+    list_of_borders = [rs.permutation(np.array(sorted(borders[tuple(e)]), dtype=np.int64)) for e in edges]
+    assert( min([x.size for x in list_of_borders]) <= 3 )   # includes degenerate overlaps
+
+    ovlps = frag.getOvlpAttrs(edges, list_of_borders, [None]*edges.shape[0]); nsel = nskip = 0
+    for e in range(edges.shape[0]):
+        border_voxels = np.transpose(np.unravel_index(list_of_borders[e], svox.shape))
+        bmin = border_voxels.min(axis=0); bmax = border_voxels.max(axis=0) + 1
+        aobnd = tuple([slice(x-z, y+z) for x,y,z in zip(bmin, bmax, perim)])
+        sel = np.zeros(svox[aobnd].shape, dtype=bool); sel[tuple((border_voxels - bmin + perim).T)] = 1
+        ref = [svd_attrs(sel, sampling)]
+        ref += [svd_attrs(svox[aobnd] == edges[e,k], sampling, Vother=ref[0]['V']) for k in range(2)]
+
+        for m, r in zip(ovlps[e], ref):
+            assert( m['sel_size'] == r['sel_size'] and np.allclose(m['C'], r['C']) )
+            # axes are only unique for distinct singular values, with the same signs unless decided by rounding
+            if np.diff(r['S']).max() > -1e-6*r['S'][0] or r['rounding']: nskip += 1; continue
+            assert( np.allclose(m['V'], r['V'], atol=1e-6) ); nsel += 1
+            if r['angles'] is not None and not ref[0]['rounding']:
+                assert( np.allclose(m['angles'], r['angles'], atol=1e-6) )
+    assert( nskip < nsel/5 )
+
+# voronoi supervoxels, probabilities and raw em in a volume large enough for the perimeters around the test chunks
+def write_volumes(tmp_path):
+    rs = np.random.RandomState(0); size = [128, 96, 80]
+    seeds = np.zeros(size, dtype=np.uint32); pts = [rs.randint(x, size=400) for x in size]
+    seeds[tuple(pts)] = np.arange(1, 401)
+    labels = seeds[tuple(nd.distance_transform_edt(seeds == 0, return_distances=False, return_indices=True))]
+    emLabels.writeLabels(outfile=str(tmp_path / 'labels.h5'), chunk=[0,0,0], offset=[0,0,0], size=size,
+        datasize=size, chunksize=[32,32,16], data=labels, subgroups=['with_background', '0.99'])
+    # hdf5 is stored in zyx order
+    with h5py.File(str(tmp_path / 'probs.h5'), 'w') as h5file:
+        for k in ['MEM', 'ICS']:
+            h5file.create_dataset(k, data=nd.gaussian_filter(rs.rand(*size), 1).astype(np.float32).transpose((2,1,0)),
+                chunks=(16,32,32))
+    with h5py.File(str(tmp_path / 'raw.h5'), 'w') as h5file:
+        h5file.create_dataset('data', data=rs.randint(0, 255, size).astype(np.uint8).transpose((2,1,0)),
+            chunks=(16,32,32))
+
+def test_threshold_table(tmp_path):
+    write_volumes(tmp_path); chunks = [[1,1,2], [2,1,2]]; size = [32,32,16]; thresholds = [0.7, 0.95]
+
+    # agglomerate two neighboring test chunks into the same output, full labels or agglomeration tables
+    outfiles = [str(tmp_path / 'full.h5'), str(tmp_path / 'table.h5')]
+    for table, outfile in zip([False, True], outfiles):
+        for chunk in chunks:
+            frag = dpFRAG.makeTestingFRAG(str(tmp_path / 'labels.h5'), chunk, size, [0,0,0],
+                [str(tmp_path / 'probs.h5'), ''], [str(tmp_path / 'raw.h5'), ''], 'data', outfile=outfile,
+                subgroups=['with_background', '0.99'], subgroups_out=['thresholds', '0'], feature_set='minimal',
+                neighbor_only=True)
+            frag.createFRAG()
+            probs = np.random.RandomState(chunk[0]).rand(frag.FRAG.number_of_edges())
+            frag.threshold_agglomerate(np.stack([1-probs, probs], axis=1), thresholds, table=table)
+
+    # the tables for both chunks are kept, each chunk and a window across both match the full labels
+    for thr in thresholds:
+        subgroups = ['thresholds', '0', '%.8f' % thr]
+        for chunk, offset, sz in [(x, [0,0,0], size) for x in chunks] + [(chunks[0], [16,0,0], size)]:
+            full = emLabels.readLabels(outfiles[0], chunk, offset, sz, subgroups=subgroups)
+            delta = emLabels.readLabels(outfiles[1], chunk, offset, sz, subgroups=subgroups)
+            assert( full.data_cube.max() > 1 and (full.data_cube == delta.data_cube).all() )
+        with h5py.File(outfiles[1], 'r') as h5file:
+            assert( len(h5file['/'.join(subgroups + ['labels_delta'])]) == len(chunks) )
+
+def test_parallel_edge_features(tmp_path):
+    write_volumes(tmp_path); frags = []
+
+    # the small feature set needs the overlap geometry, so the edge features are computed per edge
+    for nworkers in [1, 2]:
+        frag = dpFRAG.makeTestingFRAG(str(tmp_path / 'labels.h5'), [1,1,2], [32,32,16], [0,0,0],
+            [str(tmp_path / 'probs.h5'), ''], [str(tmp_path / 'raw.h5'), ''], 'data',
+            subgroups=['with_background', '0.99'], feature_set='small', neighbor_only=True, nworkers=nworkers)
+        frag.createFRAG(); frags.append(frag)
+    assert( 'rad_std_ovlp' in frags[0].features_names and frags[1].nworkers == 2 )
+
+    # the parallel workers give the same edges in the same order with the same features
+    serial, parallel = [x.FRAG for x in frags]
+    assert( serial.number_of_edges() > 8 )
+    assert( (serial.edges == parallel.edges).all() and (serial.features == parallel.features).all() )
+    assert( np.isfinite(serial.features).all() )
+
+def test_getBorderStats():
+    # border voxels of random sizes for each edge (including an edge with a single voxel), F-order channel data
+    rs = np.random.RandomState(0); shape = (12, 10, 8)
+    channels = {'MEM':rs.rand(*shape).astype(np.float32), 'raw':np.asfortranarray(rs.randint(0, 255, shape))}
+    borders = [rs.choice(np.prod(shape), size=n, replace=False) for n in [5, 1, 30, 2, 1, 17]]
+    border_voxel_index = np.concatenate(borders).astype(np.uint32)
+    edge_offsets = np.cumsum([0] + [x.size for x in borders]).astype(np.uint32)
+
+    # same as the per edge loop over the border voxels with the mean over the overlap (C-order indices)
+    counts, stats = dpFRAG.getBorderStats(border_voxel_index, edge_offsets, channels)
+    assert( (counts == [x.size for x in borders]).all() )
+    for name, data in channels.items():
+        for e, inds in enumerate(borders):
+            values = np.ascontiguousarray(data).reshape(-1)[inds].astype(np.double)
+            s = stats[name]
+            assert( np.isclose(s['sum'][e], values.sum()) and np.isclose(s['sumsq'][e], (values**2).sum()) )
+            assert( np.isclose(s['mean'][e], values.mean(dtype=np.double)) )
+            assert( s['min'][e] == values.min() and s['max'][e] == values.max() )
+            assert( np.isclose(s['var'][e], values.var(), atol=1e-9*values.max()**2) and s['var'][e] >= 0 )
+        assert( stats[name]['var'][1] == 0 and stats[name]['var'][4] == 0 )
+
+    # no edges
+    counts, stats = dpFRAG.getBorderStats(np.zeros((0,), dtype=np.uint32), np.zeros((1,), dtype=np.uint32), channels)
+    assert( counts.size == 0 and list(stats.keys()) == list(channels.keys()) )
+    assert( all([x.size == 0 for s in stats.values() for x in s.values()]) )
+
+def test_moment_update(tmp_path):
+    write_volumes(tmp_path); frags = []
+
+    # moment update only supports the size and mean border features
+    for moment_update, feature_set in [(True, 'small'), (True, 'minimal'), (False, 'minimal')]:
+        try:
+            frag = dpFRAG.makeTestingFRAG(str(tmp_path / 'labels.h5'), [1,1,2], [32,32,16], [0,0,0],
+                [str(tmp_path / 'probs.h5'), ''], [str(tmp_path / 'raw.h5'), ''], 'data',
+                subgroups=['with_background', '0.99'], feature_set=feature_set, neighbor_only=True,
+                moment_update=moment_update)
+        except Exception as e:
+            assert( feature_set == 'small' and 'moment update' in str(e) ); continue
+        assert( feature_set == 'minimal' )
+        frag.createFRAG(); frags.append(frag)
+
+    # agglomerate and update the features from the moments or recompute them from the agglomerated voxels
+    rs = np.random.RandomState(0); target = rs.rand(frags[0].FRAG.number_of_edges()) < 0.2
+    for frag in frags: frag.agglomerate(target, doWrite=False)
+    changed = np.logical_not(frags[0].FRAG.has_features)
+    for frag in frags: frag.createFRAG(update=True)
+    moment, voxel = [x.FRAG for x in frags]; F = frags[0].features
+    assert( changed.any() and not changed.all() and moment.has_features.all() )
+    assert( (moment.edges == voxel.edges).all() and (moment.features[~changed,:] == voxel.features[~changed,:]).all() )
+
+    # supervoxel sizes are exact, border voxels touching more than one contracted supervoxel are counted for each
+    sizes = [F['size_small'], F['size_large']]
+    assert( (moment.features[:,sizes] == voxel.features[:,sizes]).all() )
+    assert( (moment.features[:,F['size_overlap']] >= voxel.features[:,F['size_overlap']]).all() )
+    means = [F[x] for x in frags[0].features_names if x.startswith('mean_')]
+    assert( np.allclose(moment.features[:,means], voxel.features[:,means], rtol=0.1) )
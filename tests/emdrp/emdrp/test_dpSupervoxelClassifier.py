@@ -0,0 +1,113 @@
+import os
+import sys
+import numpy as np
+from collections import OrderedDict
+from sklearn.preprocessing import StandardScaler
+import emdrp.dpLoadh5
+
+# dpSupervoxelClassifier uses script style imports, with the package and its utils on the path (see set_environment.sh)
+sys.path.insert(0, os.path.dirname(emdrp.dpLoadh5.__file__)); import utils.typesh5
+sys.path.append(os.path.join(sys.path[0], 'utils'))
+import dpSupervoxelClassifier
+from dpSupervoxelClassifier import _init_train_worker
+from utils.FeatureStore import FeatureStore
+from utils.typesh5 import emLabels
+from test_dpFRAGc import write_volumes
+
+# small feature store with linearly separable targets and features on different scales, chunk 3 is a test chunk
+def write_store(fn, rs):
+    names = OrderedDict([('size_small', 0), ('mean_ICS', 1), ('overlap', 2), ('constant', 3)])
+    w = np.array([1., -2., 0.5, 0.]); store = FeatureStore(fn); cubes = []
+    for i,n in enumerate([40, 25, 31, 50]):
+        fdata = rs.randn(n, 4)*[100, 1, 0.01, 0] + [1000, -5, 0.5, 3]
+        target = ((fdata - [1000, -5, 0.5, 3]) / [100, 1, 0.01, 1]).dot(w) > 0
+        data = {'feature_names':names, 'target_names':{'no_merge':0, 'yes_merge':1}, 'data':fdata,
+            'target':target.astype(np.int64)}
+        store.write('chunk%d' % i, data, rs.randint(1, 20, (n, 2)), {'index':i, 'chunk_list_index':i, 'nnodes':20})
+        cubes.append(data)
+    return cubes
+
+def get_classifier(classifier):
+    clf = dpSupervoxelClassifier.dpSupervoxelClassifier.__new__(dpSupervoxelClassifier.dpSupervoxelClassifier)
+    clf.classifier = classifier; clf.test_chunks = [3]; clf.nfeatures = 4; clf.train_batch_size = 16
+    clf.train_epochs = 20; clf.dpSupervoxelClassifier_verbose = False
+    return clf
+
+def test_train_streaming(tmp_path):
+    rs = np.random.RandomState(0); fn = str(tmp_path / 'features.h5'); cubes = write_store(fn, rs)
+    _init_train_worker(0, True)     # sets the dynamically imported dpFRAG, same as init
+    fdata = np.concatenate([x['data'] for x in cubes[:3]]); target = np.concatenate([x['target'] for x in cubes[:3]])
+    scaler = StandardScaler().fit(fdata)
+    sdata = (cubes[3]['data'] - scaler.mean_) / scaler.scale_
+
+    for classifier in ['nb', 'lr']:
+        np.random.seed(0); clf = get_classifier(classifier); clf.trainStreaming(fn)
+
+        # the streamed two pass mean and std are the same as for the in memory training data (without test chunk)
+        assert( np.allclose(clf.train_mean, scaler.mean_) and np.allclose(clf.train_std, scaler.scale_) )
+        assert( clf.train_std[3] == 1 )
+
+        # partial_fit over the batches gives a model that predicts the held out test chunk
+        assert( (clf.clf.classes_ == [0, 1]).all() )
+        assert( (clf.clf.predict(sdata) == cubes[3]['target']).mean() > 0.85 )
+        assert( (clf.clf.predict((fdata - scaler.mean_) / scaler.scale_) == target).mean() > 0.85 )
+
+    # the streaming scaler is saved with the classifier and loaded with it for testing
+    clf = get_classifier('lr'); clf.train_streaming = True; clf.trainin = fn; clf.classifierin = ''
+    clf.classifierout = str(tmp_path / 'clf.dill'); clf.doplots = False; clf.iterative_mode = False
+    clf.train_mean = None; clf.train_std = None; np.random.seed(0); clf.train()
+    assert( np.allclose(clf.train_mean, scaler.mean_) )
+    loaded = get_classifier('lr'); loaded.train_streaming = True; loaded.trainin = fn
+    loaded.classifierin = clf.classifierout; loaded.doplots = False; loaded.iterative_mode = False
+    loaded.train_mean = None; loaded.train_std = None; loaded.train()
+    assert( (loaded.train_mean == clf.train_mean).all() and (loaded.train_std == clf.train_std).all() )
+    assert( (loaded.clf.predict(sdata) == clf.clf.predict(sdata)).all() )
+
+def test_iterative_spill(tmp_path):
+    write_volumes(tmp_path); size = [128, 96, 80]; _init_train_worker(0, True)
+    # ground truth slabs along x, so that neighboring supervoxels in the same slab are merged
+    gt = np.broadcast_to((np.arange(size[0]) // 16 + 1)[:,None,None], size).astype(np.uint32)
+    emLabels.writeLabels(outfile=str(tmp_path / 'gt.h5'), chunk=[0,0,0], offset=[0,0,0], size=size, datasize=size,
+        chunksize=[32,32,16], data=gt)
+
+    # iterative FRAGs for three chunks, with the dataset for each before any spilling
+    frags = []; refs = []
+    for chunk, offset in [([1,1,2], [0,0,0]), ([2,1,2], [0,0,0]), ([1,1,2], [16,8,0])]:
+        frag = dpSupervoxelClassifier.dpFRAG.makeBothFRAG(str(tmp_path / 'labels.h5'), chunk, [32,32,16], offset,
+            [str(tmp_path / 'probs.h5'), ''], [str(tmp_path / 'raw.h5'), ''], 'data', str(tmp_path / 'gt.h5'),
+            str(tmp_path / 'out.h5'), ['with_background', '0.99'], ['agglomeration_training'], feature_set='small',
+            neighbor_only=True)
+        frag.createFRAG(); frag.isTraining = True; frags.append(frag)
+        refs.append({'edges':frag.FRAG.edges.copy(), 'features':frag.FRAG.features.copy(),
+            'supervoxels':frag.supervoxels.copy(), 'data':frag.createDataset()})
+
+    clf = get_classifier('lr'); clf.iterative_frag = frags; clf.iterative_lru = OrderedDict()
+    clf.iterative_scratch = str(tmp_path); clf.iterative_mem = 0
+    for chunk in range(3): assert( clf.getIterativeFRAG(chunk) is frags[chunk] )
+    assert( not any([x.spilled() for x in frags]) )
+
+    # with a budget for two of the FRAGs, the least recently used FRAG is spilled
+    nbytes = [x.nbytes() for x in frags]; clf.iterative_mem = (nbytes[0] + nbytes[2] + 1) / 2**30
+    clf.getIterativeFRAG(0)
+    assert( [x.spilled() for x in frags] == [False, True, False] and list(clf.iterative_lru.keys()) == [2, 0] )
+    assert( os.path.isfile(frags[1].spillfile) and frags[1].isTraining and frags[1].nbytes() == 0 )
+    assert( not hasattr(frags[1], 'supervoxels') and not hasattr(frags[1], 'FRAG') )
+
+    # restoring a FRAG spills the next least recently used one
+    spillfile = frags[1].spillfile; clf.getIterativeFRAG(1)
+    assert( [x.spilled() for x in frags] == [False, False, True] and list(clf.iterative_lru.keys()) == [0, 1] )
+    # restored arrays are counted for the budget, the unpadded supervoxels are a view after restore
+    assert( not os.path.isfile(spillfile) and 0.9*nbytes[1] < frags[1].nbytes() <= nbytes[1] )
+
+    # the restored FRAG is the same as before the round trip
+    ref = refs[1]; frag = frags[1]
+    assert( (frag.FRAG.edges == ref['edges']).all() and (frag.FRAG.features == ref['features']).all() )
+    assert( (frag.supervoxels == ref['supervoxels']).all() )
+    assert( (frag.supervoxels_noperim == frag.supervoxels[tuple(slice(x,-x) for x in frag.eperim)]).all() )
+    data = frag.createDataset()
+    assert( ref['data']['target'].any() and (data['target'] == ref['data']['target']).all() )
+    assert( (data['data'] == ref['data']['data']).all() and data['feature_names'] == ref['data']['feature_names'] )
+
+    # freeing a spilled FRAG removes the scratch file
+    spillfile = frags[2].spillfile; clf.freeIterativeFRAG(2)
+    assert( not os.path.isfile(spillfile) and clf.iterative_frag[2] is None )
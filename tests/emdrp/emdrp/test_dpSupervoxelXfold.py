@@ -0,0 +1,70 @@
+import os
+import sys
+import numpy as np
+from collections import OrderedDict
+import emdrp.dpLoadh5
+
+# dpSupervoxelXfold uses script style imports, with the package and its utils on the path (see set_environment.sh)
+sys.path.insert(0, os.path.dirname(emdrp.dpLoadh5.__file__)); import utils.typesh5
+sys.path.append(os.path.join(sys.path[0], 'utils'))
+from dpSupervoxelXfold import dpSupervoxelXfold
+from utils.FeatureStore import FeatureStore
+
+# cross-fold over three chunks with the feature extraction replaced by random datasets that record the chunks
+def get_xfold(fn, extracted, feature_names):
+    xfold = dpSupervoxelXfold.__new__(dpSupervoxelXfold)
+    xfold.featurestore = fn; xfold.nchunks = 3; xfold.use_chunk_range = False; xfold.xfold_nworkers = 1
+    xfold.chunk_range_beg = np.array([[0,0,0], [1,0,0], [2,0,0]]); xfold.offset_list = np.zeros((3,3), dtype=int)
+    xfold.size_list = np.ones((3,3), dtype=int)*32; xfold.dpSupervoxelClassifier_verbose = False
+    xfold.useFRAGc = True; xfold.feature_set = 'medium'; xfold.has_ECS = True; xfold.neighbor_only = False
+    xfold.prob_svox_context = True; xfold.no_agglo_ECS = False; xfold.label_subgroups = ['with_background', '0.9']
+    xfold.chunk_subgroups = False; xfold.labelfile = 'labels.h5'; xfold.probfile = 'probs.h5'
+    xfold.probaugfile = ''; xfold.rawfile = 'raw.h5'; xfold.rawaugfile = ''; xfold.raw_dataset = 'data_mag1'
+    xfold.gtfile = 'gt.h5'
+
+    def trainDataset(chunk):
+        extracted.append(chunk); n = 5 + chunk
+        names = OrderedDict([(x,y) for x,y in zip(feature_names, range(len(feature_names)))])
+        return {'feature_names':names, 'target_names':{'no_merge':0, 'yes_merge':1},
+            'data':np.random.rand(n, len(names)), 'target':np.random.randint(0, 2, n),
+            'edges':np.random.randint(1, 20, (n, 2)), 'nnodes':20}
+    xfold.trainDataset = trainDataset
+    return xfold
+
+def test_extract_cache(tmp_path):
+    fn = str(tmp_path / 'features.h5'); names = ['size_small', 'mean_ICS', 'overlap']
+
+    # all chunks are extracted the first time, then the store is reused
+    extracted = []; get_xfold(fn, extracted, names).extract()
+    assert( extracted == [0, 1, 2] )
+    attrs = dict(FeatureStore(fn).cubes())['chunk1']
+    assert( list(attrs['feature_names']) == names and 'feature_set=' in attrs['feature_options'] )
+    extracted = []; get_xfold(fn, extracted, names).extract()
+    assert( extracted == [] )
+
+    # a different chunk location only extracts that chunk
+    extracted = []; xfold = get_xfold(fn, extracted, names); xfold.offset_list[1,:] = 8; xfold.extract()
+    assert( extracted == [1] )
+
+    # different extraction options with the same chunk locations extracts all chunks
+    for opt, val in [('feature_set', 'small'), ('useFRAGc', False), ('label_subgroups', ['with_background', '0.8'])]:
+        extracted = []; xfold = get_xfold(fn, extracted, names); xfold.offset_list[1,:] = 8
+        setattr(xfold, opt, val); xfold.extract()
+        assert( extracted == [0, 1, 2] )
+    extracted = []; xfold = get_xfold(fn, extracted, names); xfold.offset_list[1,:] = 8; xfold.extract()
+    assert( extracted == [0, 1, 2] )
+
+    # a chunk with different feature names than the other cached chunks is extracted
+    store = FeatureStore(fn); data = store.read('chunk2'); attrs = data['attrs']
+    for k in FeatureStore.DATASETS: data[k] = np.array(data[k])   # copy from the memory map before replacing
+    attrs['feature_names'] = np.array(names[:2] + ['other'], dtype=object)
+    store.write('chunk2', data, data['edges'], attrs)
+    extracted = []; xfold = get_xfold(fn, extracted, names); xfold.offset_list[1,:] = 8; xfold.extract()
+    assert( extracted == [2] )
+
+    # features that changed without the options changing, the extracted chunk does not match the cached chunks
+    extracted = []; xfold = get_xfold(fn, extracted, names + ['new']); xfold.offset_list[1,:] = 0; xfold.extract()
+    assert( extracted == [1, 0, 2] )
+    assert( all([list(attrs['feature_names']) == names + ['new'] for name, attrs in FeatureStore(fn).cubes()]) )
+    extracted = []; xfold = get_xfold(fn, extracted, names + ['new']); xfold.extract()
+    assert( extracted == [] )
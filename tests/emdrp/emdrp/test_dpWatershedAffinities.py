@@ -0,0 +1,70 @@
+from emdrp.dpWatershedAffinities import *
+import h5py
+
+def test_imports():
+    pass
+
+def affinity_volume():
+    # four blocks separated by single voxel membranes and a small region inside the first block
+    size = [25, 25, 12]; gt = np.zeros(size, dtype=np.uint32)
+    gt[:12,:12,:] = 1; gt[13:,:12,:] = 2; gt[:12,13:,:] = 3; gt[13:,13:,:] = 4; gt[4:6,4:6,4:6] = 5
+    # affinity to the next voxel in each dimension, high within labels, lower between the small region and its block
+    #   and lowest to the membrane voxels (which are not seeds but are flooded by the watershed)
+    affins = np.zeros(size + [3], dtype=np.float32)
+    for i in range(3):
+        a = gt; b = np.roll(gt, -1, axis=i)
+        affins[:,:,:,i] = np.where(np.logical_or(a == 0, b == 0), 0.4, np.where(a == b, 0.95, 0.5))
+    return gt, affins
+
+def run_watershed(tmp_path, affins, Tsize, ThrMerge):
+    probfile = str(tmp_path / 'affins.h5'); outlabels = str(tmp_path / 'labels.h5'); size = affins.shape[:3]
+    with h5py.File(probfile, 'w') as h5file:
+        # hdf5 is stored in zyx order
+        for i in range(3):
+            h5file.create_dataset('ICS_DIM%d' % (i,), data=affins[:,:,:,i].transpose((2,1,0)), chunks=size[::-1])
+    parser = argparse.ArgumentParser(); dpWatershedAffinities.addArgs(parser)
+    arg_str = '--probfile %s --outlabels %s --size %d %d %d --ThrHi 0.9 --ThrLo 0.3 --Tmin 8' % \
+        (probfile, outlabels, *size)
+    arg_str += ' --Tsize %d --ThrMerge %g' % (Tsize, ThrMerge)
+    ws = dpWatershedAffinities(parser.parse_args(arg_str.split())); ws.watershed_cube()
+    return ws, outlabels
+
+def test_watershed_cube(tmp_path):
+    gt, affins = affinity_volume(); size = list(gt.shape)
+
+    # seeds are the labeled regions (including the small region) and the watershed floods the membranes
+    ws, outlabels = run_watershed(tmp_path, affins, 1, 0.2)
+    loadh5 = emLabels.readLabels(srcfile=outlabels, chunk=[0,0,0], offset=[0,0,0], size=size,
+        subgroups=['with_background', '0.90000000'])
+    labels = loadh5.data_cube
+    assert( (labels > 0).all() and loadh5.data_attrs['types_nlabels'][0] == 5 )
+    pairs = np.unique(np.stack((gt[gt > 0], labels[gt > 0]), axis=1), axis=0)
+    assert( pairs.shape[0] == 5 and np.unique(pairs[:,1]).size == 5 )
+
+    # the small region is merged into its block, the blocks are large enough to not be merged
+    ws, outlabels = run_watershed(tmp_path, affins, 20, 0.2)
+    labels = emLabels.readLabels(srcfile=outlabels, chunk=[0,0,0], offset=[0,0,0], size=size,
+        subgroups=['with_background', '0.90000000']).data_cube
+    assert( labels.max() == 4 and (labels[gt == 5] == labels[0,0,0]).all() )
+    pairs = np.unique(np.stack((gt[gt > 0], labels[gt > 0]), axis=1), axis=0)
+    assert( pairs.shape[0] == 5 and np.unique(pairs[:,1]).size == 4 )
+
+    # all the label versions are written as for dpWatershedTypes
+    with h5py.File(outlabels, 'r') as h5file:
+        for kind in ['with_background', 'zero_background', 'no_adjacencies']:
+            assert( '/'.join([kind, '0.90000000', emLabels.LBLS_DATASET]) in h5file )
+    uclabels = emLabels.readLabels(srcfile=outlabels, chunk=[0,0,0], offset=[0,0,0], size=size,
+        subgroups=['no_adjacencies', '0.90000000']).data_cube
+    assert( np.logical_or(uclabels == 0, uclabels == labels).all() )
+
+def test_agglomerate_sizes():
+    gt, affins = affinity_volume()
+    parser = argparse.ArgumentParser(); dpWatershedAffinities.addArgs(parser)
+    ws = dpWatershedAffinities(parser.parse_args('--Tsize 20'.split()))
+    labels = gt.copy(); labels[gt == 0] = 6
+
+    # small region is only merged if the affinity to its block is above ThrMerge
+    for ThrMerge,nlabels in [(0.2, 5), (0.6, 6)]:
+        ws.ThrMerge = ThrMerge; alabels, n = ws.agglomerate_sizes(labels, affins)
+        assert( n == nlabels and alabels.max() == nlabels )
+        assert( (alabels[gt == 5] == alabels[0,0,0]).all() == (ThrMerge < 0.5) )
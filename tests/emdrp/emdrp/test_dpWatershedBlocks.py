@@ -0,0 +1,75 @@
+from emdrp.dpWatershedBlocks import *
+import argparse
+
+def test_imports():
+    pass
+
+def write_probs(probfile):
+    # tubes crossing the block faces in x and y, a blob crossing both faces and a blob inside a single block
+    size = [64, 64, 32]; x, y, z = np.mgrid[0:size[0], 0:size[1], 0:size[2]]; ics = np.zeros(size)
+    for c in [(30,34,20), (14,48,12)]:
+        ics = np.maximum(ics, np.exp(-((x-c[0])**2 + (y-c[1])**2 + (z-c[2])**2/4)/40.))
+    ics = np.maximum(ics, np.exp(-((y-16)**2 + (z-8)**2)/6.)*(x > 5)*(x < 58))
+    ics = np.maximum(ics, np.exp(-((x-48)**2 + (z-22)**2)/6.)*(y > 5)*(y < 58))
+    with h5py.File(probfile, 'w') as h5file:
+        # hdf5 is stored in zyx order
+        for name,data in zip(['ICS','MEM'], [ics, 1-ics]):
+            h5file.create_dataset(name, data=data.astype(np.float32).transpose((2,1,0)), chunks=(32,32,32))
+    return size
+
+def get_blocks(probfile, outlabels):
+    # 2x2x1 blocks of a single chunk each
+    parser = argparse.ArgumentParser(); dpWatershedBlocks.addArgs(parser)
+    arg_str = '--fg-types ICS --bg-type MEM --probfile %s --ThrRng 0.5 0.8 0.1 --ThrHi --Tmins 8' % (probfile,)
+    arg_str += ' --outlabels %s --use-chunksize 32 32 32 --volume_range_beg 0 0 0 --volume_range_end 2 2 1' % \
+        (outlabels,)
+    arg_str += ' --cube_size 1 1 1 --overlap 8 8 8 --nworkers 2'
+    return dpWatershedBlocks(parser.parse_args(arg_str.split()))
+
+def test_resolve_faces(tmp_path):
+    probfile = str(tmp_path / 'probs.h5'); write_probs(probfile)
+    ws = get_blocks(probfile, str(tmp_path / 'labels.h5')); assert( ws.nblocks == 4 )
+    a, b, c, d = [ws.block_index[x] for x in [(0,0,0), (1,0,0), (0,1,0), (1,1,0)]]
+
+    # two labels per block, right face of a block must match the left face of the next block
+    e = np.zeros((0,), dtype=np.uint32); faces = [[[e, e] for i in range(3)] + [np.array([0,1,2])] for n in range(4)]
+    faces[a][0][1] = np.array([1,1,2,2]); faces[b][0][0] = np.array([1,1,1,2])   # b1 -> a1, b2 -> a2
+    faces[a][1][1] = np.array([2,2]); faces[c][1][0] = np.array([1,1])           # c1 -> a2
+    faces[b][1][1] = np.array([2,0]); faces[d][1][0] = np.array([1,0])           # d1 -> b2
+    faces[c][0][1] = np.array([2]); faces[d][0][0] = np.array([2])               # d2 -> c2
+    offsets = np.arange(0, 10, 2, dtype=np.int64)
+    mapping, nlabels = ws.resolve_faces(('labels',), faces, offsets)
+    glbl = lambda n, l: mapping[offsets[n] + l]
+
+    # global ids are sequential in the order of the first block label in each component
+    assert( nlabels == 3 and mapping[0] == 0 )
+    assert( glbl(a,1) == 1 and glbl(b,1) == 1 )
+    assert( all([glbl(n,l) == 2 for n,l in [(a,2), (b,2), (c,1), (d,1)]]) )
+    assert( glbl(c,2) == 3 and glbl(d,2) == 3 )
+
+def test_watershed(tmp_path):
+    probfile = str(tmp_path / 'probs.h5'); size = write_probs(probfile)
+    outlabels = str(tmp_path / 'labels.h5'); get_blocks(probfile, outlabels).watershed()
+
+    # single cube watershed over the whole volume
+    parser = argparse.ArgumentParser(); dpWatershedTypes.addArgs(parser)
+    cubelabels = str(tmp_path / 'cube.h5')
+    arg_str = '--fg-types ICS --bg-type MEM --probfile %s --ThrRng 0.5 0.8 0.1 --ThrHi --Tmins 8' % (probfile,)
+    arg_str += ' --outlabels %s --chunk 0 0 0 --size %d %d %d' % (cubelabels, *size)
+    dpWatershedTypes(parser.parse_args(arg_str.split())).watershed_cube()
+
+    # filled labels (zero_background) depend on objects further away than the overlap, so are not compared
+    for kind in ['with_background', 'no_adjacencies']:
+        for thr in ['0.50000000', '0.60000000', '0.70000000']:
+            loadh5 = emLabels.readLabels(srcfile=outlabels, chunk=[0,0,0], offset=[0,0,0], size=size,
+                subgroups=[kind, thr])
+            labels = loadh5.data_cube; nlabels = loadh5.data_attrs['types_nlabels'][0]
+            cube = emLabels.readLabels(srcfile=cubelabels, chunk=[0,0,0], offset=[0,0,0], size=size,
+                subgroups=[kind, thr]).data_cube
+
+            # ids are sequential over all blocks and objects crossing block faces have a single id
+            assert( (np.unique(labels) == np.arange(nlabels + 1)).all() )
+            assert( nlabels == cube.max() and nlabels >= 4 )
+            # same as the single cube up to relabeling
+            pairs = np.unique(np.stack((labels.ravel(), cube.ravel()), axis=1), axis=0)
+            assert( pairs.shape[0] == nlabels + 1 )
@@ -1,4 +1,105 @@
 from emdrp.dpWatershedTypes import *
+from scipy import interpolate
+import networkx as nx
 
 def test_imports():
-    pass
\ No newline at end of file
+    pass
+
+def write_probs(probfile, datasize, chunksize):
+    # smooth random probabilities of a single foreground type
+    rs = np.random.RandomState(0); ics = nd.gaussian_filter(rs.rand(*datasize), 1.5)
+    ics = ((ics - ics.min()) / (ics.max() - ics.min())).astype(np.float32)
+    with h5py.File(probfile, 'w') as h5file:
+        # hdf5 is stored in zyx order
+        for name,data in zip(['ICS','MEM'], [ics, 1-ics]):
+            h5file.create_dataset(name, data=data.transpose((2,1,0)), chunks=tuple(chunksize[::-1]))
+
+def run_watershed(probfile, outlabels, chunk, size, delta_out):
+    parser = argparse.ArgumentParser(); dpWatershedTypes.addArgs(parser)
+    arg_str = '--probfile %s --outlabels %s --fg-types ICS --chunk %d %d %d --size %d %d %d' % \
+        (probfile, outlabels, *chunk, *size)
+    arg_str += ' --ThrRng 0.3 0.8 0.1 --ThrHi --Tmins 4' + (' --delta-out' if delta_out else '')
+    dpWatershedTypes(parser.parse_args(arg_str.split())).watershed_cube()
+
+def test_delta_out_cubes(tmp_path):
+    # several cubes written with delta-out into the same file read back the same as full labels
+    datasize = [32, 32, 16]; chunksize = [16, 16, 16]; size = [16, 32, 16]; cubes = [[0,0,0], [1,0,0]]
+    probfile = str(tmp_path / 'probs.h5'); write_probs(probfile, datasize, chunksize)
+    full = str(tmp_path / 'full.h5'); delta = str(tmp_path / 'delta.h5')
+    for chunk in cubes:
+        run_watershed(probfile, full, chunk, size, False); run_watershed(probfile, delta, chunk, size, True)
+
+    subgroups = [['with_background', '%.8f' % (x,)] for x in np.arange(0.3, 0.8, 0.1)]
+    assert( emLabels.readLabelsDelta(delta, subgroups[0]) is not None )
+    assert( len(emLabels.readLabelsDelta(delta, subgroups[0])) == len(cubes) )
+    # read the cubes written, windows inside a cube and windows over both cubes
+    reads = [(chunk, [0,0,0], size) for chunk in cubes] + [([0,0,0], [2,3,1], [8,8,8]), ([1,0,0], [4,0,2], [12,32,8]),
+        ([0,0,0], [8,4,0], [16,16,16]), ([0,0,0], [0,0,0], datasize)]
+    for sg in subgroups:
+        for chunk,offset,rsize in reads:
+            a = emLabels.readLabels(srcfile=full, chunk=chunk, offset=offset, size=rsize, subgroups=sg).data_cube
+            b = emLabels.readLabels(srcfile=delta, chunk=chunk, offset=offset, size=rsize, subgroups=sg).data_cube
+            assert( (a == b).all() )
+            cache = {}
+            b = emLabels.readLabelsCached(delta, chunk, offset, rsize, cache, subgroups=sg)
+            assert( (a == b).all() )
+
+# per zslice linking with networkx, as computed before the zslices were vectorized
+def label_overlap_slices(ws, bwlabels, mask, warps=None):
+    zlabels = np.zeros(ws.size, dtype=np.int64)
+    nzlabels = 0; prv_labels = None; connections = [None]*(ws.size[2]-1)
+    s = ws.size; s2 = [s[0], s[1], 1]; c = ws.cropborder
+    if warps:
+        x = np.arange(s[0], dtype=warps[0].dtype); y = np.arange(s[1], dtype=warps[0].dtype)
+        X = np.meshgrid(x,y, indexing='ij')
+    for z in range(ws.size[2]):
+        cur_bwlabels = bwlabels[:,:,z]; cur_mask = mask[:,:,z]
+        bw = cur_bwlabels[:,:,None].copy(order='C'); msk = cur_mask[:,:,None].copy(order='C')
+        bw, diff, ws.simpleLUT = binary_warping(bw, np.ones(s2,dtype=bool),
+            mask=msk, borderval=False, slow=True, simpleLUT=ws.simpleLUT, connectivity=ws.connectivity)
+        cur_fill_labels, cur_nlabels = nd.label(bw[:,:,0], ws.bwconn2d, output=np.int64)
+        sel = (cur_fill_labels > 0); cur_fill_labels[sel] += nzlabels; zlabels[:,:,z] = cur_fill_labels
+        cur_labels = cur_fill_labels.copy(); cur_labels[np.logical_not(cur_bwlabels)] = 0
+        if z > 0:
+            if warps:
+                xi = X[0] + warps[0][:,:,z-1]; yi = X[1] + warps[1][:,:,z-1]
+                f = interpolate.RegularGridInterpolator((x,y), prv_labels, method='nearest',
+                    bounds_error=False, fill_value=0)
+                prv_labels = f( np.vstack((xi.ravel(),yi.ravel())).T ).reshape(prv_labels.shape)
+            prv_labels_crop = prv_labels; cur_labels_crop = cur_labels
+            if ws.docrop:
+                prv_labels_crop = prv_labels_crop[c[0]:s[0]-c[0],c[1]:s[1]-c[1]]
+                cur_labels_crop = cur_labels_crop[c[0]:s[0]-c[0],c[1]:s[1]-c[1]]
+            tmp = dpWatershedTypes.unique_rows(\
+                np.ascontiguousarray( np.vstack((prv_labels_crop.ravel(),cur_labels_crop.ravel())).T ))
+            connections[z-1] = tmp[(tmp>0).all(axis=1),:]
+        prv_labels = cur_labels; nzlabels += cur_nlabels
+
+    G = nx.Graph(); G.add_edges_from(np.vstack(connections).astype(np.int64))
+    nlabels = 0; mapping = np.zeros((nzlabels+1,), dtype=np.int64)
+    for nodes in nx.connected_components(G):
+        nlabels += 1; mapping[np.array(tuple(nodes),dtype=np.int64)] = nlabels
+    return mapping[zlabels], nlabels
+
+def test_label_overlap():
+    # thresholded smooth random probabilities, with the mask at a lower threshold
+    rs = np.random.RandomState(0); size = np.array([40, 36, 12]); probs = nd.gaussian_filter(rs.rand(*size), 1.5)
+    probs = (probs - probs.min()) / (probs.max() - probs.min())
+    bwlabels = (probs > 0.6); mask = (probs > 0.45)
+
+    for connectivity in [1, 3]:
+        for cropborder in [[0,0,0], [3,2,0]]:
+            ws = dpWatershedTypes.__new__(dpWatershedTypes); ws.size = size; ws.connectivity = connectivity
+            ws.cropborder = np.array(cropborder); ws.docrop = (ws.cropborder > 0).any()
+            ws.bwconn2d = nd.generate_binary_structure(3, connectivity)[:,:,1]; ws.simpleLUT = None
+
+            # no warps, random warps and warps with ties for the nearest neighbor rounding
+            for warps in [None, [rs.randn(*size)*2, rs.randn(*size)*2],
+                    [np.round(rs.randn(*size)*2)/2, np.round(rs.randn(*size)*2)/2]]:
+                labels, nlabels = ws.label_overlap(bwlabels, mask, warps)
+                ref, ref_nlabels = label_overlap_slices(ws, bwlabels, mask, warps)
+                assert( nlabels == ref_nlabels and nlabels > 1 )
+                assert( ((labels > 0) == (ref > 0)).all() )
+                # same labels up to label permutation
+                pairs = np.unique(np.column_stack((labels.reshape(-1), ref.reshape(-1))), axis=0)
+                assert( pairs.shape[0] == nlabels+1 and np.unique(pairs[:,0]).size == nlabels+1 )
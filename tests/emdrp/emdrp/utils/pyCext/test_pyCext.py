@@ -0,0 +1,74 @@
+from emdrp.utils.pyCext.pyCext import *
+
+def test_label_overlap():
+    # compare with unique label pairs, with and without mask / background and in blocks / accumulated
+    rs = np.random.RandomState(0)
+    lblsA = rs.randint(50, size=(40, 30, 20)); lblsB = rs.randint(70, size=(40, 30, 20)).astype(np.uint32)
+    mask = (rs.rand(40, 30, 20) < 0.7)
+    for nonzero in [False, True]:
+        for msk in [None, mask]:
+            sel = np.ones(lblsA.shape, dtype=bool) if msk is None else msk.copy()
+            if nonzero: sel = np.logical_and(sel, np.logical_and(lblsA > 0, lblsB > 0))
+            upairs, ucounts = np.unique(np.stack((lblsA[sel], lblsB[sel]), axis=1), axis=0, return_counts=True)
+            for nblocks in [1, 3]:
+                pairs, counts = label_overlap(lblsA, lblsB, mask=msk, nonzero=nonzero, nblocks=nblocks)
+                assert( (pairs == upairs).all() and (counts == ucounts).all() )
+
+    table = label_overlap(lblsA[:20], lblsB[:20]); pairs, counts = label_overlap(lblsA[20:], lblsB[20:], table=table)
+    upairs, ucounts = np.unique(np.stack((lblsA.ravel(), lblsB.ravel()), axis=1), axis=0, return_counts=True)
+    assert( (pairs == upairs).all() and (counts == ucounts).all() )
+
+def watershed_volume():
+    # image increasing away from markers, so that basins are local (and blocks match the whole volume).
+    # markers are jittered on a grid so that they are not adjacent.
+    rs = np.random.RandomState(0); shape = (48, 40, 32)
+    markers = np.zeros(shape, dtype=np.uint32); pts = np.mgrid[0:48:8, 0:40:8, 0:32:8].reshape(3,-1)
+    pts = pts + rs.randint(6, size=pts.shape); markers[tuple(pts)] = np.arange(1, pts.shape[1]+1)
+    image = (nd.distance_transform_edt(markers == 0) + rs.rand(*shape)).astype(np.float32)
+    mask = (rs.rand(*shape) < 0.95); mask[markers > 0] = 1
+    return image, markers, mask
+
+def test_seeded_watershed():
+    from skimage.segmentation import watershed
+    image, markers, mask = watershed_volume()
+    for connectivity in [1, 3]:
+        bwconn = nd.generate_binary_structure(3, connectivity)
+        labels = watershed(image, markers, connectivity=bwconn, mask=mask)
+        assert( (seeded_watershed(image, markers, bwconn, mask=mask) == labels).all() )
+        for nblocks in [1, 3]:
+            assert( (seeded_watershed(image, markers, bwconn, mask=mask, nblocks=nblocks) == labels).all() )
+
+def test_seeded_watershed_no_adjacencies():
+    image, markers, mask = watershed_volume()
+    for connectivity in [1, 3]:
+        bwconn = nd.generate_binary_structure(3, connectivity)
+        labels = seeded_watershed(image, markers, bwconn, mask=mask)
+        for nblocks in [1, 3]:
+            flabels, uclabels = seeded_watershed(image, markers, bwconn, mask=mask, no_adjacencies=True,
+                nblocks=nblocks)
+            # full labels are not changed by the boundary, unconnected labels are a subset containing all markers
+            assert( (flabels == labels).all() )
+            assert( np.logical_or(uclabels == 0, uclabels == labels).all() )
+            assert( (uclabels[markers > 0] == markers[markers > 0]).all() )
+            # no two different labels are adjacent with connectivity of bwconn
+            pad = np.pad(uclabels, 1)
+            for x,y,z in np.transpose(np.nonzero(bwconn)) - 1:
+                nbr = pad[1+x:pad.shape[0]-1+x, 1+y:pad.shape[1]-1+y, 1+z:pad.shape[2]-1+z]
+                assert( not np.logical_and(np.logical_and(uclabels > 0, nbr > 0), uclabels != nbr).any() )
+
+def test_frag_with_borders_csr():
+    # random labels with background, the csr mode has the same edges and border voxels for each edge as list mode
+    rs = np.random.RandomState(0)
+    supervoxels = rs.randint(12, size=(20, 16, 12)).astype(np.uint32); supervoxels[rs.rand(20, 16, 12) < 0.2] = 0
+    for nbhd in [1, 2]:
+        for conn in [1, 3]:
+            edges, borders, steps, min_step, max_step = frag_with_borders(supervoxels, 11, nbhd=nbhd, conn=conn)
+            csr_edges, border_voxel_index, edge_offsets = frag_with_borders(supervoxels, 11, nbhd=nbhd, conn=conn,
+                steps=steps, min_step=min_step, max_step=max_step, csr=True)
+            edges = np.asarray(edges); assert( edges.shape[0] > 11 and edge_offsets.size == edges.shape[0]+1 )
+            assert( (np.unique(edges, axis=0) == np.unique(csr_edges, axis=0)).all() )
+            ref = {tuple(x):np.unique(y) for x,y in zip(edges, borders)}
+            for e in range(csr_edges.shape[0]):
+                voxels = border_voxel_index[edge_offsets[e]:edge_offsets[e+1]]
+                assert( voxels.size == np.unique(voxels).size )
+                assert( (np.sort(voxels) == ref[tuple(csr_edges[e])]).all() )
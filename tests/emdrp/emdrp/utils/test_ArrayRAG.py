@@ -0,0 +1,37 @@
+from emdrp.utils.ArrayRAG import *
+
+def test_imports():
+    pass
+
+def test_rag_contract():
+    rag = ArrayRAG(6, ['a', 'b'], edge_attrs=['x'])
+    assert( rag.add_edge(4, 2) == 0 )
+    assert( (rag.add_edges([[1, 2], [2, 4], [5, 6], [3, 4]]) == [1, 0, 3, 2]).all() )
+    assert( rag.has_edge(2, 4) and not rag.has_edge(1, 3) )
+    rag.features[:, 0] = np.arange(4); rag.has_features[:] = True; rag.edge_attrs['x'][0] = 'e24'
+    rag.sort()
+    assert( (rag.edges == [[1, 2], [2, 4], [3, 4], [5, 6]]).all() )
+    assert( (rag.features[:, 0] == [1, 0, 2, 3]).all() and rag.edge_attrs['x'] == {1: 'e24'} )
+    assert( set(rag.neighbors(4).tolist()) == {2, 3} )
+
+    ncomps, comps = rag.components(rag.edges[:, 0] == 1)
+    assert( ncomps == 5 and (comps == [0, 1, 1, 2, 3, 4, 5]).all() )
+    crag, inverse = rag.contract(comps, ncomps)
+    assert( (crag.edges == [[1, 3], [2, 3], [4, 5]]).all() and (inverse == [-1, 0, 1, 2]).all() )
+    assert( (crag.has_features == [False, True, True]).all() and (crag.features[1:, 0] == [2, 3]).all() )
+
+def test_rag_moments():
+    rag = ArrayRAG(4, node_moments=[('size', 'sum')], edge_moments=[('count', 'sum'), ('vmax', 'max')])
+    rag.add_edges([[1, 3], [2, 3], [3, 4]]); rag.sort()
+    rag.node_moments[1:, 0] = [1, 2, 3, 4]; rag.edge_moments[:, :] = [[5, 1], [6, 7], [8, 2]]
+    crag, inverse = rag.contract(np.array([0, 1, 1, 2, 3]), 3)
+    assert( (crag.edges == [[1, 2], [2, 3]]).all() and (crag.node_moments[1:, 0] == [3, 3, 4]).all() )
+    assert( (crag.edge_moments == [[11, 7], [8, 2]]).all() )
+
+def test_rag_threshold_components():
+    rs = np.random.RandomState(0); rag = ArrayRAG(200)
+    rag.add_edges(rs.randint(1, 201, size=(400, 2))); rag.sort()
+    weights = rs.rand(rag.number_of_edges()); thresholds = [0.9, 0.7, 0.5, 0.2]
+    for thr,(ncomps, comps) in zip(thresholds, rag.threshold_components(weights, thresholds)):
+        rncomps, rcomps = rag.components(weights > thr)
+        assert( ncomps == rncomps and (comps == rcomps).all() )
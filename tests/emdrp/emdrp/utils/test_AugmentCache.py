@@ -0,0 +1,38 @@
+from emdrp.utils.AugmentCache import *
+import numpy as np
+import pytest
+
+def test_key(tmp_path):
+    # key does not depend on argument order, any changed argument gives a new key
+    key = AugmentCache.key(dataset='data', size=[8,8,8], filter='kuwahara')
+    assert( key == AugmentCache.key(filter='kuwahara', size=[8,8,8], dataset='data') )
+    assert( key[0] != AugmentCache.key(dataset='data', size=[8,8,4], filter='kuwahara')[0] )
+    assert( 'filter=kuwahara' in key[1] )
+
+    # file key changes with the file contents
+    fn = tmp_path / 'raw.h5'; fn.write_bytes(b'raw'); fkey = AugmentCache.file_key(str(fn))
+    fn.write_bytes(b'raw data'); assert( fkey != AugmentCache.file_key(str(fn)) )
+
+def test_get_put(tmp_path):
+    cache = AugmentCache(str(tmp_path / 'cache')); rs = np.random.RandomState(0)
+    data = rs.rand(8, 8, 4).astype(np.float32); key = AugmentCache.key(filter='kuwahara')
+    assert( cache.get(key) is None )
+    cache.put(key, data); assert( (cache.get(key) == data).all() )
+    assert( cache.get(AugmentCache.key(filter='gaussian')) is None )
+
+    # temporary file is removed if writing fails
+    with pytest.raises(Exception):
+        cache.put(AugmentCache.key(filter='gaussian'), np.array([object()]))
+    assert( os.listdir(cache.cachedir) == [key[0] + AugmentCache.EXT] )
+
+def test_evict(tmp_path):
+    cache = AugmentCache(str(tmp_path / 'cache')); rs = np.random.RandomState(0)
+    keys = [AugmentCache.key(index=i) for i in range(3)]
+    for i in range(3):
+        cache.put(keys[i], rs.rand(32, 32, 32)); os.utime(cache._get_fn(keys[i]), (i, i))
+    sizes = [os.path.getsize(cache._get_fn(x)) for x in keys]
+
+    # getting an entry makes it the most recently used, least recently used entries are removed first
+    assert( cache.get(keys[0]) is not None )
+    cache.max_bytes = sizes[0] + sizes[2]; cache.evict()
+    assert( [cache.get(x) is not None for x in keys] == [True, False, True] )
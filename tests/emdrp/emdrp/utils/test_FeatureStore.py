@@ -0,0 +1,21 @@
+from collections import OrderedDict
+from emdrp.utils.FeatureStore import *
+
+def test_round_trip(tmp_path):
+    rs = np.random.RandomState(0); fn = str(tmp_path / 'features.h5')
+    assert( FeatureStore.isFeatureStore(fn) and not FeatureStore.isFeatureStore('features.dill') )
+    names = OrderedDict([('size_small', 0), ('mean_ICS', 1), ('overlap', 2)])
+    cubes = [{'feature_names':names, 'target_names':{'no_merge':0, 'yes_merge':1}, 'DESCR':'test',
+        'data':rs.rand(n, 3), 'target':rs.randint(0, 2, n)} for n in [10, 7, 0]]
+    store = FeatureStore(fn)
+    for i in [2, 0, 1]:
+        edges = rs.randint(1, 20, (cubes[i]['data'].shape[0], 2))
+        store.write('chunk%d' % i, cubes[i], edges, {'index':i, 'nnodes':20}); cubes[i]['edges'] = edges
+
+    assert( [x for x,y in store.cubes()] == ['chunk0', 'chunk1', 'chunk2'] )
+    for i in range(3):
+        data = store.read('chunk%d' % i)
+        assert( data['feature_names'] == names and data['target_names'] == cubes[i]['target_names'] )
+        assert( data['attrs']['nnodes'] == 20 )
+        for k in FeatureStore.DATASETS: assert( (data[k] == cubes[i][k]).all() )
+    assert( isinstance(store.read('chunk0')['data'], np.memmap) )
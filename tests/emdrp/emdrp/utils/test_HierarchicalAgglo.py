@@ -0,0 +1,37 @@
+from emdrp.utils.ArrayRAG import ArrayRAG
+from emdrp.utils.HierarchicalAgglo import *
+
+def random_rag(nnodes, nedges, seed):
+    rs = np.random.RandomState(seed)
+    rag = ArrayRAG(nnodes, node_moments=[('size', 'sum')], edge_moments=[('count', 'sum'), ('sum', 'sum'),
+        ('w', 'max')])
+    edges = rs.randint(1, nnodes+1, size=(nedges, 2)); rag.add_edges(edges[edges[:, 0] != edges[:, 1], :]); rag.sort()
+    rag.node_moments[1:, 0] = rs.randint(1, 100, size=nnodes)
+    rag.edge_moments[:, 0] = rs.randint(1, 20, size=rag.number_of_edges())
+    rag.edge_moments[:, 1] = rag.edge_moments[:, 0]*rs.rand(rag.number_of_edges())
+    rag.edge_moments[:, 2] = rs.rand(rag.number_of_edges())
+    return rag
+
+def test_single_linkage():
+    # max reduction of edge weights is single linkage, same as threshold cuts on the edge weights
+    rag = random_rag(100, 200, 0); thresholds = [0.9, 0.7, 0.5, 0.2]
+    hagglo = HierarchicalAgglo(rag, lambda edges, moments, node_moments: moments[:, 2]); hagglo.agglomerate()
+    for thr,(ncomps, comps) in zip(thresholds, rag.threshold_components(rag.edge_moments[:, 2], thresholds)):
+        hncomps, hcomps = hagglo.components(thr)
+        assert( ncomps == hncomps and (comps == hcomps).all() )
+
+def test_mean_boundary():
+    # compare with greedy agglomeration that contracts the rag and rescores all edges for every merge
+    score = lambda edges, moments, node_moments: moments[:, 1]/moments[:, 0]/np.sqrt(node_moments[edges, 0].min(1))
+    rag = random_rag(40, 80, 1); thr = 0.02
+    hagglo = HierarchicalAgglo(rag, score); hagglo.agglomerate()
+
+    crag = rag; labels = np.arange(rag.number_of_nodes()+1)
+    while crag.number_of_edges() > 0:
+        scores = score(crag.edges, crag.edge_moments, crag.node_moments); e = np.argmax(scores)
+        if scores[e] < thr: break
+        i, j = crag.edges[e, :]; mapping = np.arange(crag.number_of_nodes()+1); mapping[j] = i
+        mapping[j+1:] -= 1; crag, inverse = crag.contract(mapping, crag.number_of_nodes()-1); labels = mapping[labels]
+
+    ncomps, comps = hagglo.components(thr)
+    assert( ncomps == crag.number_of_nodes() and (np.unique(np.stack((labels, comps)), axis=1).shape[1] == ncomps+1) )
@@ -23,6 +23,24 @@ def test_calc_supervoxel_eftpl(tmp_path):
 
     return
 
+def test_calc_supervoxel_eftpl_table(tmp_path):
+    # agglomeration table (labels delta without residual voxels) gives the same result as the agglomerated labels
+    rs = np.random.RandomState(0); base = rs.randint(1, 20, size=(10, 10, 10)).astype(np.uint32)
+    lut = np.zeros((20,), dtype=np.uint32); lut[1:] = rs.randint(1, 4, size=19)
+    with h5py.File(tmp_path / 'test.h5', 'w') as h5file:
+        h5file.create_dataset('with_background/supervoxels/labels', data=base)
+        h5file.create_dataset('with_background/full/labels', data=lut[base])
+        grp = h5file.create_group('with_background/table/labels_delta')
+        grp.create_dataset('lut', data=lut); grp.create_dataset('inds', data=np.zeros((0,), dtype=np.uint32))
+        grp.create_dataset('vals', data=np.zeros((0,), dtype=np.uint32))
+        grp.attrs['base'] = [b'with_background', b'supervoxels']
+
+    with open(tmp_path / "test.nml", "wb") as f:
+        wknml.write_nml(f, util_get_nml())
+
+    eftpl, params = calc_supervoxel_eftpl(tmp_path / 'test.nml', tmp_path / 'test.h5', dset_vals=['full', 'table'])
+    assert np.allclose(eftpl[0], eftpl[1], equal_nan=True)
+
 def test_calc_efpl_outside_roi():
     import wknml
     nml = wknml.NML(
@@ -1,4 +1,52 @@
 from emdrp.utils.typesh5 import *
 
 def test_imports():
-    pass
\ No newline at end of file
+    pass
+
+def test_labels_delta(tmp_path):
+    # fine labels and coarse labels that merge fine labels plus a few voxels that are not nested
+    fine = np.random.randint(20, size=(16, 16, 8)).astype(emLabels.LBLS_DTYPE)
+    coarse = (fine // 4).astype(emLabels.LBLS_DTYPE); coarse[0, 0, :] = 7
+
+    lut, inds, vals = emLabels.delta_encode(fine, coarse)
+    assert( (emLabels.delta_decode(fine, lut, inds, vals) == coarse).all() )
+    assert( inds.size <= 8 )
+
+    outfile = str(tmp_path / 'test.h5'); chunk = [0, 0, 0]; offset = [0, 0, 0]; size = list(fine.shape)
+    emLabels.writeLabels(outfile=outfile, chunk=chunk, offset=offset, size=size, datasize=size, chunksize=size,
+        data=fine, subgroups=['with_background', 'fine'])
+    emLabels.writeLabelsDelta(outfile=outfile, chunk=chunk, offset=offset, size=size, lut=lut, inds=inds, vals=vals,
+        base=['with_background', 'fine'], attrs={'threshold': 0.5}, subgroups=['with_background', 'coarse'])
+
+    loadh5 = emLabels.readLabels(srcfile=outfile, chunk=chunk, offset=offset, size=size,
+        subgroups=['with_background', 'coarse'])
+    assert( (loadh5.data_cube == coarse).all() )
+    assert( loadh5.data_attrs['threshold'] == 0.5 )
+
+def test_labels_mapping(tmp_path):
+    labels = np.random.randint(20, size=(16, 16, 8)).astype(emLabels.LBLS_DTYPE)
+    mapping = (np.arange(20) // 4).astype(emLabels.LBLS_DTYPE)
+
+    outfile = str(tmp_path / 'test.h5'); chunk = [0, 0, 0]; offset = [0, 0, 0]; size = list(labels.shape)
+    emLabels.writeLabels(outfile=outfile, chunk=chunk, offset=offset, size=size, datasize=size, chunksize=size,
+        data=labels, attrs={'types_nlabels': [19]})
+    emLabels.writeLabelsMapping(outfile=outfile, mapping=mapping, attrs={'types_nlabels': [4]})
+
+    loadh5 = emLabels.readLabels(srcfile=outfile, chunk=chunk, offset=offset, size=size)
+    assert( (loadh5.data_cube == mapping[labels]).all() and loadh5.data_attrs['types_nlabels'][0] == 4 )
+    loadh5 = emLabels.readLabels(srcfile=outfile, chunk=chunk, offset=offset, size=size, mapping=False)
+    assert( (loadh5.data_cube == labels).all() and loadh5.data_attrs['types_nlabels'][0] == 4 )
+    assert( loadh5.data_attrs['mapping_nlabels'][0] == 19 )
+
+    # only part of the mapping is needed for a cube, labels outside the mapping are not mapped
+    loadh5 = emLabels.readLabels(srcfile=outfile, chunk=chunk, offset=offset, size=[8, 8, 4])
+    assert( (loadh5.data_cube == mapping[labels[:8,:8,:4]]).all() )
+    labels[labels == 7] = emLabels.EMPTY_LABEL
+    emLabels.writeLabels(outfile=outfile, chunk=chunk, offset=offset, size=size, datasize=size, chunksize=size,
+        data=labels)
+    loadh5 = emLabels.readLabels(srcfile=outfile, chunk=chunk, offset=offset, size=size)
+    sel = (labels == emLabels.EMPTY_LABEL); assert( sel.any() and (loadh5.data_cube[sel] == labels[sel]).all() )
+    assert( (loadh5.data_cube[~sel] == mapping[labels[~sel]]).all() )
+
+    emLabels.writeLabelsMapping(outfile=outfile, mapping=None)
+    assert( emLabels.readLabelsMapping(outfile) is None )